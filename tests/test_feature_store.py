@@ -0,0 +1,128 @@
+import os
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+try:
+    from valis import feature_detectors, feature_store, registration
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+N_KP = 20
+
+
+def _make_img():
+    return np.random.default_rng(0).integers(0, 255, (60, 80), dtype=np.uint8)
+
+
+def _save_features(store, feature_id, seed=0):
+    rng = np.random.default_rng(seed)
+    kp_xy = rng.uniform(0, 80, (N_KP, 2))
+    desc = rng.integers(0, 255, (N_KP, 64), dtype=np.uint8)
+    store.save_features(feature_id, kp_xy, desc, response=rng.uniform(size=N_KP))
+
+    return kp_xy, desc
+
+
+def _set_mtime(store, feature_id, mtime):
+    for f in os.listdir(store.store_dir):
+        if f.startswith(f"{feature_id}_"):
+            os.utime(os.path.join(store.store_dir, f), (mtime, mtime))
+
+
+def test_feature_id_changes_with_settings(monkeypatch):
+    img = _make_img()
+    feature_id = feature_store.get_feature_id("img", img, feature_detectors.BriskFD(cv2.BRISK_create(thresh=10)))
+
+    assert feature_id == feature_store.get_feature_id("img", img, feature_detectors.BriskFD(cv2.BRISK_create(thresh=10)))
+    assert feature_id != feature_store.get_feature_id("img", img, feature_detectors.BriskFD(cv2.BRISK_create(thresh=80)))
+    assert feature_id != feature_store.get_feature_id("img", img[::-1], feature_detectors.BriskFD(cv2.BRISK_create(thresh=10)))
+
+    monkeypatch.setattr(feature_detectors, "MAX_FEATURES", feature_detectors.MAX_FEATURES + 1)
+    assert feature_id != feature_store.get_feature_id("img", img, feature_detectors.BriskFD(cv2.BRISK_create(thresh=10)))
+
+
+def test_setting_str():
+    assert feature_store.get_setting_str({"b": 1, "a": [2.0, None]}) == feature_store.get_setting_str({"a": [2.0, None], "b": 1})
+    assert feature_store.get_setting_str(np.arange(3)) != feature_store.get_setting_str(np.arange(1, 4))
+    assert feature_store.get_setting_str(cv2.BRISK_create(thresh=10)) != feature_store.get_setting_str(cv2.BRISK_create(thresh=80))
+
+    # Objects are represented by their attributes, not their id
+    assert feature_store.get_setting_str(SimpleNamespace(a=1)) == feature_store.get_setting_str(SimpleNamespace(a=1))
+    assert feature_store.get_setting_str(SimpleNamespace(a=1)) != feature_store.get_setting_str(SimpleNamespace(a=2))
+
+
+def test_features_round_trip(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path))
+    assert store.load_features("a") == (None, None)
+
+    kp_xy, desc = _save_features(store, "a")
+    assert store.has_features("a")
+    loaded_xy, loaded_desc = store.load_features("a")
+    assert np.array_equal(loaded_xy, kp_xy)
+    assert np.array_equal(loaded_desc, desc)
+
+
+def test_load_matches_reversed(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path))
+    xy_a, desc_a = _save_features(store, "a", 0)
+    xy_b, desc_b = _save_features(store, "b", 1)
+    match_idx = np.array([[0, 3], [5, 1], [7, 7]])
+    store.save_matches("a", "b", match_idx)
+
+    assert np.array_equal(store.load_matches("a", "b"), match_idx)
+    assert np.array_equal(store.load_matches("b", "a"), match_idx[:, ::-1])
+    assert store.load_matches("a", "c") is None
+
+    matched_b, matched_a = store.get_matched_xy("b", "a")
+    assert np.array_equal(matched_a, xy_a[match_idx[:, 0]])
+    assert np.array_equal(matched_b, xy_b[match_idx[:, 1]])
+
+    matched_desc_b, matched_desc_a = store.get_matched_desc("b", "a")
+    assert np.array_equal(matched_desc_a, desc_a[match_idx[:, 0]])
+    assert np.array_equal(matched_desc_b, desc_b[match_idx[:, 1]])
+
+
+def test_least_recently_used_removed(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path))
+    for i, feature_id in enumerate(["a", "b"]):
+        _save_features(store, feature_id, i)
+        _set_mtime(store, feature_id, 1000 + i)
+
+    # Loading marks "a" as recently used, so "b" is removed first
+    store.load_features("a")
+    store.max_gb = 2.5*store.get_size_gb()/2
+    _save_features(store, "c", 2)
+
+    assert store.has_features("a")
+    assert not store.has_features("b")
+    assert store.has_features("c")
+    # All of the removed features' columns are removed
+    assert not any(f.startswith("b_") for f in os.listdir(tmp_path))
+    assert store.get_size_gb() <= store.max_gb
+
+
+def test_clear(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path))
+    _save_features(store, "a")
+    store.save_matches("a", "a", np.zeros((2, 2)))
+    store.clear()
+
+    assert len(os.listdir(tmp_path)) == 0
+    assert store.get_size_gb() == 0
+
+
+def test_feature_store_disabled(tmp_path):
+    registrar = registration.Valis.__new__(registration.Valis)
+    registrar.dst_dir = str(tmp_path)
+    registrar.feature_store_dir = str(tmp_path / "features")
+
+    registrar.feature_store_max_gb = 1
+    store = registrar.get_feature_store()
+    assert store.store_dir == registrar.feature_store_dir and store.max_gb == 1
+
+    registrar.feature_store_max_gb = 0
+    assert registrar.get_feature_store() is None
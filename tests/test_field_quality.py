@@ -0,0 +1,87 @@
+import warnings
+
+import numpy as np
+import pytest
+
+try:
+    from valis import field_quality
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+SHAPE_RC = (120, 150)
+METHODS = [field_quality.INPAINT_METHOD, field_quality.REGULARIZE_METHOD]
+
+
+def _make_folded_field(shape_rc=SHAPE_RC, center_xy=(60, 50), sigma=6, strength=12) -> np.ndarray:
+    """Field that squeezes a small region so hard that it folds, and is smooth elsewhere
+    """
+    yy, xx = np.mgrid[0:shape_rc[0], 0:shape_rc[1]].astype(np.float32)
+    bump = np.exp(-((xx - center_xy[0])**2 + (yy - center_xy[1])**2)/(2*sigma**2))
+    dx = -strength*bump*(xx - center_xy[0])/sigma
+    dy = 2*np.sin(xx/25)
+
+    return np.array([dx, dy], dtype=np.float32)
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_remove_folds(method):
+    dxdy = _make_folded_field()
+    folded_frac, min_det = field_quality.measure_folds(dxdy)
+    assert folded_frac > 0 and min_det < 0
+
+    no_folds_dxdy = field_quality.remove_folds(dxdy, method=method)
+    folded_frac, min_det = field_quality.measure_folds(no_folds_dxdy)
+    assert folded_frac == 0 and min_det > 0
+
+    # Only the region around the fold changes
+    changed = np.any(np.abs(no_folds_dxdy - dxdy) > 1e-4, axis=0)
+    assert changed.any()
+    assert not changed[:, 0:20].any() and not changed[:, 100:].any()
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_remove_folds_everywhere(method):
+    # Every pixel is folded, so the repaired region covers the whole field
+    yy, xx = np.mgrid[0:20, 0:24].astype(np.float32)
+    dxdy = np.array([3 - 2*xx, np.full_like(yy, 5)])
+    assert field_quality.measure_folds(dxdy)[0] == 1
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        no_folds_dxdy = field_quality.remove_folds(dxdy, method=method)
+
+    assert np.all(np.isfinite(no_folds_dxdy))
+    assert field_quality.measure_folds(no_folds_dxdy)[0] == 0
+
+
+def test_solve_region_without_boundary():
+    rng = np.random.default_rng(0)
+    dxdy = rng.normal(1.5, 1, (2, 15, 18)).astype(np.float32)
+    region_mask = np.ones(dxdy.shape[1:], dtype=bool)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        repaired = field_quality._solve_region(dxdy, region_mask)
+
+    # Smoothest field is constant, and keeps the mean displacement
+    assert np.allclose(repaired, dxdy.mean(axis=(1, 2))[:, None, None], atol=1e-5)
+
+    # Regularized system has a unique solution that stays close to the original field
+    regularized = field_quality._solve_region(dxdy, region_mask, smoothness_weight=1.0)
+    assert np.all(np.isfinite(regularized))
+    assert regularized.std(axis=(1, 2)).max() < dxdy.std(axis=(1, 2)).min()
+    assert np.allclose(regularized.mean(axis=(1, 2)), dxdy.mean(axis=(1, 2)), atol=1e-4)
+
+
+def test_solve_region_matches_boundary():
+    dxdy = _make_folded_field()
+    region_mask = np.zeros(SHAPE_RC, dtype=bool)
+    region_mask[30:70, 40:80] = True
+    repaired = field_quality._solve_region(dxdy, region_mask)
+
+    assert np.array_equal(repaired[:, ~region_mask], dxdy[:, ~region_mask])
+    # Harmonic, so each repaired pixel is the average of its neighbors
+    inner = repaired[:, 31:69, 41:79]
+    nbr_mean = (repaired[:, 30:68, 41:79] + repaired[:, 32:70, 41:79] + repaired[:, 31:69, 40:78] + repaired[:, 31:69, 42:80])/4
+    assert np.abs(inner - nbr_mean).max() < 1e-3
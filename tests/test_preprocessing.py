@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+try:
+    from valis import preprocessing, warp_tools
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+def _make_rgb(seed):
+    return np.random.default_rng(seed).integers(0, 255, (64, 64, 3), dtype=np.uint8)
+
+
+def _make_stained_img(shape_rc=(200, 240)):
+    """Image with pink and purple tissue on a white background
+    """
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:shape_rc[0], 0:shape_rc[1]]
+    img = np.full((*shape_rc, 3), 240, dtype=float)
+    tissue = (yy - shape_rc[0]/2)**2/(0.35*shape_rc[0])**2 + (xx - shape_rc[1]/2)**2/(0.35*shape_rc[1])**2 < 1
+    nuclei = tissue & (np.sin(xx/4)*np.sin(yy/4) > 0.5)
+    img[tissue] = [230, 150, 190]
+    img[nuclei] = [120, 70, 160]
+    img += rng.normal(0, 4, img.shape)
+
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def _count_fits(monkeypatch):
+    n_fits = [0]
+    cluster_colors = preprocessing.StainFlattener.cluster_colors
+
+    def counting_cluster_colors(self, *args, **kwargs):
+        n_fits[0] += 1
+        return cluster_colors(self, *args, **kwargs)
+
+    monkeypatch.setattr(preprocessing.StainFlattener, "cluster_colors", counting_cluster_colors)
+
+    return n_fits
+
+
+def _convert(rgb):
+    jab = preprocessing.rgb2jab(rgb)
+    return jab, preprocessing.jab2jch(jab), preprocessing.jab2rgb(jab)
+
+
+def test_color_conversion_in_threads():
+    rgb_list = [_make_rgb(i) for i in range(8)]
+    expected = [_convert(rgb) for rgb in rgb_list]
+
+    with ThreadPoolExecutor(4) as executor:
+        for _ in range(5):
+            results = list(executor.map(_convert, rgb_list))
+            for result, expected_result in zip(results, expected):
+                for converted, expected_converted in zip(result, expected_result):
+                    assert np.allclose(converted, expected_converted, equal_nan=True)
+
+
+def test_stain_model_reused_for_tiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocessing, "STAIN_MODEL_CACHE", preprocessing.StainModelCache())
+    n_fits = _count_fits(monkeypatch)
+    img = _make_stained_img()
+    src_f = tmp_path / "slide.tiff"
+    warp_tools.numpy2vips(img).tiffsave(str(src_f))
+
+    thumbnail_processor = preprocessing.StainFlattener(img[::2, ::2], str(src_f), level=1, series=0)
+    thumbnail_processor.process_image(n_colors=3, adaptive_eq=False)
+    tile_processor = preprocessing.StainFlattener(img[40:140, 60:200], str(src_f), level=0, series=0)
+    tile_processor.process_image(n_colors=3, adaptive_eq=False)
+
+    assert n_fits[0] == 1
+    assert tile_processor.stain_model is thumbnail_processor.stain_model
+
+    # Different settings, or not reusing the model, fit a new one
+    tile_processor.process_image(n_colors=4, adaptive_eq=False)
+    tile_processor.process_image(n_colors=3, adaptive_eq=False, reuse_model=False)
+    assert n_fits[0] == 3
+    assert len(preprocessing.STAIN_MODEL_CACHE) == 2
+
+
+def test_stain_model_cache_least_recently_used_removed():
+    cache = preprocessing.StainModelCache(max_size=2)
+    cache.get("a", lambda: "model_a")
+    cache.get("b", lambda: "model_b")
+    # Using "a" makes "b" the least recently used model
+    assert cache.get("a", lambda: "new_model_a") == "model_a"
+    cache.get("c", lambda: "model_c")
+
+    assert len(cache) == 2
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
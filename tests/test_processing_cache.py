@@ -0,0 +1,126 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+try:
+    from valis import processing_cache
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+PROCESSOR_SRC = '''
+class Processor(object):
+    def process_image(self, *args, **kwargs):
+        return {result}
+'''
+
+
+def _make_img():
+    return np.random.default_rng(0).integers(0, 255, (60, 80), dtype=np.uint8)
+
+
+def _import_processor(tmp_path, monkeypatch, result):
+    """Write and import a processing class, so that its source can be edited
+    """
+
+    src_f = tmp_path / "processor.py"
+    src_f.write_text(PROCESSOR_SRC.format(result=result))
+    spec = importlib.util.spec_from_file_location("processor", src_f)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, "processor", module)
+    spec.loader.exec_module(module)
+
+    return module.Processor
+
+
+def _get_key(processing_cls, processing_kwargs=None, img=None):
+    if img is None:
+        img = _make_img()
+
+    if processing_kwargs is None:
+        processing_kwargs = {}
+
+    return processing_cache.get_processing_key(None, img, processing_cls, processing_kwargs, settings={"level": 0})
+
+
+def _set_mtime(cache, key, mtime):
+    os.utime(cache._get_f(key), (mtime, mtime))
+
+
+def test_key_changes_with_inputs(tmp_path, monkeypatch):
+    processor_cls = _import_processor(tmp_path, monkeypatch, 1)
+    key = _get_key(processor_cls)
+
+    assert key == _get_key(processor_cls)
+    assert key != _get_key(processor_cls, {"c": 2})
+    assert key != _get_key(processor_cls, img=_make_img()[::-1])
+
+    # Same name, but the class was edited
+    edited_cls = _import_processor(tmp_path, monkeypatch, "img[::-1]")
+    assert edited_cls.__qualname__ == processor_cls.__qualname__
+    assert key != _get_key(edited_cls)
+
+
+def test_no_key_for_object_kwargs(tmp_path, monkeypatch):
+    processor_cls = _import_processor(tmp_path, monkeypatch, 1)
+
+    assert _get_key(processor_cls, {"c": 2, "p": [1, 2.0], "arr": np.arange(3)}) is not None
+    assert _get_key(processor_cls, {"model": object()}) is None
+
+
+def test_metadata_round_trip(tmp_path):
+    cache = processing_cache.ProcessingCache(str(tmp_path))
+    img = _make_img()
+    bbox = np.array([1.5, 2, 30, 40])
+    cache.save("a", img, img > 100, shape_rc=(60, 80), bbox=bbox)
+
+    results = cache.load("a")
+    assert np.array_equal(results[processing_cache.PROCESSED_IMG_KEY], img)
+    assert np.array_equal(results[processing_cache.MASK_KEY], img > 100)
+    assert results["shape_rc"] == (60, 80) and isinstance(results["shape_rc"], tuple)
+    assert isinstance(results["bbox"], np.ndarray) and np.array_equal(results["bbox"], bbox)
+    assert processing_cache.TUPLE_KEYS_KEY not in results
+
+
+def test_least_recently_used_removed(tmp_path):
+    cache = processing_cache.ProcessingCache(str(tmp_path))
+    img = _make_img()
+    for i, key in enumerate(["a", "b"]):
+        cache.save(key, img, img)
+        _set_mtime(cache, key, 1000 + i)
+
+    # Loading marks "a" as recently used, so "b" is removed first
+    cache.load("a")
+    entry_gb = os.path.getsize(cache._get_f("a"))/(1024**3)
+    cache.max_gb = 2.5*entry_gb
+    cache.save("c", img, img)
+
+    assert cache.has_results("a")
+    assert not cache.has_results("b")
+    assert cache.has_results("c")
+
+
+def test_large_results_not_saved(tmp_path):
+    cache = processing_cache.ProcessingCache(str(tmp_path))
+    img = _make_img()
+    cache.save("a", img, img)
+
+    cache.max_gb = 1e-9
+    cache.save("b", img, img)
+
+    assert not cache.has_results("b")
+    # Saving results that don't fit doesn't remove the others
+    assert cache.has_results("a")
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_corrupt_file_removed(tmp_path):
+    cache = processing_cache.ProcessingCache(str(tmp_path))
+    with open(cache._get_f("a"), "wb") as f:
+        f.write(b"not a zip file")
+
+    assert cache.load("a") is None
+    assert not cache.has_results("a")
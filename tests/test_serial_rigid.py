@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+try:
+    from valis import feature_matcher, serial_rigid, warp_tools
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+SHAPE_RC = (80, 100)
+N_IMGS = 4
+REF_IDX = 1
+N_KP = 50
+
+
+class KeypointOptimizer(object):
+    """Finds the affine transformation that best aligns the keypoints
+
+    Deterministic stand-in for an AffineOptimizer, so that sequential
+    and concurrent optimization should give the same result.
+    """
+
+    accepts_xy = True
+    accepts_pyramids = False
+
+    def align(self, moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None):
+        # warp_xy(moving_xy, M) should be close to fixed_xy, so M maps fixed_xy to moving_xy
+        fixed_xy_h = np.hstack([fixed_xy, np.ones((fixed_xy.shape[0], 1))])
+        coef = np.linalg.lstsq(fixed_xy_h, moving_xy, rcond=None)[0]
+        M = np.eye(3)
+        M[0:2] = coef.T
+
+        return None, M, None
+
+    def cost_fxn(self, fixed_image, transformed, mask):
+        return None
+
+
+def _random_affine(rng, scale=0.05, shift=3):
+    M = np.eye(3)
+    M[0:2, 0:2] += rng.uniform(-scale, scale, (2, 2))
+    M[0:2, 2] = rng.uniform(-shift, shift, 2)
+
+    return M
+
+
+def _make_registrar():
+    rng = np.random.default_rng(0)
+    registrar = serial_rigid.SerialRigidRegistrar.__new__(serial_rigid.SerialRigidRegistrar)
+    registrar.size = N_IMGS
+    registrar.reference_img_idx = REF_IDX
+    registrar.iter_order = [(0, 1), (2, 1), (3, 2)]
+    registrar.img_obj_list = []
+    for i in range(N_IMGS):
+        img = rng.integers(0, 255, SHAPE_RC, dtype=np.uint8)
+        img_obj = serial_rigid.ZImage(img, f"img_{i}.png", i, f"img_{i}")
+        img_obj.padded_shape_rc = SHAPE_RC
+        if i != REF_IDX:
+            img_obj.to_prev_A = _random_affine(rng)
+        registrar.img_obj_list.append(img_obj)
+
+    for moving_idx, fixed_idx in registrar.iter_order:
+        moving_kp_xy = rng.uniform(0, SHAPE_RC[1], (N_KP, 2))
+        fixed_kp_xy = warp_tools.warp_xy(moving_kp_xy, _random_affine(rng)) + rng.normal(0, 0.5, (N_KP, 2))
+        match_info = feature_matcher.MatchInfo(matched_kp1_xy=moving_kp_xy, matched_desc1=None,
+                                               matches12=None, matched_kp2_xy=fixed_kp_xy,
+                                               matched_desc2=None, matches21=None,
+                                               match_distances=np.zeros(N_KP), distance=None,
+                                               similarity=None, metric_name=None,
+                                               metric_type=None)
+
+        moving_obj = registrar.img_obj_list[moving_idx]
+        fixed_obj = registrar.img_obj_list[fixed_idx]
+        moving_obj.match_dict[fixed_obj] = match_info
+
+    return registrar
+
+
+@pytest.mark.parametrize("min_pairs_for_processes", [serial_rigid.MIN_PAIRS_FOR_PROCESSES, 1])
+def test_optimize_concurrently_matches_sequential(monkeypatch, min_pairs_for_processes):
+    monkeypatch.setattr(serial_rigid, "MIN_PAIRS_FOR_PROCESSES", min_pairs_for_processes)
+    sequential = _make_registrar()
+    sequential.optimize(KeypointOptimizer(), concurrent=False)
+
+    concurrent = _make_registrar()
+    concurrent.optimize(KeypointOptimizer(), concurrent=True)
+
+    for seq_obj, con_obj in zip(sequential.img_obj_list, concurrent.img_obj_list):
+        if seq_obj.id != REF_IDX:
+            assert not np.allclose(seq_obj.optimal_M, np.eye(3))
+        assert np.allclose(seq_obj.optimal_M, con_obj.optimal_M, atol=1e-8)
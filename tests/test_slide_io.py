@@ -0,0 +1,180 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+try:
+    import ome_types
+    import pyvips
+    from valis import slide_io, slide_tools, warp_tools
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+def _make_slide(shape_rc=(700, 1000)) -> np.ndarray:
+    yy, xx = np.mgrid[0:shape_rc[0], 0:shape_rc[1]]
+    img = np.dstack([60 + 150*(xx/shape_rc[1]), 60 + 150*(yy/shape_rc[0]), np.full(shape_rc, 200.0)])
+
+    return img.astype(np.uint8)
+
+
+class _FakeBfReader(object):
+    def getPixelType(self):
+        return 1
+
+    def isLittleEndian(self):
+        return True
+
+    def getOptimalTileWidth(self):
+        return 256
+
+    def close(self):
+        pass
+
+
+class InMemoryBioFormatsSlideReader(slide_io.BioFormatsSlideReader):
+    """BioFormatsSlideReader that reads from an array, so that the JVM isn't needed
+    """
+
+    def __init__(self, img):
+        self.img = img
+        self.meta_list = [SimpleNamespace(slide_dimensions=np.array([img.shape[1::-1]]),
+                                          pyvips_interpretation="srgb")]
+        self.series = 0
+
+    def _get_bf_objects(self):
+        return _FakeBfReader(), None
+
+    def slide2image(self, level, series=None, xywh=None, *args, **kwargs):
+        if xywh is None:
+            return self.img
+
+        x, y, w, h = xywh
+        return self.img[y:y+h, x:x+w]
+
+    def slide2vips(self, level, series=None, xywh=None, *args, **kwargs):
+        return slide_tools.numpy2vips(self.slide2image(level, series, xywh))
+
+    def get_tiles_parallel(self, level, tile_bbox_list, pixel_type, series=0, z=0, t=0, shrink=1):
+        tiles = [self.slide2image(level, series, xywh=tuple(xywh)) for xywh in tile_bbox_list]
+        if shrink > 1:
+            tiles = [slide_io._shrink_tile(tile, shrink) for tile in tiles]
+
+        return [slide_tools.numpy2vips(tile) for tile in tiles]
+
+
+def test_bioformats_thumbnail_matches_slide_reader(monkeypatch):
+    monkeypatch.setattr(slide_io, "bf_to_numpy_dtype", lambda *args: (np.uint8, 255))
+    img = _make_slide()
+    reader = InMemoryBioFormatsSlideReader(img)
+
+    max_dim = 240
+    thumbnail = warp_tools.vips2numpy(reader.read_thumbnail(max_dim))
+    expected = warp_tools.vips2numpy(slide_io.SlideReader.read_thumbnail(reader, max_dim))
+
+    assert thumbnail.shape == expected.shape == (168, 240, 3)
+    # No black padding from partial edge tiles
+    assert thumbnail.min() >= 50
+    assert np.abs(thumbnail.astype(float) - expected).max() <= 3
+
+
+def _make_multichannel_img(shape_rc=(300, 420), n_channels=3, dtype=np.uint16) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, np.iinfo(dtype).max, (*shape_rc, n_channels), dtype=dtype)
+
+    return img
+
+
+def _read_level(dst_f, level=0, page=0) -> np.ndarray:
+    """Read a page of the ome.tiff, with pyramid levels in SubIFDs
+    """
+    if level == 0:
+        vips_img = pyvips.Image.new_from_file(dst_f, page=page)
+    else:
+        vips_img = pyvips.Image.new_from_file(dst_f, page=page, subifd=level - 1)
+
+    return warp_tools.vips2numpy(vips_img)
+
+
+def _downsample(img: np.ndarray) -> np.ndarray:
+    """Average each 2x2 block, repeating the last row and column of odd sized images
+    """
+    img = np.pad(img, ((0, img.shape[0] % 2), (0, img.shape[1] % 2), (0, 0)), mode="edge").astype(float)
+    small_img = (img[0::2, 0::2] + img[1::2, 0::2] + img[0::2, 1::2] + img[1::2, 1::2])/4
+
+    return small_img
+
+
+def _check_ome_tiff(dst_f, img, is_rgb):
+    n_pages = 1 if is_rgb else img.shape[2]
+    n_levels = 3
+    assert pyvips.Image.new_from_file(dst_f).get("n-pages") == n_pages
+    level_img = img
+    for level in range(n_levels):
+        if level > 0:
+            level_img = _downsample(level_img)
+
+        for page in range(n_pages):
+            saved = _read_level(dst_f, level, page)
+            expected = level_img if is_rgb else level_img[..., page]
+            assert saved.dtype == img.dtype
+            assert saved.shape == expected.shape
+            if level == 0:
+                assert np.array_equal(saved, expected)
+            else:
+                # Averages of lower levels are rounded at each level
+                assert np.abs(saved - expected).max() <= level
+
+    with pytest.raises(pyvips.Error):
+        pyvips.Image.new_from_file(dst_f, subifd=n_levels - 1).numpy()
+
+    ome_obj = ome_types.from_xml(pyvips.Image.new_from_file(dst_f).get("image-description"))
+    pixels = ome_obj.images[0].pixels
+    assert (pixels.size_x, pixels.size_y, pixels.size_c) == (img.shape[1], img.shape[0], img.shape[2])
+    assert pixels.type.value == img.dtype.name
+    if is_rgb:
+        assert pixels.channels[0].samples_per_pixel == img.shape[2]
+
+
+@pytest.mark.parametrize("is_rgb, n_channels, dtype", [(True, 3, np.uint8),
+                                                       (False, 5, np.uint16),
+                                                       (True, 4, np.uint8)])
+def test_ome_tiff_round_trip(tmp_path, is_rgb, n_channels, dtype):
+    img = _make_multichannel_img(n_channels=n_channels, dtype=dtype)
+    vips_img = warp_tools.numpy2vips(img)
+    if is_rgb:
+        vips_img = vips_img.copy(interpretation="srgb")
+    else:
+        vips_img = vips_img.copy(interpretation="multiband")
+
+    dst_f = str(tmp_path / "img.ome.tiff")
+    slide_io.save_ome_tiff_parallel(vips_img, dst_f, tile_wh=128, n_jobs=2)
+
+    _check_ome_tiff(dst_f, img, is_rgb)
+
+
+def test_ome_tiff_tile_writer_strips(tmp_path):
+    img = _make_multichannel_img(n_channels=2)
+    dst_f = str(tmp_path / "img.ome.tiff")
+    with slide_io.OmeTiffTileWriter(dst_f, shape_wh=img.shape[1::-1], n_channels=2, dtype=img.dtype,
+                                    tile_wh=128, compression="none", n_jobs=2) as writer:
+        # Strips don't need to line up with the tiles
+        for y in range(0, img.shape[0], 70):
+            writer.write_strip(img[y:y + 70])
+
+    _check_ome_tiff(dst_f, img, False)
+
+
+def test_ome_tiff_rgba_extra_samples(tmp_path):
+    tifffile = pytest.importorskip("tifffile")
+    img = _make_multichannel_img(n_channels=4, dtype=np.uint8)
+    dst_f = str(tmp_path / "img.ome.tiff")
+    slide_io.save_ome_tiff_parallel(warp_tools.numpy2vips(img).copy(interpretation="srgb"), dst_f, tile_wh=128)
+
+    with tifffile.TiffFile(dst_f) as tif:
+        assert tif.is_ome
+        page = tif.pages[0]
+        assert page.photometric == tifffile.PHOTOMETRIC.RGB
+        assert tuple(page.extrasamples) == (tifffile.EXTRASAMPLE.UNASSALPHA,)
+        assert len(page.subifds) == 2
+        assert np.array_equal(page.asarray(), img)
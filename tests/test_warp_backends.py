@@ -0,0 +1,182 @@
+import numpy as np
+import pytest
+
+try:
+    from valis import warp_tools
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+SHAPE_RC = (120, 150)
+
+BORDER_WIDTH = 3
+"""int: Pixels sampled within this distance of the image's edge, where the image meets the background, are border pixels"""
+
+INTERIOR_MAX_DIFF = {"nearest": 0, "bilinear": 2, "bicubic": 3}
+"""dict: Maximum difference between the backends, away from the border"""
+
+BORDER_MAX_DIFF = {"nearest": 0, "bilinear": 6, "bicubic": 40}
+"""dict: Maximum difference between the backends at the border, where the bicubic kernels ring differently"""
+
+
+def _make_img(n_bands: int = 3, dtype=np.uint8) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    # Smooth image, so that differences between interpolation kernels are small
+    yy, xx = np.mgrid[0:SHAPE_RC[0], 0:SHAPE_RC[1]]
+    bands = [127 + 100*np.sin(xx/(7 + 3*i) + rng.uniform(0, np.pi))*np.cos(yy/(9 + 2*i)) for i in range(n_bands)]
+    img = np.dstack(bands).astype(dtype)
+    if n_bands == 1:
+        img = img[..., 0]
+
+    return img
+
+
+def _make_M() -> np.ndarray:
+    angle = np.deg2rad(12)
+    M = np.array([[0.95*np.cos(angle), -np.sin(angle), 8.3],
+                  [np.sin(angle), 1.05*np.cos(angle), -5.7],
+                  [0, 0, 1]])
+
+    return M
+
+
+def _make_dxdy(shape_rc=SHAPE_RC) -> np.ndarray:
+    yy, xx = np.mgrid[0:shape_rc[0], 0:shape_rc[1]]
+    dx = 3*np.sin(yy/15)
+    dy = 2*np.cos(xx/20)
+
+    return np.array([dx, dy], dtype=np.float32)
+
+
+def _warp_both(img: np.ndarray, **kwargs) -> tuple:
+    vips_warped = warp_tools.warp_img(img, backend=warp_tools.WARP_BACKEND_VIPS, **kwargs)
+    cv2_warped = warp_tools.warp_img(img, backend=warp_tools.WARP_BACKEND_CV2, **kwargs)
+
+    return vips_warped, cv2_warped
+
+
+def _get_edge_dist(shape_rc) -> np.ndarray:
+    """Distance from each pixel to the outside of the image
+    """
+    yy, xx = np.mgrid[0:shape_rc[0], 0:shape_rc[1]]
+    edge_dist = np.minimum.reduce([xx + 1, yy + 1, shape_rc[1] - xx, shape_rc[0] - yy])
+
+    return edge_dist.astype(np.float32)
+
+
+def _get_border_mask(img: np.ndarray, warped_shape_rc, **kwargs) -> np.ndarray:
+    """Get mask of pixels sampled near the edge of the image, where the image meets the background
+    """
+    kwargs = dict(kwargs, interp_method="nearest", bg_color=None, backend=warp_tools.WARP_BACKEND_VIPS)
+    border_width = BORDER_WIDTH
+    if kwargs.get("M") is not None and kwargs.get("bk_dxdy") is not None and not kwargs.get("composed", False):
+        # Two resamplings, so the edges of the rigidly warped image are also borders,
+        # and the first resampling's differences spread further into the image
+        kwargs["out_shape_rc"] = warped_shape_rc
+        rigid_edge_dist = warp_tools.warp_img(_get_edge_dist(img.shape[0:2]), **dict(kwargs, bk_dxdy=None))
+        rigid_edge_dist = np.minimum(rigid_edge_dist, _get_edge_dist(warped_shape_rc))
+        warped_edge_dist = warp_tools.warp_img(rigid_edge_dist, **dict(kwargs, M=None))
+        border_width += 2
+    else:
+        warped_edge_dist = warp_tools.warp_img(_get_edge_dist(img.shape[0:2]), **kwargs)
+
+    return warped_edge_dist < border_width
+
+
+def _assert_similar(vips_warped: np.ndarray, cv2_warped: np.ndarray, interp_method: str, border_mask: np.ndarray) -> None:
+    assert vips_warped.shape == cv2_warped.shape
+    assert vips_warped.dtype == cv2_warped.dtype
+    assert border_mask.shape == vips_warped.shape[0:2]
+
+    abs_diff = np.abs(vips_warped.astype(float) - cv2_warped.astype(float))
+    if abs_diff.ndim == 3:
+        abs_diff = abs_diff.max(axis=2)
+
+    # libvips and OpenCV use slightly different bicubic kernels
+    assert abs_diff[~border_mask].max() <= INTERIOR_MAX_DIFF[interp_method]
+    if interp_method != "nearest":
+        assert np.mean(abs_diff[~border_mask]) < 1.0
+
+    if border_mask.any():
+        assert abs_diff[border_mask].max() <= BORDER_MAX_DIFF[interp_method]
+        assert np.mean(abs_diff[border_mask]) < 2.0
+
+
+def _assert_warps_similar(img: np.ndarray, interp_method: str, **kwargs) -> tuple:
+    vips_warped, cv2_warped = _warp_both(img, interp_method=interp_method, **kwargs)
+    border_mask = _get_border_mask(img, vips_warped.shape[0:2], **kwargs)
+    _assert_similar(vips_warped, cv2_warped, interp_method, border_mask)
+
+    return vips_warped, cv2_warped
+
+
+@pytest.mark.parametrize("interp_method", ["nearest", "bilinear", "bicubic"])
+def test_rigid_warp_parity(interp_method: str) -> None:
+    _assert_warps_similar(_make_img(), interp_method, M=_make_M())
+
+
+@pytest.mark.parametrize("interp_method", ["nearest", "bilinear", "bicubic"])
+def test_non_rigid_warp_parity(interp_method: str) -> None:
+    _assert_warps_similar(_make_img(), interp_method, bk_dxdy=_make_dxdy())
+
+
+@pytest.mark.parametrize("interp_method", ["nearest", "bilinear", "bicubic"])
+@pytest.mark.parametrize("composed", [False, True])
+def test_rigid_and_non_rigid_warp_parity(composed: bool, interp_method: str) -> None:
+    _assert_warps_similar(_make_img(), interp_method, M=_make_M(), bk_dxdy=_make_dxdy(), composed=composed)
+
+
+@pytest.mark.parametrize("interp_method", ["bilinear", "bicubic"])
+def test_scaled_warp_parity(interp_method: str) -> None:
+    # Transformations found using a smaller image, and applied to a larger one.
+    # Nearest neighbor isn't compared, as scaled positions often fall exactly between
+    # pixels, and libvips rounds these differently from row to row
+    small_shape_rc = (60, 75)
+    out_shape_rc = (100, 130)
+    vips_warped, _ = _assert_warps_similar(_make_img(), interp_method, M=_make_M(),
+                                           bk_dxdy=_make_dxdy(small_shape_rc),
+                                           transformation_src_shape_rc=small_shape_rc,
+                                           transformation_dst_shape_rc=small_shape_rc,
+                                           out_shape_rc=out_shape_rc)
+
+    assert vips_warped.shape[0:2] == out_shape_rc
+
+
+def test_bg_color_and_bands_parity() -> None:
+    bg_color = [10, 20, 30, 40, 50, 60]
+    _, cv2_warped = _assert_warps_similar(_make_img(n_bands=6), "bilinear", M=_make_M(), bg_color=bg_color)
+
+    assert np.all(cv2_warped[0, 0] == bg_color)
+
+
+def test_crop_parity() -> None:
+    bbox_xywh = np.array([10.2, 15, 60, 40])
+    _, cv2_warped = _assert_warps_similar(_make_img(n_bands=1), "bilinear", M=_make_M(), bbox_xywh=bbox_xywh)
+
+    assert cv2_warped.shape == (40, 60)
+
+
+def test_mask_parity() -> None:
+    mask = np.full(SHAPE_RC, 255, dtype=np.uint8)
+    _assert_warps_similar(mask, "nearest", M=_make_M(), bk_dxdy=_make_dxdy())
+
+
+def test_backend_selection() -> None:
+    img = _make_img()
+    assert warp_tools._can_warp_with_cv2(img, None, SHAPE_RC, "bicubic")
+    assert not warp_tools._can_warp_with_cv2(img, None, SHAPE_RC, "lbb")
+    assert not warp_tools._can_warp_with_cv2(warp_tools.numpy2vips(img), None, SHAPE_RC, "bicubic")
+    assert not warp_tools._can_warp_with_cv2(img.astype(bool), None, SHAPE_RC, "bicubic")
+
+    big_shape_rc = (warp_tools.CV2_WARP_MAX_PX, 2)
+    assert not warp_tools._can_warp_with_cv2(img, None, big_shape_rc, "bicubic")
+
+
+def test_cv2_backend_unsupported_interp() -> None:
+    img = _make_img()
+    with pytest.raises(ValueError, match="lbb"):
+        warp_tools.warp_img(img, M=_make_M(), interp_method="lbb", backend=warp_tools.WARP_BACKEND_CV2)
+
+    # Selecting the backend automatically falls back to libvips
+    warped = warp_tools.warp_img(img, M=_make_M(), out_shape_rc=SHAPE_RC, interp_method="lbb")
+    assert warped.shape == img.shape
@@ -0,0 +1,198 @@
+import pickle
+
+import cv2
+import numpy as np
+import pytest
+from scipy import ndimage
+
+try:
+    from valis import valtils, warp_tools
+except Exception as e:
+    pytest.skip(f"valis could not be imported: {e}", allow_module_level=True)
+
+
+FIELD_SHAPE_RC = (240, 300)
+MAX_DISPLACEMENT = 6
+
+# Maximum residual of the inverse, and difference between tiled and untiled inverses
+INVERSE_TOL = {warp_tools.INVERSE_ITK: (0.5, 0.25),
+               warp_tools.INVERSE_FIXED_POINT: (0.05, 0.02)}
+
+# Image used to find the transformations, and the registered image
+WARP_SRC_SHAPE_RC = (300, 400)
+WARP_DST_SHAPE_RC = (320, 420)
+WARP_M = np.array([[0.98, 0.1, 12.3], [-0.08, 1.01, -7.2], [0, 0, 1]])
+WARP_BBOX_XYWH = (30.2, 40.7, 500, 300)
+
+# Mean difference between composed and 2 step warps, measured on registered slides
+COMPOSED_WARP_MAX_MEAN_DIFF = 0.43
+COMPOSED_FROM_TO_MAX_MEAN_DIFF = 0.66
+
+# "To" image used to find its transformations, and the shape of the image to warp onto
+TO_SRC_SHAPE_RC = (290, 410)
+TO_M = np.array([[1.02, -0.05, -5], [0.04, 0.99, 8], [0, 0, 1]])
+
+
+def _make_smooth_field(shape_rc=FIELD_SHAPE_RC, max_displacement=MAX_DISPLACEMENT, seed=0) -> list:
+    rng = np.random.default_rng(seed)
+    dxdy = []
+    for _ in range(2):
+        d = ndimage.gaussian_filter(rng.normal(size=shape_rc), 20)
+        dxdy.append((d*max_displacement/np.abs(d).max()).astype(np.float32))
+
+    return dxdy
+
+
+def _make_warp_img(seed=0) -> np.ndarray:
+    """Smooth image that is 2x larger than the one used to find the transformations
+    """
+    shape_rc = tuple(2*np.array(WARP_SRC_SHAPE_RC))
+    img = ndimage.gaussian_filter(np.random.default_rng(seed).random(shape_rc), 8)
+    img = 255*(img - img.min())/(img.max() - img.min())
+
+    return img.astype(np.uint8)
+
+
+def _get_warp_kwargs(bbox_xywh=None) -> dict:
+    return {"M": WARP_M,
+            "bk_dxdy": _make_smooth_field(WARP_DST_SHAPE_RC, seed=1),
+            "transformation_src_shape_rc": WARP_SRC_SHAPE_RC,
+            "transformation_dst_shape_rc": WARP_DST_SHAPE_RC,
+            "out_shape_rc": tuple(2*np.array(WARP_DST_SHAPE_RC)),
+            "bbox_xywh": bbox_xywh}
+
+
+def _get_inverse_residual(bk_dxdy, fwd_dxdy, margin=10) -> np.ndarray:
+    """Get how far warping by `fwd_dxdy` and then `bk_dxdy` is from the identity
+
+    The inverse satisfies fwd_dxdy(p) = -bk_dxdy(p + fwd_dxdy(p))
+    """
+    grid_y, grid_x = np.indices(bk_dxdy[0].shape, dtype=np.float32)
+    bk_at_fwd = cv2.remap(np.dstack(bk_dxdy), grid_x + fwd_dxdy[0], grid_y + fwd_dxdy[1], cv2.INTER_LINEAR)
+    residual = np.abs(np.dstack(fwd_dxdy) + bk_at_fwd)
+
+    return residual[margin:-margin, margin:-margin]
+
+
+@pytest.mark.parametrize("method", [warp_tools.INVERSE_ITK, warp_tools.INVERSE_FIXED_POINT])
+def test_inverse_field(method):
+    bk_dxdy = _make_smooth_field()
+    max_residual, max_tile_diff = INVERSE_TOL[method]
+
+    fwd_dxdy = warp_tools.get_inverse_field(bk_dxdy, method=method)
+    residual = _get_inverse_residual(bk_dxdy, fwd_dxdy)
+    assert residual.max() < max_residual
+    assert residual.mean() < 0.01
+    # Much better than just negating the field
+    assert residual.max() < 0.5*_get_inverse_residual(bk_dxdy, [-d for d in bk_dxdy]).max()
+
+    tiled_fwd_dxdy = warp_tools.get_inverse_field(bk_dxdy, method=method, tile_wh=96)
+    assert np.abs(np.dstack(tiled_fwd_dxdy) - np.dstack(fwd_dxdy)).max() < max_tile_diff
+    assert _get_inverse_residual(bk_dxdy, tiled_fwd_dxdy).max() < max_residual
+
+
+def test_inverse_field_tiles_in_one_thread(tmp_path, monkeypatch):
+    bk_dxdy = _make_smooth_field()
+    method = warp_tools.INVERSE_FIXED_POINT
+    tiled_fwd_dxdy = warp_tools.get_inverse_field(bk_dxdy, method=method, tile_wh=96)
+
+    monkeypatch.setattr(valtils, "get_ncpus_available", lambda: 1)
+    dst_f = str(tmp_path / "inverse.raw")
+    memmap_fwd_dxdy = warp_tools.get_inverse_field(bk_dxdy, method=method, tile_wh=96, dst_f=dst_f)
+
+    assert isinstance(memmap_fwd_dxdy[0], np.memmap)
+    assert np.array_equal(np.dstack(memmap_fwd_dxdy), np.dstack(tiled_fwd_dxdy))
+
+
+def test_warp_map_positions():
+    shift_M = np.array([[1, 0, 5.0], [0, 1, -3.0], [0, 0, 1]])
+    bk_dxdy = [np.full((300, 400), 2.0, dtype=np.float32), np.full((300, 400), -1.5, dtype=np.float32)]
+    warp_map = warp_tools.get_img_warp_map((300, 400), M=shift_M, bk_dxdy=bk_dxdy, bbox_xywh=(10, 20, 100, 50))
+    warp_map = warp_tools.vips2numpy(warp_map)
+
+    # Displaced, then rigidly transformed, starting from the top left of the bbox
+    yy, xx = np.mgrid[20:70, 10:110]
+    assert warp_map.shape == (50, 100, 2)
+    assert np.allclose(warp_map[..., 0], xx + 2 + 5)
+    assert np.allclose(warp_map[..., 1], yy - 1.5 - 3)
+
+
+@pytest.mark.parametrize("bbox_xywh", [None, WARP_BBOX_XYWH])
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_compiled_warp_matches_warp_img(tmp_path, bbox_xywh, in_memory):
+    img = _make_warp_img()
+    warp_kwargs = _get_warp_kwargs(bbox_xywh)
+    map_f = None if in_memory else str(tmp_path / "warp_map.v")
+    compiled_warp = warp_tools.CompiledWarp(img.shape[0:2], map_f=map_f, **warp_kwargs)
+    compiled_warp = pickle.loads(pickle.dumps(compiled_warp))
+    warped = compiled_warp.warp(img)
+
+    expected_warped = warp_tools.warp_img(img, backend=warp_tools.WARP_BACKEND_VIPS, **warp_kwargs)
+    assert warped.shape == expected_warped.shape
+    assert np.array_equal(compiled_warp.out_shape_rc, warped.shape[0:2])
+    assert np.abs(warped.astype(float) - expected_warped).mean() < COMPOSED_WARP_MAX_MEAN_DIFF
+
+    # Same as warping with the map
+    warp_map = warp_tools.get_img_warp_map(img.shape[0:2], **warp_kwargs)
+    assert np.array_equal(warped, warp_tools.warp_img_with_map(img, warp_map))
+
+
+def test_compiled_warp_crop():
+    img = _make_warp_img()
+    warped = warp_tools.CompiledWarp(img.shape[0:2], **_get_warp_kwargs()).warp(img)
+    cropped = warp_tools.CompiledWarp(img.shape[0:2], **_get_warp_kwargs(WARP_BBOX_XYWH)).warp(img)
+
+    # Like warp_img, the bbox's top left corner is rounded up
+    x, y, w, h = np.ceil(WARP_BBOX_XYWH).astype(int)
+    assert cropped.shape == (h, w)
+    assert np.array_equal(cropped, warped[y:y+h, x:x+w])
+
+
+@pytest.mark.parametrize("backend", [warp_tools.WARP_BACKEND_VIPS, warp_tools.WARP_BACKEND_CV2])
+@pytest.mark.parametrize("bbox_xywh", [None, WARP_BBOX_XYWH])
+def test_composed_warp_img(backend, bbox_xywh):
+    img = _make_warp_img()
+    warp_kwargs = _get_warp_kwargs(bbox_xywh)
+    warped = warp_tools.warp_img(img, backend=backend, **warp_kwargs)
+    composed_warped = warp_tools.warp_img(img, backend=backend, composed=True, **warp_kwargs)
+
+    assert composed_warped.shape == warped.shape
+    assert np.abs(composed_warped.astype(float) - warped).mean() < COMPOSED_WARP_MAX_MEAN_DIFF
+
+    if bbox_xywh is not None:
+        uncropped = warp_tools.warp_img(img, backend=backend, composed=True, **_get_warp_kwargs())
+        x, y, w, h = np.ceil(bbox_xywh).astype(int)
+        assert np.array_equal(composed_warped, uncropped[y:y+h, x:x+w])
+
+
+@pytest.mark.parametrize("non_rigid", [True, False])
+def test_composed_warp_img_from_to(non_rigid):
+    img = _make_warp_img()
+    warp_kwargs = _get_warp_kwargs()
+    to_src_shape_rc = tuple(2*np.array(TO_SRC_SHAPE_RC))
+    from_to_kwargs = {"from_M": warp_kwargs["M"],
+                      "from_transformation_src_shape_rc": WARP_SRC_SHAPE_RC,
+                      "from_transformation_dst_shape_rc": WARP_DST_SHAPE_RC,
+                      "from_dst_shape_rc": warp_kwargs["out_shape_rc"],
+                      "to_M": TO_M,
+                      "to_transformation_src_shape_rc": TO_SRC_SHAPE_RC,
+                      "to_transformation_dst_shape_rc": WARP_DST_SHAPE_RC,
+                      "to_src_shape_rc": to_src_shape_rc}
+
+    if non_rigid:
+        to_bk_dxdy = _make_smooth_field(WARP_DST_SHAPE_RC, seed=2)
+        from_to_kwargs.update({"from_bk_dxdy": warp_kwargs["bk_dxdy"],
+                               "to_bk_dxdy": to_bk_dxdy,
+                               "to_fwd_dxdy": warp_tools.get_inverse_field(to_bk_dxdy)})
+
+    warp_map = warp_tools.get_img_from_to_warp_map(from_src_shape_rc=img.shape[0:2], **from_to_kwargs)
+    assert (warp_map.height, warp_map.width, warp_map.bands) == (*to_src_shape_rc, 2)
+
+    # Warp in 2 steps with libvips, so that both warps use the same interpolator
+    warped = warp_tools.vips2numpy(warp_tools.warp_img_from_to(warp_tools.numpy2vips(img), **from_to_kwargs))
+    composed_warped = warp_tools.warp_img_from_to(img, composed=True, **from_to_kwargs)
+
+    assert isinstance(composed_warped, np.ndarray)
+    assert composed_warped.shape == warped.shape == to_src_shape_rc
+    assert np.abs(composed_warped.astype(float) - warped).mean() < COMPOSED_FROM_TO_MAX_MEAN_DIFF
+    assert np.array_equal(composed_warped, warp_tools.warp_img_with_map(img, warp_map))
@@ -6,6 +6,8 @@ custom optimization methods.
 
 There are several subclasses, but AffineOptimizerMattesMI is the
 the fastest and most accurate, and so is default affine optimizer in VALIS.
+AffineOptimizerSampledMattesMI also maximizes Mattes mutual information,
+but doesn't require SimpleElastix.
 It's not recommended that the other subclasses be used, but they are kept
 to provide examples on how to subclass AffineOptimizer.
 """
@@ -21,12 +23,17 @@ import os
 import SimpleITK as sitk
 from scipy import interpolate
 import pathlib
+import weakref
+from . import uint8_stats
 from . warp_tools import get_affine_transformation_params, \
     get_corners_of_image, warp_xy
 
 # Cost functions #
 EPS = np.finfo("float").eps
 
+PYRAMID_DTYPE = np.float32
+"""type: dtype of the images in the Gaussian pyramids created by `AffineOptimizer.get_pyramid`"""
+
 
 def mse(arr1, arr2, mask=None):
     """Compute the mean squared error between two arrays."""
@@ -395,24 +402,28 @@ def normalized_mutual_information(A, B, mask, n_bins=256):
     y_range = y_max - y_min + EPS
 
     _bins = n_bins * (1 - EPS)  # Keeps right bin closed
-    x_margins = np.zeros(n_bins)
-    y_margins = np.zeros(n_bins)
-    results = np.zeros((n_bins, n_bins))
-
-    for i in range(A.shape[0]):
-        for j in range(A.shape[1]):
-            if mask[i, j] == 0:
-                continue
-
-            x = A[i, j]
-            y = B[i, j]
+    if uint8_stats.is_uint8(A, B):
+        # Bin each of the 256 possible values, rather than each pixel
+        vals = np.arange(uint8_stats.N_VALUES)
+        x_bin_lut = np.clip((_bins * ((vals - x_min) / x_range)).astype(int), 0, n_bins - 1)
+        y_bin_lut = np.clip((_bins * ((vals - y_min) / y_range)).astype(int), 0, n_bins - 1)
+        value_counts = uint8_stats.joint_histogram(A, B, mask)
+        results = uint8_stats.rebin_joint(value_counts, x_bin_lut, y_bin_lut, n_bins, n_bins)
+    else:
+        if mask is None:
+            x = A.reshape(-1)
+            y = B.reshape(-1)
+        else:
+            x = A[mask != 0]
+            y = B[mask != 0]
 
-            x_bin = int(_bins * ((x - x_min) / x_range))
-            y_bin = int(_bins * ((y - y_min) / y_range))
+        # Bin in double precision, so that the maximum values stay in the last bin
+        x_bin = (_bins * ((x.astype(float) - x_min) / x_range)).astype(int)
+        y_bin = (_bins * ((y.astype(float) - y_min) / y_range)).astype(int)
+        results = np.bincount(x_bin*n_bins + y_bin, minlength=n_bins**2).reshape(n_bins, n_bins).astype(float)
 
-            x_margins[x_bin] += 1
-            y_margins[y_bin] += 1
-            results[x_bin, y_bin] += 1
+    x_margins = results.sum(axis=1)
+    y_margins = results.sum(axis=0)
 
     n = np.sum(results)
     results /= n
@@ -426,7 +437,7 @@ def normalized_mutual_information(A, B, mask, n_bins=256):
     if MI < 0:
         MI = 0
 
-        return MI
+    return MI
 
 
 def sample_img(img, spacing=10):
@@ -458,6 +469,239 @@ def MI(fixed, moving, nb, spacing):
     return MI
 
 
+def cubic_bspline(x):
+    """Cubic B-spline kernel, and its derivative
+
+    Parameters
+    ----------
+    x : ndarray
+        Positions at which to evaluate the kernel
+
+    Returns
+    -------
+    b : ndarray
+        Value of the kernel at `x`
+
+    db : ndarray
+        Derivative of the kernel at `x`
+
+    """
+
+    ax = np.abs(x)
+    inner = ax < 1
+    outer = (ax >= 1) & (ax < 2)
+    b = np.where(inner, 2/3 - ax**2 + 0.5*ax**3, np.where(outer, (2 - ax)**3/6, 0))
+    db = np.where(inner, -2*x + 1.5*x*ax, np.where(outer, -0.5*np.sign(x)*(2 - ax)**2, 0))
+
+    return b.astype(x.dtype), db.astype(x.dtype)
+
+
+def sample_bilinear(img, xy):
+    """Bilinearly interpolate an image, and its gradient, at each point
+
+    Parameters
+    ----------
+    img : ndarray
+        (N, M) image
+
+    xy : ndarray
+        (K, 2) array of positions, in xy coordinates
+
+    Returns
+    -------
+    vals : ndarray
+        (K) array of interpolated values
+
+    grad_xy : ndarray
+        (K, 2) array of the gradient of the interpolated image at each point,
+        i.e. the derivative of `vals` with respect to `xy`
+
+    valid : ndarray
+        (K) boolean array, True if the point is inside the image
+
+    """
+
+    h, w = img.shape[0:2]
+    x = xy[:, 0]
+    y = xy[:, 1]
+    valid = (x >= 0) & (y >= 0) & (x <= w - 1) & (y <= h - 1)
+
+    x0 = np.clip(np.floor(x), 0, max(w - 2, 0)).astype(int)
+    y0 = np.clip(np.floor(y), 0, max(h - 2, 0)).astype(int)
+    x1 = np.minimum(x0 + 1, w - 1)
+    y1 = np.minimum(y0 + 1, h - 1)
+    fx = np.clip(x - x0, 0, 1)
+    fy = np.clip(y - y0, 0, 1)
+
+    top_left = img[y0, x0]
+    top_right = img[y0, x1]
+    bottom_left = img[y1, x0]
+    bottom_right = img[y1, x1]
+
+    top = top_left + fx*(top_right - top_left)
+    bottom = bottom_left + fx*(bottom_right - bottom_left)
+    vals = top + fy*(bottom - top)
+
+    dx = (1 - fy)*(top_right - top_left) + fy*(bottom_right - bottom_left)
+    dy = bottom - top
+    grad_xy = np.dstack([dx, dy])[0]
+
+    return vals, grad_xy, valid
+
+
+def mattes_mutual_information(fixed_vals, moving_vals, n_bins=32, fixed_range=None, moving_range=None, return_grad=False,
+                              weights=None):
+    """Mutual information, estimated using B-spline Parzen windows
+
+    As described in Mattes et al. 2003, fixed values are binned using a zero order
+    (box) kernel, and moving values are binned using a cubic B-spline. This makes
+    the mutual information differentiable with respect to the moving values.
+
+    Parameters
+    ----------
+    fixed_vals : ndarray
+        (N) array of values sampled from the fixed image
+
+    moving_vals : ndarray
+        (N) array of values sampled from the moving image, at
+        the positions corresponding to `fixed_vals`
+
+    n_bins : int
+        Number of bins in the joint histogram, including 2 bins of
+        padding at each end
+
+    fixed_range, moving_range : tuple, optional
+        (min, max) values used to bin `fixed_vals` and `moving_vals`. If None,
+        the min and max of the values will be used.
+
+    return_grad : bool
+        Whether or not to also return the derivative of the mutual
+        information with respect to each value in `moving_vals`
+
+    weights : ndarray, optional
+        (N) array of how many times each pair of values occurs. Used
+        when the values are the pairs in a joint histogram, such as one
+        created by `uint8_stats.joint_histogram`
+
+    Returns
+    -------
+    mi : float
+        Mutual information
+
+    grad : ndarray
+        (N) array of the derivative of `mi` with respect to each value
+        in `moving_vals`. Only returned if `return_grad` is True
+
+    """
+
+    if fixed_range is None:
+        fixed_range = (np.min(fixed_vals), np.max(fixed_vals))
+
+    if moving_range is None:
+        moving_range = (np.min(moving_vals), np.max(moving_vals))
+
+    # Cubic B-spline covers 4 bins, so 2 bins at each end are padding
+    n_val_bins = n_bins - 4
+    fixed_bin_w = max(fixed_range[1] - fixed_range[0], EPS)/n_val_bins
+    moving_bin_w = max(moving_range[1] - moving_range[0], EPS)/n_val_bins
+
+    fixed_bin = np.clip(np.floor((fixed_vals - fixed_range[0])/fixed_bin_w), 0, n_val_bins - 1).astype(int) + 2
+    moving_pos = np.clip((moving_vals - moving_range[0])/moving_bin_w, 0, n_val_bins) + 2
+    moving_bins = np.floor(moving_pos).astype(int)[:, None] + np.arange(-1, 3)
+    w, dw = cubic_bspline(moving_bins - moving_pos[:, None])
+    # Maximum value's last bin is outside of the histogram, but has a weight of 0
+    moving_bins = np.minimum(moving_bins, n_bins - 1)
+
+    if weights is not None:
+        w = w*weights[:, None]
+        dw = dw*weights[:, None]
+
+    flat_idx = (fixed_bin[:, None]*n_bins + moving_bins).ravel()
+    joint_p = np.bincount(flat_idx, weights=w.ravel(), minlength=n_bins**2).reshape(n_bins, n_bins)
+    n = joint_p.sum()
+    joint_p /= n
+    fixed_p = joint_p.sum(axis=1)
+    moving_p = joint_p.sum(axis=0)
+
+    nz = joint_p > 0
+    log_p_ratio = np.zeros_like(joint_p)
+    log_p_ratio[nz] = np.log(joint_p[nz]/np.broadcast_to(moving_p, joint_p.shape)[nz])
+    mi = np.sum(joint_p[nz]*(log_p_ratio[nz] - np.log(np.broadcast_to(fixed_p[:, None], joint_p.shape)[nz])))
+    if not return_grad:
+        return mi
+
+    # Fixed histogram doesn't change, and so derivative only depends on how joint histogram changes
+    grad = -np.sum(dw*log_p_ratio[fixed_bin[:, None], moving_bins], axis=1)/(n*moving_bin_w)
+
+    return mi, grad.astype(moving_vals.dtype)
+
+
+class PyramidCache(object):
+    """Cache of Gaussian pyramids, and other values created from images
+
+    Values are keyed by the identity of the image they were created from,
+    and are removed when that image is garbage collected. This way, an image that
+    is aligned more than once, such as an image that is the fixed image
+    for one pair and the moving image for another, only has its pyramid
+    built once. The cached values are shared, and so should not be modified.
+
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def _remove(self, key, img_ref):
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] is img_ref:
+            del self._cache[key]
+
+    def get(self, img, name, fxn):
+        """Get value created from an image, only creating it if it hasn't been cached
+
+        Parameters
+        ----------
+        img : ndarray
+            Image the value is created from
+
+        name : str, tuple
+            Name of the value, e.g. ("pyramid", nlevels)
+
+        fxn : callable
+            Function that creates the value, with `img` as the only argument
+
+        Returns
+        -------
+        value : object
+            Value returned by `fxn(img)`
+
+        """
+
+        key = id(img)
+        entry = self._cache.get(key)
+        if entry is None or entry[0]() is not img:
+            try:
+                img_ref = weakref.ref(img, lambda ref, key=key: self._remove(key, ref))
+            except TypeError:
+                # Can't tell when img is garbage collected, so don't cache
+                return fxn(img)
+
+            entry = (img_ref, {})
+            self._cache[key] = entry
+
+        values = entry[1]
+        if name not in values:
+            values[name] = fxn(img)
+
+        return values[name]
+
+    def clear(self):
+        self._cache = {}
+
+
+PYRAMID_CACHE = PyramidCache()
+"""PyramidCache: Pyramids and interpolators shared by all AffineOptimizers"""
+
+
 class AffineOptimizer(object):
     """Class that optimizes ridid registration
 
@@ -483,15 +727,22 @@ class AffineOptimizer(object):
     accepts_xy : bool
         Bool declaring whether or not the optimizer will use corresponding points to optimize the registration
 
+    accepts_pyramids : bool
+        Bool declaring whether or not the optimizer can use Gaussian pyramids that were already built
+        with `get_pyramid`, instead of building them in `setup`
+
     Methods
     -------
-    setup(moving, fixed, mask, initial_M=None)
+    setup(moving, fixed, mask, initial_M=None, moving_pyramid=None, fixed_pyramid=None)
         Gets images ready for alignment
 
+    get_pyramid(img)
+        Build the Gaussian pyramid used to align an image
+
     cost_fxn(fixed_image, transformed, mask)
         Calculates metric that is to be minimized
 
-    align(moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None)
+    align(moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None, moving_pyramid=None, fixed_pyramid=None)
         Align images by minimizing cost_fxn
 
 
@@ -512,8 +763,12 @@ class AffineOptimizer(object):
     If the optimizer uses corressponding points, then the class attribute
     accepts_xy needs to be set to True. The default is False.
 
+    If the optimizer doesn't use the pyramids created by `get_pyramid`, then
+    the class attribute accepts_pyramids needs to be set to False.
+
     """
     accepts_xy = False
+    accepts_pyramids = True
 
     def __init__(self, nlevels=1, nbins=256, optimization="Powell", transformation="EuclideanTransform"):
         """AffineOptimizer registers moving and fixed images by minimizing a cost function
@@ -540,7 +795,43 @@ class AffineOptimizer(object):
         self.current_level = nlevels - 1
         self.accepts_xy = AffineOptimizer.accepts_xy
 
-    def setup(self, moving, fixed, mask, initial_M=None):
+    def get_pyramid(self, img):
+        """Build the Gaussian pyramid used to align an image
+
+        Pyramids are cached in `PYRAMID_CACHE`, so that images that are aligned more
+        than once only have their pyramids built once. Passing the pyramids to
+        `align` avoids having to rebuild them in other processes.
+
+        Parameters
+        ----------
+        img : ndarray
+            Image that will be aligned
+
+        Returns
+        -------
+        pyramid : list
+            List of images in the Gaussian pyramid, starting with `img`.
+            Images are converted to `PYRAMID_DTYPE`
+
+        """
+
+        nlevels = self.nlevels
+
+        def build_pyramid(x):
+            pyramid = list(gaussian_pyramid(np.asarray(x, dtype=PYRAMID_DTYPE), levels=int(nlevels)))
+            if pyramid[0] is x:
+                # Cache can't keep a reference to x, or x would never be garbage collected
+                pyramid[0] = None
+
+            return pyramid
+
+        pyramid = PYRAMID_CACHE.get(img, ("pyramid", nlevels), build_pyramid)
+        if pyramid[0] is None:
+            pyramid = [img] + pyramid[1:]
+
+        return pyramid
+
+    def setup(self, moving, fixed, mask, initial_M=None, moving_pyramid=None, fixed_pyramid=None):
         """Get images ready for alignment
 
         Parameters
@@ -558,6 +849,14 @@ class AffineOptimizer(object):
         initial_M : (3x3) array
             Initial transformation matrix
 
+        moving_pyramid : list, optional
+            Gaussian pyramid of `moving`, created by `get_pyramid`. If None,
+            it will be built here
+
+        fixed_pyramid : list, optional
+            Gaussian pyramid of `fixed`, created by `get_pyramid`. If None,
+            it will be built here
+
         """
         self.moving = moving
         self.fixed = fixed
@@ -568,9 +867,15 @@ class AffineOptimizer(object):
         else:
             self.mask = mask
 
-        self.pyramid_fixed = list(gaussian_pyramid(fixed, levels=self.nlevels))
-        self.pyramid_moving = list(gaussian_pyramid(moving, levels=self.nlevels))
-        self.pyramid_mask = list(gaussian_pyramid(self.mask, levels=self.nlevels))
+        if fixed_pyramid is None:
+            fixed_pyramid = self.get_pyramid(fixed)
+
+        if moving_pyramid is None:
+            moving_pyramid = self.get_pyramid(moving)
+
+        self.pyramid_fixed = fixed_pyramid
+        self.pyramid_moving = moving_pyramid
+        self.pyramid_mask = self.get_pyramid(self.mask)
         if self.transformation == "EuclideanTransform":
             self.p = np.zeros(3)
         else:
@@ -600,7 +905,8 @@ class AffineOptimizer(object):
 
         return self.cost_fxn(self.pyramid_fixed[self.current_level], transformed, self.pyramid_mask[self.current_level])
 
-    def align(self, moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None):
+    def align(self, moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None,
+              moving_pyramid=None, fixed_pyramid=None):
         """Align images by minimizing self.cost_fxn. Aligns each level of the Gaussian pyramid, and uses previous transform
         as the initial guess in the next round of optimization. Also uses other "good" estimates to define the
         parameter boundaries.
@@ -625,6 +931,12 @@ class AffineOptimizer(object):
         fixed_xy : ndarray, optional
             (N, 2) array containing points in the fixed image that correspond to those in the moving image
 
+        moving_pyramid : list, optional
+            Gaussian pyramid of `moving`, created by `get_pyramid`
+
+        fixed_pyramid : list, optional
+            Gaussian pyramid of `fixed`, created by `get_pyramid`
+
         Returns
         -------
         aligned : (N,M) array
@@ -637,7 +949,7 @@ class AffineOptimizer(object):
 
         """
 
-        self.setup(moving, fixed, mask, initial_M)
+        self.setup(moving, fixed, mask, initial_M, moving_pyramid=moving_pyramid, fixed_pyramid=fixed_pyramid)
         method = self.optimization
         levels = range(self.nlevels-1, -1, -1)  # Iterate from top to bottom of pyramid
         cost_list = [None] * self.nlevels
@@ -729,10 +1041,12 @@ class AffineOptimizerMattesMI(AffineOptimizer):
         sitk.ElastixImageFilter object that will perform the optimization
 
     fixed_kp_fname : str
-        Name of file where to fixed_xy will be temporarily be written. Eventually deleted
+        Name of file where to fixed_xy will be temporarily be written. Eventually deleted.
+        Includes the process id, so that images can be aligned in parallel processes
 
     moving_kp_fname : str
-        Name of file where to moving_xy will be temporarily be written. Eventually deleted
+        Name of file where to moving_xy will be temporarily be written. Eventually deleted.
+        Includes the process id, so that images can be aligned in parallel processes
 
 
     Methods
@@ -752,6 +1066,7 @@ class AffineOptimizerMattesMI(AffineOptimizer):
     """
 
     accepts_xy = True
+    accepts_pyramids = False
 
     def __init__(self, nlevels=4.0, nbins=32,
                  optimization="AdaptiveStochasticGradientDescent", transform="EuclideanTransform"):
@@ -759,8 +1074,8 @@ class AffineOptimizerMattesMI(AffineOptimizer):
 
         self.Reg = None
         self.accepts_xy = AffineOptimizerMattesMI.accepts_xy
-        self.fixed_kp_fname = os.path.join(pathlib.Path(__file__).parent, ".fixedPointSet.pts")
-        self.moving_kp_fname = os.path.join(pathlib.Path(__file__).parent, ".movingPointSet.pts")
+        self.fixed_kp_fname = None
+        self.moving_kp_fname = None
 
     def cost_fxn(self, fixed_image, transformed, mask):
         return None
@@ -828,6 +1143,9 @@ class AffineOptimizerMattesMI(AffineOptimizer):
 
         rigid_map["Registration"] = ["MultiMetricMultiResolutionRegistration"]
         if moving_xy is not None and fixed_xy is not None:
+            kp_dir = pathlib.Path(__file__).parent
+            self.fixed_kp_fname = os.path.join(kp_dir, f".fixedPointSet.{os.getpid()}.pts")
+            self.moving_kp_fname = os.path.join(kp_dir, f".movingPointSet.{os.getpid()}.pts")
             self.write_elastix_kp(fixed_xy, self.fixed_kp_fname)
             self.write_elastix_kp(moving_xy, self.moving_kp_fname)
             current_metrics = rigid_map["Metric"]
@@ -922,11 +1240,318 @@ class AffineOptimizerMattesMI(AffineOptimizer):
 
             if len(tform_files) > 0:
                 for f in tform_files:
-                    os.remove(f)
+                    try:
+                        os.remove(f)
+                    except FileNotFoundError:
+                        # Already removed by another process
+                        pass
 
         return aligned, M, None
 
 
+class AffineOptimizerSampledMattesMI(AffineOptimizer):
+    """Optimize rigid registration by maximizing Mattes mutual information
+
+    AffineOptimizerSampledMattesMI is an AffineOptimizer subclass that doesn't require SimpleElastix.
+    Mattes mutual information is estimated using a random sample of pixels inside the mask, and B-spline
+    Parzen windows (Mattes et al. 2003). This makes it possible to calculate the gradient of the
+    mutual information with respect to the transformation parameters, which is used by a gradient based
+    optimizer, such as L-BFGS-B. The optimization proceeds from the top (lowest resolution) to
+    the bottom of the Gaussian pyramid.
+
+    Attributes
+    ----------
+    nlevels : int
+        Number of levels in the Gaussian pyramid
+
+    nbins : int
+        Number of bins to have in histograms used to estimate mutual information
+
+    optimization : str
+        Optimization method. Can be any method in scipy.optimize.minimize that uses the gradient
+
+    transformation : str
+        Type of transformation, "EuclideanTransform" or "SimilarityTransform"
+
+    n_samples : int
+        Maximum number of pixels sampled from each level of the pyramid
+
+    max_iter : int
+        Maximum number of iterations performed by the optimizer at each level of the pyramid
+
+    seed : int
+        Seed used to sample pixels, so that results are reproducible
+
+    Methods
+    -------
+    calc_cost_and_grad(p)
+        Calculates the negative mutual information, and its gradient, at the current level
+
+    align(moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None, moving_pyramid=None, fixed_pyramid=None)
+        Align images by maximizing the mutual information
+
+    Notes
+    -----
+    The transformation parameters are the rotation around the center of the fixed image,
+    the translation, and for SimilarityTransform, the log of the scale. The rotation and
+    log scale are multiplied by half the size of the fixed image, so that all parameters
+    are in units of pixels, and have similar effects on the positions of the pixels.
+
+    """
+
+    accepts_xy = False
+    accepts_pyramids = True
+
+    def __init__(self, nlevels=3, nbins=32, optimization="L-BFGS-B", transform="EuclideanTransform",
+                 n_samples=5000, max_iter=100, seed=0):
+        """
+        Parameters
+        ----------
+        nlevels : int
+            Number of levels in the Gaussian pyramid
+
+        nbins : int
+            Number of bins to have in histograms used to estimate mutual information
+
+        optimization : str
+            Optimization method. Can be any method in scipy.optimize.minimize that uses the gradient
+
+        transform : str
+            Type of transformation, "EuclideanTransform" or "SimilarityTransform"
+
+        n_samples : int
+            Maximum number of pixels sampled from each level of the pyramid
+
+        max_iter : int
+            Maximum number of iterations performed by the optimizer at each level of the pyramid
+
+        seed : int
+            Seed used to sample pixels, so that results are reproducible
+
+        """
+
+        super().__init__(nlevels, nbins, optimization, transform)
+        self.accepts_xy = AffineOptimizerSampledMattesMI.accepts_xy
+        self.n_samples = n_samples
+        self.max_iter = max_iter
+        self.seed = seed
+
+    def cost_fxn(self, fixed_image, transformed, mask):
+        if uint8_stats.is_uint8(fixed_image, transformed):
+            # Each pair of values only needs to be binned once
+            value_counts = uint8_stats.joint_histogram(fixed_image, transformed, mask)
+            fixed_vals, moving_vals = np.where(value_counts > 0)
+            if fixed_vals.size == 0:
+                return None
+
+            return -mattes_mutual_information(fixed_vals.astype(np.float32), moving_vals.astype(np.float32),
+                                              n_bins=self.nbins, weights=value_counts[fixed_vals, moving_vals])
+
+        in_mask = mask != 0
+        fixed_vals = fixed_image[in_mask].astype(np.float32)
+        moving_vals = transformed[in_mask].astype(np.float32)
+        if fixed_vals.size == 0:
+            return None
+
+        return -mattes_mutual_information(fixed_vals, moving_vals, n_bins=self.nbins)
+
+    def _get_level_coords(self, shape_list):
+        """Get scale and offset that convert each level's xy coordinates to those in the bottom level
+
+        Matches the sampling in `downsample2x`
+        """
+
+        scale = np.ones(2)
+        offset = np.zeros(2)
+        coords_list = [(scale.copy(), offset.copy())]
+        for shape_rc in shape_list[:-1]:
+            level_offset = np.array([(shape_rc[1] + 1) % 2, (shape_rc[0] + 1) % 2])/2
+            offset += scale*level_offset
+            scale *= 2
+            coords_list.append((scale.copy(), offset.copy()))
+
+        return coords_list
+
+    def _sample_level(self, level):
+        """Randomly sample pixels inside the mask
+        """
+
+        mask_r, mask_c = np.where(self.pyramid_mask[level] > 0)
+        n_samples = min(self.n_samples, len(mask_r))
+        rng = np.random.default_rng(self.seed)
+        sample_idx = rng.choice(len(mask_r), n_samples, replace=False)
+        sample_r = mask_r[sample_idx]
+        sample_c = mask_c[sample_idx]
+
+        fixed_scale, fixed_offset = self.fixed_level_coords[level]
+        sample_xy = np.dstack([sample_c, sample_r])[0]*fixed_scale + fixed_offset
+        self.sample_d_xy = (sample_xy - self.center_xy).astype(np.float32)
+        self.sample_fixed_vals = self.pyramid_fixed[level][sample_r, sample_c]
+        self.fixed_range = (self.sample_fixed_vals.min(), self.sample_fixed_vals.max())
+        self.moving_range = (self.pyramid_moving[level].min(), self.pyramid_moving[level].max())
+
+    def _get_A(self, p):
+        """Get linear part of the transformation, and its derivative with respect to the rotation
+        """
+
+        rotation = p[0]/self.param_scale
+        scale = np.exp(p[3]/self.param_scale) if len(p) > 3 else 1.0
+        cos_r = np.cos(rotation)
+        sin_r = np.sin(rotation)
+        A = scale*np.array([[cos_r, -sin_r], [sin_r, cos_r]])
+        dA_drotation = scale*np.array([[-sin_r, -cos_r], [cos_r, -sin_r]])
+
+        return A, dA_drotation
+
+    def params_to_M(self, p):
+        """Get transformation matrix that maps positions in the fixed image to the moving image
+        """
+
+        A, _ = self._get_A(p)
+        M = np.eye(3)
+        M[0:2, 0:2] = A
+        M[0:2, 2] = self.center_xy + p[1:3] - A @ self.center_xy
+
+        return M
+
+    def M_to_params(self, M):
+        """Get parameters of transformation matrix `M`
+        """
+
+        scale = np.sqrt(np.abs(np.linalg.det(M[0:2, 0:2])))
+        rotation = np.arctan2(M[1, 0], M[0, 0])
+        A = M[0:2, 0:2]
+        p = np.zeros(4 if self.transformation == "SimilarityTransform" else 3)
+        p[0] = rotation*self.param_scale
+        p[1:3] = M[0:2, 2] - self.center_xy + A @ self.center_xy
+        if len(p) > 3:
+            p[3] = np.log(scale)*self.param_scale
+
+        return p
+
+    def setup(self, moving, fixed, mask, initial_M=None, moving_pyramid=None, fixed_pyramid=None):
+        AffineOptimizer.setup(self, moving, fixed, mask, initial_M=None,
+                              moving_pyramid=moving_pyramid, fixed_pyramid=fixed_pyramid)
+
+        # Pyramids may be shared with other pairs, so create new lists
+        self.pyramid_fixed = [np.asarray(img, dtype=np.float32) for img in self.pyramid_fixed]
+        self.pyramid_moving = [np.asarray(img, dtype=np.float32) for img in self.pyramid_moving]
+
+        self.fixed_level_coords = self._get_level_coords([img.shape for img in self.pyramid_fixed])
+        self.moving_level_coords = self._get_level_coords([img.shape for img in self.pyramid_moving])
+        self.center_xy = (np.array(fixed.shape[0:2][::-1]) - 1)/2
+        self.param_scale = np.max(fixed.shape[0:2])/2
+
+        if initial_M is None:
+            initial_M = np.eye(3)
+
+        self.p = self.M_to_params(initial_M)
+
+    def calc_cost_and_grad(self, p):
+        """Cost function and gradient passed into scipy.optimize
+
+        Returns
+        -------
+        cost : float
+            Negative mutual information at the current level
+
+        grad : ndarray
+            Gradient of `cost` with respect to `p`
+
+        """
+
+        moving_img = self.pyramid_moving[self.current_level]
+        moving_scale, moving_offset = self.moving_level_coords[self.current_level]
+
+        A, dA_drotation = self._get_A(p)
+        warped_d_xy = self.sample_d_xy @ A.T.astype(np.float32)
+        moving_xy = (warped_d_xy + (self.center_xy + p[1:3] - moving_offset).astype(np.float32))/moving_scale.astype(np.float32)
+        moving_vals, moving_grad_xy, valid = sample_bilinear(moving_img, moving_xy)
+
+        # Need enough points in the image to estimate the histogram
+        if np.sum(valid) < self.nbins:
+            return 0.0, np.zeros_like(p)
+
+        mi, dmi_dvals = mattes_mutual_information(self.sample_fixed_vals[valid], moving_vals[valid],
+                                                  n_bins=self.nbins,
+                                                  fixed_range=self.fixed_range,
+                                                  moving_range=self.moving_range,
+                                                  return_grad=True)
+
+        # Chain rule: how each sampled value changes as the bottom level positions change
+        dmi_dxy = dmi_dvals[:, None]*moving_grad_xy[valid]/moving_scale.astype(np.float32)
+        grad = np.zeros_like(p)
+        grad[0] = np.sum(dmi_dxy*(self.sample_d_xy[valid] @ dA_drotation.T.astype(np.float32)))/self.param_scale
+        grad[1:3] = np.sum(dmi_dxy, axis=0)
+        if len(p) > 3:
+            grad[3] = np.sum(dmi_dxy*warped_d_xy[valid])/self.param_scale
+
+        return -mi, -grad
+
+    def calc_cost(self, p):
+        return self.calc_cost_and_grad(p)[0]
+
+    def align(self, moving, fixed, mask, initial_M=None, moving_xy=None, fixed_xy=None,
+              moving_pyramid=None, fixed_pyramid=None):
+        """Align images by maximizing the mutual information at each level of the Gaussian pyramid
+
+        Parameters
+        ----------
+        moving : ndarray
+            Image to warp to align with fixed
+
+        fixed : ndarray
+            Image moving is warped to align with
+
+        mask : ndarray
+            2D array having non-zero pixel values, where values of 0 are ignnored during registration
+
+        initial_M : (3x3) array
+            Initial transformation matrix
+
+        moving_xy, fixed_xy : ndarray, optional
+            Not used
+
+        moving_pyramid : list, optional
+            Gaussian pyramid of `moving`, created by `get_pyramid`
+
+        fixed_pyramid : list, optional
+            Gaussian pyramid of `fixed`, created by `get_pyramid`
+
+        Returns
+        -------
+        aligned : (N,M) array
+            Moving image warped to align with the fixed image
+
+        M : (3,3) array
+            Optimal transformation matrix
+
+        cost_list : list
+            list containing the minimized cost for each level in the pyramid
+
+        """
+
+        self.setup(moving, fixed, mask, initial_M, moving_pyramid=moving_pyramid, fixed_pyramid=fixed_pyramid)
+        cost_list = [None] * self.nlevels
+        for n in range(self.nlevels - 1, -1, -1):
+            self.current_level = n
+            if np.sum(self.pyramid_mask[n] > 0) < self.nbins:
+                # Too few pixels at this level to estimate the histogram
+                continue
+
+            self._sample_level(n)
+            res = optimize.minimize(self.calc_cost_and_grad, self.p, jac=True, method=self.optimization,
+                                    options={"maxiter": self.max_iter})
+
+            self.p = res.x
+            cost_list[n] = float(res.fun)
+
+        M = self.params_to_M(self.p)
+        aligned = transform.warp(self.moving, M, order=3)
+
+        return aligned, M, cost_list
+
+
 class AffineOptimizerRMI(AffineOptimizer):
     def __init__(self,  r=6, nlevels=1, nbins=256, optimization="Powell", transform="euclidean"):
         super().__init__(nlevels, nbins, optimization, transform)
@@ -1014,12 +1639,13 @@ class AffineOptimizerOffGrid(AffineOptimizer):
         super().__init__(nlevels, nbins, optimization, transform)
         self.spacing = spacing
 
-    def setup(self, moving, fixed, mask, initial_M=None):
-        AffineOptimizer.setup(self, moving, fixed, mask, initial_M)
+    def setup(self, moving, fixed, mask, initial_M=None, moving_pyramid=None, fixed_pyramid=None):
+        AffineOptimizer.setup(self, moving, fixed, mask, initial_M,
+                              moving_pyramid=moving_pyramid, fixed_pyramid=fixed_pyramid)
 
-        self.moving_interps = [self.get_interp(img)
+        self.moving_interps = [PYRAMID_CACHE.get(img, "interp", self.get_interp)
                                for img in self.pyramid_moving]
-        self.fixed_interps = [self.get_interp(img)
+        self.fixed_interps = [PYRAMID_CACHE.get(img, "interp", self.get_interp)
                               for img in self.pyramid_fixed]
 
         self.z_range = (min(np.min(self.moving[self.nlevels - 1]),
@@ -1055,7 +1681,7 @@ class AffineOptimizerOffGrid(AffineOptimizer):
         return (filtered_sr, filtered_sc)
 
     def get_interp(self, img):
-        return interpolate.RectBivariateSpline(np.arange(0, img.shape[0], dtype=np.float), np.arange(0, img.shape[1], dtype=np.float), img)
+        return interpolate.RectBivariateSpline(np.arange(0, img.shape[0], dtype=float), np.arange(0, img.shape[1], dtype=float), img)
 
     def interp_point(self, zr, zc, interp, z_range):
         z = np.array([interp(zr[i], zc[i])[0][0] for i in range(zr.size)])
@@ -14,6 +14,7 @@ import cv2
 from skimage import feature, exposure
 from skimage import color as skcolor
 import numpy as np
+import threading
 import traceback
 from kornia.feature import DISK, DeDoDe
 from . import valtils
@@ -31,6 +32,38 @@ MAX_FEATURES = 7500
 of features exceeds this value, the MAX_FEATURES features with the
 highest response will be returned."""
 
+SUPERPOINT_BATCH_SIZE = 4
+"""int: Maximum number of images SuperPoint will process in a single forward pass"""
+
+_SUPERPOINT_MODELS = {}
+_SUPERPOINT_MODEL_LOCK = threading.Lock()
+
+
+def get_superpoint_model(config):
+    """Get SuperPoint model, which is only loaded once per process
+
+    Parameters
+    ----------
+    config : dict
+        SuperPoint configuration, e.g. `SuperPointFD.config["superpoint"]`.
+        Should include the "device" the model will be on.
+
+    Returns
+    -------
+    model : superpoint.SuperPoint
+        SuperPoint model in evaluation mode
+
+    """
+
+    model_key = tuple(sorted(config.items()))
+    with _SUPERPOINT_MODEL_LOCK:
+        if model_key not in _SUPERPOINT_MODELS:
+            model = superpoint.SuperPoint(config).to(config["device"])
+            model.eval()
+            _SUPERPOINT_MODELS[model_key] = model
+
+    return _SUPERPOINT_MODELS[model_key]
+
 
 def filter_features(kp, desc, n_keep=MAX_FEATURES):
     """Get keypoints with highest response
@@ -84,13 +117,24 @@ class FeatureDD(object):
         kp_descriptor : str
             Name of keypoint descriptor
 
+        reflection_invariant : bool
+            Whether reflecting the image only reflects the keypoint
+            positions, leaving the descriptors unchanged. If True,
+            reflections can be checked by reflecting the keypoints, rather than
+            re-detecting features in reflected images.
+
     Methods
     -------
     detectAndCompute(image, mask=None)
         Detects and describes keypoints in image
 
+    detect_and_compute_batch(img_list, mask_list=None)
+        Detects and describes keypoints in each image in a list
+
     """
 
+    reflection_invariant = False
+
     def __init__(self, kp_detector=None, kp_descriptor=None, rgb=False, n_levels=1):
         """
         Parameters
@@ -200,6 +244,35 @@ class FeatureDD(object):
 
         return all_kp, all_desc
 
+    def detect_and_compute_batch(self, img_list, mask_list=None):
+        """Detect and describe the features in several images
+
+        Subclasses that can process several images at once (e.g. neural
+        networks) can override this method to do so. By default,
+        each image is processed separately.
+
+        Parameters
+        ----------
+        img_list : list
+            List of images in which features will be detected
+
+        mask_list : list, optional
+            List of masks, one per image in `img_list`
+
+        Returns
+        -------
+        kp_desc_list : list
+            List of (kp_pos_xy, desc) tuples, one per image in `img_list`
+
+        """
+
+        if mask_list is None:
+            mask_list = [None] * len(img_list)
+
+        kp_desc_list = [self.detect_and_compute(img, mask) for img, mask in zip(img_list, mask_list)]
+
+        return kp_desc_list
+
 # Thin wrappers around OpenCV detectors and descriptors #
 
 
@@ -431,7 +504,7 @@ class SuperPointFD(FeatureDD):
 
     """
 
-    def __init__(self, keypoint_threshold=0.005, nms_radius=4, force_cpu=False, kp_descriptor=None, kp_detector=None, *args, **kwargs):
+    def __init__(self, keypoint_threshold=0.005, nms_radius=4, force_cpu=False, kp_descriptor=None, kp_detector=None, batch_size=SUPERPOINT_BATCH_SIZE, *args, **kwargs):
 
         """
         Parameters
@@ -448,8 +521,14 @@ class SuperPointFD(FeatureDD):
 
         kp_descriptor : optional, OpenCV feature descriptor
 
+        batch_size : int
+            Maximum number of images processed in a single forward pass
+            by `detect_and_compute_batch`. Larger values may be faster,
+            but use more memory.
+
         """
         super().__init__(kp_detector=kp_detector, kp_descriptor=kp_descriptor, *args, **kwargs)
+        self.batch_size = batch_size
         self.keypoint_threshold = keypoint_threshold
         self.nms_radius = nms_radius
         self.device = 'cuda' if torch.cuda.is_available() and not force_cpu else "cpu"
@@ -492,28 +571,30 @@ class SuperPointFD(FeatureDD):
     def compute(self, img, kp_pos_xy):
 
         if self.kp_descriptor is None:
-            sp = superpoint.SuperPoint(self.config["superpoint"])
-
-            x = sp.relu(sp.conv1a(self.frame2tensor(img)))
-            x = sp.relu(sp.conv1b(x))
-            x = sp.pool(x)
-            x = sp.relu(sp.conv2a(x))
-            x = sp.relu(sp.conv2b(x))
-            x = sp.pool(x)
-            x = sp.relu(sp.conv3a(x))
-            x = sp.relu(sp.conv3b(x))
-            x = sp.pool(x)
-            x = sp.relu(sp.conv4a(x))
-            x = sp.relu(sp.conv4b(x))
-
-            cDa = sp.relu(sp.convDa(x))
-            descriptors = sp.convDb(cDa)
-            descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
-
-            descriptors = [superpoint.sample_descriptors(k[None], d[None], 8)[0]
-                    for k, d in zip([torch.from_numpy(kp_pos_xy.astype(np.float32))], descriptors)]
-
-            descriptors = descriptors[0].detach().numpy().T
+            sp = get_superpoint_model(self.config["superpoint"])
+
+            with torch.inference_mode():
+                x = sp.relu(sp.conv1a(self.frame2tensor(img)))
+                x = sp.relu(sp.conv1b(x))
+                x = sp.pool(x)
+                x = sp.relu(sp.conv2a(x))
+                x = sp.relu(sp.conv2b(x))
+                x = sp.pool(x)
+                x = sp.relu(sp.conv3a(x))
+                x = sp.relu(sp.conv3b(x))
+                x = sp.pool(x)
+                x = sp.relu(sp.conv4a(x))
+                x = sp.relu(sp.conv4b(x))
+
+                cDa = sp.relu(sp.convDa(x))
+                descriptors = sp.convDb(cDa)
+                descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
+
+                kp_tensor = torch.from_numpy(kp_pos_xy.astype(np.float32)).to(self.device)
+                descriptors = [superpoint.sample_descriptors(k[None], d[None], 8)[0]
+                        for k, d in zip([kp_tensor], descriptors)]
+
+            descriptors = descriptors[0].cpu().numpy().T
         else:
             kp = cv2.KeyPoint_convert(kp_pos_xy.tolist())
             kp, descriptors = self.kp_descriptor.compute(img, kp)
@@ -524,17 +605,36 @@ class SuperPointFD(FeatureDD):
 
         return descriptors
 
+    def _detect_and_compute_sg_batch(self, img_list):
+        """Detect and describe features using SuperPoint, batching images that have the same shape
+        """
+
+        sp = get_superpoint_model(self.config["superpoint"])
+        kp_desc_list = [None] * len(img_list)
+        shape_groups = {}
+        for i, img in enumerate(img_list):
+            shape_groups.setdefault(img.shape[0:2], []).append(i)
+
+        for group_idx in shape_groups.values():
+            for j in range(0, len(group_idx), self.batch_size):
+                batch_idx = group_idx[j:j + self.batch_size]
+                inp = torch.cat([self.frame2tensor(img_list[i]) for i in batch_idx])
+                with torch.inference_mode():
+                    pred = sp({'image': inp})
+
+                for k, i in enumerate(batch_idx):
+                    kp_pos_xy = pred['keypoints'][k].cpu().numpy()
+                    desc = pred['descriptors'][k].cpu().numpy().T
+                    kp_desc_list[i] = (kp_pos_xy, desc)
+
+        return kp_desc_list
+
     def detect_and_compute_sg(self, img):
-        inp = self.frame2tensor(img)
-        superpoint_obj = superpoint.SuperPoint(self.config.get('superpoint', {}))
-        pred = superpoint_obj({'image': inp})
-        pred = {**pred, **{k+'0': v for k, v in pred.items()}}
-        kp_pos_xy = pred['keypoints'][0].detach().numpy()
-        desc = pred['descriptors'][0].detach().numpy().T
+        kp_pos_xy, desc = self._detect_and_compute_sg_batch([img])[0]
 
         return kp_pos_xy, desc
 
-    def _detect_and_compute(self, img):
+    def _detect_and_compute(self, img, mask=None):
         if self.kp_detector is None and self.kp_descriptor is None:
             kp_pos_xy, desc = self.detect_and_compute_sg(img)
 
@@ -544,6 +644,20 @@ class SuperPointFD(FeatureDD):
 
         return kp_pos_xy, desc
 
+    def detect_and_compute_batch(self, img_list, mask_list=None):
+        """Detect and describe features in several images
+
+        When SuperPoint is used to both detect and describe features,
+        images with the same shape are processed together, `batch_size`
+        images per forward pass. Masks are ignored, as in `detect_and_compute`.
+
+        """
+
+        if self.kp_detector is not None or self.kp_descriptor is not None or self.n_levels > 1:
+            return super().detect_and_compute_batch(img_list, mask_list)
+
+        return self._detect_and_compute_sg_batch(img_list)
+
 
 class KorniaFD(FeatureDD):
     """
@@ -9,6 +9,7 @@ from copy import deepcopy
 from sklearn import metrics
 from sklearn.metrics.pairwise import pairwise_kernels
 from skimage import transform
+import threading
 import traceback
 
 from . import warp_tools, valtils, feature_detectors
@@ -58,6 +59,37 @@ DEFAULT_RANSAC = 7
 DEFAULT_FD = feature_detectors.VggFD
 ROTATION_ESTIMATOR_FD = feature_detectors.VggFD
 
+_SUPERGLUE_MODELS = {}
+_SUPERGLUE_MODEL_LOCK = threading.Lock()
+
+
+def get_superglue_model(config, device="cpu"):
+    """Get SuperGlue model, which is only loaded once per process
+
+    Parameters
+    ----------
+    config : dict
+        SuperGlue configuration, e.g. `SuperGlueMatcher.config["superglue"]`
+
+    device : str
+        Device the model will be on
+
+    Returns
+    -------
+    model : superglue.SuperGlue
+        SuperGlue model in evaluation mode
+
+    """
+
+    model_key = (tuple(sorted(config.items())), str(device))
+    with _SUPERGLUE_MODEL_LOCK:
+        if model_key not in _SUPERGLUE_MODELS:
+            model = superglue.SuperGlue(config).to(device)
+            model.eval()
+            _SUPERGLUE_MODELS[model_key] = model
+
+    return _SUPERGLUE_MODELS[model_key]
+
 def convert_distance_to_similarity(d, n_features=64):
     """
     Convert distance to similarity
@@ -343,7 +375,10 @@ def filter_matches(kp1_xy, kp2_xy, method=DEFAULT_MATCH_FILTER,
     filtered_src_points, filtered_dst_points, good_idx = filter_fxn(**all_matching_args)
 
     # Do additional filtering to remove other outliers that may have been missed by RANSAC
-    filtered_src_points, filtered_dst_points, good_idx = filter_matches_tukey(filtered_src_points, filtered_dst_points)
+    filtered_src_points, filtered_dst_points, tukey_idx = filter_matches_tukey(filtered_src_points, filtered_dst_points)
+    # Indices from Tukey filtering are relative to the points that passed the first filter
+    good_idx = np.asarray(good_idx)[tukey_idx]
+
     return filtered_src_points, filtered_dst_points, good_idx
 
 
@@ -1090,7 +1125,10 @@ class SuperGlueMatcher(Matcher):
             }
         }
 
-        self.sg_matcher = superglue.SuperGlue(self.config["superglue"])
+    @property
+    def sg_matcher(self):
+        """SuperGlue model, which is shared by all matchers with the same configuration"""
+        return get_superglue_model(self.config["superglue"], self.device)
 
     def frame2tensor(self, img):
         tensor = torch.from_numpy(img/255.).float()[None, None].to(self.device)
@@ -1099,30 +1137,31 @@ class SuperGlueMatcher(Matcher):
 
 
     def calc_scores(self, tensor_img, kp_xy):
-        sp = superpoint.SuperPoint(self.config["superpoint"])
-
-        x = sp.relu(sp.conv1a(tensor_img))
-        x = sp.relu(sp.conv1b(x))
-        x = sp.pool(x)
-        x = sp.relu(sp.conv2a(x))
-        x = sp.relu(sp.conv2b(x))
-        x = sp.pool(x)
-        x = sp.relu(sp.conv3a(x))
-        x = sp.relu(sp.conv3b(x))
-        x = sp.pool(x)
-        x = sp.relu(sp.conv4a(x))
-        x = sp.relu(sp.conv4b(x))
-
-        cPa = sp.relu(sp.convPa(x))
-        scores = sp.convPb(cPa)
-        scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
-        b, _, h, w = scores.shape
-        scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
-        scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
-        scores = superpoint.simple_nms(scores, sp.config['nms_radius'])
-        kp = [torch.from_numpy(kp_xy[:, ::-1].astype(int))]
-        scores = [s[tuple(k.t())] for s, k in zip(scores, kp)]
-        scores = scores[0].unsqueeze(dim=0)
+        sp = feature_detectors.get_superpoint_model(self.config["superpoint"])
+
+        with torch.inference_mode():
+            x = sp.relu(sp.conv1a(tensor_img))
+            x = sp.relu(sp.conv1b(x))
+            x = sp.pool(x)
+            x = sp.relu(sp.conv2a(x))
+            x = sp.relu(sp.conv2b(x))
+            x = sp.pool(x)
+            x = sp.relu(sp.conv3a(x))
+            x = sp.relu(sp.conv3b(x))
+            x = sp.pool(x)
+            x = sp.relu(sp.conv4a(x))
+            x = sp.relu(sp.conv4b(x))
+
+            cPa = sp.relu(sp.convPa(x))
+            scores = sp.convPb(cPa)
+            scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
+            b, _, h, w = scores.shape
+            scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
+            scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
+            scores = superpoint.simple_nms(scores, sp.config['nms_radius'])
+            kp = [torch.from_numpy(kp_xy[:, ::-1].astype(int)).to(self.device)]
+            scores = [s[tuple(k.t())] for s, k in zip(scores, kp)]
+            scores = scores[0].unsqueeze(dim=0)
 
         return scores
 
@@ -1135,9 +1174,9 @@ class SuperGlueMatcher(Matcher):
 
         inp = self.frame2tensor(img)
         scores = self.calc_scores(tensor_img=inp, kp_xy=kp_xy)
-        kp_xy_inp = torch.from_numpy(kp_xy[None, :].astype(np.float32))
+        kp_xy_inp = torch.from_numpy(kp_xy[None, :].astype(np.float32)).to(self.device)
 
-        desc_inp = torch.from_numpy(desc.T[None, :].astype(np.float32))
+        desc_inp = torch.from_numpy(desc.T[None, :].astype(np.float32)).to(self.device)
 
         n_kp = kp_xy.shape[0]
 
@@ -1178,9 +1217,10 @@ class SuperGlueMatcher(Matcher):
                 "scores1": scores2
                 }
 
-        sg_pred = self.sg_matcher(data)
+        with torch.inference_mode():
+            sg_pred = self.sg_matcher(data)
 
-        sg_pred = {k: v[0].detach().numpy() for k, v in sg_pred.items()}
+        sg_pred = {k: v[0].cpu().numpy() for k, v in sg_pred.items()}
         sg_pred.update(data)
 
         # Keep the matching keypoints and descriptors
@@ -0,0 +1,542 @@
+"""Store image features and matches on disk
+
+Features are saved in a columnar format, where each image has one
+contiguous array per column (keypoint positions, responses, and descriptors).
+Matches between two images are saved as (K, 2) arrays of indices into
+each image's features, so matched keypoints and descriptors don't need to be copied.
+Arrays are memory-mapped when loaded, and so only the rows that
+are used are read from disk.
+
+Each set of features has an id that is based on the image it was
+detected in, and the feature detector used. This means that if the same
+image is registered again with the same feature detector, the features can be
+loaded instead of being re-detected.
+
+"""
+
+import os
+import pathlib
+import hashlib
+import cv2
+import numpy as np
+
+from . import __version__
+from . import feature_detectors
+
+XY_COLUMN = "xy"
+"""str: Name of column containing the (N, 2) keypoint positions, in xy coordinates"""
+
+DESC_COLUMN = "desc"
+"""str: Name of column containing the (N, M) keypoint descriptors"""
+
+RESPONSE_COLUMN = "response"
+"""str: Name of column containing the (N) keypoint responses"""
+
+MATCHES_SUFFIX = "matches"
+"""str: Suffix of files containing match indices"""
+
+DEFAULT_MAX_STORE_GB = 2.0
+"""float: Default maximum size of the feature store, in gigabytes"""
+
+SETTING_MAX_DEPTH = 3
+"""int: Number of levels of an object's attributes included in its setting string"""
+
+
+def _get_cv2_params_str(algorithm):
+    """Get the parameters of an OpenCV algorithm, such as a feature detector
+
+    The parameters are those written by the algorithm's `write` method. If
+    the algorithm can't be written, the values returned by its getters are used.
+
+    """
+
+    fs = cv2.FileStorage(".yml", cv2.FILE_STORAGE_WRITE | cv2.FILE_STORAGE_MEMORY)
+    try:
+        algorithm.write(fs, "params")
+        yml_str = fs.releaseAndGetString()
+    except cv2.error:
+        fs.release()
+        yml_str = ""
+
+    # Keep the "key: value" lines written after the YAML header
+    yml_lines = yml_str.split("params:", 1)[-1].splitlines() if "params:" in yml_str else []
+    params_str = ", ".join(line.strip() for line in yml_lines if line.strip())
+    if len(params_str) == 0:
+        params = {}
+        for attr in dir(algorithm):
+            if not attr.startswith("get") or attr == "getDefaultName":
+                continue
+            try:
+                params[attr] = getattr(algorithm, attr)()
+            except Exception:
+                continue
+
+        params_str = get_setting_str(params)
+
+    return f"{algorithm.getDefaultName()}({params_str})"
+
+
+def get_setting_str(v, depth=0):
+    """Get string representation of a setting, which is the same each time the setting is used
+
+    Dictionaries are sorted by key, arrays are represented by a hash of their
+    values, and OpenCV algorithms by their parameters. Other objects are
+    represented by their class and public attributes, up to `SETTING_MAX_DEPTH`
+    levels deep.
+
+    """
+    if v is None or isinstance(v, (bool, int, float, str, np.generic)):
+        return repr(v)
+
+    if isinstance(v, dict):
+        return "{" + ", ".join(f"{k!r}: {get_setting_str(v[k], depth)}" for k in sorted(v, key=str)) + "}"
+
+    if isinstance(v, (list, tuple)):
+        return "[" + ", ".join(get_setting_str(x, depth) for x in v) + "]"
+
+    if isinstance(v, np.ndarray):
+        arr_hash = hashlib.sha1(np.ascontiguousarray(v).tobytes()).hexdigest()
+        return f"ndarray({v.shape}, {v.dtype.str}, {arr_hash})"
+
+    if hasattr(v, "getDefaultName") and hasattr(v, "write"):
+        # OpenCV algorithms, which the Python bindings don't expose as cv2.Algorithm subclasses
+        return _get_cv2_params_str(v)
+
+    if isinstance(v, type) or callable(v) and hasattr(v, "__qualname__"):
+        # Classes and functions
+        return f"{getattr(v, '__module__', '')}.{v.__qualname__}"
+
+    cls_name = f"{v.__class__.__module__}.{v.__class__.__qualname__}"
+    if depth >= SETTING_MAX_DEPTH or not hasattr(v, "__dict__"):
+        return cls_name
+
+    attr_dict = {k: x for k, x in vars(v).items() if not k.startswith("_")}
+
+    return f"{cls_name}({get_setting_str(attr_dict, depth + 1)})"
+
+
+def get_detector_signature(feature_detector):
+    """Get string that changes when the feature detector's settings change
+
+    Parameters
+    ----------
+    feature_detector : FeatureDD
+        FeatureDD object that detects and computes image features.
+
+    Returns
+    -------
+    signature : str
+        String containing the name of the feature detector, its
+        settings, the maximum number of features, and the version of VALIS
+
+    """
+
+    settings = [f"{k}={get_setting_str(v, depth=1)}" for k, v in sorted(vars(feature_detector).items())]
+    settings.append(f"MAX_FEATURES={feature_detectors.MAX_FEATURES}")
+    settings.append(f"version={__version__}")
+
+    signature = f"{feature_detector.__class__.__name__}({', '.join(settings)})"
+
+    return signature
+
+
+def get_feature_id(name, img, feature_detector):
+    """Get id of the features detected in an image
+
+    Parameters
+    ----------
+    name : str
+        Name of the image
+
+    img : ndarray
+        Image in which features will be detected
+
+    feature_detector : FeatureDD
+        FeatureDD object that detects and computes image features.
+
+    Returns
+    -------
+    feature_id : str
+        Id of the features, which changes if the image or feature
+        detector change.
+
+    """
+
+    sig = hashlib.sha1()
+    sig.update(str([img.shape, img.dtype.str]).encode())
+    sig.update(np.ascontiguousarray(img).tobytes())
+    sig.update(get_detector_signature(feature_detector).encode())
+    feature_id = f"{name}_{sig.hexdigest()[:16]}"
+
+    return feature_id
+
+
+class FeatureStore(object):
+    """Save and load features and matches in a directory
+
+    Attributes
+    ----------
+    store_dir : str
+        Directory where features and matches are saved
+
+    max_gb : float
+        Maximum size of all saved features and matches, in gigabytes
+
+    """
+
+    def __init__(self, store_dir, max_gb=DEFAULT_MAX_STORE_GB):
+        """
+        Parameters
+        ----------
+        store_dir : str
+            Directory where features and matches will be saved
+
+        max_gb : float
+            Maximum size of all saved features and matches, in gigabytes.
+            When the store is larger than this, the least recently used
+            features and matches are removed.
+
+        """
+
+        self.store_dir = store_dir
+        self.max_gb = max_gb
+        self._size_bytes = None
+
+    def _get_f(self, *parts):
+        return os.path.join(self.store_dir, "_".join(parts) + ".npy")
+
+    def _save_arrays(self, arr_dict):
+        """Save arrays, only replacing each file once it has been completely written
+
+        Saved in the order of `arr_dict`. Room is made for the arrays before
+        they are saved, so that they aren't removed right away.
+
+        """
+
+        arr_dict = {f: np.ascontiguousarray(arr) for f, arr in arr_dict.items()}
+        new_bytes = sum(arr.nbytes for arr in arr_dict.values())
+        self._make_room(new_bytes)
+
+        pathlib.Path(self.store_dir).mkdir(exist_ok=True, parents=True)
+        for f, arr in arr_dict.items():
+            tmp_f = f"{f}.{os.getpid()}.tmp"
+            with open(tmp_f, "wb") as f_out:
+                np.save(f_out, arr)
+
+            os.replace(tmp_f, f)
+
+        self._size_bytes += new_bytes
+
+    def _load_array(self, f):
+        """Memory-map array. Changes to the array are not written to disk
+        """
+        if not os.path.exists(f):
+            return None
+
+        return np.load(f, mmap_mode="c")
+
+    def _mark_used(self, f):
+        try:
+            os.utime(f)
+        except OSError:
+            pass
+
+    def _get_entries(self):
+        """Group saved files into entries that are added and removed together
+
+        Returns
+        -------
+        entries : dict
+            Key is the name of the entry, and the value is a list of
+            (last time used, size, filename) tuples. Each set of features
+            is one entry, and each set of matches is another.
+
+        """
+
+        if not os.path.exists(self.store_dir):
+            return {}
+
+        column_suffixes = tuple(f"_{c}.npy" for c in [XY_COLUMN, DESC_COLUMN, RESPONSE_COLUMN])
+        entries = {}
+        for entry in os.scandir(self.store_dir):
+            if not entry.name.endswith(".npy"):
+                continue
+
+            try:
+                f_stat = entry.stat()
+            except OSError:
+                continue
+
+            if entry.name.endswith(column_suffixes):
+                entry_name = entry.name[:entry.name.rfind("_")]
+            else:
+                entry_name = entry.name
+
+            entries.setdefault(entry_name, []).append((f_stat.st_mtime_ns, f_stat.st_size, entry.path))
+
+        return entries
+
+    def get_size_gb(self):
+        """Size of all saved features and matches, in gigabytes
+        """
+        self._size_bytes = sum(f_size for f_list in self._get_entries().values() for _, f_size, _ in f_list)
+
+        return self._size_bytes/(1024**3)
+
+    def _make_room(self, new_bytes):
+        if self._size_bytes is None:
+            self.get_size_gb()
+
+        max_bytes = self.max_gb*(1024**3)
+        if self._size_bytes + new_bytes > max_bytes:
+            self.remove_least_recently_used(max_gb=max(max_bytes - new_bytes, 0)/(1024**3))
+
+    def remove_least_recently_used(self, max_gb=None):
+        """Remove least recently used features and matches until the store is no larger than `max_gb`
+
+        Parameters
+        ----------
+        max_gb : float, optional
+            Size that the store should be reduced to, in gigabytes.
+            If None, `FeatureStore.max_gb` will be used.
+
+        """
+
+        if max_gb is None:
+            max_gb = self.max_gb
+
+        entries = self._get_entries()
+        entry_list = [(max(t for t, _, _ in f_list), sum(f_size for _, f_size, _ in f_list), f_list)
+                      for f_list in entries.values()]
+
+        max_bytes = max_gb*(1024**3)
+        total_bytes = sum(entry_size for _, entry_size, _ in entry_list)
+        for _, entry_size, f_list in sorted(entry_list, key=lambda x: x[0:2]):
+            if total_bytes <= max_bytes:
+                break
+
+            # Remove keypoint positions first, so that features are no longer considered saved
+            for _, _, f in sorted(f_list, key=lambda x: not x[2].endswith(f"_{XY_COLUMN}.npy")):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+            total_bytes -= entry_size
+
+        self._size_bytes = total_bytes
+
+    def clear(self):
+        """Remove all saved features and matches
+        """
+        self.remove_least_recently_used(max_gb=0)
+
+    def has_features(self, feature_id):
+        return os.path.exists(self._get_f(feature_id, XY_COLUMN)) and os.path.exists(self._get_f(feature_id, DESC_COLUMN))
+
+    def save_features(self, feature_id, kp_xy, desc, response=None):
+        """Save features
+
+        Parameters
+        ----------
+        feature_id : str
+            Id of the features. See `get_feature_id`
+
+        kp_xy : ndarray
+            (N, 2) array of keypoint positions, in xy coordinates
+
+        desc : ndarray
+            (N, M) array of descriptors for each keypoint
+
+        response : ndarray, optional
+            (N) array of the response of each keypoint
+
+        Returns
+        -------
+        kp_xy : ndarray
+            Memory-mapped keypoint positions
+
+        desc : ndarray
+            Memory-mapped descriptors
+
+        """
+
+        arr_dict = {}
+        if response is not None:
+            arr_dict[self._get_f(feature_id, RESPONSE_COLUMN)] = response
+
+        arr_dict[self._get_f(feature_id, DESC_COLUMN)] = desc
+        # Positions saved last, so that features are only considered saved once all columns are written
+        arr_dict[self._get_f(feature_id, XY_COLUMN)] = kp_xy
+        self._save_arrays(arr_dict)
+
+        return self.load_features(feature_id)
+
+    def load_features(self, feature_id):
+        """Load features
+
+        Returns
+        -------
+        kp_xy : ndarray
+            Memory-mapped (N, 2) array of keypoint positions. None
+            if the features have not been saved
+
+        desc : ndarray
+            Memory-mapped (N, M) array of descriptors. None
+            if the features have not been saved
+
+        """
+
+        if not self.has_features(feature_id):
+            return None, None
+
+        xy_f = self._get_f(feature_id, XY_COLUMN)
+        kp_xy = self._load_array(xy_f)
+        desc = self._load_array(self._get_f(feature_id, DESC_COLUMN))
+        self._mark_used(xy_f)
+
+        return kp_xy, desc
+
+    def load_response(self, feature_id):
+        """Load keypoint responses, or None if they were not saved
+        """
+        return self._load_array(self._get_f(feature_id, RESPONSE_COLUMN))
+
+    def detect_and_compute_batch(self, feature_detector, img_list, name_list):
+        """Get features for each image, only detecting those that have not been saved
+
+        Parameters
+        ----------
+        feature_detector : FeatureDD
+            FeatureDD object that detects and computes image features.
+
+        img_list : list
+            List of images in which features will be detected
+
+        name_list : list
+            Name of each image in `img_list`
+
+        Returns
+        -------
+        features_list : list
+            List of (feature_id, kp_xy, desc) tuples, one per image in `img_list`
+
+        """
+
+        feature_id_list = [get_feature_id(name, img, feature_detector) for name, img in zip(name_list, img_list)]
+        features_list = [(feature_id, *self.load_features(feature_id)) for feature_id in feature_id_list]
+        detect_idx = [i for i, (_, kp_xy, _) in enumerate(features_list) if kp_xy is None]
+        if len(detect_idx) > 0:
+            kp_desc_list = feature_detector.detect_and_compute_batch([img_list[i] for i in detect_idx])
+            for i, (kp_xy, desc) in zip(detect_idx, kp_desc_list):
+                feature_id = feature_id_list[i]
+                features_list[i] = (feature_id, *self.save_features(feature_id, kp_xy, desc))
+
+        return features_list
+
+    def detect_and_compute(self, feature_detector, img, name):
+        """Get features for an image, only detecting them if they have not been saved
+
+        Returns
+        -------
+        feature_id : str
+            Id of the features
+
+        kp_xy : ndarray
+            (N, 2) array of keypoint positions
+
+        desc : ndarray
+            (N, M) array of descriptors
+
+        """
+
+        return self.detect_and_compute_batch(feature_detector, [img], [name])[0]
+
+    def save_matches(self, feature_id1, feature_id2, match_idx):
+        """Save matches between two sets of features
+
+        Parameters
+        ----------
+        feature_id1 : str
+            Id of the first set of features
+
+        feature_id2 : str
+            Id of the second set of features
+
+        match_idx : ndarray
+            (K, 2) array, where each row contains the index of the
+            matched keypoint in `feature_id1`, and the index of the
+            corresponding keypoint in `feature_id2`
+
+        """
+
+        match_idx = np.asarray(match_idx, dtype=np.int64).reshape(-1, 2)
+        self._save_arrays({self._get_f(feature_id1, feature_id2, MATCHES_SUFFIX): match_idx})
+
+    def load_matches(self, feature_id1, feature_id2):
+        """Load matches between two sets of features
+
+        Returns
+        -------
+        match_idx : ndarray
+            (K, 2) array of indices of matched keypoints in `feature_id1` and `feature_id2`.
+            None if the matches have not been saved
+
+        """
+
+        match_f = self._get_f(feature_id1, feature_id2, MATCHES_SUFFIX)
+        match_idx = self._load_array(match_f)
+        if match_idx is None:
+            match_f = self._get_f(feature_id2, feature_id1, MATCHES_SUFFIX)
+            match_idx = self._load_array(match_f)
+            if match_idx is not None:
+                match_idx = match_idx[:, ::-1]
+
+        if match_idx is not None:
+            self._mark_used(match_f)
+
+        return match_idx
+
+    def get_matched_xy(self, feature_id1, feature_id2):
+        """Get positions of matched keypoints
+
+        Returns
+        -------
+        matched_xy1 : ndarray
+            (K, 2) positions of keypoints in `feature_id1` that have a match in `feature_id2`
+
+        matched_xy2 : ndarray
+            (K, 2) positions of the corresponding keypoints in `feature_id2`
+
+        """
+
+        match_idx = self.load_matches(feature_id1, feature_id2)
+        if match_idx is None:
+            return None, None
+
+        xy1, _ = self.load_features(feature_id1)
+        xy2, _ = self.load_features(feature_id2)
+
+        return xy1[match_idx[:, 0]], xy2[match_idx[:, 1]]
+
+    def get_matched_desc(self, feature_id1, feature_id2):
+        """Get descriptors of matched keypoints
+
+        Returns
+        -------
+        matched_desc1 : ndarray
+            Descriptors of keypoints in `feature_id1` that have a match in `feature_id2`
+
+        matched_desc2 : ndarray
+            Descriptors of the corresponding keypoints in `feature_id2`
+
+        """
+
+        match_idx = self.load_matches(feature_id1, feature_id2)
+        if match_idx is None:
+            return None, None
+
+        _, desc1 = self.load_features(feature_id1)
+        _, desc2 = self.load_features(feature_id2)
+
+        return desc1[match_idx[:, 0]], desc2[match_idx[:, 1]]
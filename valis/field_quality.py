@@ -0,0 +1,268 @@
+"""Functions to measure and repair the quality of displacement fields
+
+Folds are found using the determinant of the Jacobian of the transformation
+x -> x + d(x), which is calculated using finite differences. Where the
+determinant is not positive, the transformation is not invertible, i.e.
+the field folds the image over itself. Large fields are processed in
+chunks of rows, so the full Jacobian never needs to be in memory.
+
+"""
+
+import numpy as np
+import pyvips
+from scipy import ndimage, sparse
+from scipy.sparse import linalg as splinalg
+
+from . import warp_tools
+from . import valtils
+
+FOLD_THRESHOLD = 0.0
+"""float: Pixels where the determinant of the Jacobian is less than or equal to this value are considered folded"""
+
+CHUNK_ROWS = 1024
+"""int: Number of rows of the displacement field processed at a time"""
+
+FOLD_DILATION = 3
+"""int: Number of pixels folded regions are expanded by before being repaired"""
+
+REGULARIZE_WEIGHT = 0.05
+"""float: How much regularization preserves the original displacements in folded regions. Larger values preserve more of the original field"""
+
+REPAIR_MAX_ROUNDS = 5
+"""int: Maximum number of times to try to repair folds. The repaired area grows each round"""
+
+INPAINT_METHOD = "inpaint"
+"""str: Repair folds by replacing the displacements in folded regions with the smoothest (harmonic) displacements that match the surrounding field"""
+
+REGULARIZE_METHOD = "regularize"
+"""str: Repair folds by smoothing the displacements in folded regions, while staying close to the original displacements"""
+
+
+def _get_field_shape(dxdy):
+    if isinstance(dxdy, pyvips.Image):
+        return np.array([dxdy.height, dxdy.width])
+
+    return np.array(dxdy[0].shape[0:2])
+
+
+def _get_field_rows(dxdy, r0, r1):
+    """Get rows `r0` to `r1` of the displacement field as a (2, r1-r0, M) float32 array
+    """
+    if isinstance(dxdy, pyvips.Image):
+        rows = warp_tools.vips2numpy(dxdy, xywh=(0, r0, dxdy.width, r1 - r0))
+        return np.array([rows[..., 0], rows[..., 1]], dtype=np.float32)
+
+    return np.array([dxdy[0][r0:r1], dxdy[1][r0:r1]], dtype=np.float32)
+
+
+def _calc_jacobian_det(dxdy):
+    ddx_dy, ddx_dx = np.gradient(dxdy[0])
+    ddy_dy, ddy_dx = np.gradient(dxdy[1])
+
+    return (1 + ddx_dx)*(1 + ddy_dy) - ddx_dy*ddy_dx
+
+
+def get_jacobian_det(dxdy, chunk_rows=CHUNK_ROWS):
+    """Determinant of the Jacobian of the transformation defined by a displacement field
+
+    Parameters
+    ----------
+    dxdy : ndarray, list, pyvips.Image
+        (2, N, M) array, or list, of the x and y displacements,
+        or a pyvips.Image with 2 bands
+
+    chunk_rows : int
+        Number of rows processed at a time
+
+    Returns
+    -------
+    jac_det : ndarray
+        (N, M) array of the determinant of the Jacobian at each pixel.
+
+    """
+
+    shape_rc = _get_field_shape(dxdy)
+    jac_det = np.empty(shape_rc, dtype=np.float32)
+    for r0 in range(0, shape_rc[0], chunk_rows):
+        r1 = min(r0 + chunk_rows, shape_rc[0])
+
+        # Include neighboring rows so that finite differences at the edges of the chunk are correct
+        halo_r0 = max(r0 - 1, 0)
+        halo_r1 = min(r1 + 1, shape_rc[0])
+        chunk_dxdy = _get_field_rows(dxdy, halo_r0, halo_r1)
+        if chunk_dxdy.shape[1] == 1:
+            chunk_dxdy = np.concatenate([chunk_dxdy, chunk_dxdy], axis=1)
+
+        chunk_det = _calc_jacobian_det(chunk_dxdy)
+        jac_det[r0:r1] = chunk_det[r0 - halo_r0:r1 - halo_r0]
+
+    return jac_det
+
+
+def get_fold_mask(dxdy, threshold=FOLD_THRESHOLD, chunk_rows=CHUNK_ROWS):
+    """Find pixels where the displacement field folds
+
+    Returns
+    -------
+    fold_mask : ndarray
+        (N, M) boolean array, where True indicates a fold
+
+    """
+
+    return get_jacobian_det(dxdy, chunk_rows=chunk_rows) <= threshold
+
+
+def measure_folds(dxdy, threshold=FOLD_THRESHOLD, chunk_rows=CHUNK_ROWS):
+    """Summarize how much a displacement field folds
+
+    Returns
+    -------
+    folded_frac : float
+        Fraction of pixels where the field folds
+
+    min_det : float
+        Minimum determinant of the Jacobian
+
+    """
+
+    jac_det = get_jacobian_det(dxdy, chunk_rows=chunk_rows)
+    folded_frac = np.mean(jac_det <= threshold)
+    min_det = jac_det.min()
+
+    return folded_frac, min_det
+
+
+def _solve_region(dxdy, region_mask, smoothness_weight=0.0):
+    """Replace displacements inside `region_mask` by solving a sparse linear system
+
+    Displacements inside the region minimize the squared gradient of
+    the field, plus `smoothness_weight` times the squared difference from
+    the original displacements. The displacements around the region are used as
+    boundary conditions. If `smoothness_weight` is 0, the solution is harmonic.
+
+    """
+
+    region_shape_rc = region_mask.shape
+    n_px = np.sum(region_mask)
+    if smoothness_weight == 0 and n_px == region_mask.size:
+        # No boundary conditions, so the system is singular. The smoothest field is constant.
+        repaired = np.empty_like(dxdy)
+        repaired[:] = dxdy.reshape(dxdy.shape[0], -1).mean(axis=1, dtype=np.float64)[:, None, None]
+
+        return repaired
+
+    px_idx = np.full(region_shape_rc, -1, dtype=np.int64)
+    px_idx[region_mask] = np.arange(n_px)
+    px_r, px_c = np.where(region_mask)
+
+    degree = np.full(n_px, smoothness_weight, dtype=np.float64)
+    rhs = smoothness_weight*dxdy[:, px_r, px_c].T.astype(np.float64)
+    adj_rows = []
+    adj_cols = []
+    for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        nbr_r = px_r + dr
+        nbr_c = px_c + dc
+        in_bounds = (nbr_r >= 0) & (nbr_r < region_shape_rc[0]) & (nbr_c >= 0) & (nbr_c < region_shape_rc[1])
+        degree[in_bounds] += 1
+
+        nbr_idx = np.full(n_px, -1, dtype=np.int64)
+        nbr_idx[in_bounds] = px_idx[nbr_r[in_bounds], nbr_c[in_bounds]]
+
+        # Neighbors inside the region are unknown
+        is_unknown = nbr_idx >= 0
+        adj_rows.append(np.where(is_unknown)[0])
+        adj_cols.append(nbr_idx[is_unknown])
+
+        # Neighbors outside the region are boundary conditions
+        is_boundary = in_bounds & ~is_unknown
+        rhs[is_boundary] += dxdy[:, nbr_r[is_boundary], nbr_c[is_boundary]].T
+
+    adj_rows = np.hstack(adj_rows)
+    adj_cols = np.hstack(adj_cols)
+    A = sparse.csc_matrix((np.hstack([degree, -np.ones(len(adj_rows))]),
+                           (np.hstack([np.arange(n_px), adj_rows]), np.hstack([np.arange(n_px), adj_cols]))),
+                          shape=(n_px, n_px))
+
+    solved = splinalg.splu(A).solve(rhs)
+    repaired = dxdy.copy()
+    repaired[:, px_r, px_c] = solved.T
+
+    return repaired
+
+
+def remove_folds(dxdy, method=INPAINT_METHOD, threshold=FOLD_THRESHOLD, dilation=FOLD_DILATION,
+                 regularize_weight=REGULARIZE_WEIGHT, max_rounds=REPAIR_MAX_ROUNDS, chunk_rows=CHUNK_ROWS):
+    """Find and remove folds in a displacement field
+
+    Each folded region is repaired independently, by solving a sparse
+    linear system that only involves the pixels in and around it.
+    If folds remain, the repaired regions are expanded and repaired again.
+
+    Parameters
+    ----------
+    dxdy : ndarray, list
+        (2, N, M) array, or list, of the x and y displacements
+
+    method : str
+        `INPAINT_METHOD` will replace the displacements in folded regions with
+        the smoothest displacements that match the surrounding field.
+        `REGULARIZE_METHOD` will smooth the displacements in the folded regions,
+        but keep them close to the original displacements.
+
+    threshold : float
+        Pixels where the determinant of the Jacobian is less than or
+        equal to `threshold` are considered folded
+
+    dilation : int
+        Number of pixels folded regions are expanded by before being repaired.
+        Doubles each round.
+
+    regularize_weight : float
+        How much to preserve the original displacements when `method` is
+        `REGULARIZE_METHOD`. Larger values preserve more of the original field,
+        but may need more rounds to remove all folds.
+
+    max_rounds : int
+        Maximum number of times to try to repair folds
+
+    chunk_rows : int
+        Number of rows processed at a time when finding folds
+
+    Returns
+    -------
+    no_folds_dxdy : ndarray
+        (2, N, M) array of the x and y displacements after removing folds.
+
+    """
+
+    if method == REGULARIZE_METHOD:
+        smoothness_weight = regularize_weight
+    else:
+        smoothness_weight = 0.0
+
+    no_folds_dxdy = np.array(dxdy, dtype=np.float32)
+    shape_rc = no_folds_dxdy.shape[1:]
+    for i in range(max_rounds):
+        fold_mask = get_fold_mask(no_folds_dxdy, threshold=threshold, chunk_rows=chunk_rows)
+        if not fold_mask.any():
+            break
+
+        labeled, _ = ndimage.label(fold_mask)
+        for region_slice in ndimage.find_objects(labeled):
+            pad = dilation + 2
+            r0 = max(region_slice[0].start - pad, 0)
+            r1 = min(region_slice[0].stop + pad, shape_rc[0])
+            c0 = max(region_slice[1].start - pad, 0)
+            c1 = min(region_slice[1].stop + pad, shape_rc[1])
+
+            region_mask = ndimage.binary_dilation(fold_mask[r0:r1, c0:c1], iterations=dilation)
+            region_dxdy = no_folds_dxdy[:, r0:r1, c0:c1]
+            no_folds_dxdy[:, r0:r1, c0:c1] = _solve_region(region_dxdy, region_mask, smoothness_weight)
+
+        dilation *= 2
+    else:
+        folded_frac, _ = measure_folds(no_folds_dxdy, threshold=threshold, chunk_rows=chunk_rows)
+        if folded_frac > 0:
+            valtils.print_warning(f"{100*folded_frac:.3f}% of the displacement field is still folded after {max_rounds} rounds of repair")
+
+    return no_folds_dxdy
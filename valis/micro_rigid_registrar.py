@@ -4,18 +4,22 @@ import kornia
 import numpy as np
 from skimage import exposure, transform
 import multiprocessing
+import os
+import tempfile
+from time import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 from colorama import Fore
 from contextlib import suppress
 
 from . import feature_matcher
 from . import feature_detectors
 from . import preprocessing
+from . import slide_tools
 from . import warp_tools
 from . import valtils
 from . import viz
 
-from pqdm.threads import pqdm
-
 ROI_MASK = "mask"
 ROI_MATCHES = "matches"
 
@@ -30,6 +34,202 @@ DEFAULT_BF_PROCESSOR_KWARGS = {}
 DEFAULT_FLOURESCENCE_CLASS = preprocessing.ChannelGetter
 DEFAULT_FLOURESCENCE_PROCESSING_ARGS = {"channel": "dapi", "adaptive_eq": True}
 
+MIN_TILES_FOR_PROCESSES = 8
+"""int: Minimum number of tiles needed before tiles are processed and matched in a process pool"""
+
+_TILE_STATE = None
+"""dict: State shared by the tiles processed in a worker process. Set by `_init_tile_worker`"""
+
+
+def _save_roi_memmap(vips_img, roi_xywh, dst_f, tile_xywh=None):
+    """Render a region of a (lazy) pyvips.Image to a raw file that can be memory-mapped
+
+    Parameters
+    ----------
+    tile_xywh : list of ndarray, optional
+        xywh of the tiles, relative to the ROI, that should be rendered. Areas
+        outside of these tiles will be 0. If None, the whole ROI is rendered.
+
+    Returns
+    -------
+    memmap_info : tuple
+        The filename, numpy dtype, and shape needed to open the file as a `numpy.memmap`
+
+    """
+
+    roi = vips_img.extract_area(*roi_xywh)
+    if roi.bands > 1:
+        shape = (roi.height, roi.width, roi.bands)
+    else:
+        shape = (roi.height, roi.width)
+
+    np_dtype = slide_tools.VIPS_FORMAT_NUMPY_DTYPE[roi.format]
+    if tile_xywh is None:
+        roi.rawsave(dst_f)
+    else:
+        roi_mmap = np.memmap(dst_f, dtype=np_dtype, mode="w+", shape=shape)
+        for x, y, w, h in tile_xywh:
+            roi_mmap[y:y+h, x:x+w] = warp_tools.vips2numpy(roi, xywh=(x, y, w, h)).reshape((h, w, *shape[2:]))
+
+        roi_mmap.flush()
+        del roi_mmap
+
+    return dst_f, np_dtype, shape
+
+
+def _open_roi_memmap(memmap_info):
+    f, np_dtype, shape = memmap_info
+
+    return np.memmap(f, dtype=np_dtype, mode="r", shape=shape)
+
+
+def _uses_cuda(matcher):
+    """Determine if the matcher or its feature detector use CUDA, in which case they can't be used in forked processes
+    """
+    for obj in [matcher, matcher.feature_detector]:
+        device = getattr(obj, "device", None)
+        if device is not None and str(device).startswith("cuda"):
+            return True
+
+    return False
+
+
+def _norm_imgs(img_list):
+    _, target_processing_stats = preprocessing.collect_img_stats(img_list)
+
+    normed_list = [None] * len(img_list)
+    for i, img in enumerate(img_list):
+        try:
+            processed = preprocessing.norm_img_stats(img, target_processing_stats)
+        except ValueError:
+            processed = img
+
+        normed_list[i] = exposure.rescale_intensity(processed, out_range=(0, 255)).astype(np.uint8)
+
+    return normed_list
+
+
+def _init_tile_worker(tile_state):
+    """Open the memory-mapped ROI in a worker process
+    """
+
+    global _TILE_STATE
+    torch.set_num_threads(1)
+    _TILE_STATE = _open_tile_state(tile_state)
+
+
+def _open_tile_state(tile_state):
+    opened_state = dict(tile_state)
+    for k in ["moving", "fixed", "mask"]:
+        opened_state[k] = _open_roi_memmap(tile_state[k])
+
+    return opened_state
+
+
+def _match_tile_in_worker(tile_id):
+    return tile_id, _match_tile(tile_id, _TILE_STATE)
+
+
+def _get_tile_matches(future, tile_id):
+    """Get the matches found in a tile, treating tiles that could not be matched as having no matches
+    """
+
+    try:
+        _, tile_matches = future.result()
+    except Exception as e:
+        valtils.print_warning(f"Error processing or matching tile {tile_id}: {e}")
+        tile_matches = None
+
+    return tile_matches
+
+
+def _match_tile(tile_id, tile_state):
+    """Process, normalize, detect and match features in a tile of the ROI
+
+    Parameters
+    ----------
+    tile_id : int
+        Index of the tile's xywh in `tile_state["tile_xywh"]`
+
+    tile_state : dict
+        Contains the memory-mapped ROI of the moving and fixed images,
+        and the mask, as well as the processors and matcher.
+
+    Returns
+    -------
+    matched_xy : tuple of ndarray, None
+        Positions of the matched moving and fixed features, in the
+        coordinates of the full images. None if there were not
+        enough matches.
+
+    """
+
+    x, y, w, h = tile_state["tile_xywh"][tile_id]
+    if tile_state["mask"][y:y+h, x:x+w].max() == 0:
+        return None
+
+    matcher = tile_state["matcher"]
+    match_rgb = tile_state["match_rgb"]
+    tile_regions = [None] * 2
+    tile_processed = [None] * 2
+    for i, img_key in enumerate(["moving", "fixed"]):
+        region_np = np.array(tile_state[img_key][y:y+h, x:x+w])
+        tile_regions[i] = region_np
+        if match_rgb:
+            continue
+
+        processor_cls, processor_kwargs, src_f, series, reader = tile_state[f"{img_key}_processor"]
+        processor = processor_cls(region_np, src_f=src_f, level=0, series=series, reader=reader)
+        tile_processed[i] = processor.process_image(**processor_kwargs)
+
+    if not match_rgb:
+        moving_normed, fixed_normed = _norm_imgs(img_list=tile_processed)
+    else:
+        moving_normed, fixed_normed = tile_regions
+
+    try:
+
+        feature_store = tile_state["feature_store"]
+        if feature_store is not None:
+            # Load features if this tile has already been matched, e.g. when re-running registration
+            tile_names = [f"{name}_tile_{x}_{y}" for name in tile_state["names"]]
+            (moving_id, moving_kp, moving_desc), (fixed_id, fixed_kp, fixed_desc) = \
+                feature_store.detect_and_compute_batch(matcher.feature_detector, [moving_normed, fixed_normed], tile_names)
+        else:
+            (moving_kp, moving_desc), (fixed_kp, fixed_desc) = matcher.feature_detector.detect_and_compute_batch([moving_normed, fixed_normed])
+
+        _, filtered_match_info12, _, _ = matcher.match_images(img1=moving_normed, desc1=moving_desc, kp1_xy=moving_kp,
+                                                              img2=fixed_normed,  desc2=fixed_desc,  kp2_xy=fixed_kp)
+
+        if feature_store is not None:
+            match_idx = np.column_stack([np.asarray(filtered_match_info12.matches12, dtype=int),
+                                         np.asarray(filtered_match_info12.matches21, dtype=int)])
+
+            feature_store.save_matches(moving_id, fixed_id, match_idx)
+
+        filtered_matched_moving_xy = filtered_match_info12.matched_kp1_xy
+        filtered_matched_fixed_xy = filtered_match_info12.matched_kp2_xy
+
+        if filtered_matched_moving_xy.shape[0] < 3:
+            return None
+
+        filtered_matched_moving_xy, filtered_matched_fixed_xy, _ = feature_matcher.filter_matches_tukey(filtered_matched_moving_xy, filtered_matched_fixed_xy, tform=transform.EuclideanTransform())
+        if filtered_matched_moving_xy.shape[0] < 3:
+            return None
+
+    except Exception as e:
+        valtils.print_warning(f"Error rigidly aligning tile {tile_id}: {e}")
+
+        return None
+
+    # Add tile and ROI offset to matched points
+    tile_offset = np.array([x, y]) + tile_state["roi_xywh"][0:2]
+    matched_moving_xy = filtered_matched_moving_xy + tile_offset
+    matched_fixed_xy = filtered_matched_fixed_xy + tile_offset
+
+    return matched_moving_xy, matched_fixed_xy
+
+
 class MicroRigidRegistrar(object):
     """Refine rigid registration using higher resolution images
 
@@ -69,6 +269,26 @@ class MicroRigidRegistrar(object):
         `roi=matches` will use the bounding box of the previously matched features to
         define the search area.
 
+    use_processes : bool
+        Whether tiles should be processed and matched in a process pool. If False
+        (the default), or if the matcher uses CUDA, the tiles will be matched using threads.
+
+    tmp_dir : str, optional
+        Directory in which the region of interest of each pair of warped slides
+        is saved, so that it can be memory-mapped. If None, the system's temporary
+        directory will be used.
+
+    max_tiles : int, optional
+        Maximum number of tiles to match for each pair of slides. Tiles are
+        planned using the mask and previously matched features, so the
+        tiles with the most tissue and features are matched first.
+        If None, all tiles containing tissue are matched.
+
+    time_budget : float, optional
+        Maximum number of seconds spent matching the tiles of each pair of slides.
+        Once exceeded, the remaining (least informative) tiles are skipped.
+        If None, all planned tiles are matched.
+
     iter_order : list of tuples
         Determines the order in which images are aligned. Goes from reference image to
         the edges of the stack.
@@ -77,7 +297,8 @@ class MicroRigidRegistrar(object):
 
     def __init__(self, val_obj, feature_detector_cls=None,
                  matcher=DEFAULT_MATCHER, processor_dict=None,
-                 scale=0.5**3, tile_wh=2**9, roi=DEFAULT_ROI):
+                 scale=0.5**3, tile_wh=2**9, roi=DEFAULT_ROI, use_processes=False, tmp_dir=None,
+                 max_tiles=None, time_budget=None):
         """
 
         Parameters
@@ -114,6 +335,28 @@ class MicroRigidRegistrar(object):
             `roi=matches` will use the bounding box around the matching features, which may
             be smaller than the registration mask.
 
+        use_processes : bool
+            Whether tiles should be processed and matched in a process pool. The
+            worker processes are forked, as the matcher's OpenCV objects can't be
+            pickled, which may deadlock or crash if the JVM, torch, or libvips have
+            already started threads. If False (the default), or if the matcher
+            uses CUDA, the tiles will be matched using threads.
+
+        tmp_dir : str, optional
+            Directory in which the region of interest of each pair of warped slides
+            is saved, so that it can be memory-mapped. If None, the system's temporary
+            directory will be used.
+
+        max_tiles : int, optional
+            Maximum number of tiles to match for each pair of slides. Tiles are
+            planned using the mask and previously matched features, so the
+            tiles with the most tissue and features are matched first.
+            If None, all tiles containing tissue are matched.
+
+        time_budget : float, optional
+            Maximum number of seconds spent matching the tiles of each pair of slides.
+            Once exceeded, the remaining (least informative) tiles are skipped.
+            If None, all planned tiles are matched.
 
         """
 
@@ -140,6 +383,10 @@ class MicroRigidRegistrar(object):
         self.scale = scale
         self.tile_wh = tile_wh
         self.roi = roi
+        self.use_processes = use_processes
+        self.tmp_dir = tmp_dir
+        self.max_tiles = max_tiles
+        self.time_budget = time_budget
         self.iter_order = warp_tools.get_alignment_indices(val_obj.size, val_obj.reference_img_idx)
 
     def create_mask(self, moving_slide, fixed_slide):
@@ -232,97 +479,81 @@ class MicroRigidRegistrar(object):
         reg_bbox = warp_tools.xy2bbox(small_reg_bbox*reg_s)
         slide_mask = warp_tools.resize_img(warp_tools.numpy2vips(mask), warp_tools.get_shape(fixed_img)[0:2], interp_method="nearest")
 
-        # Collect high rez matches
-        bbox_tiles = self.get_tiles(reg_bbox, self.tile_wh)
-        n_tiles = len(bbox_tiles)
-        high_rez_moving_match_xy_list = [None]*n_tiles
-        high_rez_fixed_match_xy_list = [None]*n_tiles
-
-        moving_processing_cls, moving_processing_kwargs = processor_dict[moving_slide.name]
-        fixed_processing_cls, fixed_processing_kwargs = processor_dict[fixed_slide.name]
-
-        match_rgb = self.matcher.feature_detector.rgb and moving_slide.is_rgb and fixed_slide.is_rgb
-        def _match_tile(bbox_id):
-            bbox_xy = bbox_tiles[bbox_id]
-
-            region_xywh = warp_tools.xy2bbox(bbox_xy)
-            region_mask = slide_mask.extract_area(*region_xywh)
-            if region_mask.max() == 0:
-
-                return None
-
-            moving_region, moving_processed, moving_bbox_xywh = self.process_roi(img=moving_img,
-                                                                            slide_obj=moving_slide,
-                                                                            xy=bbox_xy,
-                                                                            processor_cls=moving_processing_cls,
-                                                                            processor_kwargs=moving_processing_kwargs,
-                                                                            apply_mask=False,
-                                                                            scale=1.0,
-                                                                            return_rgb_only=match_rgb
-                                                                            )
-
-            fixed_region, fixed_processed, fixed_bbox_xywh = self.process_roi(img=fixed_img,
-                                                                            slide_obj=fixed_slide,
-                                                                            xy=bbox_xy,
-                                                                            processor_cls=fixed_processing_cls,
-                                                                            processor_kwargs=fixed_processing_kwargs,
-                                                                            apply_mask=False,
-                                                                            scale=1.0,
-                                                                            return_rgb_only=match_rgb
-                                                                            )
-
-
-            if not match_rgb:
-                moving_normed, fixed_normed = self.norm_imgs(img_list=[moving_processed, fixed_processed])
-
-            else:
-                moving_normed = moving_region
-                fixed_normed = fixed_region
-
-            try:
+        # Render the ROI of both warped slides once, so that tiles can be read from a memory-mapped array
+        img_wh = np.array(fixed_shape_rc[::-1])
+        roi_xy0 = np.clip(np.floor(reg_bbox[0:2]), 0, img_wh - 1).astype(int)
+        roi_xy1 = np.clip(np.ceil(reg_bbox[0:2] + reg_bbox[2:]), roi_xy0 + 1, img_wh).astype(int)
+        roi_xywh = np.array([*roi_xy0, *(roi_xy1 - roi_xy0)])
 
-                moving_kp, moving_desc = self.matcher.feature_detector.detect_and_compute(moving_normed)
-                fixed_kp, fixed_desc = self.matcher.feature_detector.detect_and_compute(fixed_normed)
+        bbox_tiles = self.get_tiles(np.array([0, 0, *roi_xywh[2:]]), self.tile_wh)
+        tile_xywh = [np.array([*np.floor(xy[0]), *np.ceil(xy[1] - np.floor(xy[0]))]).astype(int) for xy in bbox_tiles]
+        n_tiles = len(tile_xywh)
 
-                _, filtered_match_info12, _, _ = self.matcher.match_images(img1=moving_normed, desc1=moving_desc, kp1_xy=moving_kp,
-                                                                           img2=fixed_normed,  desc2=fixed_desc,  kp2_xy=fixed_kp)
-
-                filtered_matched_moving_xy = filtered_match_info12.matched_kp1_xy
-                filtered_matched_fixed_xy = filtered_match_info12.matched_kp2_xy
-                matched_moving_desc = filtered_match_info12.matched_desc1
-                matched_fixed_desc = filtered_match_info12.matched_desc2
-
-                if filtered_matched_moving_xy.shape[0] < 3:
-                    return None
-
-                filtered_matched_moving_xy, filtered_matched_fixed_xy, tukey_idx = feature_matcher.filter_matches_tukey(filtered_matched_moving_xy, filtered_matched_fixed_xy, tform=transform.EuclideanTransform())
-                matched_moving_desc = matched_moving_desc[tukey_idx, :]
-                matched_fixed_desc = matched_fixed_desc[tukey_idx, :]
-                if filtered_matched_moving_xy.shape[0] < 3:
-                    return None
-
-            except Exception as e:
-                valtils.print_warning(f"Error rigidly aligning tile {bbox_id}: {e}")
-
-                return None
+        # Plan tiles using the low resolution mask and matches, so that background tiles are never read
+        if moving_slide.xy_matched_to_prev is not None:
+            prev_matched_xy = warp_tools.warp_xy(moving_slide.xy_matched_to_prev, moving_slide.M)*reg_s
+        else:
+            prev_matched_xy = None
 
-            matched_moving_xy = filtered_matched_moving_xy.copy()
-            matched_fixed_xy = filtered_matched_fixed_xy.copy()
+        planned_tile_ids = warp_tools.plan_tiles(np.array(tile_xywh) + np.array([*roi_xywh[0:2], 0, 0]),
+                                                 shape_rc=fixed_shape_rc,
+                                                 mask=mask,
+                                                 feature_xy=prev_matched_xy,
+                                                 max_tiles=self.max_tiles)
 
-            # Add ROI offset to matched points
-            matched_moving_xy += moving_bbox_xywh[0:2]
-            matched_fixed_xy += fixed_bbox_xywh[0:2]
+        if len(planned_tile_ids) < n_tiles:
+            planned_tile_xywh = [tile_xywh[i] for i in planned_tile_ids]
+        else:
+            planned_tile_xywh = None
 
-            high_rez_moving_match_xy_list[bbox_id] = matched_moving_xy
-            high_rez_fixed_match_xy_list[bbox_id] = matched_fixed_xy
+        moving_processing_cls, moving_processing_kwargs = processor_dict[moving_slide.name]
+        fixed_processing_cls, fixed_processing_kwargs = processor_dict[fixed_slide.name]
 
+        match_rgb = self.matcher.feature_detector.rgb and moving_slide.is_rgb and fixed_slide.is_rgb
 
         print(f"Aligning {moving_slide.name} to {fixed_slide.name}. ROI width, height is {reg_bbox[2:]} pixels")
         n_cpu = valtils.get_ncpus_available() - 1
-
-        with suppress(UserWarning):
-            # Avoid printing warnings that not enough matches were found, which can happen frequently with this
-            res = pqdm(range(n_tiles), _match_tile, n_jobs=n_cpu)
+        high_rez_moving_match_xy_list = [None]*n_tiles
+        high_rez_fixed_match_xy_list = [None]*n_tiles
+        with tempfile.TemporaryDirectory(dir=self.tmp_dir) as roi_dir:
+            tile_state = {"moving": _save_roi_memmap(moving_img, roi_xywh, os.path.join(roi_dir, "moving.raw"), planned_tile_xywh),
+                          "fixed": _save_roi_memmap(fixed_img, roi_xywh, os.path.join(roi_dir, "fixed.raw"), planned_tile_xywh),
+                          "mask": _save_roi_memmap(slide_mask, roi_xywh, os.path.join(roi_dir, "mask.raw"), planned_tile_xywh),
+                          "roi_xywh": roi_xywh,
+                          "tile_xywh": tile_xywh,
+                          "matcher": self.matcher,
+                          "match_rgb": match_rgb,
+                          "names": (moving_slide.name, fixed_slide.name),
+                          "feature_store": self.val_obj.get_feature_store(),
+                          "moving_processor": (moving_processing_cls, moving_processing_kwargs, moving_slide.src_f, moving_slide.series, moving_slide.reader),
+                          "fixed_processor": (fixed_processing_cls, fixed_processing_kwargs, fixed_slide.src_f, fixed_slide.series, fixed_slide.reader)
+                          }
+
+            n_planned = len(planned_tile_ids)
+            use_processes = self.use_processes and n_cpu > 1 and n_planned >= MIN_TILES_FOR_PROCESSES and not _uses_cuda(self.matcher)
+            if use_processes:
+                executor = ProcessPoolExecutor(max_workers=n_cpu, initializer=_init_tile_worker, initargs=(tile_state, ))
+                match_tile = _match_tile_in_worker
+            else:
+                executor = ThreadPoolExecutor(max_workers=max(n_cpu, 1))
+                opened_tile_state = _open_tile_state(tile_state)
+                match_tile = lambda tile_id: (tile_id, _match_tile(tile_id, opened_tile_state))
+
+            start_time = time()
+            with suppress(UserWarning), executor:
+                # Avoid printing warnings that not enough matches were found, which can happen frequently with this
+                futures = {executor.submit(match_tile, tile_id): tile_id for tile_id in planned_tile_ids}
+                for f in tqdm(as_completed(futures), total=n_planned, unit="tile", leave=None):
+                    if self.time_budget is not None and time() - start_time > self.time_budget:
+                        n_cancelled = sum([f.cancel() for f in futures])
+                        valtils.print_warning(f"Exceeded time budget of {self.time_budget} seconds. Skipping {n_cancelled} tiles")
+                        break
+
+            res = [(tile_id, _get_tile_matches(f, tile_id)) for f, tile_id in futures.items() if not f.cancelled()]
+
+        for tile_id, tile_matches in res:
+            if tile_matches is not None:
+                high_rez_moving_match_xy_list[tile_id], high_rez_fixed_match_xy_list[tile_id] = tile_matches
 
         # Remove tiles that didn't have any matches
         high_rez_moving_match_xy_list = [xy for xy in high_rez_moving_match_xy_list if xy is not None]
@@ -419,18 +650,7 @@ class MicroRigidRegistrar(object):
         return tile_bbox_list
 
     def norm_imgs(self, img_list):
-        _, target_processing_stats = preprocessing.collect_img_stats(img_list)
-
-        normed_list = [None] * len(img_list)
-        for i, img in enumerate(img_list):
-            try:
-                processed = preprocessing.norm_img_stats(img, target_processing_stats)
-            except ValueError:
-                processed = img
-
-            normed_list[i] = exposure.rescale_intensity(processed, out_range=(0, 255)).astype(np.uint8)
-
-        return normed_list
+        return _norm_imgs(img_list)
 
     def process_roi(self, img, slide_obj, xy, processor_cls, processor_kwargs, apply_mask=True, scale=0.5, return_rgb_only=False):
         is_array = isinstance(img, np.ndarray)
@@ -6,7 +6,8 @@ from torchvision.models.optical_flow import raft_large, Raft_Large_Weights
 import torchvision.transforms as tv_transforms
 
 import os
-import pathlib
+import tempfile
+import threading
 import cv2
 import numpy as np
 import SimpleITK as sitk
@@ -19,6 +20,7 @@ from pqdm.threads import pqdm
 import inspect
 from . import viz
 from . import warp_tools
+from . import field_quality
 from . import preprocessing
 from . import valtils
 
@@ -40,6 +42,114 @@ NR_TILE_FIXED_P_KEY = f"{NR_FIXED}_{NR_PROCESSING_CLASS_KEY}"
 NR_TILE_FIXED_P_INIT_KW_KEY = f"{NR_FIXED}_{NR_PROCESSING_INIT_KW_KEY}"
 NR_TILE_FIXED_P_KW_KEY = f"{NR_FIXED}_{NR_PROCESSING_KW_KEY}"
 
+ELASTIX_SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+"""str: Directory in which temporary elastix work directories are created. Uses tmpfs when available,
+otherwise the system's default temporary directory"""
+
+_ELASTIX_FILTERS = threading.local()
+
+RAFT_TILE_WH = 1024
+"""int: Width and height of tiles used by RAFTWarper. Images larger than this are registered tile by tile"""
+
+RAFT_TILE_OVERLAP = 128
+"""int: Number of pixels by which RAFTWarper tiles overlap. Flows are blended in the overlapping regions"""
+
+RAFT_BATCH_SIZE = 2
+"""int: Number of tile pairs RAFTWarper passes through the model at once"""
+
+_RAFT_MODELS = {}
+_RAFT_MODEL_LOCK = threading.Lock()
+
+
+def get_elastix_scratch_dir():
+    """Create a temporary directory for a single elastix registration
+
+    Each registration gets its own directory, so several registrations can
+    be run at the same time without overwriting each other's files.
+
+    Returns
+    -------
+    scratch_dir : tempfile.TemporaryDirectory
+        Temporary directory, which is deleted when closed or used as a context manager
+
+    """
+
+    return tempfile.TemporaryDirectory(prefix="valis_elastix_", dir=ELASTIX_SCRATCH_DIR)
+
+
+def get_elastix_image_filter(out_dir):
+    """Get an ElastixImageFilter for the current thread
+
+    The filter is created once per thread with logging turned off, and
+    then re-used. Images, masks, and point sets from previous
+    registrations are removed.
+
+    Parameters
+    ----------
+    out_dir : str
+        Where elastix will write its files, such as the TransformParameters.
+
+    Returns
+    -------
+    elastix_image_filter_obj : sitk.ElastixImageFilter
+
+    """
+
+    elastix_image_filter_obj = getattr(_ELASTIX_FILTERS, "elastix_image_filter_obj", None)
+    if elastix_image_filter_obj is None:
+        elastix_image_filter_obj = sitk.ElastixImageFilter()
+        elastix_image_filter_obj.LogToConsoleOff()
+        elastix_image_filter_obj.LogToFileOff()
+        _ELASTIX_FILTERS.elastix_image_filter_obj = elastix_image_filter_obj
+    else:
+        elastix_image_filter_obj.RemoveFixedMask()
+        elastix_image_filter_obj.RemoveMovingMask()
+        elastix_image_filter_obj.RemoveFixedPointSetFileName()
+        elastix_image_filter_obj.RemoveMovingPointSetFileName()
+
+    elastix_image_filter_obj.SetOutputDirectory(out_dir)
+
+    return elastix_image_filter_obj
+
+
+def get_raft_model(weights=Raft_Large_Weights.DEFAULT, device="cpu"):
+    """Get RAFT model, which is only loaded once per process
+
+    Parameters
+    ----------
+    weights : Raft_Large_Weights
+        Weights to use. See `torchvision.models.optical_flow.Raft_Large_Weights`
+
+    device : str
+        Device the model will be on
+
+    Returns
+    -------
+    model : torchvision.models.optical_flow.RAFT
+        RAFT model in evaluation mode
+
+    """
+
+    model_key = (weights, str(device))
+    with _RAFT_MODEL_LOCK:
+        if model_key not in _RAFT_MODELS:
+            model = raft_large(weights=weights, progress=False).to(device)
+            model.eval()
+            _RAFT_MODELS[model_key] = model
+
+    return _RAFT_MODELS[model_key]
+
+
+def get_transformix_image_filter(out_dir):
+    """Get a TransformixImageFilter that writes to `out_dir`, with logging turned off
+    """
+    transformixImageFilter = sitk.TransformixImageFilter()
+    transformixImageFilter.LogToConsoleOff()
+    transformixImageFilter.LogToFileOff()
+    transformixImageFilter.SetOutputDirectory(out_dir)
+
+    return transformixImageFilter
+
 
 # Abstract Classes #
 class NonRigidRegistrar(object):
@@ -123,8 +233,9 @@ class NonRigidRegistrar(object):
         self.shape = None
         self.grid_spacing = None
         self.method = None
-        self.warped_image = None
-        self.deformation_field_img = None
+        self.fields_only = False
+        self._warped_image = None
+        self._deformation_field_img = None
         self.backward_dx = None
         self.backward_dy = None
 
@@ -186,7 +297,43 @@ class NonRigidRegistrar(object):
 
         return mask
 
-    def register(self, moving_img, fixed_img, mask=None, **kwargs):
+    def get_warped_image(self):
+        if getattr(self, "_warped_image", None) is None and self._can_warp():
+            self._warped_image = warp_tools.warp_img(self.moving_img,
+                                                     bk_dxdy=[self.backward_dx, self.backward_dy])
+
+        return getattr(self, "_warped_image", None)
+
+    def set_warped_image(self, warped_image):
+        self._warped_image = warped_image
+
+    warped_image = property(fget=get_warped_image,
+                            fset=set_warped_image,
+                            doc="Registered copy of `moving_img`. Created when first accessed")
+
+    def get_deformation_field_img(self):
+        if getattr(self, "_deformation_field_img", None) is None and self._can_warp():
+            grid_img = self.get_grid_image(grid_spacing=16)
+            self._deformation_field_img = warp_tools.warp_img(grid_img,
+                                                              bk_dxdy=[self.backward_dx, self.backward_dy])
+
+        return getattr(self, "_deformation_field_img", None)
+
+    def set_deformation_field_img(self, deformation_field_img):
+        self._deformation_field_img = deformation_field_img
+
+    deformation_field_img = property(fget=get_deformation_field_img,
+                                     fset=set_deformation_field_img,
+                                     doc="Image showing deformation applied to a regular grid. Created when first accessed")
+
+    def _can_warp(self):
+        """Determine if there is a single moving image and displacement field that can be used to create the warped images
+        """
+        return self.moving_img is not None and \
+            self.backward_dx is not None and \
+            np.ndim(self.backward_dx) == 2
+
+    def register(self, moving_img, fixed_img, mask=None, fields_only=False, **kwargs):
         """
         Register images, warping moving_img to align with fixed_img
 
@@ -208,16 +355,25 @@ class NonRigidRegistrar(object):
             and 0 is background, which is ignnored during registration. If None,
             then all non-zero pixels in images will be used to create the mask.
 
+        fields_only : bool, optional
+            If True, only the displacement fields will be calculated, and
+            they will be stored as float32. The warped image and deformation
+            grid will be returned as None, but can still be accessed
+            through `warped_image` and `deformation_field_img`, which are
+            created when first accessed.
+
         **kwargs : dict, optional
             Additional keyword arguments passed to NonRigidRegistrar.calc
 
         Returns
         -------
         warped_img : ndarray
-            Moving image registered to align with fixed image.
+            Moving image registered to align with fixed image. None
+            if `fields_only` is True.
 
         warped_grid : ndarray
-            Image showing deformation applied to a regular grid.
+            Image showing deformation applied to a regular grid. None
+            if `fields_only` is True.
 
         bk_dxdy : ndarray
             (2, N, M) numpy array of pixel displacements in
@@ -234,6 +390,14 @@ class NonRigidRegistrar(object):
         self.shape = moving_shape
         self.moving_img = moving_img
         self.fixed_img = fixed_img
+        self.fields_only = fields_only
+        self._warped_image = None
+        self._deformation_field_img = None
+
+        if fields_only:
+            dxdy_dtype = np.float32
+        else:
+            dxdy_dtype = np.float64
 
         if mask is None:
             mask = np.full(self.shape, 255, dtype=np.uint8)
@@ -261,24 +425,21 @@ class NonRigidRegistrar(object):
                             mask=mask, **kwargs)
 
         if mask is not None:
-            bk_dx = np.zeros(self.shape)
-            bk_dx[min_r:max_r, min_c:max_c] = bk_dxdy[0]
-            bk_dx[self.mask == 0] = 0
-
-            bk_dy = np.zeros(self.shape)
-            bk_dy[min_r:max_r, min_c:max_c] = bk_dxdy[1]
-            bk_dy[self.mask == 0] = 0
-
-            bk_dxdy = np.array([bk_dx, bk_dy])
+            bk_dxdy_shape = (2, *self.shape)
+            full_bk_dxdy = np.zeros(bk_dxdy_shape, dtype=dxdy_dtype)
+            full_bk_dxdy[:, min_r:max_r, min_c:max_c] = bk_dxdy[0:2]
+            full_bk_dxdy[:, self.mask == 0] = 0
+            bk_dxdy = full_bk_dxdy
+        else:
+            bk_dxdy = np.asarray(bk_dxdy, dtype=dxdy_dtype)
 
-        warped_img, warp_grid = self.get_warped_img_and_grid(bk_dxdy)
+        self.backward_dx = bk_dxdy[0]
+        self.backward_dy = bk_dxdy[1]
 
-        self.backward_dx = bk_dxdy[..., 0]
-        self.backward_dy = bk_dxdy[..., 1]
-        self.deformation_field_img = warp_grid
-        self.warped_image = warped_img
+        if fields_only:
+            return None, None, bk_dxdy
 
-        return warped_img, warp_grid, bk_dxdy
+        return self.warped_image, self.deformation_field_img, bk_dxdy
 
     def get_grid_image(self, grid_spacing=None, thickness=1, grid_spacing_ratio=0.025):
         """Create an image of a regular grid.
@@ -424,7 +585,7 @@ class NonRigidRegistrarXY(NonRigidRegistrar):
         self.fixed_xy = None
 
     def register(self, moving_img, fixed_img, mask=None, moving_xy=None,
-                 fixed_xy=None, **kwargs):
+                 fixed_xy=None, fields_only=False, **kwargs):
         """Register images, warping moving_img to align with fixed_img
 
         Uses backwards transforms to register images (i.e. aligning
@@ -453,13 +614,19 @@ class NonRigidRegistrarXY(NonRigidRegistrar):
             (N, 2) array containing points in the `fixed_img` that correspond
             to those in the `moving_img`.
 
+        fields_only : bool, optional
+            If True, only calculate the displacement fields. See
+            `NonRigidRegistrar.register`
+
         Returns
         -------
         warped_img : ndarray
-            `moving_img` registered to align with `fixed_img`.
+            `moving_img` registered to align with `fixed_img`. None
+            if `fields_only` is True.
 
         warped_grid : ndarray
-            Image showing deformation applied to a regular grid.
+            Image showing deformation applied to a regular grid. None
+            if `fields_only` is True.
 
         bk_dxdy : ndarray
             (2, N, M) numpy array of pixel displacements in the
@@ -480,6 +647,7 @@ class NonRigidRegistrarXY(NonRigidRegistrar):
                                        mask=mask,
                                        moving_xy=moving_xy,
                                        fixed_xy=fixed_xy,
+                                       fields_only=fields_only,
                                        **kwargs)
 
         return warped_img, warp_grid, bk_dxdy
@@ -771,15 +939,13 @@ class SimpleElastixWarper(NonRigidRegistrarXY):
 
         """
 
-        argfile = open(fname, 'w')
         npts = kp.shape[0]
-        argfile.writelines(f"index\n{npts}\n")
-        for i in range(npts):
-            xy = kp[i]
-            argfile.writelines(f"{xy[0]} {xy[1]}\n")
+        kp_txt = "\n".join([f"{xy[0]} {xy[1]}" for xy in kp])
+        with open(fname, 'w') as argfile:
+            argfile.write(f"index\n{npts}\n{kp_txt}\n")
 
     def run_elastix(self, moving_img, fixed_img, moving_xy=None, fixed_xy=None,
-                    params=None, mask=None):
+                    params=None, mask=None, warp_grid=True):
 
         """Run SimpleElastix to register images.
 
@@ -808,17 +974,34 @@ class SimpleElastixWarper(NonRigidRegistrarXY):
             registration. If None, then all non-zero pixels in images
             will be used to create the mask.
 
+        warp_grid : bool, optional
+            Whether or not to use Transformix to warp an image of a regular grid.
+            If False, `warped_grid` will be None.
+
+        Note
+        ----
+        Files created by elastix (e.g. point sets and transform parameters) are
+        written to a temporary directory that is unique to each call (on tmpfs,
+        if available), so it is safe to run several registrations concurrently.
+        The ElastixImageFilter is re-used by calls made in the same thread.
+
         """
 
-        elastix_image_filter_obj = sitk.ElastixImageFilter()
+        with get_elastix_scratch_dir() as scratch_dir:
+            return self._run_elastix(scratch_dir, moving_img, fixed_img,
+                                     moving_xy=moving_xy, fixed_xy=fixed_xy,
+                                     params=params, mask=mask, warp_grid=warp_grid)
+
+    def _run_elastix(self, scratch_dir, moving_img, fixed_img, moving_xy=None, fixed_xy=None,
+                     params=None, mask=None, warp_grid=True):
+        """Run SimpleElastix, writing all files to `scratch_dir`
+        """
+        elastix_image_filter_obj = get_elastix_image_filter(scratch_dir)
 
         if moving_xy is not None and fixed_xy is not None:
 
-            rand_id = np.random.randint(0, 10000)
-            fixed_kp_fname = os.path.join(pathlib.Path(__file__).parent,
-                                          f".{rand_id}_fixedPointSet.pts")
-            moving_kp_fname = os.path.join(pathlib.Path(__file__).parent,
-                                           f".{rand_id}_.movingPointSet.pts")
+            fixed_kp_fname = os.path.join(scratch_dir, "fixedPointSet.pts")
+            moving_kp_fname = os.path.join(scratch_dir, "movingPointSet.pts")
 
             self.write_elastix_kp(fixed_xy, fixed_kp_fname)
             self.write_elastix_kp(moving_xy, moving_kp_fname)
@@ -862,7 +1045,7 @@ class SimpleElastixWarper(NonRigidRegistrarXY):
         elastix_image_filter_obj.Execute()
 
         # Get deformation field #
-        transformixImageFilter = sitk.TransformixImageFilter()
+        transformixImageFilter = get_transformix_image_filter(scratch_dir)
         transformixImageFilter.SetTransformParameterMap(elastix_image_filter_obj.GetTransformParameterMap())
         transformixImageFilter.ComputeDeformationFieldOn()
         transformixImageFilter.Execute()
@@ -873,26 +1056,14 @@ class SimpleElastixWarper(NonRigidRegistrarXY):
         resultImage = sitk.GetArrayFromImage(resultImage)
 
         # Get deformation grid #
-        grid_spacing = int(eval(params["FinalGridSpacingInPhysicalUnits"][0]))
-        grid_img = self.get_grid_image(grid_spacing=grid_spacing)
-        transformixImageFilter.SetMovingImage(sitk.GetImageFromArray(grid_img))
-        transformixImageFilter.Execute()
-        warped_grid = sitk.GetArrayFromImage(transformixImageFilter.GetResultImage())
-
-        if moving_xy is not None and fixed_xy is not None:
-            if os.path.exists(fixed_kp_fname):
-                os.remove(fixed_kp_fname)
-
-            if os.path.exists(moving_kp_fname):
-                os.remove(moving_kp_fname)
-
-        tform_files = [f for f in os.listdir(".")
-                    if f.startswith("TransformParameters.")
-                    and f.endswith(".txt")]
-
-        if len(tform_files) > 0:
-            for f in tform_files:
-                os.remove(f)
+        if warp_grid:
+            grid_spacing = int(eval(params["FinalGridSpacingInPhysicalUnits"][0]))
+            grid_img = self.get_grid_image(grid_spacing=grid_spacing)
+            transformixImageFilter.SetMovingImage(sitk.GetImageFromArray(grid_img))
+            transformixImageFilter.Execute()
+            warped_grid = sitk.GetArrayFromImage(transformixImageFilter.GetResultImage())
+        else:
+            warped_grid = None
 
         return resultImage, warped_grid, deformationField, elastix_image_filter_obj, transformixImageFilter
 
@@ -918,7 +1089,8 @@ class SimpleElastixWarper(NonRigidRegistrarXY):
             backward_transformixImageFilter = \
             self.run_elastix(moving_img, fixed_img,
                              moving_xy=moving_xy, fixed_xy=fixed_xy,
-                             params=self.params, mask=mask)
+                             params=self.params, mask=mask,
+                             warp_grid=False)
 
         # Record other params #
         self.grid_spacing = int(eval(self.params["FinalGridSpacingInPhysicalUnits"][0]))
@@ -951,20 +1123,16 @@ class OpticalFlowWarper(NonRigidRegistrar):
             Object that will perform dense optical flow.
 
         n_grid_pts : int
-            Number of gridpoints used to detect folds. Also the number
-            of gridpoints to use when regularizing he mesh when
-            `method` = "regularize".
+            Deprecated. Folds are now found using the Jacobian of
+            the displacement field at each pixel, so this isn't used.
 
         paint_size : int
-            Used to determine how much to resize the image to have
-            efficient inpainting. Larger values = longer processing time.
-            Only used if `smoothing_method` = "inpaint".
+            Deprecated. Folded regions are repaired at full resolution, so
+            this isn't used.
 
         fold_penalty : float
-            How much to penalize folding/stretching. Larger values will make
-            the deformation field more uniform, which may or may not be
-            desired, as too much can remove all displacements.
-            Only used if `smoothing_method` = "regularize"
+            Deprecated. See `field_quality.remove_folds` for how folded
+            regions are regularized.
 
         sigma_ratio : float
             Determines the amount of Gaussian smoothing, as
@@ -975,12 +1143,13 @@ class OpticalFlowWarper(NonRigidRegistrar):
             If "gauss", then a Gaussian blur will be applied to the
             deformation fields, using sigma defined by sigma_ratio.
 
-            If "inpaint", folded regions will be detected and removed.
-            Folded regions will then be removed using inpainting.
+            If "inpaint", folded regions will be detected and
+            replaced with the smoothest displacements that match the
+            surrounding field. See `field_quality.remove_folds`.
 
             If "regularize", folded regions will be detected and
-            regularized using the method fescribed in
-            "Foldover-free maps in 50 lines of code" Garanzha et al. 2021.
+            smoothed, while staying close to the original displacements.
+            See `field_quality.remove_folds`.
 
             If "None" then no smoothing will be applied.
 
@@ -1015,16 +1184,8 @@ class OpticalFlowWarper(NonRigidRegistrar):
             smooth_dy = filters.gaussian(backward_flow[1], sigma=sigma)
             backward_flow = np.array([smooth_dx, smooth_dy])
 
-        elif self.smoothing_method == "inpaint":
-            backward_flow = warp_tools.remove_folds_in_dxdy(backward_flow,
-                                                            n_grid_pts=self.n_grid_pts,
-                                                            paint_size=self.paint_size,
-                                                            method=self.smoothing_method)
-        elif self.smoothing_method == "regularize":
-            backward_flow = warp_tools.untangle(backward_flow,
-                                                n_grid_pts=self.n_grid_pts,
-                                                penalty=self.fold_penalty,
-                                                mask=self.mask)
+        elif self.smoothing_method in [field_quality.INPAINT_METHOD, field_quality.REGULARIZE_METHOD]:
+            backward_flow = field_quality.remove_folds(backward_flow, method=self.smoothing_method)
 
         return np.array(backward_flow)
 
@@ -1034,8 +1195,16 @@ class RAFTWarper(NonRigidRegistrar):
 
     Dense optical flow fields may not be diffeomorphic, and so
     this class provides options to smooth displacement fields.
+
+    Large images are split into overlapping tiles, which are passed
+    through the model in batches, and the flows are blended together
+    where the tiles overlap. Inference is done in `torch.inference_mode`,
+    and the model is only loaded once per process.
+
     """
-    def __init__(self, weights=Raft_Large_Weights.DEFAULT, transform_method="pad", device=None, rgb=True, quant_img=True, *args, **kwargs):
+    def __init__(self, weights=Raft_Large_Weights.DEFAULT, transform_method="pad", device=None, rgb=True, quant_img=True,
+                 tile_wh=RAFT_TILE_WH, tile_overlap=RAFT_TILE_OVERLAP, batch_size=RAFT_BATCH_SIZE,
+                 n_threads=None, *args, **kwargs):
         """
         Parameters
         ----------
@@ -1048,6 +1217,22 @@ class RAFTWarper(NonRigidRegistrar):
             "pad" will pad the image with 0s, "resize" will resize the image.
             These transformations are removed from the displacement fields
 
+        tile_wh : int, optional
+            Images with a width or height larger than `tile_wh` will be registered
+            tile by tile, which uses much less memory. If None, the whole
+            image will always be registered at once.
+
+        tile_overlap : int, optional
+            Number of pixels by which tiles overlap. Should be larger than the
+            expected displacements.
+
+        batch_size : int, optional
+            Number of tile pairs to pass through the model at the same time.
+
+        n_threads : int, optional
+            Number of threads torch should use. If None, torch's current setting
+            will be used.
+
         """
 
         super().__init__(rgb=rgb)
@@ -1059,14 +1244,23 @@ class RAFTWarper(NonRigidRegistrar):
         self.quant_img = quant_img
         self.weights = weights
         self.transform_method = transform_method
-        self.model = raft_large(weights=self.weights, progress=False).to(self.device)
-        self.model.eval()
+        self.tile_wh = tile_wh
+        self.tile_overlap = tile_overlap
+        self.batch_size = batch_size
+        self.n_threads = n_threads
 
-    def prep_img_for_raft(self, img, dim_div=8, method="pad"):
-        """
-        3 channels. Dimensions divisible by 8
+        # Load the model now, so it is ready when calc is called
+        get_raft_model(self.weights, self.device)
+
+    @property
+    def model(self):
+        """RAFT model, shared by all RAFTWarpers with the same weights and device
         """
+        return get_raft_model(self.weights, self.device)
 
+    def get_img3d(self, img):
+        """Convert image to the 3 channel image used by RAFT
+        """
         if img.ndim == 2:
             img3d = np.dstack(3*[img])
         else:
@@ -1076,6 +1270,14 @@ class RAFTWarper(NonRigidRegistrar):
             else:
                 img3d = img
 
+        return img3d
+
+    def prep_img_for_raft(self, img, dim_div=8, method="pad"):
+        """
+        3 channels. Dimensions divisible by 8
+        """
+
+        img3d = self.get_img3d(img)
         torch_img = tv_transforms.ToTensor()(img3d).unsqueeze(0)
 
         h, w = torch_img.shape[-2:]
@@ -1105,14 +1307,82 @@ class RAFTWarper(NonRigidRegistrar):
 
         return transformed_img, img_transform
 
-    def calc(self, moving_img, fixed_img, *args, **kwargs):
+    def get_tile_blending_weights(self, tile_wh):
+        """Weights that decrease linearly towards the edges of a tile, over `tile_overlap` pixels
+        """
+        ramp = np.minimum(np.arange(tile_wh) + 1, np.arange(tile_wh)[::-1] + 1)
+        ramp = np.clip(ramp/max(self.tile_overlap, 1), 0, 1).astype(np.float32)
+
+        return np.outer(ramp, ramp)
+
+    def get_tile_xy(self, img_shape_rc, tile_wh):
+        """Get position of the top left corner of each tile
+        """
+        step = max(tile_wh - self.tile_overlap, 8)
+        tile_xy = []
+        for dim_len in img_shape_rc[::-1]:
+            dim_pos = list(range(0, max(dim_len - tile_wh, 0) + 1, step))
+            if dim_pos[-1] + tile_wh < dim_len:
+                dim_pos.append(dim_len - tile_wh)
+            tile_xy.append(dim_pos)
+
+        tile_xy = [(x, y) for y in tile_xy[1] for x in tile_xy[0]]
+
+        return tile_xy
+
+    def calc_tiled(self, moving_img, fixed_img):
+        """Calculate flow tile by tile
+
+        Tiles overlap by `tile_overlap` pixels, and are blended together
+        using weights that decrease towards the edges of each tile.
+
+        """
+
+        dim_div = 8
+        tile_wh = int(dim_div*np.ceil(self.tile_wh/dim_div))
+        img_h, img_w = moving_img.shape[0:2]
+
+        # Pad so that image is at least as large as a tile
+        pad_h = max(tile_wh - img_h, 0)
+        pad_w = max(tile_wh - img_w, 0)
+        padding = [0, 0, pad_w, pad_h] # left, top, right and bottom
+        moving_t = tv_transforms.Pad(padding)(tv_transforms.ToTensor()(self.get_img3d(moving_img)).unsqueeze(0))
+        fixed_t = tv_transforms.Pad(padding)(tv_transforms.ToTensor()(self.get_img3d(fixed_img)).unsqueeze(0))
+        moving_t, fixed_t = self.weights.transforms()(moving_t, fixed_t)
+
+        padded_shape_rc = moving_t.shape[-2:]
+        tile_xy = self.get_tile_xy(padded_shape_rc, tile_wh)
+        tile_weights = self.get_tile_blending_weights(tile_wh)
+
+        flow_sum = np.zeros((2, *padded_shape_rc), dtype=np.float32)
+        weight_sum = np.zeros(padded_shape_rc, dtype=np.float32)
+        model = self.model
+        for batch_start in range(0, len(tile_xy), self.batch_size):
+            batch_xy = tile_xy[batch_start:batch_start + self.batch_size]
+            moving_batch = torch.cat([moving_t[..., y:y+tile_wh, x:x+tile_wh] for x, y in batch_xy])
+            fixed_batch = torch.cat([fixed_t[..., y:y+tile_wh, x:x+tile_wh] for x, y in batch_xy])
+
+            batch_flows = model(fixed_batch.to(self.device), moving_batch.to(self.device))[-1]
+            batch_flows = batch_flows.cpu().numpy()
+            for (x, y), tile_flow in zip(batch_xy, batch_flows):
+                flow_sum[:, y:y+tile_wh, x:x+tile_wh] += tile_weights*tile_flow
+                weight_sum[y:y+tile_wh, x:x+tile_wh] += tile_weights
+
+        backward_flow = flow_sum/weight_sum
+        backward_flow = backward_flow[:, 0:img_h, 0:img_w]
+
+        return backward_flow
+
+    def calc_whole(self, moving_img, fixed_img):
+        """Calculate flow using the whole image
+        """
         transformed_moving_img, moving_transform = self.prep_img_for_raft(moving_img, method=self.transform_method)
         transformed_fixed_img, fixed_transform = self.prep_img_for_raft(fixed_img, method=self.transform_method)
 
         transformed_moving_img, transformed_fixed_img = self.weights.transforms()(transformed_moving_img, transformed_fixed_img)
 
         list_of_flows = self.model(transformed_fixed_img.to(self.device), transformed_moving_img.to(self.device))
-        dxdy = list_of_flows[-1].squeeze(0).detach().numpy()
+        dxdy = list_of_flows[-1].squeeze(0).cpu().numpy()
 
         if self.transform_method == "pad" and len(moving_transform) == 4:
             # Remove padding
@@ -1130,6 +1400,22 @@ class RAFTWarper(NonRigidRegistrar):
 
         return backward_flow
 
+    def calc(self, moving_img, fixed_img, *args, **kwargs):
+        prev_n_threads = torch.get_num_threads()
+        if self.n_threads is not None:
+            torch.set_num_threads(self.n_threads)
+
+        try:
+            with torch.inference_mode():
+                if self.tile_wh is not None and np.max(moving_img.shape[0:2]) > self.tile_wh:
+                    backward_flow = self.calc_tiled(moving_img, fixed_img)
+                else:
+                    backward_flow = self.calc_whole(moving_img, fixed_img)
+        finally:
+            torch.set_num_threads(prev_n_threads)
+
+        return backward_flow
+
 
 class SimpleElastixGroupwiseWarper(NonRigidRegistrarGroupwise):
     """
@@ -1211,55 +1497,49 @@ class SimpleElastixGroupwiseWarper(NonRigidRegistrarGroupwise):
             vectorOfImages.push_back(sitk.GetImageFromArray(img))
 
         image = sitk.JoinSeries(vectorOfImages)
-        elastix_image_filter_obj = sitk.ElastixImageFilter()
-        elastix_image_filter_obj.SetFixedImage(image)
-        elastix_image_filter_obj.SetMovingImage(image)
-        elastix_image_filter_obj.SetParameterMap(self.params)
-
-        if mask is not None:
-            vectorOfMasks = sitk.VectorOfImage()
+        # Remove the scratch directory, which contains copies of all images, even if elastix fails
+        with get_elastix_scratch_dir() as scratch_dir:
+            elastix_image_filter_obj = get_elastix_image_filter(scratch_dir)
+            elastix_image_filter_obj.SetFixedImage(image)
+            elastix_image_filter_obj.SetMovingImage(image)
+            elastix_image_filter_obj.SetParameterMap(self.params)
+
+            if mask is not None:
+                vectorOfMasks = sitk.VectorOfImage()
+                for i in range(len(img_list)):
+                    vectorOfMasks.push_back(sitk.GetImageFromArray(mask))
+                mask3d = sitk.JoinSeries(vectorOfMasks)
+                elastix_image_filter_obj.SetFixedMask(mask3d)
+
+            elastix_image_filter_obj.Execute()
+
+            # Get warped images #
+            resultImage = elastix_image_filter_obj.GetResultImage()
+            resultImage = sitk.GetArrayFromImage(resultImage)
+
+            # Get deformation fields #
+            transformixImageFilter = get_transformix_image_filter(scratch_dir)
+            transformixImageFilter.SetTransformParameterMap(elastix_image_filter_obj.GetTransformParameterMap())
+            transformixImageFilter.SetMovingImage(image)
+            transformixImageFilter.ComputeDeformationFieldOn()
+            transformixImageFilter.Execute()
+            deformationField = sitk.GetArrayFromImage(transformixImageFilter.GetDeformationField())[..., 0:2]
+
+            # Get deformation grid #
+            grid_spacing = int(eval(self.params["FinalGridSpacingInPhysicalUnits"][0]))
+            self.elastix_params = self.params.asdict()
+            self.params = None  # Can't pickle SimpleITK.ParameterMap
+            grid_img = self.get_grid_image(grid_spacing=grid_spacing)
+            self.method = elastix_image_filter_obj.__class__.__name__
+
+            vectorOfGrids = sitk.VectorOfImage()
             for i in range(len(img_list)):
-                vectorOfMasks.push_back(sitk.GetImageFromArray(mask))
-            mask3d = sitk.JoinSeries(vectorOfMasks)
-            elastix_image_filter_obj.SetFixedMask(mask3d)
+                vectorOfGrids.push_back(sitk.GetImageFromArray(grid_img))
+            grid3d = sitk.JoinSeries(vectorOfGrids)
 
-        elastix_image_filter_obj.Execute()
-
-        # Get warped images #
-        resultImage = elastix_image_filter_obj.GetResultImage()
-        resultImage = sitk.GetArrayFromImage(resultImage)
-
-        # Get deformation fields #
-        transformixImageFilter = sitk.TransformixImageFilter()
-        transformixImageFilter.SetTransformParameterMap(elastix_image_filter_obj.GetTransformParameterMap())
-        transformixImageFilter.SetMovingImage(image)
-        transformixImageFilter.ComputeDeformationFieldOn()
-        transformixImageFilter.Execute()
-        deformationField = sitk.GetArrayFromImage(transformixImageFilter.GetDeformationField())[..., 0:2]
-
-        # Get deformation grid #
-        grid_spacing = int(eval(self.params["FinalGridSpacingInPhysicalUnits"][0]))
-        self.elastix_params = self.params.asdict()
-        self.params = None  # Can't pickle SimpleITK.ParameterMap
-        grid_img = self.get_grid_image(grid_spacing=grid_spacing)
-        self.method = elastix_image_filter_obj.__class__.__name__
-
-        vectorOfGrids = sitk.VectorOfImage()
-        for i in range(len(img_list)):
-            vectorOfGrids.push_back(sitk.GetImageFromArray(grid_img))
-        grid3d = sitk.JoinSeries(vectorOfGrids)
-
-        transformixImageFilter.SetMovingImage(grid3d)
-        transformixImageFilter.Execute()
-        warped_grid = sitk.GetArrayFromImage(transformixImageFilter.GetResultImage())
-
-        tform_files = [f for f in os.listdir(".")
-                    if f.startswith("TransformParameters.")
-                    and f.endswith(".txt")]
-
-        if len(tform_files) > 0:
-            for f in tform_files:
-                os.remove(f)
+            transformixImageFilter.SetMovingImage(grid3d)
+            transformixImageFilter.Execute()
+            warped_grid = sitk.GetArrayFromImage(transformixImageFilter.GetResultImage())
 
         deformationField = np.array([[deformationField[i][...,  0],
                                       deformationField[i][...,  1]]
@@ -1300,9 +1580,15 @@ class NonRigidTileRegistrar(object):
 
     fwd_dxdy : pyvips.Image
         Displacement field after stitching `fwd_dxdy_tiles` together
+
+    tile_idx : ndarray
+        Indices of the tiles that were registered, ordered from most to least
+        informative. Tiles without any foreground in the mask are not
+        registered, and have no displacement.
+
     """
 
-    def __init__(self, params=None, tile_wh=512, tile_buffer=100):
+    def __init__(self, params=None, tile_wh=512, tile_buffer=100, max_tiles=None):
         """
         Parameters
         ----------
@@ -1320,9 +1606,15 @@ class NonRigidTileRegistrar(object):
         tile_buffer : int
             The amount of overlap between each tile.
 
+        max_tiles : int, optional
+            Maximum number of tiles to register. Tiles are planned using the mask,
+            so that the tiles with the most foreground are registered. If None,
+            all tiles that have foreground in the mask will be registered.
+
         """
         self.tile_wh = tile_wh
         self.tile_buffer = tile_buffer
+        self.max_tiles = max_tiles
         self.params = params
 
         self.moving_img = None
@@ -1338,6 +1630,8 @@ class NonRigidTileRegistrar(object):
         self.fwd_dxdy_tiles = None
         self.fwd_dxdy = None
 
+        self.tile_idx = None
+
     def norm_img(self, img, stats, mask=None):
         normed_img = exposure.rescale_intensity(img, out_range=(0, 255)).astype(np.uint8)
         normed_img = preprocessing.norm_img_stats(img=normed_img, target_stats=stats, mask=mask)
@@ -1416,9 +1710,7 @@ class NonRigidTileRegistrar(object):
 
             if is_empty:
                 # Nothing to register
-                empty_dxdy = pyvips.Image.black(moving_tile.width, moving_tile.height, bands=2).cast("float")
-                self.bk_dxdy_tiles[tile_idx] = empty_dxdy
-                self.fwd_dxdy_tiles[tile_idx] = empty_dxdy
+                self.set_empty_tile(tile_idx)
 
                 return None
 
@@ -1456,7 +1748,7 @@ class NonRigidTileRegistrar(object):
             else:
                 # self.non_rigid_registrar_cls is already instantiated
                 tile_non_rigid_reg_obj = self.non_rigid_registrar_cls
-            _, _, bk_dxdy = tile_non_rigid_reg_obj.register(moving_normed, fixed_normed)
+            _, _, bk_dxdy = tile_non_rigid_reg_obj.register(moving_normed, fixed_normed, fields_only=True)
             fwd_dxdy = warp_tools.get_inverse_field(bk_dxdy)
 
             vips_tile_bk_dxdy = warp_tools.numpy2vips(np.dstack(bk_dxdy).astype(np.float32))
@@ -1465,6 +1757,32 @@ class NonRigidTileRegistrar(object):
             self.bk_dxdy_tiles[tile_idx] = vips_tile_bk_dxdy
             self.fwd_dxdy_tiles[tile_idx] = vips_tile_fwd_dxdy
 
+    def set_empty_tile(self, tile_idx):
+        """Set the displacement fields of a tile that isn't registered to 0
+        """
+        tile_w, tile_h = self.expanded_bboxes[tile_idx][2:]
+        empty_dxdy = pyvips.Image.black(tile_w, tile_h, bands=2).cast("float")
+        self.bk_dxdy_tiles[tile_idx] = empty_dxdy
+        self.fwd_dxdy_tiles[tile_idx] = empty_dxdy
+
+    def plan_tiles(self, tile_bboxes):
+        """Determine which tiles should be registered, without reading them
+
+        Returns
+        -------
+        tile_idx : ndarray
+            Indices of the tiles to register, ordered from most to least informative
+
+        """
+        if self.mask is None:
+            tile_idx = np.arange(len(tile_bboxes))
+            if self.max_tiles is not None:
+                tile_idx = tile_idx[:self.max_tiles]
+        else:
+            tile_idx = warp_tools.plan_tiles(tile_bboxes, self.shape, self.mask, max_tiles=self.max_tiles)
+
+        return tile_idx
+
     def calc(self, *args, **kwargs):
         """Cacluate displacement fields
         Each tile is registered and then stitched together
@@ -1474,8 +1792,12 @@ class NonRigidTileRegistrar(object):
 
         n_cpu = valtils.get_ncpus_available() - 1
 
+        skipped_tiles = np.setdiff1d(np.arange(self.n_tiles), self.tile_idx)
+        for i in skipped_tiles:
+            self.set_empty_tile(i)
+
         lock = multiprocessing.Lock()
-        args = [{"tile_idx":i, "lock":lock} for i in range(self.n_tiles)]
+        args = [{"tile_idx":i, "lock":lock} for i in self.tile_idx]
         res = pqdm(args, self.reg_tile, n_jobs=n_cpu, unit="image", leave=None, argument_type='kwargs')
 
         bk_dxdy = warp_tools.stitch_tiles(self.bk_dxdy_tiles, self.expanded_bboxes, self.n_rows, self.n_cols, self.tile_buffer)
@@ -1581,6 +1903,7 @@ class NonRigidTileRegistrar(object):
         self.expanded_bboxes = np.array([warp_tools.expand_bbox(bbox_xywh, self.tile_buffer, self.shape) for bbox_xywh in temp_tile_bboxes])
 
         self.n_tiles = len(temp_tile_bboxes)
+        self.tile_idx = self.plan_tiles(self.expanded_bboxes)
         self.bk_dxdy_tiles = [None] * self.n_tiles
         self.fwd_dxdy_tiles = [None] * self.n_tiles
         self.n_cols = len(np.unique(temp_tile_bboxes[:, 0]))
@@ -1,6 +1,9 @@
 """
 Collection of pre-processing methods for aligning images
 """
+import os
+import threading
+from collections import OrderedDict
 import torch
 import kornia
 
@@ -25,11 +28,25 @@ from shapely import ops
 import einops
 
 from . import slide_io
+from . import valtils
 from . import warp_tools
+from . import uint8_stats
 
 # DEFAULT_COLOR_STD_C = 0.01 # jzazbz
 DEFAULT_COLOR_STD_C = 0.2 # cam16-ucs
 
+TISSUE_MASK_MAX_DIM = 1024
+"""int: Images larger than this are downsampled before creating tissue masks, and the masks are then resized to the image's shape"""
+
+STAIN_MODEL_MAX_PX = 50000
+"""int: Maximum number of pixels sampled when finding the stain colors in a slide"""
+
+STAIN_MODEL_CACHE_SIZE = 32
+"""int: Maximum number of stain models kept in `STAIN_MODEL_CACHE`"""
+
+COLOUR_LOCK = threading.RLock()
+"""threading.RLock: Held while converting colors with the colour package, which changes a global domain-range scale during each conversion, and so isn't thread-safe"""
+
 
 class ImageProcesser(object):
     """Process images for registration
@@ -358,12 +375,123 @@ class BgColorDistance(ImageProcesser):
         return processed_img
 
 
+class StainModel(object):
+    """Stain colors found in a slide, used to deconvolve images of that slide
+
+    Attributes
+    ----------
+    stain_rgb : ndarray
+        (N, 3) array of the RGB (0-255) color of each stain
+
+    D : ndarray
+        Deconvolution matrix, created from `stain_rgb` using `stainmat2decon`
+
+    clusterer : MiniBatchKMeans
+        Clusterer fit to the pixels' colors. The cluster centers are in
+        the scaled JAB colorspace used for clustering.
+
+    n_colors : int
+        Number of color clusters
+
+    """
+
+    def __init__(self, stain_rgb, D, clusterer, n_colors):
+        self.stain_rgb = stain_rgb
+        self.D = D
+        self.clusterer = clusterer
+        self.n_colors = n_colors
+
+
+class StainModelCache(object):
+    """Cache of each slide's `StainModel`
+
+    Models are keyed by the slide's file, and the settings used to fit the model.
+    This way, once a model has been fit to a slide's thumbnail, larger
+    images and tiles of that slide can be deconvolved without clustering
+    their pixels again. Models can be fetched by several threads at once.
+    Once there are more than `max_size` models, the least recently used
+    model is removed.
+
+    """
+
+    def __init__(self, max_size=STAIN_MODEL_CACHE_SIZE):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of models to keep
+
+        """
+
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key, fxn):
+        """Get model, only fitting it if it hasn't been cached
+
+        Parameters
+        ----------
+        key : tuple
+            Key of the model. If None, the model is not cached
+
+        fxn : callable
+            Function, with no arguments, that fits and returns the model
+
+        """
+
+        if key is None:
+            return fxn()
+
+        with self._lock:
+            model = self._cache.get(key)
+            if model is not None:
+                self._cache.move_to_end(key)
+
+        if model is None:
+            model = fxn()
+            with self._lock:
+                model = self._cache.setdefault(key, model)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+
+        return model
+
+    def clear(self):
+        with self._lock:
+            self._cache = OrderedDict()
+
+
+STAIN_MODEL_CACHE = StainModelCache()
+"""StainModelCache: Stain models shared by all StainFlatteners"""
+
+
+def _sample_px(px, max_px=STAIN_MODEL_MAX_PX, seed=0):
+    """Randomly select at most `max_px` pixels (rows) from `px`
+    """
+    if max_px is None or len(px) <= max_px:
+        return px
+
+    rng = np.random.default_rng(seed)
+    sample_idx = np.sort(rng.choice(len(px), max_px, replace=False))
+
+    return px[sample_idx]
+
+
 class StainFlattener(ImageProcesser):
     def __init__(self, image, src_f, level, series, *args, **kwargs):
         super().__init__(image=image, src_f=src_f, level=level,
                          series=series, *args, **kwargs)
 
         self.n_colors = -1
+        self.stain_model = None
 
 
     def create_mask(self):
@@ -381,85 +509,126 @@ class StainFlattener(ImageProcesser):
 
         return tissue_mask
 
-    def process_image_with_mask(self, n_colors=100, q=95, max_colors=100):
-        fg_mask, _ = create_tissue_mask_from_rgb(self.image)
-        mean_bg_rgb = np.mean(self.image[fg_mask == 0], axis=0)
+    def cluster_colors(self, rgb, n_colors=100, max_colors=100):
+        """Cluster a random sample of the pixels' colors
 
-        # Get stain vectors
-        fg_rgb = self.image[fg_mask > 0]
-        fg_to_cluster = rgb2jab(fg_rgb)
+        Parameters
+        ----------
+        rgb : ndarray
+            (N, 3) array of RGB pixel values
+
+        Returns
+        -------
+        clusterer : MiniBatchKMeans
+            Clusterer fit to the pixels' colors
+
+        stain_rgb : ndarray
+            (n_colors, 3) array of the RGB (0-1) color of each cluster
+
+        """
+
+        to_cluster = rgb2jab(_sample_px(rgb))
 
         ss = StandardScaler()
-        x = ss.fit_transform(fg_to_cluster)
+        x = ss.fit_transform(to_cluster)
 
         if n_colors > 0:
-            self.n_colors = n_colors
             clusterer = MiniBatchKMeans(n_clusters=n_colors,
                                         reassignment_ratio=0,
                                         n_init=3)
             clusterer.fit(x)
         else:
-            k, clusterer = estimate_k(x, max_k=max_colors)
-            self.n_colors = k
+            n_colors, clusterer = estimate_k(x, max_k=max_colors)
 
-        self.clusterer = clusterer
         stain_rgb = jab2rgb(ss.inverse_transform(clusterer.cluster_centers_))
         stain_rgb = np.clip(stain_rgb, 0, 1)
 
-        stain_rgb = np.vstack([255*stain_rgb, mean_bg_rgb])
-        D = stainmat2decon(stain_rgb)
-        deconvolved = deconvolve_img(self.image, D)
-
-        eps = np.finfo("float").eps
-        d_flat = deconvolved.reshape(-1, deconvolved.shape[2])
-        dmax = np.percentile(d_flat, q, axis=0)
-        for i in range(deconvolved.shape[2]):
-            c_dmax  = dmax[i] + eps
-            deconvolved[..., i] = np.clip(deconvolved[..., i], 0, c_dmax)
-            deconvolved[..., i] /= c_dmax
+        return clusterer, stain_rgb
 
-        summary_img = deconvolved.mean(axis=2)
+    def fit_stain_model_with_mask(self, n_colors=100, max_colors=100):
+        """Fit `StainModel` to the foreground pixels, with the mean background color as an additional stain
+        """
+        fg_mask, _ = create_tissue_mask_from_rgb(self.image)
+        mean_bg_rgb = np.mean(self.image[fg_mask == 0], axis=0)
 
-        return summary_img
+        # Get stain vectors
+        clusterer, stain_rgb = self.cluster_colors(self.image[fg_mask > 0], n_colors=n_colors, max_colors=max_colors)
 
-    def process_image_all(self, n_colors=100, q=95, max_colors=100):
-        img_to_cluster = rgb2jab(self.image)
+        stain_rgb = np.vstack([255*stain_rgb, mean_bg_rgb])
+        D = stainmat2decon(stain_rgb)
 
-        ss = StandardScaler()
-        x = ss.fit_transform(img_to_cluster.reshape(-1, img_to_cluster.shape[2]))
-        if n_colors > 0:
-            self.n_colors = n_colors
-            clusterer = MiniBatchKMeans(n_clusters=n_colors,
-                                        reassignment_ratio=0,
-                                        n_init=3)
-            clusterer.fit(x)
-        else:
-            k, clusterer = estimate_k(x, max_k=max_colors)
-            self.n_colors = k
-            print(f"estimated {k} colors")
+        return StainModel(stain_rgb=stain_rgb, D=D, clusterer=clusterer, n_colors=clusterer.n_clusters)
 
-        self.clusterer = clusterer
-        stain_rgb = jab2rgb(ss.inverse_transform(clusterer.cluster_centers_))
-        stain_rgb = np.clip(stain_rgb, 0, 1)
+    def fit_stain_model_all(self, n_colors=100, max_colors=100):
+        """Fit `StainModel` to all pixels
+        """
+        clusterer, stain_rgb = self.cluster_colors(self.image.reshape(-1, self.image.shape[2]), n_colors=n_colors, max_colors=max_colors)
+        if n_colors <= 0:
+            print(f"estimated {clusterer.n_clusters} colors")
 
         stain_rgb = 255*stain_rgb
         stain_rgb = np.clip(stain_rgb, 0, 255)
         stain_rgb = np.unique(stain_rgb, axis=0)
         D = stainmat2decon(stain_rgb)
-        deconvolved = deconvolve_img(self.image, D)
 
-        d_flat = deconvolved.reshape(-1, deconvolved.shape[2])
-        dmax = np.percentile(d_flat, q, axis=0) + np.finfo("float").eps
-        for i in range(deconvolved.shape[2]):
+        return StainModel(stain_rgb=stain_rgb, D=D, clusterer=clusterer, n_colors=clusterer.n_clusters)
+
+    def get_stain_model(self, n_colors=100, max_colors=100, with_mask=True, reuse_model=True):
+        """Get `StainModel` for this slide
+
+        Parameters
+        ----------
+        reuse_model : bool
+            Whether or not to use the model already fit to another image of
+            the same slide, e.g. a thumbnail, if there is one. If False, a new
+            model is fit to this image.
+
+        """
+
+        if with_mask:
+            fit_fxn = lambda: self.fit_stain_model_with_mask(n_colors=n_colors, max_colors=max_colors)
+        else:
+            fit_fxn = lambda: self.fit_stain_model_all(n_colors=n_colors, max_colors=max_colors)
+
+        src_f_id = valtils.get_file_id(self.src_f)
+        if reuse_model and src_f_id is not None:
+            model_key = (src_f_id, self.series, with_mask, n_colors, max_colors)
+        else:
+            model_key = None
+
+        stain_model = STAIN_MODEL_CACHE.get(model_key, fit_fxn)
+        self.stain_model = stain_model
+        self.clusterer = stain_model.clusterer
+        self.n_colors = stain_model.n_colors
 
-            deconvolved[..., i] = np.clip(deconvolved[..., i], 0, dmax[i])
-            deconvolved[..., i] /= dmax[i]
+        return stain_model
+
+    def deconvolve(self, D, q=95):
+        """Deconvolve image, scale each stain's values, and then average the stains
+        """
+        od_flat = rgb2od(self.image).reshape(-1, self.image.shape[2]).astype(np.float32)
 
-        summary_img = deconvolved.mean(axis=2)
+        # Stains are along the first axis, so that each stain's values are contiguous
+        deconvolved = D.T.astype(np.float32) @ od_flat.T
+        dmax = (np.percentile(deconvolved, q, axis=1) + np.finfo("float").eps).astype(np.float32)
+        np.clip(deconvolved, 0, dmax[:, None], out=deconvolved)
+        deconvolved /= dmax[:, None]
+
+        summary_img = deconvolved.mean(axis=0, dtype=float).reshape(self.image.shape[0:2])
 
         return summary_img
 
-    def process_image(self, n_colors=100, q=95, with_mask=True, adaptive_eq=True, max_colors=100):
+    def process_image_with_mask(self, n_colors=100, q=95, max_colors=100, reuse_model=True):
+        stain_model = self.get_stain_model(n_colors=n_colors, max_colors=max_colors, with_mask=True, reuse_model=reuse_model)
+
+        return self.deconvolve(stain_model.D, q=q)
+
+    def process_image_all(self, n_colors=100, q=95, max_colors=100, reuse_model=True):
+        stain_model = self.get_stain_model(n_colors=n_colors, max_colors=max_colors, with_mask=False, reuse_model=reuse_model)
+
+        return self.deconvolve(stain_model.D, q=q)
+
+    def process_image(self, n_colors=100, q=95, with_mask=True, adaptive_eq=True, max_colors=100, reuse_model=True):
         """
         Parameters
         ----------
@@ -469,11 +638,19 @@ class StainFlattener(ImageProcesser):
 
         max_colors : int
             If `n_colors = -1`, this value sets the maximum number of color clusters
+
+        reuse_model : bool
+            Whether or not to reuse the stain colors found in another image
+            of the same slide. If True, the stain colors are only found once per
+            slide, using a random sample of at most `STAIN_MODEL_MAX_PX` pixels, and
+            larger images or tiles of that slide are deconvolved using those colors.
+            If False, the stain colors are found in each image.
+
         """
         if with_mask:
-            processed_img = self.process_image_with_mask(n_colors=n_colors, q=q, max_colors=max_colors)
+            processed_img = self.process_image_with_mask(n_colors=n_colors, q=q, max_colors=max_colors, reuse_model=reuse_model)
         else:
-            processed_img = self.process_image_all(n_colors=n_colors, q=q, max_colors=max_colors)
+            processed_img = self.process_image_all(n_colors=n_colors, q=q, max_colors=max_colors, reuse_model=reuse_model)
 
         if adaptive_eq:
             processed_img = exposure.equalize_adapthist(processed_img)
@@ -647,7 +824,7 @@ def standardize_colorfulness(img, c=DEFAULT_COLOR_STD_C, h=0):
     """
     # Convert to CAM16 #
     eps = np.finfo("float").eps
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         if 1 < img.max() <= 255 and np.issubdtype(img.dtype, np.integer):
             cam = colour.convert(img/255 + eps, 'sRGB', 'CAM16UCS')
         else:
@@ -658,7 +835,7 @@ def standardize_colorfulness(img, c=DEFAULT_COLOR_STD_C, h=0):
     hc = np.full_like(lum, h)
     new_a, new_b = cc * np.cos(hc), cc * np.sin(hc)
     new_cam = np.dstack([lum, new_a+eps, new_b+eps])
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         rgb2 = colour.convert(new_cam, 'CAM16UCS', 'sRGB')
         rgb2 -= eps
 
@@ -684,7 +861,7 @@ def get_luminosity(img, **kwargs):
 
     """
 
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         if 1 < img.max() <= 255 and np.issubdtype(img.dtype, np.integer):
             cam = colour.convert(img/255, 'sRGB', 'CAM16UCS')
         else:
@@ -695,7 +872,7 @@ def get_luminosity(img, **kwargs):
     return lum
 
 
-def calc_background_color_dist(img, brightness_q=0.99, mask=None, cspace="CAM16UCS"):
+def calc_background_color_dist(img, brightness_q=0.99, mask=None, cspace="CAM16UCS", cam=None):
     """Create mask that only covers tissue
 
     #. Find background pixel (most luminescent)
@@ -703,6 +880,12 @@ def calc_background_color_dist(img, brightness_q=0.99, mask=None, cspace="CAM16U
     #. Calculate distance between each pixel and background pixel
     #. Threshold on distance (i.e. higher distance = different color)
 
+    Parameters
+    ----------
+    cam : ndarray, optional
+        `img` already converted to `cspace`, e.g. using `rgb2jab`. If provided,
+        `img` isn't converted again
+
     Returns
     -------
     cam_d : float
@@ -712,11 +895,12 @@ def calc_background_color_dist(img, brightness_q=0.99, mask=None, cspace="CAM16U
 
     """
     eps = np.finfo("float").eps
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
-        if 1 < img.max() <= 255 and np.issubdtype(img.dtype, np.integer):
-            cam = colour.convert(img/255 + eps, 'sRGB', cspace)
-        else:
-            cam = colour.convert(img + eps, 'sRGB', cspace)
+    if cam is None:
+        with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
+            if 1 < img.max() <= 255 and np.issubdtype(img.dtype, np.integer):
+                cam = colour.convert(img/255 + eps, 'sRGB', cspace)
+            else:
+                cam = colour.convert(img + eps, 'sRGB', cspace)
 
     if mask is None:
         brightest_thresh = np.quantile(cam[..., 0], brightness_q)
@@ -840,7 +1024,7 @@ def deconvolution_he(img: np.array, normalized_concentrations: np.array, stain:
 def rgb2jab(rgb, cspace='CAM16UCS'):
     eps = np.finfo("float").eps
     rgb01 = rgb255_to_rgb1(rgb)
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         jab = colour.convert(rgb01+eps, 'sRGB', cspace)
 
     return jab
@@ -848,12 +1032,19 @@ def rgb2jab(rgb, cspace='CAM16UCS'):
 
 def jab2rgb(jab, cspace='CAM16UCS'):
     eps = np.finfo("float").eps
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         rgb = colour.convert(jab+eps, cspace, 'sRGB')
 
     return rgb
 
 
+def jab2jch(jab):
+    with COLOUR_LOCK:
+        jch = colour.models.Jab_to_JCh(jab)
+
+    return jch
+
+
 def jch2rgb(jch, cspace="CAM16UCS", h_rotation=0):
     eps = np.finfo("float").eps
 
@@ -865,7 +1056,7 @@ def jch2rgb(jch, cspace="CAM16UCS", h_rotation=0):
 
     jab = np.dstack([jch[..., 0], a, b])
 
-    with colour.utilities.suppress_warnings(colour_usage_warnings=True):
+    with COLOUR_LOCK, colour.utilities.suppress_warnings(colour_usage_warnings=True):
         rgb = colour.convert(jab + eps, cspace, 'sRGB')
 
     rgb = np.clip(rgb, 0, 1)
@@ -876,7 +1067,7 @@ def jch2rgb(jch, cspace="CAM16UCS", h_rotation=0):
 
 def rgb2jch(rgb, cspace='CAM16UCS', h_rotation=0):
     jab = rgb2jab(rgb, cspace)
-    jch = colour.models.Jab_to_JCh(jab)
+    jch = jab2jch(jab)
     jch[..., 2] += h_rotation
 
     above_360 = np.where(jch[..., 2] > 360)
@@ -896,6 +1087,12 @@ def rgb255_to_rgb1(rgb_img):
 
 
 def rgb2od(rgb_img):
+    if uint8_stats.is_uint8(rgb_img):
+        # Only 256 possible values, so look up each value's OD
+        od_lut = rgb2od(np.arange(uint8_stats.N_VALUES, dtype=float))
+
+        return od_lut[rgb_img]
+
     eps = np.finfo("float").eps
     rgb01 = rgb255_to_rgb1(rgb_img)
 
@@ -1015,6 +1212,11 @@ def calc_shannon(img, n_bins=10, mask=None):
 
     """
 
+    if uint8_stats.is_uint8(img):
+        uint8_res = _calc_uint8_shannon(img, n_bins=n_bins, mask=mask)
+        if uint8_res is not None:
+            return uint8_res
+
     img01 = exposure.rescale_intensity(img, out_range=(0, 1))
     if img.ndim > 2:
         img01 = img01.reshape(-1, img.shape[2])
@@ -1054,6 +1256,49 @@ def calc_shannon(img, n_bins=10, mask=None):
     return ent_img, prob_img
 
 
+def _calc_uint8_shannon(img, n_bins=10, mask=None):
+    """Calculate Shannon's entropy for each pixel in a uint8 image
+
+    Each of the 256 values is binned once, and then
+    the number of pixels in each bin is counted. Returns
+    None if this isn't possible, in which case `calc_shannon`
+    bins each pixel.
+
+    """
+
+    n_channels = img.shape[2] if img.ndim > 2 else 1
+    if n_bins**n_channels > uint8_stats.N_VALUES**3:
+        return None
+
+    img_min, img_max = uint8_stats.value_range(uint8_stats.histogram(img))
+    if img_min == img_max:
+        return None
+
+    # Same binning as rescaling to 0-1, and then rounding
+    vals01 = (np.arange(uint8_stats.N_VALUES) - img_min)/(img_max - img_min)
+    bin_lut = np.round(np.clip(vals01, 0, 1)*(n_bins-1)).astype(int)
+    binned_img = bin_lut[img]
+    if img.ndim > 2:
+        # Each combination of channel bins gets its own index
+        binned_img = np.dot(binned_img, n_bins**np.arange(n_channels))
+
+    if mask is None:
+        counts = np.bincount(binned_img.reshape(-1), minlength=n_bins**n_channels)
+    else:
+        counts = np.bincount(binned_img[mask > 0], minlength=n_bins**n_channels)
+
+    probs = counts/counts.sum()
+    prob_img = probs[binned_img]
+    if mask is not None:
+        prob_img[mask == 0] = 0
+
+    ent_img = np.zeros_like(prob_img)
+    fg_idx = prob_img > 0
+    ent_img[fg_idx] = -np.log(prob_img[fg_idx])
+
+    return ent_img, prob_img
+
+
 def find_elbow(x, y):
     m = (y[-1] - y[0]) / (x[-1] - x[0])
     c = y[0]
@@ -1083,13 +1328,22 @@ def thresh_unimodal(x, bins=256):
     :return:
     """
     # Threshold unimodal distribution
-    skew = stats.skew(x)
+    if uint8_stats.is_uint8(x):
+        # Bin each of the 256 possible values, weighted by how often they occur
+        value_counts = uint8_stats.histogram(x)
+        vals = np.where(value_counts > 0)[0]
+        skew = uint8_stats.skew(value_counts)
+        hist_x, hist_weights = vals, value_counts[vals]
+    else:
+        skew = stats.skew(x)
+        hist_x, hist_weights = x, None
+
     # Find line from peak to tail
     if skew >= 0:
-        counts, bin_edges = np.histogram(x, bins=bins)
+        counts, bin_edges = np.histogram(hist_x, bins=bins, weights=hist_weights)
     else:
         # Tail is to the left, so reverse values to use this method, which assumes tail is on the right
-        counts, bin_edges = np.histogram(-x, bins=bins)
+        counts, bin_edges = np.histogram(-hist_x, bins=bins, weights=hist_weights)
 
     bin_width = bin_edges[1] - bin_edges[0]
     midpoints = bin_edges[0:-1] + bin_width/2
@@ -1235,7 +1489,12 @@ def combine_masks_by_hysteresis(mask_list, upper_t=None):
 
     if upper_t is None:
         upper_t = len(mask_list)
-    hyst_mask = 255*filters.apply_hysteresis_threshold(to_hyst_mask, 0.5, upper_t - 0.5).astype(np.uint8)
+
+    # Same as `filters.apply_hysteresis_threshold(to_hyst_mask, 0.5, upper_t - 0.5)`
+    n_labels, labeled_mask, _ = _label_mask(to_hyst_mask > 0.5, connectivity=4)
+    keep = np.zeros(n_labels, dtype=bool)
+    keep[labeled_mask[to_hyst_mask > upper_t - 0.5]] = True
+    hyst_mask = _keep_labeled_regions(labeled_mask, keep)
 
     return hyst_mask
 
@@ -1379,7 +1638,144 @@ def create_edges_mask(labeled_img):
     return inner_mask, edges_mask
 
 
-def create_tissue_mask_from_rgb(img, brightness_q=0.99, kernel_size=3, gray_thresh=0.075, light_gray_thresh=0.875, dark_gray_thresh=0.7):
+def _label_mask(mask, connectivity=8):
+    """Label connected regions in a mask
+
+    Uses OpenCV, which releases the GIL, so masks can be labeled in
+    several threads at once.
+
+    Returns
+    -------
+    n_labels : int
+        Number of labels, including the background, which has label 0
+
+    labeled_mask : ndarray
+        Image where each region's pixels have that region's label
+
+    region_stats : ndarray
+        (n_labels, 5) array of each region's bounding box (x, y, w, h) and area.
+        Columns can be indexed using cv2.CC_STAT_LEFT, cv2.CC_STAT_AREA, etc...
+
+    """
+
+    fg = (np.asarray(mask) > 0).astype(np.uint8)
+    n_labels, labeled_mask, region_stats, _ = cv2.connectedComponentsWithStats(fg, connectivity=connectivity)
+
+    return n_labels, labeled_mask, region_stats
+
+
+def _keep_labeled_regions(labeled_mask, keep):
+    """Create mask of regions to keep
+
+    Parameters
+    ----------
+    labeled_mask : ndarray
+        Labeled image, from `_label_mask`
+
+    keep : ndarray
+        Boolean array, where keep[i] is whether or not to keep the region with label i
+
+    Returns
+    -------
+    mask : ndarray
+        Mask where kept regions are 255
+
+    """
+
+    keep_lut = np.where(keep, 255, 0).astype(np.uint8)
+    keep_lut[0] = 0
+
+    return keep_lut[labeled_mask]
+
+
+def fill_mask_holes(mask):
+    """Fill holes in a mask
+
+    Holes are background regions that are not connected to the image's border,
+    which is the same as `scipy.ndimage.binary_fill_holes`. Uses OpenCV's
+    flood fill, which releases the GIL.
+
+    """
+
+    fg = (np.asarray(mask) > 0).astype(np.uint8)
+    # Pad so that all background touching the border is connected to the top left corner
+    padded = cv2.copyMakeBorder(fg, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    flood_mask = np.zeros((padded.shape[0] + 2, padded.shape[1] + 2), dtype=np.uint8)
+    cv2.floodFill(padded, flood_mask, (0, 0), 2, flags=4)
+    filled_mask = 255*(padded[1:-1, 1:-1] != 2).astype(np.uint8)
+
+    return filled_mask
+
+
+def close_mask_on_border(mask):
+    """Close regions along the image's border
+
+    For each region touching the image's border, the gap along the border
+    between the region's first and last pixel is filled in. This means that
+    holes which are open to the image's border can be filled.
+
+    """
+
+    n_labels, labeled_mask, _ = _label_mask(mask)
+    closed_mask = 255*(np.asarray(mask) > 0).astype(np.uint8)
+    border_labels_list = [labeled_mask[0, :], labeled_mask[-1, :], labeled_mask[:, 0], labeled_mask[:, -1]]
+    border_mask_list = [closed_mask[0, :], closed_mask[-1, :], closed_mask[:, 0], closed_mask[:, -1]]
+    for border_labels, border_mask in zip(border_labels_list, border_mask_list):
+        border_idx = np.where(border_labels > 0)[0]
+        if len(border_idx) == 0:
+            continue
+
+        idx_labels = border_labels[border_idx]
+        first_idx = np.full(n_labels, len(border_labels))
+        last_idx = np.full(n_labels, -1)
+        np.minimum.at(first_idx, idx_labels, border_idx)
+        np.maximum.at(last_idx, idx_labels, border_idx)
+        on_border = last_idx >= 0
+
+        # Positions covered by at least 1 region's gap are filled in
+        n_covering = np.zeros(len(border_labels) + 1, dtype=int)
+        np.add.at(n_covering, first_idx[on_border], 1)
+        np.add.at(n_covering, last_idx[on_border] + 1, -1)
+        border_mask[np.cumsum(n_covering)[:-1] > 0] = 255
+
+    return closed_mask
+
+
+def _downsample_for_mask(img, max_dim=TISSUE_MASK_MAX_DIM):
+    """Downsample image so that its largest dimension is at most `max_dim`
+
+    Returns
+    -------
+    small_img : ndarray
+        Downsampled image, or `img` if it is already small enough
+
+    original_shape_rc : tuple
+        Shape of `img`, or None if it was not downsampled
+
+    """
+
+    original_shape_rc = img.shape[0:2]
+    if max_dim is None or np.max(original_shape_rc) <= max_dim:
+        return img, None
+
+    s = max_dim/np.max(original_shape_rc)
+    small_wh = tuple(max(1, int(round(s*d))) for d in original_shape_rc[::-1])
+    small_img = cv2.resize(img, small_wh, interpolation=cv2.INTER_AREA)
+
+    return small_img, original_shape_rc
+
+
+def _upsample_mask(mask, original_shape_rc):
+    """Resize mask created from a downsampled image to the original image's shape
+    """
+
+    if original_shape_rc is None:
+        return mask
+
+    return cv2.resize(mask, tuple(original_shape_rc[::-1]), interpolation=cv2.INTER_NEAREST)
+
+
+def create_tissue_mask_from_rgb(img, brightness_q=0.99, kernel_size=3, gray_thresh=0.075, light_gray_thresh=0.875, dark_gray_thresh=0.7, max_dim=TISSUE_MASK_MAX_DIM):
     """Create mask that only covers tissue
 
     Also remove dark regions on the edge of the slide, which could be artifacts
@@ -1395,6 +1791,11 @@ def create_tissue_mask_from_rgb(img, brightness_q=0.99, kernel_size=3, gray_thre
     dark_gray_thresh : float
         Upper limit for dark gray
 
+    max_dim : int, optional
+        If the image's largest dimension is greater than `max_dim`, the
+        masks are created using a downsampled copy of the image, and then
+        resized to the image's shape. If None, the image is not downsampled
+
     Returns
     -------
     tissue_mask : ndarray
@@ -1405,24 +1806,27 @@ def create_tissue_mask_from_rgb(img, brightness_q=0.99, kernel_size=3, gray_thre
         Covers more area
 
     """
-    # Ignore artifacts that could throw off thresholding. These are often greyish in color
 
-    jch = rgb2jch(img)
+    img, original_shape_rc = _downsample_for_mask(img, max_dim)
+
+    # Ignore artifacts that could throw off thresholding. These are often greyish in color
+    cam = rgb2jab(img)
+    jch = jab2jch(cam)
     light_greys = 255*((jch[..., 1] < gray_thresh) & (jch[..., 0] < light_gray_thresh)).astype(np.uint8)
     dark_greys = 255*((jch[..., 1] < gray_thresh) & (jch[..., 0] < dark_gray_thresh)).astype(np.uint8)
     grey_mask = combine_masks_by_hysteresis([light_greys, dark_greys])
 
     color_mask = 255 - grey_mask
 
-    cam_d, cam = calc_background_color_dist(img, brightness_q=brightness_q, mask=color_mask)
+    cam_d, cam = calc_background_color_dist(img, brightness_q=brightness_q, mask=color_mask, cam=cam)
 
     # Reduce intensity of thick horizontal and vertial lines, usually artifacts like edges, streaks, folds, etc...
-    vert_knl = np.ones((1, 5))
-    no_v_lines = morphology.opening(cam_d, vert_knl)
+    vert_knl = np.ones((1, 5), dtype=np.uint8)
+    no_v_lines = cv2.morphologyEx(cam_d, cv2.MORPH_OPEN, vert_knl, borderType=cv2.BORDER_REFLECT)
 
-    horiz_knl = np.ones((5, 1))
-    no_h_lines = morphology.opening(cam_d, horiz_knl)
-    cam_d_no_lines = np.dstack([no_v_lines, no_h_lines]).min(axis=2)
+    horiz_knl = np.ones((5, 1), dtype=np.uint8)
+    no_h_lines = cv2.morphologyEx(cam_d, cv2.MORPH_OPEN, horiz_knl, borderType=cv2.BORDER_REFLECT)
+    cam_d_no_lines = np.minimum(no_v_lines, no_h_lines)
 
     # Foreground is where color is different than backaground color
     cam_d_t, _ = filters.threshold_multiotsu(cam_d_no_lines[grey_mask == 0])
@@ -1432,6 +1836,9 @@ def create_tissue_mask_from_rgb(img, brightness_q=0.99, kernel_size=3, gray_thre
     concave_tissue_mask = mask2contours(tissue_mask, kernel_size)
     cleaned_mask = clean_mask(mask=concave_tissue_mask, img=img)
 
+    tissue_mask = _upsample_mask(tissue_mask, original_shape_rc)
+    cleaned_mask = _upsample_mask(cleaned_mask, original_shape_rc)
+
     return tissue_mask, cleaned_mask
 
 
@@ -1464,7 +1871,8 @@ def jc_dist(img, cspace="IHLS", p=99, metric="euclidean"):
     """
 
     if cspace.upper() == "IHLS":
-        hys = colour.models.RGB_to_IHLS(img) # Hue, luminance, saturation/colorfulness
+        with COLOUR_LOCK:
+            hys = colour.models.RGB_to_IHLS(img) # Hue, luminance, saturation/colorfulness
         j = hys[..., 1]
         c = hys[..., 2]
 
@@ -1485,7 +1893,7 @@ def jc_dist(img, cspace="IHLS", p=99, metric="euclidean"):
     return jc_dist_img
 
 
-def create_tissue_mask_with_jc_dist(img):
+def create_tissue_mask_with_jc_dist(img, max_dim=TISSUE_MASK_MAX_DIM):
     """
     Create tissue mask using JC distance from background
 
@@ -1494,6 +1902,11 @@ def create_tissue_mask_with_jc_dist(img):
     img : np.ndarray
         RGB image
 
+    max_dim : int, optional
+        If the image's largest dimension is greater than `max_dim`, the
+        masks are created using a downsampled copy of the image, and then
+        resized to the image's shape. If None, the image is not downsampled
+
     Returns
     -------
     mask : np.ndarray
@@ -1506,6 +1919,7 @@ def create_tissue_mask_with_jc_dist(img):
     """
 
     assert img.ndim == 3, f"`img` needs to be RGB image"
+    img, original_shape_rc = _downsample_for_mask(img, max_dim)
     jc_dist_img = jc_dist(img, metric="chebyshev")
     jc_dist_img[np.isnan(jc_dist_img)] = np.nanmax(jc_dist_img)
 
@@ -1524,6 +1938,9 @@ def create_tissue_mask_with_jc_dist(img):
     mask = clean_mask(mask=temp_mask, img=img)
     chull_mask = mask2covexhull(mask)
 
+    mask = _upsample_mask(mask, original_shape_rc)
+    chull_mask = _upsample_mask(chull_mask, original_shape_rc)
+
     return mask, chull_mask
 
 
@@ -1532,46 +1949,21 @@ def clean_mask(mask, img=None, rel_min_size=0.001):
     Remove small objects, regions that are not very colorful (relativey)
     """
 
-    fg_labeled = measure.label(mask)
-    fg_regions = measure.regionprops(fg_labeled)
-
-    if len(fg_regions) == 1:
+    n_fg_labels, _, _ = _label_mask(mask)
+    if n_fg_labels <= 2:
+        # Mask is empty or has 1 region
         return mask
 
     if img is not None:
         jch = rgb2jch(img, cspace="JzAzBz")
         c = exposure.rescale_intensity(jch[..., 1], out_range=(0, 1))
-        colorfulness_img = np.zeros(mask.shape)
-
-    for i, r in enumerate(fg_regions):
-        # Fill in contours that are touching border
-        r0, c0, r1, c1 = r.bbox
-        r_filled_img = r.image_filled.copy()
-        if r0 == 0:
-            # Touching top
-            lr = np.where(r.image_filled[0, :])[0]
-            r_filled_img[0, min(lr):max(lr)] = 255
-
-        if r1 == mask.shape[0]:
-            # Touching bottom
-            lr = np.where(r.image_filled[-1, :])[0]
-            r_filled_img[-1, min(lr):max(lr)] = 255
-
-        if c0 == 0:
-            tb = np.where(r.image_filled[:, 0])[0]
-            # Touchng left border
-            r_filled_img[min(tb):max(tb), 0] = 255
-
-        if c1 == mask.shape[1]:
-            # Touchng right border
-            tb = np.where(r.image_filled[:, -1])[0]
-            r_filled_img[min(tb):max(tb), -1] = 255
-
-        r_filled_img = ndimage.binary_fill_holes(r_filled_img)
-        if img is not None:
-            colorfulness_img[r.slice][r_filled_img] = np.max(c[r.slice][r_filled_img])
 
-    if img is not None:
+        # Fill in regions, including holes that touch the border, and then get each region's maximum colorfulness
+        filled_mask = fill_mask_holes(close_mask_on_border(mask))
+        n_filled_labels, filled_labeled, _ = _label_mask(filled_mask)
+        region_c = np.zeros(n_filled_labels)
+        region_c[1:] = ndimage.maximum(c, filled_labeled, index=np.arange(1, n_filled_labels))
+        colorfulness_img = region_c[filled_labeled]
 
         colors_to_thresh = colorfulness_img[mask > 0]
         n_colors_to_thresh = len(np.unique(colors_to_thresh))
@@ -1593,28 +1985,20 @@ def clean_mask(mask, img=None, rel_min_size=0.001):
         feature_mask[feature_mask <= feature_thresh] = 0
         feature_mask[feature_mask != 0] = 255
 
-    features_labeled = measure.label(feature_mask)
-    feature_regions = measure.regionprops(features_labeled)
-
-    if len(feature_regions) == 1 or rel_min_size <= 0:
+    n_feature_labels, features_labeled, feature_stats = _label_mask(feature_mask)
+    if n_feature_labels <= 2 or rel_min_size <= 0:
         return feature_mask
 
-    region_sizes = np.array([r.area for r in feature_regions])
+    region_sizes = feature_stats[:, cv2.CC_STAT_AREA]
     min_abs_size = int(rel_min_size*np.multiply(*mask.shape[0:2])) #*kernel_size
-    keep_region_idx = np.where(region_sizes > min_abs_size)[0]
-    if len(keep_region_idx) == 0:
-        biggest_idx = np.argmax([r.area for r in fg_regions])
-        keep_region_idx = [biggest_idx]
-
-    if len(keep_region_idx) == 0:
-        biggest_idx = np.argmax([r.area for r in fg_regions])
-        keep_region_idx = [biggest_idx]
+    keep_region = region_sizes > min_abs_size
+    keep_region[0] = False
+    if not np.any(keep_region):
+        biggest_idx = np.argmax(region_sizes[1:]) + 1
+        keep_region[biggest_idx] = True
 
     # Get final regions
-    fg_mask = np.zeros(mask.shape[0:2], np.uint8)
-    for i, rid in enumerate(keep_region_idx):
-        r = feature_regions[rid]
-        fg_mask[r.slice][r.image_filled] = 255
+    fg_mask = fill_mask_holes(_keep_labeled_regions(features_labeled, keep_region))
 
     return fg_mask
 
@@ -1635,37 +2019,69 @@ def thresh_rel_max_region_size(mask, rel_min_size=0.2):
     """
     Keep regions that are `rel_min_size` of the largest region
     """
-    regions = measure.regionprops(measure.label(mask))
-    region_sizes = [r.area for r in regions]
-    max_size = np.max(region_sizes)
-    size_thresh = max_size*rel_min_size
-    size_thresh_mask = np.zeros_like(mask)
-    for r in regions:
-        if r.area > size_thresh:
-            size_thresh_mask[r.slice][r.image] = 255
+    n_labels, labeled_mask, region_stats = _label_mask(mask)
+    if n_labels <= 1:
+        return np.zeros(mask.shape[0:2], dtype=np.uint8)
+
+    region_sizes = region_stats[:, cv2.CC_STAT_AREA]
+    size_thresh = region_sizes[1:].max()*rel_min_size
+    size_thresh_mask = _keep_labeled_regions(labeled_mask, region_sizes > size_thresh)
 
     return size_thresh_mask
 
 
+def _calc_convex_area(region_mask):
+    """Number of pixels in the convex hull of a region
+
+    Like `skimage.measure.regionprops`, the hull is drawn around the midpoints
+    of each pixel's edges, and pixels whose centers are inside or on the hull
+    are counted. Pixels are counted row by row, using where each row
+    crosses the hull's edges.
+
+    """
+
+    hull_xy = cv2.convexHull(cv2.findNonZero(region_mask)).reshape(-1, 2)
+    edge_offsets = np.array([[-0.5, 0], [0.5, 0], [0, -0.5], [0, 0.5]], dtype=np.float32)
+    edges_xy = (hull_xy[:, None, :] + edge_offsets[None, :, :]).reshape(-1, 2).astype(np.float32)
+    vert_xy = cv2.convexHull(edges_xy).reshape(-1, 2).astype(float)
+
+    x0, y0 = vert_xy.T
+    x1, y1 = np.roll(vert_xy, -1, axis=0).T
+    row_y = np.arange(region_mask.shape[0])[:, None]
+    crosses_row = (row_y >= np.minimum(y0, y1)) & (row_y <= np.maximum(y0, y1)) & (y0 != y1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        row_x = x0 + (row_y - y0)*(x1 - x0)/(y1 - y0)
+
+    eps = 10**-6
+    row_min_x = np.ceil(np.where(crosses_row, row_x, np.inf).min(axis=1) - eps)
+    row_max_x = np.floor(np.where(crosses_row, row_x, -np.inf).max(axis=1) + eps)
+    convex_area = int(np.sum(np.clip(row_max_x - row_min_x + 1, 0, None)))
+
+    return convex_area
+
+
 def remove_regular_shapes(mask, irreg_thresh=0.05):
-    regions = measure.regionprops(measure.label(mask))
-    irreg_mask = np.zeros(mask.shape)
-    n_prev_regions = len(regions)
-    n_irreg_regions = 0
-    for r in regions:
-        irreg_v = 1 - r.area/r.convex_area
-        if irreg_v > irreg_thresh:
-            irreg_mask[r.slice][r.image] = 255
-            n_irreg_regions += 1
-
-    n_removed = n_prev_regions - n_irreg_regions
+    n_labels, labeled_mask, region_stats = _label_mask(mask)
+    region_areas = region_stats[:, cv2.CC_STAT_AREA]
+    irreg_v = np.zeros(n_labels)
+    for i in range(1, n_labels):
+        x, y, w, h = region_stats[i, :cv2.CC_STAT_AREA]
+        region_mask = (labeled_mask[y:y+h, x:x+w] == i).astype(np.uint8)
+        irreg_v[i] = 1 - region_areas[i]/_calc_convex_area(region_mask)
+
+    is_irreg = irreg_v > irreg_thresh
+    irreg_mask = _keep_labeled_regions(labeled_mask, is_irreg)
+
+    n_removed = n_labels - 1 - np.sum(is_irreg[1:])
     if n_removed > 0:
         print(f"Removed {n_removed} regularly shaped regions")
 
     return irreg_mask
 
 
-def entropy_mask(img, cspace="Hunter LAB", irreg_thresh=0.0, rel_min_size=0.2):
+def entropy_mask(img, cspace="Hunter LAB", irreg_thresh=0.0, rel_min_size=0.2, max_dim=TISSUE_MASK_MAX_DIM):
+    img, original_shape_rc = _downsample_for_mask(img, max_dim)
+
     # Detect and mask out backround (brightest and least colorful)
     mean_rgb, color_mask, filtered_label_counts, color_clusterer = find_dominant_colors(img, cspace=cspace, return_xy_clusterer=True)
     to_cluster_jab = rgb2jab(img, cspace=cspace)
@@ -1673,7 +2089,7 @@ def entropy_mask(img, cspace="Hunter LAB", irreg_thresh=0.0, rel_min_size=0.2):
     clustered_xy_idx = color_clusterer.predict(xy)
 
     mean_jab = rgb2jab(mean_rgb, cspace)
-    mean_jch = colour.models.Jab_to_JCh(mean_jab)
+    mean_jch = jab2jch(mean_jab)
     bg_idx = np.lexsort([mean_jch[:, 1], -mean_jch[:, 0]])[0] # Last column sorted 1st. Returns ascending order
     bg_jab = mean_jab[bg_idx, :]
 
@@ -1696,6 +2112,7 @@ def entropy_mask(img, cspace="Hunter LAB", irreg_thresh=0.0, rel_min_size=0.2):
     cleaned_mask = remove_regular_shapes(cleaned_mask, irreg_thresh=irreg_thresh)
     cleaned_mask = thresh_rel_max_region_size(cleaned_mask, rel_min_size=rel_min_size)
     cleaned_mask = exposure.rescale_intensity(cleaned_mask, out_range=np.uint8)
+    cleaned_mask = _upsample_mask(cleaned_mask, original_shape_rc)
 
     return cleaned_mask
 
@@ -1839,7 +2256,7 @@ def separate_colors(img, cspace="JzAzBz", min_colorfulness=0.005, px_thresh=0.00
 
 def find_dominant_hues(img, cspace="JzAzBz", min_colorfulness=0.005, px_thresh=0.0001, n_hue_bins=360, min_hue_dist=18, lamb=0):
     jab_img = rgb2jab(img, cspace=cspace)
-    jch_img = colour.models.Jab_to_JCh(jab_img)
+    jch_img = jab2jch(jab_img)
 
     if min_colorfulness == "auto":
         min_colorfulness = filters.threshold_otsu(jch_img[..., 1])
@@ -1868,7 +2285,7 @@ def find_dominant_hues(img, cspace="JzAzBz", min_colorfulness=0.005, px_thresh=0
         bin_h_range = np.clip(bin_h_range, 0, 360)
         in_range_idx = np.where((h >= bin_h_range[0]) & (h < bin_h_range[1]))[0]
         in_range_mean_jab = np.mean(fg_jab[in_range_idx], axis=0)
-        in_range_mean_jc = colour.models.Jab_to_JCh(in_range_mean_jab)[0:2]
+        in_range_mean_jc = jab2jch(in_range_mean_jab)[0:2]
         in_range_mean_jch = np.hstack([in_range_mean_jc, h_peaks[i]])
 
         mean_jch[i] = in_range_mean_jch
@@ -1942,7 +2359,7 @@ def find_dominant_colors(img, cspace="JzAzBz", min_colorfulness=0, px_thresh=0.0
     """
 
     jab_img = rgb2jab(img, cspace=cspace)
-    jch_img = colour.models.Jab_to_JCh(jab_img)
+    jch_img = jab2jch(jab_img)
     if min_colorfulness == "auto":
         min_colorfulness = filters.threshold_otsu(jch_img[..., 1])
 
@@ -2187,57 +2604,13 @@ def mask2bbox_mask(mask, merge_bbox=True):
 
 
 def mask2contours(mask, kernel_size=3):
-    kernel = morphology.disk(kernel_size)
+    """Dilate mask, and then fill in each region, including holes that touch the image's border
+    """
+    kernel = morphology.disk(kernel_size).astype(np.uint8)
     mask_dilated = cv2.dilate(mask, kernel)
-    contours, _ = cv2.findContours(mask_dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contour_mask = np.zeros_like(mask_dilated)
-    for cnt in contours:
-        corners_xy = cnt.squeeze()
-        on_top_border = corners_xy[:, 1].min() == 0
-        on_btm_border = corners_xy[:, 1].max() == mask.shape[0] - 1
-        on_left_border = corners_xy[:, 0].min() == 0
-        on_right_border = corners_xy[:, 0].max() == mask.shape[1] - 1
-
-        on_border = any([on_top_border, on_btm_border, on_left_border, on_right_border])
-        if not on_border:
-            cv2.drawContours(contour_mask, [cnt], 0, 255, -1)
-        else:
-            # Need to close contours on the border in order to fill holes
-            contour_w_border = np.zeros_like(mask)
-            cv2.drawContours(contour_w_border, [cnt], 0, 255, -1)
-            if on_top_border:
-                # Check top border
-                idx_at_min_y = np.where(corners_xy[:, 1] == 0)[0]
-                min_x = corners_xy[:, 0][idx_at_min_y.min()]
-                max_x = corners_xy[:, 0][idx_at_min_y.max()]
-                contour_w_border[0, min_x:max_x] = 255
-
-            if on_left_border:
-                # Check left border
-                idx_at_min_x = np.where(corners_xy[:, 0] == 0)[0]
-                min_y = corners_xy[:, 1][idx_at_min_x.min()]
-                max_y = corners_xy[:, 1][idx_at_min_x.max()]
-                contour_w_border[min_y:max_y, 0] = 255
-
-            if on_right_border:
-                # Check right border
-                max_x = mask.shape[1] - 1
-                idx_at_max_x = np.where(corners_xy[:, 0] == max_x)[0]
-                min_y = corners_xy[:, 1][idx_at_max_x.min()]
-                max_y = corners_xy[:, 1][idx_at_max_x.max()]
-                contour_w_border[min_y:max_y, max_x] = 255
-
-            if on_btm_border:
-                # Check bottom border
-                max_y = mask.shape[0] - 1
-                idx_at_max_y = np.where(corners_xy[:, 1] == max_y)[0]
-                min_x = corners_xy[:, 0][idx_at_max_y.min()]
-                max_x = corners_xy[:, 0][idx_at_max_y.max()]
-                contour_w_border[max_y, min_x:max_x] = 255
-
-            on_border_contours, _ = cv2.findContours(contour_w_border, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            for b_cnt in on_border_contours:
-                cv2.drawContours(contour_mask, [b_cnt], 0, 255, -1)
+
+    # Need to close regions on the border in order to fill holes
+    contour_mask = fill_mask_holes(close_mask_on_border(mask_dilated))
 
     return contour_mask
 
@@ -2309,6 +2682,9 @@ def match_histograms(src_image, ref_histogram, bins=256):
 
 def collect_img_stats(img_list, norm_percentiles=[1, 5, 95, 99], mask_list=None):
 
+    if uint8_stats.is_uint8(*img_list):
+        return _collect_uint8_img_stats(img_list, norm_percentiles=norm_percentiles, mask_list=mask_list)
+
     use_masks = mask_list is not None
     if use_masks:
         use_masks = mask_list[0] is not None
@@ -2346,6 +2722,35 @@ def collect_img_stats(img_list, norm_percentiles=[1, 5, 95, 99], mask_list=None)
     return all_histogram, all_img_stats
 
 
+def _collect_uint8_img_stats(img_list, norm_percentiles=[1, 5, 95, 99], mask_list=None):
+    """Same as `collect_img_stats`, but counts each value in the uint8 images,
+    instead of binning them, and gets the percentiles from the counts.
+    """
+
+    if mask_list is None:
+        mask_list = [None]*len(img_list)
+
+    all_histogram = np.zeros(uint8_stats.N_VALUES, dtype=np.int64)
+    n = 0
+    total_x = 0
+    for i, (img, mask) in enumerate(zip(img_list, mask_list)):
+        img_hist = uint8_stats.histogram(img, mask)
+        all_histogram += img_hist
+        if i == 0:
+            n += img_hist.sum()
+            total_x += np.dot(img_hist, np.arange(uint8_stats.N_VALUES))
+        else:
+            n += img.size
+            total_x += img.sum(dtype=np.int64)
+
+    mean_x = total_x/n
+    all_img_stats = uint8_stats.percentiles(all_histogram, norm_percentiles)
+    all_img_stats = np.hstack([all_img_stats, mean_x])
+    all_img_stats = all_img_stats[np.argsort(all_img_stats)]
+
+    return all_histogram, all_img_stats
+
+
 def norm_img_stats(img, target_stats, mask=None):
     """Normalize an image
 
@@ -2387,13 +2792,19 @@ def norm_img_stats(img, target_stats, mask=None):
     target_stats_flat = target_stats_flat[src_order]
 
     cs = Akima1DInterpolator(src_stats_flat, target_stats_flat)
+    if img.dtype == np.uint8:
+        # Only interpolate each of the 256 possible values once
+        normed_lut = cs(np.arange(uint8_stats.N_VALUES))
+        interp_fxn = lambda x: normed_lut[x]
+    else:
+        interp_fxn = cs
 
     if mask is None:
-        normed_img = cs(img.reshape(-1)).reshape(img.shape)
+        normed_img = interp_fxn(img.reshape(-1)).reshape(img.shape)
     else:
         normed_img = img.copy()
         fg_px = np.where(np_mask > 0)
-        normed_img[fg_px] = cs(img[fg_px])
+        normed_img[fg_px] = interp_fxn(img[fg_px])
 
     if img.dtype == np.uint8:
         normed_img = np.clip(normed_img, 0, 255)
@@ -0,0 +1,294 @@
+"""Cache the results of processing each slide's image
+
+Processing creates a processed image, a mask, and the shape and crop
+of the processed image, for each slide. These only depend on the slide's
+file, the image read from it, how the image is processed, and the
+version of VALIS. This means that if registration is run again on the same
+slides with the same processing settings, e.g. to try different non-rigid
+registration parameters, the results can be loaded instead of recomputed.
+
+Each result is saved as a compressed .npz file, named using a hash of
+everything used to create it. The cache is limited in size, and the
+least recently used results are removed when it becomes too large.
+
+"""
+
+import os
+import pathlib
+import hashlib
+import inspect
+import zipfile
+import numpy as np
+
+from . import __version__
+from . import feature_store
+from . import valtils
+
+DEFAULT_MAX_CACHE_GB = 5.0
+"""float: Default maximum size of the cache, in gigabytes"""
+
+CACHE_SUFFIX = ".npz"
+"""str: Suffix of files containing cached results"""
+
+PROCESSED_IMG_KEY = "processed_img"
+"""str: Name of the array containing the processed image"""
+
+MASK_KEY = "mask"
+"""str: Name of the array containing the mask"""
+
+TUPLE_KEYS_KEY = "tuple_keys"
+"""str: Name of the array listing the metadata that should be loaded as tuples"""
+
+
+def is_plain_setting(v):
+    """Whether a setting is a plain value, that is completely described by its string representation
+
+    Plain values are None, booleans, numbers, strings, arrays, and
+    dictionaries, lists, and tuples containing only plain values.
+
+    """
+
+    if v is None or isinstance(v, (bool, int, float, str, np.generic, np.ndarray)):
+        return True
+
+    if isinstance(v, dict):
+        return all(is_plain_setting(k) and is_plain_setting(x) for k, x in v.items())
+
+    if isinstance(v, (list, tuple)):
+        return all(is_plain_setting(x) for x in v)
+
+    return False
+
+
+def get_class_source(cls):
+    """Get the source code of a class and the classes it inherits from
+
+    Used so that results are not loaded after a processing class has been edited.
+    Classes whose source can't be read, such as builtins, are skipped.
+
+    """
+
+    src_list = []
+    for c in inspect.getmro(cls):
+        try:
+            src_list.append(inspect.getsource(c))
+        except (OSError, TypeError):
+            continue
+
+    return "\n".join(src_list)
+
+
+def get_processing_key(src_f, img, processing_cls, processing_kwargs, settings=None):
+    """Get key of the results of processing a slide's image
+
+    Parameters
+    ----------
+    src_f : str
+        Path to the slide
+
+    img : ndarray
+        Image read from the slide, that will be processed
+
+    processing_cls : ImageProcesser
+        Class used to process the image
+
+    processing_kwargs : dict
+        Keyword arguments passed to `processing_cls.process_image`
+
+    settings : dict, optional
+        Other settings that change the results, such as the
+        series or pyramid level that was read.
+
+    Returns
+    -------
+    key : str
+        Hash that changes if the slide's file, the image, how
+        it is processed (including the source code of `processing_cls`),
+        or the version of VALIS change. None if
+        `processing_kwargs` contains objects, such as a fitted model,
+        whose settings may change without changing the key, and so
+        the results should not be cached.
+
+    """
+
+    if not is_plain_setting(processing_kwargs):
+        return None
+
+    sig = hashlib.sha1()
+    sig.update(repr(valtils.get_file_id(src_f)).encode())
+    sig.update(str([img.shape, img.dtype.str]).encode())
+    sig.update(np.ascontiguousarray(img).tobytes())
+    sig.update(f"{processing_cls.__module__}.{processing_cls.__qualname__}".encode())
+    sig.update(get_class_source(processing_cls).encode())
+    sig.update(feature_store.get_setting_str(processing_kwargs).encode())
+    sig.update(feature_store.get_setting_str(settings).encode())
+    sig.update(__version__.encode())
+
+    return sig.hexdigest()
+
+
+class ProcessingCache(object):
+    """Save and load processing results in a directory
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory where results are saved
+
+    max_gb : float
+        Maximum size of all saved results, in gigabytes
+
+    """
+
+    def __init__(self, cache_dir, max_gb=DEFAULT_MAX_CACHE_GB):
+        """
+        Parameters
+        ----------
+        cache_dir : str
+            Directory where results will be saved
+
+        max_gb : float
+            Maximum size of all saved results, in gigabytes. When
+            the cache is larger than this, the least recently used
+            results are removed.
+
+        """
+
+        self.cache_dir = cache_dir
+        self.max_gb = max_gb
+
+    def _get_f(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
+
+    def _list_files(self):
+        if not os.path.exists(self.cache_dir):
+            return []
+
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(CACHE_SUFFIX)]
+
+    def has_results(self, key):
+        return os.path.exists(self._get_f(key))
+
+    def load(self, key):
+        """Load results
+
+        Returns
+        -------
+        results : dict
+            Dictionary of the saved arrays. None if the results have
+            not been saved, or could not be read.
+
+        """
+
+        f = self._get_f(key)
+        if not os.path.exists(f):
+            return None
+
+        try:
+            with np.load(f, allow_pickle=False) as npz:
+                results = {k: npz[k] for k in npz.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Incomplete or corrupted file
+            self._remove(f)
+            return None
+
+        # Metadata that was saved from a tuple is returned as a tuple, so it has the same type as when it was created
+        tuple_keys = results.pop(TUPLE_KEYS_KEY, [])
+        for k in tuple_keys:
+            results[k] = tuple(results[k].tolist())
+
+        # Mark as recently used
+        try:
+            os.utime(f)
+        except OSError:
+            pass
+
+        return results
+
+    def save(self, key, processed_img, mask, **metadata):
+        """Save results, only replacing the file once it has been completely written
+
+        Parameters
+        ----------
+        key : str
+            Key of the results. See `get_processing_key`
+
+        processed_img : ndarray
+            Processed image
+
+        mask : ndarray
+            Mask used during processing
+
+        metadata : ndarray, tuple
+            Other values to save, such as the shape of the image
+            that was processed. Tuples are loaded as tuples, and
+            everything else as arrays.
+
+        """
+
+        pathlib.Path(self.cache_dir).mkdir(exist_ok=True, parents=True)
+        f = self._get_f(key)
+        tmp_f = f"{f}.{os.getpid()}.tmp"
+        arrays = {PROCESSED_IMG_KEY: processed_img, MASK_KEY: mask}
+        arrays.update({k: np.asarray(v) for k, v in metadata.items()})
+        arrays[TUPLE_KEYS_KEY] = np.array([k for k, v in metadata.items() if isinstance(v, tuple)], dtype=str)
+        with open(tmp_f, "wb") as f_out:
+            np.savez_compressed(f_out, **arrays)
+
+        # Make room for the results before adding them, so they aren't removed right away.
+        # Results that are larger than the cache are not saved
+        results_gb = os.path.getsize(tmp_f)/(1024**3)
+        if results_gb > self.max_gb:
+            self._remove(tmp_f)
+            return
+
+        self.remove_least_recently_used(max_gb=self.max_gb - results_gb)
+        os.replace(tmp_f, f)
+
+    def _remove(self, f):
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+    def get_size_gb(self):
+        """Size of all saved results, in gigabytes
+        """
+        return sum(os.path.getsize(f) for f in self._list_files())/(1024**3)
+
+    def remove_least_recently_used(self, max_gb=None):
+        """Remove least recently used results until the cache is no larger than `max_gb`
+
+        Parameters
+        ----------
+        max_gb : float, optional
+            Size that the cache should be reduced to, in gigabytes.
+            If None, `ProcessingCache.max_gb` will be used.
+
+        """
+
+        if max_gb is None:
+            max_gb = self.max_gb
+
+        f_list = []
+        for f in self._list_files():
+            try:
+                f_stat = os.stat(f)
+            except OSError:
+                continue
+            f_list.append((f_stat.st_mtime_ns, f_stat.st_size, f))
+
+        max_bytes = max_gb*(1024**3)
+        total_bytes = sum(f_size for _, f_size, _ in f_list)
+        for _, f_size, f in sorted(f_list):
+            if total_bytes <= max_bytes:
+                break
+
+            self._remove(f)
+            total_bytes -= f_size
+
+    def clear(self):
+        """Remove all saved results
+        """
+        for f in self._list_files():
+            self._remove(f)
@@ -19,15 +19,16 @@ from time import time
 import tqdm
 import pandas as pd
 import pickle
-import colour
 import pyvips
 from scipy import ndimage
 import shapely
 from copy import deepcopy
 from pprint import pformat
 import json
+import hashlib
 from colorama import Fore
 from itertools import chain
+from pqdm.threads import pqdm
 import cv2
 import matplotlib.pyplot as plt
 from colorama import Fore
@@ -44,6 +45,8 @@ from . import slide_io
 from . import viz
 from . import warp_tools
 from . import serial_non_rigid
+from . import feature_store
+from . import processing_cache
 
 pyvips.cache_set_max(0)
 
@@ -57,6 +60,9 @@ OVERLAP_IMG_DIR = "overlaps"
 REG_RESULTS_DATA_DIR = "data"
 MICRO_REG_DIR = "micro_registration"
 DISPLACEMENT_DIRS = os.path.join(REG_RESULTS_DATA_DIR, "displacements")
+WARP_MAP_DIR = os.path.join(REG_RESULTS_DATA_DIR, "warp_maps")
+FEATURE_STORE_DIR = os.path.join(REG_RESULTS_DATA_DIR, "features")
+PROCESSING_CACHE_DIR = os.path.join(REG_RESULTS_DATA_DIR, "processing_cache")
 MASK_DIR = "masks"
 
 # Default image processing #
@@ -120,13 +126,14 @@ WARP_ANNO_MSG = "Warping annotations"
 CONVERT_MSG = "Converting images"
 DENOISE_MSG = "Denoising images"
 PROCESS_IMG_MSG = "Processing images"
+MASK_IMG_MSG = "Creating masks"
 NORM_IMG_MSG = "Normalizing images"
 TRANSFORM_MSG = "Finding rigid transforms"
 PREP_NON_RIGID_MSG = "Preparing images for non-rigid registration"
 MEASURE_MSG = "Measuring error"
 SAVING_IMG_MSG = "Saving images"
 
-PROCESS_IMG_MSG, NORM_IMG_MSG, DENOISE_MSG = valtils.pad_strings([PROCESS_IMG_MSG, NORM_IMG_MSG, DENOISE_MSG])
+PROCESS_IMG_MSG, MASK_IMG_MSG, NORM_IMG_MSG, DENOISE_MSG = valtils.pad_strings([PROCESS_IMG_MSG, MASK_IMG_MSG, NORM_IMG_MSG, DENOISE_MSG])
 
 
 def init_jvm(jar=None, mem_gb=10):
@@ -418,6 +425,8 @@ class Slide(object):
         self.M_for_cropped = None
         self.rigid_reg_cropped_shape_rc = None
 
+        self._compiled_warps = {}
+
     def __repr__(self):
         repr_str = (f'<{self.__class__.__name__}, name = {self.name}>'
                     f', width={self.slide_dimensions_wh[0][0]}'
@@ -628,7 +637,7 @@ class Slide(object):
             # RGB. Get brightest pixel
             mean_rgb, color_mask, filtered_label_counts, color_clusterer = preprocessing.find_dominant_colors(self.image, cspace=cspace, return_xy_clusterer=True)
             mean_jab = preprocessing.rgb2jab(mean_rgb, cspace=cspace)
-            mean_jch = colour.models.Jab_to_JCh(mean_jab)
+            mean_jch = preprocessing.jab2jch(mean_jab)
 
             # Find highest luminosity (L) and lowest colorfulness
             bg_idx = np.lexsort([mean_jch[:, 1], -mean_jch[:, 0]])[0] # Last column sorted 1st. Returns ascending order
@@ -830,7 +839,8 @@ class Slide(object):
         return warped_img
 
     def warp_img_from_to(self, img, to_slide_obj,
-                         dst_slide_level=0, non_rigid=True, interp_method="bicubic", bg_color=None):
+                         dst_slide_level=0, non_rigid=True, interp_method="bicubic", bg_color=None,
+                         composed=False):
 
         """Warp an image from this slide onto another unwarped slide
 
@@ -853,6 +863,10 @@ class Slide(object):
             Whether or not to conduct non-rigid warping. If False,
             then only a rigid transformation will be applied.
 
+        composed : bool, optional
+            If True, the transformations will be composed so that `img`
+            is only resampled once. See `warp_tools.warp_img_from_to`
+
         """
 
         if np.issubdtype(type(dst_slide_level), np.integer):
@@ -886,14 +900,161 @@ class Slide(object):
                                         to_src_shape_rc=to_slide_src_shape_rc,
                                         to_fwd_dxdy=to_fwd_dxdy,
                                         bg_color=bg_color,
-                                        interp_method=interp_method
+                                        interp_method=interp_method,
+                                        composed=composed
                                         )
 
         return warped_img
 
+    def _get_warp_slide_bbox(self, level, crop):
+        """Get shape of the aligned slide and the area to crop from it
+
+        Returns
+        -------
+        aligned_slide_shape : ndarray
+            Shape of the aligned slide at `level`
+
+        slide_bbox_xywh : ndarray
+            Bounding box to crop from the aligned slide. None if not cropping
+
+        crop_method : str, bool
+            Crop method determined by `crop`. None if `crop` is a bounding box
+
+        """
+        if level != 0:
+            if not np.issubdtype(type(level), np.integer):
+                msg = "Need slide level to be an integer indicating pyramid level"
+                valtils.print_warning(msg)
+            aligned_slide_shape = self.val_obj.get_aligned_slide_shape(level)
+        else:
+            aligned_slide_shape = self.aligned_slide_shape_rc
+
+        crop_method = None
+        if isinstance(crop, bool) or isinstance(crop, str):
+            crop_method = self.get_crop_method(crop)
+            if crop_method is not False:
+                if crop_method == CROP_REF:
+                    ref_slide = self.val_obj.get_ref_slide()
+                    scaled_aligned_shape_rc = ref_slide.slide_dimensions_wh[level][::-1]
+
+                elif crop_method == CROP_OVERLAP:
+                    scaled_aligned_shape_rc = aligned_slide_shape
+
+                slide_bbox_xywh, _ = self.get_crop_xywh(crop=crop_method,
+                                                        out_shape_rc=scaled_aligned_shape_rc)
+
+                if crop_method == CROP_REF:
+                    assert np.all(slide_bbox_xywh[2:] == scaled_aligned_shape_rc[::-1])
+
+            else:
+                slide_bbox_xywh = None
+
+        elif isinstance(crop[0], (int, float)) and len(crop) == 4:
+            slide_bbox_xywh = crop
+        else:
+            slide_bbox_xywh = None
+
+        return aligned_slide_shape, slide_bbox_xywh, crop_method
+
+    def _get_warp_signature(self, non_rigid):
+        """Get string that changes when the transformations change
+        """
+        sig = hashlib.sha1()
+        if self.M is not None:
+            sig.update(np.asarray(self.M, dtype=np.float64).tobytes())
+
+        if non_rigid:
+            if self.stored_dxdy:
+                bk_dxdy_f, _ = self.get_displacement_f()
+                sig.update(f"{bk_dxdy_f}_{os.path.getmtime(bk_dxdy_f)}".encode())
+            elif self._bk_dxdy_np is not None:
+                sig.update(np.ascontiguousarray(self._bk_dxdy_np).tobytes())
+
+        sig.update(str([self.processed_img_shape_rc, self.reg_img_shape_rc]).encode())
+
+        return sig.hexdigest()
+
+    def get_compiled_warp(self, level, non_rigid=True, crop=True,
+                          interp_method="bicubic", save_map=True):
+        """Get a precomputed warp for this slide at a pyramid level
+
+        The rigid and non-rigid transformations are composed into a
+        single float32 map, which is saved in `Valis.warp_map_dir` and
+        memory-mapped when used. Maps are cached, so they are only
+        re-calculated when the transformations change. Useful when
+        the same level will be warped several times, e.g. when warping
+        both the slide and processed versions of it.
+
+        Parameters
+        ----------
+        level : int
+            Pyramid level to be warped
+
+        non_rigid : bool, optional
+            Whether or not to include the non-rigid transformation
+
+        crop: bool, str, tuple
+            How to crop the registered images. See `Slide.warp_slide`
+
+        interp_method : str
+            Interpolation method used to resize the displacement fields
+
+        save_map : bool
+            Whether to save the map to `Valis.warp_map_dir` (True), or
+            keep it in memory (False).
+
+        Returns
+        -------
+        compiled_warp : warp_tools.CompiledWarp
+            Object that can warp the slide using a single resampling
+
+        """
+        aligned_slide_shape, slide_bbox_xywh, _ = self._get_warp_slide_bbox(level, crop)
+        if slide_bbox_xywh is not None:
+            slide_bbox_xywh = tuple(np.ceil(slide_bbox_xywh).astype(int).tolist())
+
+        non_rigid = non_rigid and (self.stored_dxdy or self._bk_dxdy_np is not None)
+        sig = self._get_warp_signature(non_rigid)
+        warp_key = (level, non_rigid, slide_bbox_xywh, interp_method, save_map)
+
+        if not hasattr(self, "_compiled_warps"):
+            # Slide may have been pickled before caching was added
+            self._compiled_warps = {}
+
+        if warp_key in self._compiled_warps:
+            cached_sig, compiled_warp = self._compiled_warps[warp_key]
+            if cached_sig == sig:
+                return compiled_warp
+
+        if save_map:
+            warp_map_dir = getattr(self.val_obj, "warp_map_dir",
+                                   os.path.join(self.val_obj.dst_dir, WARP_MAP_DIR))
+            pathlib.Path(warp_map_dir).mkdir(exist_ok=True, parents=True)
+            key_hash = hashlib.sha1(f"{warp_key}_{sig}".encode()).hexdigest()[:16]
+            map_f = os.path.join(warp_map_dir, f"{self.name}_level{level}_{key_hash}.v")
+        else:
+            map_f = None
+
+        bk_dxdy = self.bk_dxdy if non_rigid else None
+        slide_shape_rc = self.slide_dimensions_wh[level][::-1]
+        compiled_warp = warp_tools.CompiledWarp(src_shape_rc=slide_shape_rc,
+                                                M=self.M,
+                                                bk_dxdy=bk_dxdy,
+                                                out_shape_rc=aligned_slide_shape,
+                                                transformation_src_shape_rc=self.processed_img_shape_rc,
+                                                transformation_dst_shape_rc=self.reg_img_shape_rc,
+                                                bbox_xywh=slide_bbox_xywh,
+                                                interp_method=interp_method,
+                                                map_f=map_f)
+
+        self._compiled_warps[warp_key] = (sig, compiled_warp)
+
+        return compiled_warp
+
     @valtils.deprecated_args(crop_to_overlap="crop")
     def warp_slide(self, level, non_rigid=True, crop=True,
-                   src_f=None, interp_method="bicubic", reader=None):
+                   src_f=None, interp_method="bicubic", reader=None,
+                   compiled=False, composed=False):
         """Warp a slide using registration parameters
 
         Parameters
@@ -922,6 +1083,18 @@ class Slide(object):
         interp_method : str
             Interpolation method used when warping slide. Default is "bicubic"
 
+        compiled : bool, optional
+            If True, the slide will be warped using a cached map
+            from `Slide.get_compiled_warp`, which composes the rigid and
+            non-rigid transformations so that the slide is only resampled
+            once. The map is computed the first time it is needed, and re-used
+            for subsequent warps of slides with the same level.
+
+        composed : bool, optional
+            If True, the rigid and non-rigid transformations will be composed
+            into a single lazily evaluated map, so that the slide is only resampled
+            once. Unlike `compiled`, the map is not saved.
+
         """
         if src_f is None:
             src_f = self.src_f
@@ -931,55 +1104,28 @@ class Slide(object):
         else:
             bk_dxdy = None
 
-        if level != 0:
-            if not np.issubdtype(type(level), np.integer):
-                msg = "Need slide level to be an integer indicating pyramid level"
-                valtils.print_warning(msg)
-            aligned_slide_shape = self.val_obj.get_aligned_slide_shape(level)
-        else:
-            aligned_slide_shape = self.aligned_slide_shape_rc
-
-        if isinstance(crop, bool) or isinstance(crop, str):
-            crop_method = self.get_crop_method(crop)
-            if crop_method is not False:
-                if crop_method == CROP_REF:
-                    ref_slide = self.val_obj.get_ref_slide()
-                    scaled_aligned_shape_rc = ref_slide.slide_dimensions_wh[level][::-1]
-
-                elif crop_method == CROP_OVERLAP:
-                    scaled_aligned_shape_rc = aligned_slide_shape
-
-                slide_bbox_xywh, _ = self.get_crop_xywh(crop=crop_method,
-                                                        out_shape_rc=scaled_aligned_shape_rc)
-
-                if crop_method == CROP_REF:
-                    assert np.all(slide_bbox_xywh[2:] == scaled_aligned_shape_rc[::-1])
-                    if src_f == self.src_f and self == ref_slide:
-                        # Shouldn't need to warp, but do checks just in case
-                        no_rigid = True
-                        no_non_rigid = True
-                        if self.M is not None:
-                            sxy = (scaled_aligned_shape_rc/self.processed_img_shape_rc)[::-1]
-                            scaled_txy = sxy*self.M[:2, 2]
-                            no_transforms = all(self.M[:2, :2].reshape(-1) == [1, 0, 0, 1])
-                            crop_to_origin = np.all(np.abs(slide_bbox_xywh[0:2] + scaled_txy) < 1)
-                            no_rigid = no_transforms and crop_to_origin
-
-                        if self.bk_dxdy is not None:
-                            no_non_rigid = self.bk_dxdy.min() == 0 and self.bk_dxdy.max() == 0
-
-                        if no_rigid and no_non_rigid:
-                            # Don't need to warp, so return original reference image
-                            ref_img = self.reader.slide2vips(level=level)
-                            return ref_img
-
-            else:
-                slide_bbox_xywh = None
-
-        elif isinstance(crop[0], (int, float)) and len(crop) == 4:
-            slide_bbox_xywh = crop
-        else:
-            slide_bbox_xywh = None
+        aligned_slide_shape, slide_bbox_xywh, crop_method = self._get_warp_slide_bbox(level, crop)
+        if crop_method == CROP_REF:
+            ref_slide = self.val_obj.get_ref_slide()
+            if src_f == self.src_f and self == ref_slide:
+                # Shouldn't need to warp, but do checks just in case
+                scaled_aligned_shape_rc = ref_slide.slide_dimensions_wh[level][::-1]
+                no_rigid = True
+                no_non_rigid = True
+                if self.M is not None:
+                    sxy = (scaled_aligned_shape_rc/self.processed_img_shape_rc)[::-1]
+                    scaled_txy = sxy*self.M[:2, 2]
+                    no_transforms = all(self.M[:2, :2].reshape(-1) == [1, 0, 0, 1])
+                    crop_to_origin = np.all(np.abs(slide_bbox_xywh[0:2] + scaled_txy) < 1)
+                    no_rigid = no_transforms and crop_to_origin
+
+                if self.bk_dxdy is not None:
+                    no_non_rigid = self.bk_dxdy.min() == 0 and self.bk_dxdy.max() == 0
+
+                if no_rigid and no_non_rigid:
+                    # Don't need to warp, so return original reference image
+                    ref_img = self.reader.slide2vips(level=level)
+                    return ref_img
 
         if src_f == self.src_f:
             bg_color = self.bg_color
@@ -989,6 +1135,17 @@ class Slide(object):
         if reader is None:
             reader = self.reader
 
+        if compiled and (self.M is not None or bk_dxdy is not None):
+            vips_slide = reader.slide2vips(level=level, series=self.series)
+            compiled_warp = self.get_compiled_warp(level, non_rigid=non_rigid,
+                                                   crop=crop,
+                                                   interp_method=interp_method)
+
+            warped_slide = compiled_warp.warp(vips_slide, bg_color=bg_color,
+                                              interp_method=interp_method)
+
+            return warped_slide
+
         warped_slide = slide_tools.warp_slide(src_f, M=self.M,
                                               transformation_src_shape_rc=self.processed_img_shape_rc,
                                               transformation_dst_shape_rc=self.reg_img_shape_rc,
@@ -997,7 +1154,8 @@ class Slide(object):
                                               interp_method=interp_method,
                                               bbox_xywh=slide_bbox_xywh,
                                               bg_color=bg_color,
-                                              reader=reader)
+                                              reader=reader,
+                                              composed=composed)
         return warped_slide
 
     def warp_and_save_slide(self, dst_f, level=0, non_rigid=True,
@@ -1789,6 +1947,9 @@ class Valis(object):
                  norm_method=DEFAULT_NORM_METHOD,
                  micro_rigid_registrar_cls=None,
                  micro_rigid_registrar_params={},
+                 processing_cache_dir=None,
+                 processing_cache_max_gb=processing_cache.DEFAULT_MAX_CACHE_GB,
+                 feature_store_max_gb=feature_store.DEFAULT_MAX_STORE_GB,
                  qt_emitter=None):
 
         """
@@ -2003,6 +2164,24 @@ class Valis(object):
         micro_rigid_registrar_params : dictionary
             Dictionary of keyword arguments used intialize the `MicroRigidRegistrar`
 
+        processing_cache_dir : str, optional
+            Directory where the processed images, masks, and crops of each slide
+            are cached. If registration is run again with the same slides and
+            processing settings, these are loaded instead of recomputed. Can be shared
+            by several registrars. If None, the cache will be in `dst_dir`.
+
+        processing_cache_max_gb : float, optional
+            Maximum size of the processing cache, in gigabytes. The least recently
+            used results are removed when the cache is larger than this. If 0,
+            processing results will not be cached.
+
+        feature_store_max_gb : float, optional
+            Maximum size of the feature store, in gigabytes. Features and matches
+            are saved in `feature_store_dir`, and are loaded instead of being
+            recomputed if registration is run again. The least recently used
+            features and matches are removed when the store is larger than this.
+            If 0, features and matches will not be saved.
+
         qt_emitter : PySide2.QtCore.Signal, optional
             Used to emit signals that update the GUI's progress bars
 
@@ -2066,6 +2245,12 @@ class Valis(object):
         valtils.sort_nicely(self.original_img_list)
 
         self.set_dst_paths()
+        if processing_cache_dir is None:
+            processing_cache_dir = os.path.join(self.dst_dir, PROCESSING_CACHE_DIR)
+
+        self.processing_cache_dir = processing_cache_dir
+        self.processing_cache_max_gb = processing_cache_max_gb
+        self.feature_store_max_gb = feature_store_max_gb
 
         # Some information may already be provided #
         self.slide_dims_dict_wh = slide_dims_dict_wh
@@ -2327,9 +2512,79 @@ class Valis(object):
         self.overlap_dir = os.path.join(self.dst_dir, OVERLAP_IMG_DIR)
         self.data_dir = os.path.join(self.dst_dir, REG_RESULTS_DATA_DIR)
         self.displacements_dir = os.path.join(self.dst_dir, DISPLACEMENT_DIRS)
+        self.warp_map_dir = os.path.join(self.dst_dir, WARP_MAP_DIR)
+        self.feature_store_dir = os.path.join(self.dst_dir, FEATURE_STORE_DIR)
         self.micro_reg_dir = os.path.join(self.dst_dir, MICRO_REG_DIR)
         self.mask_dir = os.path.join(self.dst_dir, MASK_DIR)
 
+    def get_feature_store(self):
+        """Get FeatureStore where features and matches are saved
+
+        Features are saved in `feature_store_dir`, and are loaded
+        instead of being re-detected if registration is run again.
+
+        Returns
+        -------
+        store : feature_store.FeatureStore
+            FeatureStore that saves features in `feature_store_dir`. None if
+            `feature_store_max_gb` is 0.
+
+        """
+
+        # Registrar may have been pickled before the feature store was added
+        max_gb = getattr(self, "feature_store_max_gb", feature_store.DEFAULT_MAX_STORE_GB)
+        if not max_gb:
+            return None
+
+        feature_store_dir = getattr(self, "feature_store_dir", os.path.join(self.dst_dir, FEATURE_STORE_DIR))
+
+        return feature_store.FeatureStore(feature_store_dir, max_gb=max_gb)
+
+    def get_processing_cache(self):
+        """Get ProcessingCache where processed images and masks are saved
+
+        Returns
+        -------
+        cache : processing_cache.ProcessingCache
+            ProcessingCache that saves results in `processing_cache_dir`. None if
+            `processing_cache_max_gb` is 0.
+
+        """
+
+        # Registrar may have been pickled before the processing cache was added
+        max_gb = getattr(self, "processing_cache_max_gb", processing_cache.DEFAULT_MAX_CACHE_GB)
+        if not max_gb:
+            return None
+
+        cache_dir = getattr(self, "processing_cache_dir", os.path.join(self.dst_dir, PROCESSING_CACHE_DIR))
+
+        return processing_cache.ProcessingCache(cache_dir, max_gb=max_gb)
+
+    def get_processing_cache_key(self, slide_obj, processing_cls, processing_kwargs):
+        """Get key of the results of processing a Slide's image
+
+        The key changes if the slide's file, its image, how it is processed,
+        or the settings that determine the size and crop of the processed image change.
+        None if `processing_kwargs` contains objects, in which case the results
+        are not cached.
+
+        """
+
+        settings = {"series": slide_obj.series,
+                    "reader": slide_obj.reader.__class__.__name__,
+                    "level": self.get_processing_level(slide_obj),
+                    "max_processed_image_dim_px": self.max_processed_image_dim_px,
+                    "crop_for_rigid_reg": self.crop_for_rigid_reg,
+                    "create_masks": self.create_masks}
+
+        key = processing_cache.get_processing_key(src_f=slide_obj.src_f,
+                                                  img=slide_obj.image,
+                                                  processing_cls=processing_cls,
+                                                  processing_kwargs=processing_kwargs,
+                                                  settings=settings)
+
+        return key
+
     def get_slide(self, src_f):
         """Get Slide
 
@@ -2540,22 +2795,7 @@ class Valis(object):
         for f in tqdm.tqdm(self.original_img_list, desc=CONVERT_MSG, unit="image"):
             slide_name = valtils.get_name(f)
             reader = named_reader_dict[slide_name]
-            slide_dims = reader.metadata.slide_dimensions
-            levels_in_range = np.where(slide_dims.max(axis=1) <= self.max_image_dim_px)[0]
-
-            if len(levels_in_range) > 0:
-                level = levels_in_range[0] - 1
-            else:
-                level = len(slide_dims) - 1
-
-            level = max(level, 0)  # Avoid negative level
-
-            vips_img = reader.slide2vips(level=level)
-
-            scaling = np.min(self.max_image_dim_px/np.array([vips_img.width, vips_img.height]))
-            if scaling < 1:
-                vips_img = warp_tools.rescale_img(vips_img, scaling)
-
+            vips_img = reader.read_thumbnail(self.max_image_dim_px)
             img = warp_tools.vips2numpy(vips_img)
 
 
@@ -2753,15 +2993,92 @@ class Valis(object):
 
         return named_processing_dict
 
+    def get_processing_level(self, slide_obj):
+        """Pyramid level that is closest to, but larger than, the processed image
+        """
+        processing_level = slide_tools.get_level_idx(slide_obj.slide_dimensions_wh, self.max_processed_image_dim_px) - 1
+        processing_level = max(0, processing_level)
+
+        return processing_level
+
+    def get_img_to_process(self, slide_obj):
+        """Get copy of Slide's image that is no larger than `max_processed_image_dim_px`
+        """
+        img_shape_rc = warp_tools.get_shape(slide_obj.image)[0:2]
+        if np.max(img_shape_rc) > self.max_processed_image_dim_px:
+            processing_s = np.min(self.max_processed_image_dim_px/img_shape_rc)
+            img_to_process = warp_tools.rescale_img(slide_obj.image, processing_s)
+        else:
+            img_to_process = slide_obj.image
+
+        return img_to_process
+
+    def create_processing_masks(self, processor_dict, slide_list=None):
+        """Create the masks used when processing each Slide's image
+
+        If `crop_for_rigid_reg` is True, masks are created from each Slide's
+        image, and used to find the area to crop. Otherwise, masks are
+        created from the image that will be processed.
+
+        Masks are created for several Slides at once, using threads. Most of
+        the work is done by OpenCV, libvips, and numpy, which release the GIL.
+        Color conversions done with the colour package aren't thread-safe,
+        and so only one thread converts colors at a time (see
+        `preprocessing.COLOUR_LOCK`).
+
+        Parameters
+        ----------
+        processor_dict : dict
+            Each key should be the filename of the image, and the value
+            a list, where the first element is the `ImageProcesser` class,
+            and the second element is a dictionary of keyword arguments
+            passed to `ImageProcesser.process_image`.
+
+        slide_list : list, optional
+            Slides to create masks for. If None, masks will be created
+            for all Slides in `slide_dict`
+
+        Returns
+        -------
+        mask_list : list
+            Mask for each Slide, in the same order as `slide_list`
+
+        """
+
+        def create_mask(slide_obj):
+            processing_cls, _ = processor_dict[slide_obj.name]
+            if self.crop_for_rigid_reg:
+                img_to_mask = slide_obj.image
+            else:
+                img_to_mask = self.get_img_to_process(slide_obj)
+
+            mask_generator = processing_cls(image=img_to_mask,
+                                            src_f=slide_obj.src_f,
+                                            level=self.get_processing_level(slide_obj),
+                                            series=slide_obj.series,
+                                            reader=slide_obj.reader)
+
+            return mask_generator.create_mask()
+
+        if slide_list is None:
+            slide_list = list(self.slide_dict.values())
+
+        n_cpu = min(valtils.get_ncpus_available() - 1, len(slide_list))
+        if n_cpu > 1:
+            mask_list = pqdm(slide_list, create_mask, n_jobs=n_cpu, desc=MASK_IMG_MSG, unit="image",
+                             leave=None, exception_behaviour="immediate")
+        else:
+            mask_list = [create_mask(slide_obj) for slide_obj in tqdm.tqdm(slide_list, desc=MASK_IMG_MSG, unit="image", leave=None)]
+
+        return mask_list
+
     def get_roi_for_processing(self, slide_obj, processing_cls, mask=None):
 
         # First, create mask from whole image
         if mask is None:
-            mask_level = slide_tools.get_level_idx(slide_obj.slide_dimensions_wh, self.max_processed_image_dim_px) - 1
-            mask_level = max(0, mask_level)
             mask_generator = processing_cls(image=slide_obj.image,
                                     src_f=slide_obj.src_f,
-                                    level=mask_level,
+                                    level=self.get_processing_level(slide_obj),
                                     series=slide_obj.series,
                                     reader=slide_obj.reader)
 
@@ -2796,6 +3113,88 @@ class Valis(object):
 
         return cropped, mask, original_shape_rc, uncropped_shape_rc, crop_bbox
 
+    def process_slide_img(self, slide_obj, processing_cls, processing_kwargs, mask=None):
+        """Process a Slide's image, and create the mask used for rigid registration
+
+        Parameters
+        ----------
+        slide_obj : Slide
+            Slide whose image will be processed
+
+        processing_cls : ImageProcesser
+            Class used to process the image
+
+        processing_kwargs : dict
+            Keyword arguments passed to `processing_cls.process_image`
+
+        mask : ndarray, optional
+            Mask created by `create_processing_masks`. If None, and a mask is needed,
+            it will be created.
+
+        Returns
+        -------
+        processed_img : ndarray
+            Processed image
+
+        mask : ndarray
+            Mask covering the tissue in `processed_img`, before cropping
+
+        processed_img_shape_rc : tuple
+            Shape of the image used to create the mask
+
+        uncropped_processed_img_shape_rc : tuple
+            Shape of the processed image before it was cropped
+
+        processed_crop_bbox : ndarray
+            Bounding box (x, y, w, h) of the crop, in the uncropped processed image
+
+        """
+
+        if self.crop_for_rigid_reg:
+            img_to_process, mask, uncropped_unscaled_processed_shape_rc, uncropped_shape_rc, crop_bbox = self.get_roi_for_processing(slide_obj, processing_cls, mask=mask)
+        else:
+            # Create later: mask, original_processed_shape_rc, uncropped_shape_rc, crop_bbox
+            img_to_process = self.get_img_to_process(slide_obj)
+
+        processing_level = self.get_processing_level(slide_obj)
+        processor = processing_cls(image=img_to_process,
+                                    src_f=slide_obj.src_f,
+                                    level=processing_level,
+                                    series=slide_obj.series,
+                                    reader=slide_obj.reader)
+        try:
+            processed_img = processor.process_image(**processing_kwargs)
+        except TypeError:
+            # processor.process_image doesn't take kwargs
+            processed_img = processor.process_image()
+
+        processed_img = exposure.rescale_intensity(processed_img, out_range=(0, 255)).astype(np.uint8)
+
+        # Ensure processed image shape is within specified limit
+        processed_shape_rc = warp_tools.get_shape(processed_img)[0:2]
+        if np.max(processed_shape_rc) > self.max_processed_image_dim_px:
+            s = np.min(self.max_processed_image_dim_px/processed_shape_rc)
+            processed_img = warp_tools.rescale_img(processed_img, s)
+            processed_shape_rc = warp_tools.get_shape(processed_img)[0:2]
+
+        if not self.crop_for_rigid_reg:
+            uncropped_shape_rc = processed_shape_rc
+            uncropped_unscaled_processed_shape_rc = processed_shape_rc
+            crop_bbox = np.array([0, 0, *processed_shape_rc[::-1]])
+
+            if self.create_masks:
+                if mask is None:
+                    mask = processor.create_mask()
+                mask_s = warp_tools.get_shape(mask)[0:2]/processed_shape_rc
+                assert np.isclose(mask_s[0], mask_s[1], atol=10**-2), print("mask does not appear to based on scaled copy of Slide's image")
+                if np.any(mask.shape[0:2] != processed_shape_rc):
+                    mask = warp_tools.resize_img(mask, processed_shape_rc)
+
+            else:
+                mask = np.full(processor.original_shape_rc, 255, dtype=np.uint8)
+
+        return processed_img, mask, uncropped_unscaled_processed_shape_rc, uncropped_shape_rc, crop_bbox
+
     def process_imgs(self, processor_dict):
         if os.path.exists(self.processed_dir):
             n_in_processed_dir = len(os.listdir(self.processed_dir))
@@ -2809,59 +3208,47 @@ class Valis(object):
 
         pathlib.Path(self.processed_dir).mkdir(exist_ok=True, parents=True)
 
-        for i, slide_obj in enumerate(tqdm.tqdm(self.slide_dict.values(), desc=PROCESS_IMG_MSG, unit="image")):
-
-            processing_cls, processing_kwargs = processor_dict[slide_obj.name]
+        # Load results of processing slides that have already been processed with the same settings
+        slide_list = list(self.slide_dict.values())
+        results_cache = self.get_processing_cache()
+        cache_key_list = [None] * self.size
+        cached_results_list = [None] * self.size
+        if results_cache is not None:
+            for i, slide_obj in enumerate(slide_list):
+                processing_cls, processing_kwargs = processor_dict[slide_obj.name]
+                cache_key_list[i] = self.get_processing_cache_key(slide_obj, processing_cls, processing_kwargs)
+                if cache_key_list[i] is not None:
+                    cached_results_list[i] = results_cache.load(cache_key_list[i])
 
-            if self.crop_for_rigid_reg:
-                slide_obj.rigid_cropped = True
-                img_to_process, mask, uncropped_unscaled_processed_shape_rc, uncropped_shape_rc, crop_bbox = self.get_roi_for_processing(slide_obj, processing_cls)
-            else:
-                slide_obj.rigid_cropped = False
-                # Create later: mask, original_processed_shape_rc, uncropped_shape_rc, crop_bbox
-                img_shape_rc = warp_tools.get_shape(slide_obj.image)[0:2]
-                if np.max(img_shape_rc) > self.max_processed_image_dim_px:
-                    processing_s = np.min(self.max_processed_image_dim_px/img_shape_rc)
-                    img_to_process = warp_tools.rescale_img(slide_obj.image, processing_s)
-                else:
-                    img_to_process = slide_obj.image
-
-            processing_level = slide_tools.get_level_idx(slide_obj.slide_dimensions_wh, self.max_processed_image_dim_px) - 1
-            processing_level = max(0, processing_level)
-            processor = processing_cls(image=img_to_process,
-                                        src_f=slide_obj.src_f,
-                                        level=processing_level,
-                                        series=slide_obj.series,
-                                        reader=slide_obj.reader)
-            try:
-                processed_img = processor.process_image(**processing_kwargs)
-            except TypeError:
-                # processor.process_image doesn't take kwargs
-                processed_img = processor.process_image()
+        to_process_idx = [i for i in range(self.size) if cached_results_list[i] is None]
+        processing_mask_list = [None] * self.size
+        if (self.crop_for_rigid_reg or self.create_masks) and len(to_process_idx) > 0:
+            new_mask_list = self.create_processing_masks(processor_dict, slide_list=[slide_list[i] for i in to_process_idx])
+            for i, mask in zip(to_process_idx, new_mask_list):
+                processing_mask_list[i] = mask
 
-            processed_img = exposure.rescale_intensity(processed_img, out_range=(0, 255)).astype(np.uint8)
+        for i, slide_obj in enumerate(tqdm.tqdm(slide_list, desc=PROCESS_IMG_MSG, unit="image")):
 
-            # Ensure processed image shape is within specified limit
-            processed_shape_rc = warp_tools.get_shape(processed_img)[0:2]
-            if np.max(processed_shape_rc) > self.max_processed_image_dim_px:
-                s = np.min(self.max_processed_image_dim_px/processed_shape_rc)
-                processed_img = warp_tools.rescale_img(processed_img, s)
-                processed_shape_rc = warp_tools.get_shape(processed_img)[0:2]
+            processing_cls, processing_kwargs = processor_dict[slide_obj.name]
 
-            if not self.crop_for_rigid_reg:
-                uncropped_shape_rc = processed_shape_rc
-                uncropped_unscaled_processed_shape_rc = processed_shape_rc
-                crop_bbox = np.array([0, 0, *processed_shape_rc[::-1]])
+            cached_results = cached_results_list[i]
+            if cached_results is not None:
+                processed_img = cached_results[processing_cache.PROCESSED_IMG_KEY]
+                mask = cached_results[processing_cache.MASK_KEY]
+                uncropped_unscaled_processed_shape_rc = cached_results["processed_img_shape_rc"]
+                uncropped_shape_rc = cached_results["uncropped_processed_img_shape_rc"]
+                crop_bbox = cached_results["processed_crop_bbox"]
+            else:
+                processed_img, mask, uncropped_unscaled_processed_shape_rc, uncropped_shape_rc, crop_bbox = \
+                    self.process_slide_img(slide_obj, processing_cls, processing_kwargs, mask=processing_mask_list[i])
 
-                if self.create_masks:
-                    mask = processor.create_mask()
-                    mask_s = warp_tools.get_shape(mask)[0:2]/processed_shape_rc
-                    assert np.isclose(mask_s[0], mask_s[1], atol=10**-2), print("mask does not appear to based on scaled copy of Slide's image")
-                    if np.any(mask.shape[0:2] != processed_shape_rc):
-                        mask = warp_tools.resize_img(mask, processed_shape_rc)
+                if results_cache is not None and cache_key_list[i] is not None:
+                    results_cache.save(cache_key_list[i], processed_img=processed_img, mask=mask,
+                                       processed_img_shape_rc=uncropped_unscaled_processed_shape_rc,
+                                       uncropped_processed_img_shape_rc=uncropped_shape_rc,
+                                       processed_crop_bbox=crop_bbox)
 
-                else:
-                    mask = np.full(processor.original_shape_rc, 255, dtype=np.uint8)
+            slide_obj.rigid_cropped = self.crop_for_rigid_reg
 
             # Set attributes related to processed image's shape
             processed_f_out = os.path.join(self.processed_dir, slide_obj.name + ".png")
@@ -3225,7 +3612,8 @@ class Valis(object):
                                         imgs_ordered=self.imgs_ordered,
                                         reference_img_f=self.reference_img_f,
                                         name=self.name,
-                                        align_to_reference=self.align_to_reference)
+                                        align_to_reference=self.align_to_reference,
+                                        feature_store=self.get_feature_store())
 
         feature_detector = self.rigid_reg_kwargs[FD_KEY]
         matcher = self.rigid_reg_kwargs[MATCHER_KEY]
@@ -3242,8 +3630,7 @@ class Valis(object):
                 slide_obj = self.get_slide(img_obj.name)
                 features_in_mask_idx = warp_tools.get_xy_inside_mask(xy=img_obj.kp_pos_xy, mask=slide_obj.rigid_reg_mask)
                 if len(features_in_mask_idx) > 0:
-                    img_obj.kp_pos_xy = img_obj.kp_pos_xy[features_in_mask_idx, :]
-                    img_obj.desc = img_obj.desc[features_in_mask_idx, :]
+                    img_obj.keep_features(features_in_mask_idx)
 
 
         # print("\n======== Matching images\n")
@@ -3401,6 +3788,7 @@ class Valis(object):
             rigid_registrar = serial_rigid.register_images(img_dir=self.processed_dir,
                                                            align_to_reference=self.align_to_reference,
                                                            valis_obj=self,
+                                                           feature_store=self.get_feature_store(),
                                                            **self.rigid_reg_kwargs)
         else:
             if isinstance(self.do_rigid, dict):
@@ -3948,19 +4336,8 @@ class Valis(object):
                                                                             dst_shape_rc=full_out_shape,
                                                                             M=slide_obj.M)
 
-            if max_img_dim is not None:
-                closest_img_levels = np.where(np.max(slide_obj.slide_dimensions_wh, axis=1) < np.max(src_img_shape_rc))[0]
-                if len(closest_img_levels) > 0:
-                    closest_img_level = closest_img_levels[0] - 1
-                else:
-                    closest_img_level = len(slide_obj.slide_dimensions_wh) - 1
-            else:
-                closest_img_level = 0
-
-            closest_img_level = max(closest_img_level, 0)
-
-            vips_level_img = slide_obj.slide2vips(closest_img_level)
-            img_to_warp = warp_tools.resize_img(vips_level_img, src_img_shape_rc)
+            closest_img_level = slide_io.get_thumbnail_level(slide_obj.slide_dimensions_wh, src_img_shape_rc)
+            img_to_warp = slide_obj.reader.read_thumbnail(np.max(src_img_shape_rc), out_shape_rc=src_img_shape_rc)
 
             if updating_non_rigid:
                 dxdy = slide_obj.bk_dxdy
@@ -5207,7 +5584,7 @@ class Valis(object):
                               src_f_list=None, colormap=slide_io.CMAP_AUTO,
                               drop_duplicates=True, tile_wh=None,
                               interp_method="bicubic", compression=DEFAULT_COMPRESSION,
-                              Q=100, pyramid=True):
+                              Q=100, pyramid=True, single_pass=False):
 
         """Warp and merge registered slides
 
@@ -5267,6 +5644,14 @@ class Valis(object):
         pyramid : bool
             Whether or not to save an image pyramid.
 
+        single_pass : bool
+            Whether or not to save the merged slide one tile at a time, using
+            `slide_io.save_merged_ome_tiff`. Each slide is then warped only
+            once per tile, and memory is bounded to a few tiles per slide,
+            regardless of the number of channels. Only "deflate" and "none"
+            compression can be used this way; other methods will be
+            saved using `slide_io.save_ome_tiff`.
+
         Returns
         -------
         merged_slide : pyvips.Image
@@ -5293,6 +5678,8 @@ class Valis(object):
 
         all_channel_names = []
         merged_slide = None
+        warped_slide_list = []
+        keep_idx_list = []
 
         expected_channel_order = list(chain.from_iterable([channel_name_dict_by_name[valtils.get_name(f)] for f in src_f_list]))
         if drop_duplicates:
@@ -5318,6 +5705,8 @@ class Valis(object):
                 valtils.print_warning(msg)
                 continue
 
+            warped_slide_list.append(warped_slide)
+            keep_idx_list.append(keep_idx)
             if drop_duplicates and warped_slide.bands != len(keep_idx):
                 keep_channels = [warped_slide[c] for c in keep_idx]
                 slide_channel_names = [slide_channel_names[idx] for idx in keep_idx]
@@ -5367,9 +5756,15 @@ class Valis(object):
                                     level=level,
                                     out_shape_wh=out_xyczt[0:2])
 
-            slide_io.save_ome_tiff(merged_slide, dst_f=dst_f,
-                                   ome_xml=ome_xml,tile_wh=tile_wh,
-                                   compression=compression, Q=Q, pyramid=pyramid)
+            if single_pass:
+                slide_io.save_merged_ome_tiff(warped_slide_list, dst_f=dst_f,
+                                              channel_idx_list=keep_idx_list,
+                                              ome_xml=ome_xml, tile_wh=tile_wh,
+                                              compression=compression, pyramid=pyramid)
+            else:
+                slide_io.save_ome_tiff(merged_slide, dst_f=dst_f,
+                                       ome_xml=ome_xml,tile_wh=tile_wh,
+                                       compression=compression, Q=Q, pyramid=pyramid)
 
         return merged_slide, all_channel_names, ome_xml
 
@@ -17,6 +17,7 @@ import pyvips
 import inspect
 
 from . import warp_tools
+from . import field_quality
 from . import non_rigid_registrars
 from . import valtils
 from . import serial_rigid
@@ -254,6 +255,13 @@ class NonRigidZImage(object):
     warped_grid : ndarray
         Image showing deformation applied to a regular grid.
 
+    folded_frac : float
+        Fraction of pixels where `bk_dxdy` folds the image, i.e. where
+        the determinant of the Jacobian is not positive.
+
+    min_jacobian_det : float
+        Minimum determinant of the Jacobian of `bk_dxdy`
+
     """
 
     def __init__(self, reg_obj, image, name, stack_idx, moving_xy=None, fixed_xy=None, mask=None):
@@ -293,6 +301,8 @@ class NonRigidZImage(object):
         self.warped_grid = None
         self.bk_dxdy = None
         self.fwd_dxdy = None
+        self.folded_frac = None
+        self.min_jacobian_det = None
 
         self.is_vips = isinstance(image, pyvips.Image)
         self.shape = self.get_shape(image)
@@ -449,6 +459,9 @@ class NonRigidZImage(object):
 
         xy_args = {"moving_xy": moving_xy, "fixed_xy": fixed_xy}
         reg_kwargs.update(xy_args)
+        if "fields_only" in inspect.getfullargspec(non_rigid_reg_obj.register).args:
+            # Registered image and grid are created later, so only need displacements
+            reg_kwargs.setdefault("fields_only", True)
 
         warped_moving, moving_grid_img, moving_bk_dxdy = \
             non_rigid_reg_obj.register(moving_img=moving_img,
@@ -485,6 +498,11 @@ class NonRigidZImage(object):
                                                                    out_shape_rc=og_reg_shape_rc
                                                                    )
         self.bk_dxdy = img_bk_dxdy
+        self.folded_frac, self.min_jacobian_det = field_quality.measure_folds(self.bk_dxdy)
+        if self.folded_frac > 0:
+            valtils.print_warning(f"{100*self.folded_frac:.3f}% of the displacement field for {self.name} folds. "
+                                  f"Minimum Jacobian determinant is {self.min_jacobian_det:.3f}")
+
         if hasattr(non_rigid_reg_obj, "fwd_dxdy"):
             # Already calculated
             self.fwd_dxdy = non_rigid_reg_obj.fwd_dxdy
@@ -21,6 +21,7 @@ import functools
 from colorama import Fore, Style
 from scipy import stats
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from . import valtils
 from . import preprocessing
@@ -40,6 +41,16 @@ TRANSFORM_MSG = "Finding transforms"
 OPTIMIZING_MSG = "Optimizing transforms"
 FINALIZING_MSG = "Finalizing"
 
+MAX_D_TO_SKIP_REFLECTION_CHECK = 1.0
+"""float: If the median distance (pixels) between matched features, without any reflections,
+is below this value, then reflections will not be checked"""
+
+MIN_PAIRS_FOR_PROCESSES = 4
+"""int: Minimum number of image pairs needed before affine transformations are optimized in a process pool"""
+
+_OPTIMIZE_STATE = None
+"""dict: Images and keypoints shared by the pairs optimized in a worker process. Set by `_init_optimize_worker`"""
+
 msg_list = [DENOISE_MSG, FEATURE_MSG, MATCHING_MSG, TRANSFORM_MSG, FINALIZING_MSG, OPTIMIZING_MSG]
 DENOISE_MSG, FEATURE_MSG, MATCHING_MSG, TRANSFORM_MSG, FINALIZING_MSG, OPTIMIZING_MSG = valtils.pad_strings(msg_list)
 
@@ -138,6 +149,175 @@ def order_Dmat(D):
     return sorted_D, ordered_leaves, optimal_Z
 
 
+def _get_overlap_mask(warped_mask1, warped_mask2):
+    """Get mask of where two warped images overlap
+    """
+    mask = np.zeros(warped_mask1.shape, dtype=np.uint8)
+    mask[(warped_mask1 != 0) & (warped_mask2 != 0)] = 255
+
+    return mask
+
+
+def _refine_alignment(affine_optimizer, warped_img, fixed_img, mask,
+                      moving_kp_xy, moving_M, fixed_kp_xy, fixed_M,
+                      moving_pyramid=None, fixed_pyramid=None):
+    """Refine the alignment of a pair of rigidly aligned images
+
+    The refinement is only kept if it both decreases the
+    cost and median distance between keypoints.
+
+    Parameters
+    ----------
+    affine_optimizer : AffineOptimzer
+        Object that will minimize a cost function to find the optimal
+        affine transformation
+
+    warped_img : ndarray
+        Moving image, warped by `moving_M`
+
+    fixed_img : ndarray
+        Fixed image, warped by `fixed_M`
+
+    mask : ndarray
+        Where `warped_img` and `fixed_img` overlap
+
+    moving_kp_xy : ndarray
+        (N, 2) keypoints in the unwarped moving image
+
+    moving_M : ndarray
+        Transformation matrix used to warp the moving image
+
+    fixed_kp_xy : ndarray
+        (N, 2) keypoints in the unwarped fixed image that match `moving_kp_xy`
+
+    fixed_M : ndarray
+        Transformation matrix used to warp the fixed image
+
+    moving_pyramid, fixed_pyramid : list, optional
+        Gaussian pyramids of `warped_img` and `fixed_img`, created by
+        `affine_optimizer.get_pyramid`
+
+    Returns
+    -------
+    optimal_M : ndarray
+        Transformation matrix that refines the alignment of `warped_img`.
+        None if the refinement did not improve the alignment
+
+    optimal_reg_img : ndarray
+        `warped_img` warped by `optimal_M`
+
+    msg : str
+        Explanation of why the refinement was not kept. None if
+        it was kept
+
+    """
+
+    before_src_xy = warp_tools.warp_xy(moving_kp_xy, moving_M)
+    before_dst_xy = warp_tools.warp_xy(fixed_kp_xy, fixed_M)
+    before_tre, before_med_d = warp_tools.measure_error(before_src_xy,
+                                                        before_dst_xy,
+                                                        warped_img.shape)
+
+    # Optimize area inside mask
+    if affine_optimizer.accepts_xy:
+        moving_xy = before_src_xy
+        fixed_xy = before_dst_xy
+    else:
+        moving_xy = None
+        fixed_xy = None
+
+    pyramid_kwargs = {}
+    if moving_pyramid is not None and fixed_pyramid is not None:
+        pyramid_kwargs = {"moving_pyramid": moving_pyramid, "fixed_pyramid": fixed_pyramid}
+
+    with valtils.HiddenPrints():
+        _, optimal_M, _ = affine_optimizer.align(moving=warped_img, fixed=fixed_img,
+                                                 mask=mask, initial_M=None,
+                                                 moving_xy=moving_xy,
+                                                 fixed_xy=fixed_xy,
+                                                 **pyramid_kwargs)
+
+    # Keep optimal M if it actually improved alignment
+    initial_cst = affine_optimizer.cost_fxn(warped_img, fixed_img, mask)
+
+    after_src_xy = warp_tools.warp_xy(moving_kp_xy, moving_M @ optimal_M)
+    after_dst_xy = before_dst_xy
+
+    optimal_reg_img = warp_tools.warp_img(warped_img,
+                                          M=optimal_M,
+                                          out_shape_rc=warped_img.shape[0:2])
+
+    after_cst = affine_optimizer.cost_fxn(optimal_reg_img, fixed_img, mask)
+
+    after_tre, after_med_d = warp_tools.measure_error(after_src_xy,
+                                                      after_dst_xy,
+                                                      warped_img.shape)
+
+    if after_cst is not None and initial_cst is not None:
+        lower_cost = after_cst <= initial_cst
+    else:
+        lower_cost = True
+
+    lower_d = after_med_d <= before_med_d
+    if lower_cost and lower_d:
+        return optimal_M, optimal_reg_img, None
+
+    msg = (f"Somehow optimization made things worse. "
+           f"Cost was {initial_cst} but is now {after_cst}"
+           f"KP medD was {before_med_d}, but is now {after_med_d}.")
+
+    return None, optimal_reg_img, msg
+
+
+def _init_optimize_worker(optimize_state):
+    """Set the images and keypoints shared by the pairs optimized in a worker process
+    """
+
+    global _OPTIMIZE_STATE
+    torch.set_num_threads(1)
+    _OPTIMIZE_STATE = optimize_state
+
+
+def _optimize_pair(pair_idx, optimize_state):
+    """Optimize the alignment of a pair of images in `optimize_state["iter_order"]`
+
+    Both images are in the positions found by feature matching, and
+    so pairs can be optimized in any order.
+
+    Returns
+    -------
+    optimal_M : ndarray
+        Transformation matrix that refines the alignment of the moving image.
+        None if the refinement did not improve the alignment
+
+    msg : str
+        Explanation of why the refinement was not kept. None if
+        it was kept
+
+    """
+
+    moving_idx, fixed_idx = optimize_state["iter_order"][pair_idx]
+    moving_kp_xy, fixed_kp_xy = optimize_state["matched_kp_xy"][pair_idx]
+    warped_imgs = optimize_state["warped_imgs"]
+    warped_masks = optimize_state["warped_masks"]
+    M_list = optimize_state["M_list"]
+    pyramids = optimize_state["pyramids"]
+
+    mask = _get_overlap_mask(warped_masks[moving_idx], warped_masks[fixed_idx])
+    optimal_M, _, msg = _refine_alignment(optimize_state["affine_optimizer"],
+                                          warped_imgs[moving_idx], warped_imgs[fixed_idx], mask,
+                                          moving_kp_xy, M_list[moving_idx],
+                                          fixed_kp_xy, M_list[fixed_idx],
+                                          moving_pyramid=pyramids[moving_idx],
+                                          fixed_pyramid=pyramids[fixed_idx])
+
+    return optimal_M, msg
+
+
+def _optimize_pair_in_worker(pair_idx):
+    return pair_idx, _optimize_pair(pair_idx, _OPTIMIZE_STATE)
+
+
 class ZImage(object):
     """Class store info about an image, including the rigid registration parameters
 
@@ -164,6 +344,15 @@ class ZImage(object):
     kp_pos_xy : ndarray
         (N, 2) array of position for each keypoint
 
+    feature_id : str
+        Id of the features saved in the registrar's `FeatureStore`.
+        None if features were not saved.
+
+    feature_idx : ndarray
+        Indices of the saved features that `kp_pos_xy` and `desc` correspond to,
+        e.g. after removing features outside of a mask. If None,
+        all of the saved features are used.
+
     match_dict : dict
         Dictionary of image matches. Key= img_obj this ZImage is being
         compared to, value= MatchInfo containing information about the
@@ -253,6 +442,8 @@ class ZImage(object):
 
         self.desc = None
         self.kp_pos_xy = None
+        self.feature_id = None
+        self.feature_idx = None
         self.match_dict = {}
         self.unfiltered_match_dict = {}
         self.stack_idx = None
@@ -270,6 +461,33 @@ class ZImage(object):
         self.padded_shape_rc = None
         self.registered_shape_rc = None
 
+    def keep_features(self, keep_idx):
+        """Only keep some of the features
+
+        Parameters
+        ----------
+        keep_idx : ndarray
+            Indices of the features in `kp_pos_xy` and `desc` to keep
+
+        """
+
+        self.kp_pos_xy = self.kp_pos_xy[keep_idx, :]
+        self.desc = self.desc[keep_idx, :]
+        if self.feature_id is not None:
+            if self.feature_idx is None:
+                self.feature_idx = np.asarray(keep_idx)
+            else:
+                self.feature_idx = self.feature_idx[keep_idx]
+
+    def get_stored_feature_idx(self, idx):
+        """Convert indices of features in `kp_pos_xy` to indices of the saved features
+        """
+        idx = np.asarray(idx, dtype=int)
+        if self.feature_idx is None:
+            return idx
+
+        return self.feature_idx[idx]
+
     def reduce(self, prev_img_obj, next_img_obj):
         """Reduce amount of info stored, which can take up a lot of space.
 
@@ -286,6 +504,13 @@ class ZImage(object):
         """
 
         self.desc = None
+        if self.feature_id is not None:
+            # Matched descriptors can be loaded from the FeatureStore
+            for match_info in self.match_dict.values():
+                if match_info is not None:
+                    match_info.matched_desc1 = None
+                    match_info.matched_desc2 = None
+
         for img_obj in self.match_dict.keys():
             if prev_img_obj is not None and next_img_obj is not None:
                 if prev_img_obj != img_obj and img_obj != next_img_obj:
@@ -408,10 +633,14 @@ class SerialRigidRegistrar(object):
         Pandas dataframe containin the registration error of the
         alignment between each image and the previous one in the stack.
 
+    feature_store : FeatureStore
+        Where features and matches are saved. If None, features
+        and matches are only kept in memory.
+
     """
 
     def __init__(self, img_dir, imgs_ordered=False, reference_img_f=None,
-                 name=None, align_to_reference=False):
+                 name=None, align_to_reference=False, feature_store=None):
         """Class that performs serial rigid registration
 
         Parameters
@@ -443,8 +672,13 @@ class SerialRigidRegistrar(object):
             specified by `reference_img_f`. Will be set to True if
             `reference_img_f` is provided.
 
+        feature_store : FeatureStore, optional
+            Where features and matches will be saved. Features that
+            have already been saved will be loaded instead of being re-detected.
+
         """
         self.img_dir = img_dir
+        self.feature_store = feature_store
         self.aleady_sorted = imgs_ordered
         self.name = name
         self.img_file_list = get_image_files(img_dir, imgs_ordered=imgs_ordered)
@@ -508,8 +742,9 @@ class SerialRigidRegistrar(object):
         max_dist = np.ceil(np.max([out_w, out_h, max_new_h, max_new_w])).astype(int)
         out_shape = (max_dist, max_dist)
         img_obj_list = [None] * self.size
+        detect_img_list = [None] * self.size
 
-        for i in tqdm(range(self.size), desc=FEATURE_MSG, unit="image", leave=None):
+        for i in range(self.size):
             img_f = self.img_file_list[i]
             img = sorted_img_list[i]
 
@@ -519,13 +754,31 @@ class SerialRigidRegistrar(object):
             img_obj.T = warp_tools.get_padding_matrix(img.shape, img_obj.padded_shape_rc)
 
             if feature_detector is not None:
-                detect_img = self.get_fd_detection_img(img_obj, feature_detector=feature_detector, valis_obj=valis_obj)
-                img_obj.kp_pos_xy, img_obj.desc = feature_detector.detect_and_compute(detect_img)
+                detect_img_list[i] = self.get_fd_detection_img(img_obj, feature_detector=feature_detector, valis_obj=valis_obj)
 
             img_obj_list[i] = img_obj
             self.img_obj_dict[img_name] = img_obj
+
+        # Detect features in batches, so that detectors that can process several images at once (e.g. SuperPoint) can do so #
+        batch_size = getattr(feature_detector, "batch_size", 1)
+        for i in tqdm(range(0, self.size, batch_size), desc=FEATURE_MSG, unit="batch", leave=None):
+            batch_obj_list = img_obj_list[i:i + batch_size]
+            if feature_detector is not None and self.feature_store is not None:
+                features_list = self.feature_store.detect_and_compute_batch(feature_detector,
+                                                                            detect_img_list[i:i + batch_size],
+                                                                            [img_obj.name for img_obj in batch_obj_list])
+
+                for img_obj, (feature_id, kp_pos_xy, desc) in zip(batch_obj_list, features_list):
+                    img_obj.feature_id, img_obj.kp_pos_xy, img_obj.desc = feature_id, kp_pos_xy, desc
+
+            elif feature_detector is not None:
+                kp_desc_list = feature_detector.detect_and_compute_batch(detect_img_list[i:i + batch_size])
+                for img_obj, (kp_pos_xy, desc) in zip(batch_obj_list, kp_desc_list):
+                    img_obj.kp_pos_xy, img_obj.desc = kp_pos_xy, desc
+
             if qt_emitter is not None:
-                qt_emitter.emit(1)
+                for _ in batch_obj_list:
+                    qt_emitter.emit(1)
 
         self.img_obj_list = img_obj_list
         self.features = feature_detector.__class__.__name__
@@ -590,6 +843,12 @@ class SerialRigidRegistrar(object):
         filtered_match_info21.set_names(img_obj_2.name, img_obj_1.name)
         img_obj_2.match_dict[img_obj_1] = filtered_match_info21
 
+        if self.feature_store is not None and img_obj_1.feature_id is not None and img_obj_2.feature_id is not None:
+            match_idx = np.column_stack([img_obj_1.get_stored_feature_idx(filtered_match_info12.matches12),
+                                         img_obj_2.get_stored_feature_idx(filtered_match_info12.matches21)])
+
+            self.feature_store.save_matches(img_obj_1.feature_id, img_obj_2.feature_id, match_idx)
+
         if qt_emitter is not None:
             qt_emitter.emit(1)
 
@@ -812,6 +1071,16 @@ class SerialRigidRegistrar(object):
 
         return detect_img
 
+    def detect_and_compute(self, feature_detector, img, name):
+        """Detect and describe features, loading them from `feature_store` if they were already saved
+        """
+        if self.feature_store is None:
+            return feature_detector.detect_and_compute(img)
+
+        _, kp_xy, desc = self.feature_store.detect_and_compute(feature_detector, img, name)
+
+        return kp_xy, desc
+
     def rematch(self, matcher_obj, valis_obj=None, keep_unfiltered=False):
         """
         Reclaculate features using feature detecror in `matcher_obj`, and then match with `matcher_obj`.
@@ -821,7 +1090,7 @@ class SerialRigidRegistrar(object):
 
         ref_img_obj = self.img_obj_list[self.reference_img_idx]
         ref_img = self.get_fd_detection_img(ref_img_obj, feature_detector=matcher_obj.feature_detector, valis_obj=valis_obj)
-        ref_kp, ref_desc = matcher_obj.feature_detector.detect_and_compute(ref_img)
+        ref_kp, ref_desc = self.detect_and_compute(matcher_obj.feature_detector, ref_img, ref_img_obj.name)
 
         # Need existing matches to estimate rotation. Will dictionaries below to update matches once complete
         updated_matches12 = {img_obj.name: {} for img_obj in self.img_obj_list}
@@ -890,7 +1159,7 @@ class SerialRigidRegistrar(object):
                 rotated_img = detect_img
                 M = np.eye(3)
 
-            rot_kp, rot_desc = matcher_obj.feature_detector.detect_and_compute(rotated_img)
+            rot_kp, rot_desc = self.detect_and_compute(matcher_obj.feature_detector, rotated_img, img_obj.name)
             kp_in_og = warp_tools.warp_xy(rot_kp, np.linalg.inv(M))
 
             updated_kp[img_obj.name] = kp_in_og
@@ -947,6 +1216,9 @@ class SerialRigidRegistrar(object):
 
         ref_img_obj.kp_pos_xy = updated_kp[ref_img_obj.name]
         ref_img_obj.desc = updated_desc[ref_img_obj.name]
+        # Rematched keypoints are in the unrotated image, and so differ from the saved features
+        ref_img_obj.feature_id = None
+        ref_img_obj.feature_idx = None
         for moving_idx, fixed_idx in tqdm(self.iter_order):
             img_obj = self.img_obj_list[moving_idx]
             prev_img_obj = self.img_obj_list[fixed_idx]
@@ -955,6 +1227,8 @@ class SerialRigidRegistrar(object):
 
             img_obj.kp_pos_xy = new_kp
             img_obj.desc = new_desc
+            img_obj.feature_id = None
+            img_obj.feature_idx = None
 
             old_matches = img_obj.match_dict[prev_img_obj] # Here, img_obj = 1, prev_img_obj = 2
             new_matches21 = updated_filtered_matches21[img_obj.name][prev_img_obj.name]
@@ -1131,9 +1405,15 @@ class SerialRigidRegistrar(object):
             prev_img_obj = self.img_obj_list[fixed_idx]
             img_obj.fixed_obj = prev_img_obj
 
-    def align_to_prev_check_reflections(self, transformer, matcher_obj, valis_obj=None, keep_unfiltered=False, qt_emitter=None):
+    def align_to_prev_check_reflections(self, transformer, matcher_obj, valis_obj=None, keep_unfiltered=False, qt_emitter=None,
+                                        max_d_to_skip=MAX_D_TO_SKIP_REFLECTION_CHECK):
         """Use key points to align current image to previous image in the stack, but checking if reflection improves alignment
 
+        The reflected versions of each image are evaluated concurrently. If the
+        feature detector is `reflection_invariant`, the reflected features are
+        found by reflecting the keypoints that have already been detected,
+        instead of detecting features in each reflected image.
+
         Parameters
         ---------
         transformer : skimage.transform object
@@ -1152,8 +1432,61 @@ class SerialRigidRegistrar(object):
         qt_emitter : PySide2.QtCore.Signal, optional
             Used to emit signals that update the GUI's progress bars
 
+        max_d_to_skip : float, optional
+            If the median distance between matched features, without reflection,
+            is less than `max_d_to_skip`, then the image is assumed to not be
+            reflected, and the reflections will not be checked. If None, reflections
+            are always checked.
+
         """
 
+        def eval_reflection(rxy, img_obj, prev_img_obj, detect_img, prev_warped, dst_xy, prev_M, filter_kwargs):
+            """Align reflected image to the previous image
+            """
+            rx, ry = rxy
+            reflection_transformer = deepcopy(transformer)
+            rM = warp_tools.get_reflection_M(rx, ry, img_obj.image.shape)
+            reflected_img = warp_tools.warp_img(detect_img, rM @ img_obj.T, out_shape_rc=img_obj.padded_shape_rc)
+
+            if matcher_obj.feature_detector.reflection_invariant:
+                reflected_src_xy = warp_tools.warp_xy(img_obj.kp_pos_xy, rM @ img_obj.T)
+                reflected_desc = img_obj.desc
+            else:
+                reflected_src_xy, reflected_desc = matcher_obj.feature_detector.detect_and_compute(reflected_img)
+
+            unfiltered_match_info12, filtered_match_info12, unfiltered_match_info21, filtered_match_info21 = \
+                matcher_obj.match_images(img1=reflected_img, desc1=reflected_desc, kp1_xy=reflected_src_xy,
+                                         img2=prev_warped, desc2=prev_img_obj.desc, kp2_xy=dst_xy,
+                                         additional_filtering_kwargs=filter_kwargs,
+                                         **filter_kwargs)
+
+            # Record info #
+            _ = reflection_transformer.estimate(filtered_match_info12.matched_kp2_xy, filtered_match_info12.matched_kp1_xy)
+            reflected_warped_src_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp1_xy, reflection_transformer.params)
+            _,  reflected_d = warp_tools.measure_error(filtered_match_info12.matched_kp2_xy, reflected_warped_src_xy, prev_img_obj.padded_shape_rc)
+
+            # Move matched features to position in original images
+            img_inv_M = np.linalg.inv(rM @ img_obj.T)
+            prev_img_inv_M = np.linalg.inv(prev_M)
+
+            filtered_match_info12.matched_kp1_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp1_xy, img_inv_M)
+            filtered_match_info12.matched_kp2_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp2_xy, prev_img_inv_M)
+
+            filtered_match_info21.matched_kp1_xy = warp_tools.warp_xy(filtered_match_info21.matched_kp1_xy, prev_img_inv_M)
+            filtered_match_info21.matched_kp2_xy = warp_tools.warp_xy(filtered_match_info21.matched_kp2_xy, img_inv_M)
+
+            if keep_unfiltered:
+                unfiltered_match_info12.matched_kp1_xy = warp_tools.warp_xy(unfiltered_match_info12.matched_kp1_xy, img_inv_M)
+                unfiltered_match_info12.matched_kp2_xy = warp_tools.warp_xy(unfiltered_match_info12.matched_kp2_xy, prev_img_inv_M)
+
+                unfiltered_match_info21.matched_kp1_xy = warp_tools.warp_xy(unfiltered_match_info21.matched_kp1_xy, prev_img_inv_M)
+                unfiltered_match_info21.matched_kp2_xy = warp_tools.warp_xy(unfiltered_match_info21.matched_kp2_xy, img_inv_M)
+
+            return reflected_d, rM, reflection_transformer.params, filtered_match_info12, filtered_match_info21, unfiltered_match_info12, unfiltered_match_info21
+
+        reflections_xy = [(False, True), (True, False), (True, True)]
+        n_cpu = min(valtils.get_ncpus_available() - 1, len(reflections_xy))
+
         ref_img_obj = self.img_obj_list[self.reference_img_idx]
         for moving_idx, fixed_idx in tqdm(self.iter_order, desc=TRANSFORM_MSG, unit="image", leave=None):
             img_obj = self.img_obj_list[moving_idx]
@@ -1183,56 +1516,38 @@ class SerialRigidRegistrar(object):
                 unfiltered_reflected_matches12 = [img_obj.unfiltered_match_dict[prev_img_obj]]
                 unfiltered_reflected_matches21 = [prev_img_obj.unfiltered_match_dict[img_obj]]
 
-            # Estimate error with reflections
-            dst_xy = warp_tools.warp_xy(prev_img_obj.kp_pos_xy, prev_M)
-
-            prev_detect_img = self.get_fd_detection_img(prev_img_obj, feature_detector=matcher_obj.feature_detector, valis_obj=valis_obj)
-            prev_warped = warp_tools.warp_img(prev_detect_img, prev_M, out_shape_rc=prev_img_obj.padded_shape_rc)
+            if max_d_to_skip is None or unreflected_d >= max_d_to_skip:
+                # Estimate error with reflections
+                dst_xy = warp_tools.warp_xy(prev_img_obj.kp_pos_xy, prev_M)
 
-            detect_img = self.get_fd_detection_img(img_obj, feature_detector=matcher_obj.feature_detector, valis_obj=valis_obj)
-            for rx in [False, True]:
-                for ry in [False, True]:
-                    if not rx and not ry:
-                        continue
-
-                    rM = warp_tools.get_reflection_M(rx, ry, img_obj.image.shape)
-                    reflected_img = warp_tools.warp_img(detect_img, rM @ img_obj.T, out_shape_rc=img_obj.padded_shape_rc)
-
-                    reflected_src_xy, reflected_desc = matcher_obj.feature_detector.detect_and_compute(reflected_img)
-                    unfiltered_match_info12, filtered_match_info12, unfiltered_match_info21, filtered_match_info21 = \
-                        matcher_obj.match_images(img1=reflected_img, desc1=reflected_desc, kp1_xy=reflected_src_xy,
-                                                 img2=prev_warped, desc2=prev_img_obj.desc, kp2_xy=dst_xy,
-                                                 additional_filtering_kwargs=filter_kwargs,
-                                                 **filter_kwargs)
-
-                    # Record info #
-                    _ = transformer.estimate(filtered_match_info12.matched_kp2_xy, filtered_match_info12.matched_kp1_xy)
-                    reflected_warped_src_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp1_xy, transformer.params)
-                    _,  reflected_d = warp_tools.measure_error(filtered_match_info12.matched_kp2_xy, reflected_warped_src_xy, prev_img_obj.padded_shape_rc)
-                    reflected_d_vals.append(reflected_d)
-                    reflection_M.append(rM)
-                    transforms.append(transformer.params)
+                prev_detect_img = self.get_fd_detection_img(prev_img_obj, feature_detector=matcher_obj.feature_detector, valis_obj=valis_obj)
+                prev_warped = warp_tools.warp_img(prev_detect_img, prev_M, out_shape_rc=prev_img_obj.padded_shape_rc)
 
-                    # Move matched features to position in original images
-                    img_inv_M = np.linalg.inv(rM @ img_obj.T)
-                    prev_img_inv_M = np.linalg.inv(prev_M)
+                detect_img = self.get_fd_detection_img(img_obj, feature_detector=matcher_obj.feature_detector, valis_obj=valis_obj)
 
-                    filtered_match_info12.matched_kp1_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp1_xy, img_inv_M)
-                    filtered_match_info12.matched_kp2_xy = warp_tools.warp_xy(filtered_match_info12.matched_kp2_xy, prev_img_inv_M)
+                eval_reflection_fxn = functools.partial(eval_reflection,
+                                                        img_obj=img_obj,
+                                                        prev_img_obj=prev_img_obj,
+                                                        detect_img=detect_img,
+                                                        prev_warped=prev_warped,
+                                                        dst_xy=dst_xy,
+                                                        prev_M=prev_M,
+                                                        filter_kwargs=filter_kwargs)
 
-                    filtered_match_info21.matched_kp1_xy = warp_tools.warp_xy(filtered_match_info21.matched_kp1_xy, prev_img_inv_M)
-                    filtered_match_info21.matched_kp2_xy = warp_tools.warp_xy(filtered_match_info21.matched_kp2_xy, img_inv_M)
+                if n_cpu > 1:
+                    reflection_res = pqdm(reflections_xy, eval_reflection_fxn, n_jobs=n_cpu,
+                                          exception_behaviour="immediate", disable=True)
+                else:
+                    reflection_res = [eval_reflection_fxn(rxy) for rxy in reflections_xy]
 
+                for reflected_d, rM, reflected_params, filtered_match_info12, filtered_match_info21, unfiltered_match_info12, unfiltered_match_info21 in reflection_res:
+                    reflected_d_vals.append(reflected_d)
+                    reflection_M.append(rM)
+                    transforms.append(reflected_params)
                     reflected_matches12.append(filtered_match_info12)
                     reflected_matches21.append(filtered_match_info21)
 
                     if keep_unfiltered:
-                        unfiltered_match_info12.matched_kp1_xy = warp_tools.warp_xy(unfiltered_match_info12.matched_kp1_xy, img_inv_M)
-                        unfiltered_match_info12.matched_kp2_xy = warp_tools.warp_xy(unfiltered_match_info12.matched_kp2_xy, prev_img_inv_M)
-
-                        unfiltered_match_info21.matched_kp1_xy = warp_tools.warp_xy(unfiltered_match_info21.matched_kp1_xy, prev_img_inv_M)
-                        unfiltered_match_info21.matched_kp2_xy = warp_tools.warp_xy(unfiltered_match_info21.matched_kp2_xy, img_inv_M)
-
                         unfiltered_reflected_matches12.append(unfiltered_match_info12)
                         unfiltered_reflected_matches21.append(unfiltered_match_info21)
 
@@ -1315,7 +1630,7 @@ class SerialRigidRegistrar(object):
                 qt_emitter.emit(1)
 
 
-    def optimize(self, affine_optimizer, qt_emitter=None):
+    def optimize(self, affine_optimizer, qt_emitter=None, concurrent=False):
         """Refine alignment by minimizing a metric
 
         Transformation will only be allowed if it both decreases the
@@ -1330,7 +1645,20 @@ class SerialRigidRegistrar(object):
         qt_emitter : PySide2.QtCore.Signal, optional
             Used to emit signals that update the GUI's progress bars
 
+        concurrent : bool, optional
+            If False (the default), each image is aligned to the
+            optimized version of the previous image. If True, all
+            pairs are optimized at the same time, in parallel processes,
+            with each image aligned to the un-optimized version of the
+            previous image. The results are then composed to get each
+            image's optimal_M. See `optimize_concurrently`.
+
         """
+
+        if concurrent:
+            self.optimize_concurrently(affine_optimizer, qt_emitter=qt_emitter)
+            return
+
         ref_img_obj = self.img_obj_list[self.reference_img_idx]
         ref_warped = warp_tools.warp_img(ref_img_obj.image, M=ref_img_obj.T,
                                          out_shape_rc=ref_img_obj.padded_shape_rc)
@@ -1350,13 +1678,6 @@ class SerialRigidRegistrar(object):
                                              M=M,
                                              out_shape_rc=img_obj.padded_shape_rc)
 
-            to_prev_match_info = img_obj.match_dict[prev_img_obj]
-            before_src_xy = warp_tools.warp_xy(to_prev_match_info.matched_kp1_xy, M)
-            before_dst_xy = warp_tools.warp_xy(to_prev_match_info.matched_kp2_xy, prev_M)
-            before_tre, before_med_d = warp_tools.measure_error(before_src_xy,
-                                                                before_dst_xy,
-                                                                warped_img.shape)
-
             # Get mask
             img_mask = np.ones(img_obj.image.shape[0:2], dtype=np.uint8)
             warped_img_mask = warp_tools.warp_img(img_mask,
@@ -1368,59 +1689,117 @@ class SerialRigidRegistrar(object):
                                                        M=prev_M,
                                                        out_shape_rc=prev_img_obj.padded_shape_rc)
 
-            mask = np.zeros(warped_img_mask.shape, dtype=np.uint8)
-            mask[(warped_img_mask != 0) & (warped_prev_img_mask != 0)] = 255
+            mask = _get_overlap_mask(warped_img_mask, warped_prev_img_mask)
+
+            to_prev_match_info = img_obj.match_dict[prev_img_obj]
+            optimal_M, optimal_reg_img, msg = _refine_alignment(affine_optimizer, warped_img, prev_img, mask,
+                                                                to_prev_match_info.matched_kp1_xy, M,
+                                                                to_prev_match_info.matched_kp2_xy, prev_M)
 
-            # Optimize area inside mask
-            if affine_optimizer.accepts_xy:
-                moving_xy = before_src_xy
-                fixed_xy = before_dst_xy
+            if optimal_M is not None:
+                prev_img = optimal_reg_img
+                img_obj.optimal_M = optimal_M
             else:
-                moving_xy = None
-                fixed_xy = None
+                valtils.print_warning(msg)
+                prev_img = warped_img
 
-            with valtils.HiddenPrints():
-                _, optimal_M, _ = affine_optimizer.align(moving=warped_img, fixed=prev_img,
-                                                         mask=mask, initial_M=None,
-                                                         moving_xy=moving_xy,
-                                                         fixed_xy=fixed_xy)
+            prev_M = M @ img_obj.optimal_M
 
-            # Keep optimal M if it actually improved alignment
-            initial_cst = affine_optimizer.cost_fxn(warped_img, prev_img, mask)
+            if qt_emitter is not None:
+                qt_emitter.emit(1)
 
-            after_src_xy = warp_tools.warp_xy(to_prev_match_info.matched_kp1_xy, M @ optimal_M)
-            after_dst_xy = warp_tools.warp_xy(to_prev_match_info.matched_kp2_xy, prev_M)
+    def optimize_concurrently(self, affine_optimizer, qt_emitter=None):
+        """Refine alignment of all pairs of images at the same time
 
-            optimal_reg_img = warp_tools.warp_img(warped_img,
-                                                  M=optimal_M,
-                                                  out_shape_rc=img_obj.padded_shape_rc)
+        Each image is warped, and its Gaussian pyramid built, only once, as
+        the same image is the moving image in one pair, and the fixed image
+        in the next. Pairs are then optimized in parallel processes, with each
+        image aligned to the un-optimized version of the previous image.
+        Finally, working out from the reference image, each image's
+        optimal_M is composed with the changes made to the previous image,
+        so that images stay aligned to their neighbors.
 
-            after_cst = affine_optimizer.cost_fxn(optimal_reg_img, prev_img, mask)
+        Transformation will only be allowed if it both decreases the
+        cost and median distance between keypoints.
 
-            after_tre, after_med_d = warp_tools.measure_error(after_src_xy,
-                                                              after_dst_xy,
-                                                              warped_img.shape)
+        Parameters
+        -----------
+        affine_optimizer : AffineOptimzer
+            Object that will minimize a cost function to find the optimal
+            affine transformations
 
-            if after_cst is not None and initial_cst is not None:
-                lower_cost = after_cst <= initial_cst
-            else:
-                lower_cost = True
+        qt_emitter : PySide2.QtCore.Signal, optional
+            Used to emit signals that update the GUI's progress bars
 
-            lower_d = after_med_d <= before_med_d
-            if lower_cost and lower_d:
-                prev_img = optimal_reg_img
-                img_obj.optimal_M = optimal_M
+        """
+
+        M_list = [None]*self.size
+        warped_imgs = [None]*self.size
+        warped_masks = [None]*self.size
+        for i, img_obj in enumerate(self.img_obj_list):
+            if i == self.reference_img_idx:
+                M = img_obj.T
             else:
-                msg = (f"Somehow optimization made things worse. "
-                       f"Cost was {initial_cst} but is now {after_cst}"
-                       f"KP medD was {before_med_d}, but is now {after_med_d}.")
-                valtils.print_warning(msg)
-                prev_img = warped_img
+                M = img_obj.reflection_M @ img_obj.T @ img_obj.to_prev_A
 
-            prev_M = M @ img_obj.optimal_M
+            M_list[i] = M
+            warped_imgs[i] = warp_tools.warp_img(img_obj.image, M=M,
+                                                 out_shape_rc=img_obj.padded_shape_rc)
 
-            if qt_emitter is not None:
-                qt_emitter.emit(1)
+            img_mask = np.ones(img_obj.image.shape[0:2], dtype=np.uint8)
+            warped_masks[i] = warp_tools.warp_img(img_mask, M=M,
+                                                  out_shape_rc=img_obj.padded_shape_rc)
+
+        if getattr(affine_optimizer, "accepts_pyramids", False):
+            pyramids = [affine_optimizer.get_pyramid(img) for img in warped_imgs]
+        else:
+            pyramids = [None]*self.size
+
+        matched_kp_xy = []
+        for moving_idx, fixed_idx in self.iter_order:
+            match_info = self.img_obj_list[moving_idx].match_dict[self.img_obj_list[fixed_idx]]
+            matched_kp_xy.append((match_info.matched_kp1_xy, match_info.matched_kp2_xy))
+
+        optimize_state = {"affine_optimizer": affine_optimizer,
+                          "iter_order": self.iter_order,
+                          "M_list": M_list,
+                          "warped_imgs": warped_imgs,
+                          "warped_masks": warped_masks,
+                          "pyramids": pyramids,
+                          "matched_kp_xy": matched_kp_xy
+                          }
+
+        n_pairs = len(self.iter_order)
+        n_cpu = min(valtils.get_ncpus_available() - 1, n_pairs)
+        res = [None]*n_pairs
+        if n_cpu > 1 and n_pairs >= MIN_PAIRS_FOR_PROCESSES:
+            with ProcessPoolExecutor(max_workers=n_cpu, initializer=_init_optimize_worker, initargs=(optimize_state, )) as executor:
+                futures = [executor.submit(_optimize_pair_in_worker, pair_idx) for pair_idx in range(n_pairs)]
+                for f in tqdm(as_completed(futures), total=n_pairs, desc=OPTIMIZING_MSG, unit="image", leave=None):
+                    pair_idx, pair_res = f.result()
+                    res[pair_idx] = pair_res
+                    if qt_emitter is not None:
+                        qt_emitter.emit(1)
+        else:
+            for pair_idx in tqdm(range(n_pairs), desc=OPTIMIZING_MSG, unit="image", leave=None):
+                res[pair_idx] = _optimize_pair(pair_idx, optimize_state)
+                if qt_emitter is not None:
+                    qt_emitter.emit(1)
+
+        # Compose results, working out from the reference image. Each fixed image
+        # is updated before it is used as the moving image's reference
+        optimized_M_list = list(M_list)
+        for (moving_idx, fixed_idx), (optimal_M, msg) in zip(self.iter_order, res):
+            if optimal_M is None:
+                valtils.print_warning(msg)
+                optimal_M = np.eye(3)
+
+            # How much the fixed image moved after it was optimized. Transforms are
+            # composed so that warping by A and then B is the same as warping by A @ B,
+            # so the fixed image's change is applied after the moving image's transform
+            fixed_change_M = np.linalg.inv(M_list[fixed_idx]) @ optimized_M_list[fixed_idx]
+            optimized_M_list[moving_idx] = M_list[moving_idx] @ optimal_M @ fixed_change_M
+            self.img_obj_list[moving_idx].optimal_M = np.linalg.inv(M_list[moving_idx]) @ optimized_M_list[moving_idx]
 
     def calc_warped_img_size(self):
         """Determine the shape of the registered images
@@ -1629,9 +2008,15 @@ class SerialRigidRegistrar(object):
                                          prev_pts,
                                          img_obj.image.shape)
 
+            if current_to_prev_matches.matched_desc1 is not None:
+                n_matched_desc = current_to_prev_matches.matched_desc1.shape[0]
+            else:
+                # Matched descriptors removed by `clear_unused_matches`
+                n_matched_desc = len(current_to_prev_matches.match_distances)
+
             similarities = \
                 convert_distance_to_similarity(current_to_prev_matches.match_distances,
-                                               current_to_prev_matches.matched_desc1.shape[0])
+                                               n_matched_desc)
 
             _, weighted_med_d_list[i] = \
                 warp_tools.measure_error(current_pts, prev_pts,
@@ -1666,7 +2051,8 @@ def register_images(img_dir, dst_dir=None, name="registrar",
                     imgs_ordered=False, reference_img_f=None,
                     similarity_metric="n_matches",
                     check_for_reflections=False,
-                    max_scaling=3.0, align_to_reference=False, qt_emitter=None, valis_obj=None, *args, **kwargs):
+                    max_scaling=3.0, align_to_reference=False, qt_emitter=None, valis_obj=None,
+                    feature_store=None, optimize_concurrently=False, *args, **kwargs):
     """
     Rigidly align collection of images
 
@@ -1730,6 +2116,15 @@ def register_images(img_dir, dst_dir=None, name="registrar",
     qt_emitter : PySide2.QtCore.Signal, optional
         Used to emit signals that update the GUI's progress bars
 
+    feature_store : FeatureStore, optional
+        Where features and matches will be saved. Features that
+        have already been saved will be loaded instead of being re-detected.
+
+    optimize_concurrently : bool, optional
+        Whether or not `affine_optimizer` should optimize all pairs of images
+        at the same time, in parallel processes. See
+        `SerialRigidRegistrar.optimize_concurrently`.
+
     Returns
     -------
     registrar : SerialRigidRegistrar
@@ -1765,7 +2160,8 @@ def register_images(img_dir, dst_dir=None, name="registrar",
                                      imgs_ordered=imgs_ordered,
                                      reference_img_f=reference_img_f,
                                      name=name,
-                                     align_to_reference=align_to_reference)
+                                     align_to_reference=align_to_reference,
+                                     feature_store=feature_store)
 
 
     # Filter `registrar.img_file_list` to only include images in valis_obj.slide_dict
@@ -1788,8 +2184,7 @@ def register_images(img_dir, dst_dir=None, name="registrar",
                 reg_mask = preprocessing.mask2bbox_mask(reg_mask)
                 features_in_mask_idx = warp_tools.get_xy_inside_mask(xy=img_obj.kp_pos_xy, mask=reg_mask)
                 if len(features_in_mask_idx) > 0:
-                    img_obj.kp_pos_xy = img_obj.kp_pos_xy[features_in_mask_idx, :]
-                    img_obj.desc = img_obj.desc[features_in_mask_idx, :]
+                    img_obj.keep_features(features_in_mask_idx)
 
     # print("\n======== Matching images\n")
     if registrar.aleady_sorted:
@@ -1848,7 +2243,7 @@ def register_images(img_dir, dst_dir=None, name="registrar",
 
     if affine_optimizer is not None:
         # print("\n======== Optimizing alignments\n")
-        registrar.optimize(affine_optimizer, qt_emitter=qt_emitter)
+        registrar.optimize(affine_optimizer, qt_emitter=qt_emitter, concurrent=optimize_concurrently)
 
     registrar.finalize()
 
@@ -5,6 +5,7 @@ import torch
 import kornia
 
 import os
+import functools
 from skimage import io, transform
 import pyvips
 import numpy as np
@@ -29,6 +30,9 @@ from tqdm import tqdm
 import scyjava
 from difflib import get_close_matches
 import traceback
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from colorama import Fore
 from . import valtils
@@ -52,6 +56,20 @@ Default tiff compression method
 MAX_TILE_SIZE = 2**10
 """int: maximum tile used to read or write images"""
 
+TIFF_COMPRESSION_CODES = {"none": 1, "deflate": 8}
+"""dict: TIFF compression codes for the compression methods supported by `OmeTiffTileWriter`"""
+
+DEFLATE_LEVEL = 6
+"""int: zlib compression level used by `OmeTiffTileWriter`"""
+
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_LONG8 = 16
+TIFF_IFD8 = 18
+TIFF_TYPE_DTYPES = {TIFF_ASCII: "<u1", TIFF_SHORT: "<u2", TIFF_LONG: "<u4", TIFF_LONG8: "<u8", TIFF_IFD8: "<u8"}
+"""dict: numpy dtype of each TIFF field type used when writing IFDs"""
+
 BF_RDR = "bioformats"
 """str: Name of Bioformats reader."""
 
@@ -92,6 +110,12 @@ VIPS_RGB_FORMATS = [x.lower() for x in dir(pyvips.enums.Interpretation) if re.se
 """list: List of libvips rgb formats
 """
 
+CZI_MIN_TILES_PARALLEL = 4
+"""int: Minimum number of CZI subblocks before decoding is dispatched to a process pool"""
+
+CZI_READER_CACHE_SIZE = 8
+"""int: Maximum number of CZI files each process keeps open for reading subblocks"""
+
 BF_FORMAT_F = os.path.join(os.path.split(__file__)[0], "data/bf_formats.txt")
 
 
@@ -943,6 +967,118 @@ class MetaData(object):
         self.optimal_tile_wh = 1024
 
 
+def get_thumbnail_shape_rc(slide_shape_wh, max_dim):
+    """Get shape of a thumbnail whose largest dimension is at most `max_dim`
+
+    Parameters
+    ----------
+    slide_shape_wh : tuple of int
+        Width and height of the full resolution slide
+
+    max_dim : int
+        Maximum width or height of the thumbnail. Thumbnails are
+        never larger than `slide_shape_wh`
+
+    Returns
+    -------
+    thumbnail_shape_rc : ndarray
+        Number of rows and columns in the thumbnail
+
+    """
+
+    slide_shape_rc = np.array(slide_shape_wh[0:2])[::-1]
+    s = min(1.0, max_dim/np.max(slide_shape_rc))
+    thumbnail_shape_rc = np.maximum(np.round(slide_shape_rc*s), 1).astype(int)
+
+    return thumbnail_shape_rc
+
+
+def get_thumbnail_level(slide_dimensions, thumbnail_shape_rc):
+    """Get smallest pyramid level that is at least as large as the thumbnail
+
+    Parameters
+    ----------
+    slide_dimensions : ndarray
+        Dimensions (width, height) of each pyramid level
+
+    thumbnail_shape_rc : tuple of int
+        Number of rows and columns in the thumbnail
+
+    Returns
+    -------
+    level : int
+        Pyramid level to downsample to create the thumbnail
+
+    """
+
+    possible_levels = np.where(np.all(slide_dimensions >= np.array(thumbnail_shape_rc)[::-1], axis=1))[0]
+    if len(possible_levels) > 0:
+        level = possible_levels[-1]
+    else:
+        level = 0
+
+    return level
+
+
+def _resize_thumbnail(vips_img, thumbnail_shape_rc):
+    """Resize `vips_img` so that it has shape `thumbnail_shape_rc`
+    """
+    h, w = thumbnail_shape_rc
+    if vips_img.width == w and vips_img.height == h:
+        return vips_img
+
+    thumbnail = vips_img.resize(w/vips_img.width, vscale=h/vips_img.height)
+
+    return thumbnail
+
+
+def _vips_thumbnail(src_f, thumbnail_shape_rc):
+    """Create thumbnail using libvips, which can shrink-on-load
+
+    Only suitable for 8-bit RGB images, as `thumbnail` converts other images to sRGB.
+
+    Returns
+    -------
+    thumbnail : pyvips.Image
+        Thumbnail with shape `thumbnail_shape_rc`, or None if
+        libvips could not create it.
+
+    """
+
+    try:
+        thumbnail = pyvips.Image.thumbnail(src_f, thumbnail_shape_rc[1], height=thumbnail_shape_rc[0],
+                                           size=pyvips.enums.Size.FORCE, no_rotate=True)
+    except pyvips.error.Error as e:
+        traceback_msg = traceback.format_exc()
+        msg = f"Unable to create thumbnail of {valtils.get_name(src_f)} using libvips. Will resize the image instead"
+        valtils.print_warning(msg, traceback_msg=traceback_msg)
+
+        return None
+
+    if thumbnail.hasalpha() and thumbnail.bands == 4:
+        thumbnail = thumbnail.flatten()
+
+    return thumbnail
+
+
+def _shrink_tile(tile, shrink):
+    """Downsample a tile by averaging blocks of `shrink` x `shrink` pixels
+
+    Tiles are padded by repeating the edges, so that partial
+    blocks are averaged too.
+
+    """
+    h, w = tile.shape[0:2]
+    pad_width = [(0, -h % shrink), (0, -w % shrink)] + [(0, 0)]*(tile.ndim - 2)
+    padded = np.pad(tile, pad_width, mode="edge")
+    blocks = padded.reshape(padded.shape[0]//shrink, shrink, padded.shape[1]//shrink, shrink, *tile.shape[2:])
+    shrunk = blocks.mean(axis=(1, 3))
+    if np.issubdtype(tile.dtype, np.integer):
+        shrunk = np.round(shrunk)
+
+    return shrunk.astype(tile.dtype)
+
+
 class SlideReader(object):
     """Read slides and get metadata
 
@@ -1014,6 +1150,44 @@ class SlideReader(object):
 
         """
 
+    def read_thumbnail(self, max_dim, out_shape_rc=None, *args, **kwargs):
+        """Read a downsampled copy of the slide
+
+        Reads the smallest pyramid level that is at least as large as
+        the thumbnail, and then resizes it. Subclasses override this to
+        avoid reading all of that level's pixels, e.g. by using
+        shrink-on-load or downsampling tiles as they are read.
+
+        Parameters
+        -----------
+        max_dim : int
+            Maximum width or height of the thumbnail. The thumbnail
+            will have the same aspect ratio as the slide.
+
+        out_shape_rc : tuple of int, optional
+            Number of rows and columns in the thumbnail. If provided,
+            `max_dim` is ignored.
+
+        Returns
+        -------
+        thumbnail : pyvips.Image
+            Downsampled copy of the slide
+
+        """
+
+        thumbnail_shape_rc = self._get_thumbnail_shape_rc(max_dim, out_shape_rc)
+        level = get_thumbnail_level(self.metadata.slide_dimensions, thumbnail_shape_rc)
+        vips_img = self.slide2vips(level=level, *args, **kwargs)
+        thumbnail = _resize_thumbnail(vips_img, thumbnail_shape_rc)
+
+        return thumbnail
+
+    def _get_thumbnail_shape_rc(self, max_dim, out_shape_rc=None):
+        if out_shape_rc is not None:
+            return np.array(out_shape_rc[0:2]).astype(int)
+
+        return get_thumbnail_shape_rc(self.metadata.slide_dimensions[0], max_dim)
+
     def guess_image_type(self):
         f"""Guess if image is {slide_tools.IHC_NAME} or {slide_tools.IF_NAME}
 
@@ -1229,9 +1403,13 @@ class BioFormatsSlideReader(SlideReader):
                       fset=_set_series,
                       doc="Slide series")
 
-    def get_tiles_parallel(self, level, tile_bbox_list, pixel_type, series=0, z=0, t=0):
+    def get_tiles_parallel(self, level, tile_bbox_list, pixel_type, series=0, z=0, t=0, shrink=1):
         """Get tiles to slice from the slide
 
+        If `shrink` > 1, each tile is downsampled by that factor as soon
+        as it is read, so that the full resolution tiles don't need to
+        be kept in memory.
+
         """
 
         n_tiles = len(tile_bbox_list)
@@ -1252,6 +1430,9 @@ class BioFormatsSlideReader(SlideReader):
             # jpype.detachThreadFromJVM()
             jpype.java.lang.Thread.detach()
 
+            if shrink > 1:
+                tile = _shrink_tile(tile, shrink)
+
             tile_array[idx] = slide_tools.numpy2vips(tile, self.metadata.pyvips_interpretation)
 
         n_cpu = valtils.get_ncpus_available() - 1
@@ -1327,6 +1508,71 @@ class BioFormatsSlideReader(SlideReader):
 
         return vips_slide
 
+    def read_thumbnail(self, max_dim, out_shape_rc=None, series=None, z=0, t=0, *args, **kwargs):
+        """Read a downsampled copy of the slide
+
+        Tiles are read from the smallest pyramid level that is at least
+        as large as the thumbnail, and each tile is downsampled as soon
+        as it is read.
+
+        Parameters
+        -----------
+        max_dim : int
+            Maximum width or height of the thumbnail
+
+        out_shape_rc : tuple of int, optional
+            Number of rows and columns in the thumbnail. If provided,
+            `max_dim` is ignored.
+
+        series : int, optional
+            Series number. Defaults to `series`
+
+        Returns
+        -------
+        thumbnail : pyvips.Image
+            Downsampled copy of the slide
+
+        """
+
+        if series is None:
+            series = self.series
+        else:
+            self.series = series
+
+        thumbnail_shape_rc = self._get_thumbnail_shape_rc(max_dim, out_shape_rc)
+        level = get_thumbnail_level(self.metadata.slide_dimensions, thumbnail_shape_rc)
+        slide_shape_wh = self.metadata.slide_dimensions[level]
+        shrink = int(np.min(slide_shape_wh/thumbnail_shape_rc[::-1]))
+        if shrink <= 1:
+            vips_slide = self.slide2vips(level=level, series=series, z=z, t=t)
+            return _resize_thumbnail(vips_slide, thumbnail_shape_rc)
+
+        rdr, meta = self._get_bf_objects()
+        pixel_type, drange = bf_to_numpy_dtype(rdr.getPixelType(),
+                                               rdr.isLittleEndian())
+        tile_wh = rdr.getOptimalTileWidth()
+        rdr.close()
+
+        # Tiles need to be a multiple of `shrink` so that the downsampled tiles line up
+        tile_wh = min(tile_wh, MAX_TILE_SIZE)
+        tile_wh = max(tile_wh - tile_wh % shrink, shrink)
+
+        tile_bbox = warp_tools.get_grid_bboxes(slide_shape_wh[::-1],
+                                               tile_wh, tile_wh, inclusive=True)
+
+        n_across = len(np.unique(tile_bbox[:, 0]))
+        vips_slide = pyvips.Image.arrayjoin(
+                                  self.get_tiles_parallel(level, tile_bbox_list=tile_bbox, pixel_type=pixel_type, series=series, z=z, t=t, shrink=shrink),
+                                  across=n_across)
+
+        # arrayjoin puts each tile in a cell the size of the largest tile, so remove the padding after the partial edge tiles
+        shrunk_shape_wh = np.ceil(slide_shape_wh/shrink).astype(int)
+        vips_slide = vips_slide.crop(0, 0, *shrunk_shape_wh)
+
+        thumbnail = _resize_thumbnail(vips_slide, thumbnail_shape_rc)
+
+        return thumbnail
+
     def slide2image(self, level, series=None, xywh=None, z=0, t=0, *args, **kwargs):
         """Convert slide to image
 
@@ -1826,6 +2072,50 @@ class VipsSlideReader(SlideReader):
 
         return vips_slide
 
+    def read_thumbnail(self, max_dim, out_shape_rc=None, *args, **kwargs):
+        """Read a downsampled copy of the slide
+
+        8-bit RGB slides are read using libvips' `thumbnail`, which
+        will shrink-on-load, using the pyramid's levels or
+        JPEG's DCT scaling. Other slides, whose colors would be
+        converted by `thumbnail`, are resized from the smallest pyramid level that
+        is at least as large as the thumbnail.
+
+        Parameters
+        -----------
+        max_dim : int
+            Maximum width or height of the thumbnail
+
+        out_shape_rc : tuple of int, optional
+            Number of rows and columns in the thumbnail. If provided,
+            `max_dim` is ignored.
+
+        Returns
+        -------
+        thumbnail : pyvips.Image
+            Downsampled copy of the slide
+
+        """
+
+        thumbnail_shape_rc = self._get_thumbnail_shape_rc(max_dim, out_shape_rc)
+        use_vips_thumbnail = self.metadata.is_rgb and \
+                             self.metadata.server in [VIPS_RDR, OPENSLIDE_RDR] and \
+                             self.metadata.bf_datatype == slide_tools.NUMPY_FORMAT_BF_DTYPE["uint8"]
+
+        if use_vips_thumbnail:
+            if self.use_openslide:
+                # Openslide images have an alpha channel, which is removed after reading
+                thumbnail = _vips_thumbnail(f"{self.src_f}[autocrop=true]", thumbnail_shape_rc)
+                if thumbnail is not None:
+                    thumbnail = thumbnail[0:3]
+            else:
+                thumbnail = _vips_thumbnail(self.src_f, thumbnail_shape_rc)
+
+            if thumbnail is not None and thumbnail.bands == self.metadata.n_channels:
+                return thumbnail
+
+        return super().read_thumbnail(max_dim, out_shape_rc=out_shape_rc, *args, **kwargs)
+
     def slide2image(self, level, xywh=None, *args, **kwargs):
         """Convert slide to image
 
@@ -2226,6 +2516,17 @@ class FlattenedPyramidReader(VipsSlideReader):
 
         return vips_slide
 
+    def read_thumbnail(self, max_dim, out_shape_rc=None, *args, **kwargs):
+        """Read a downsampled copy of the slide
+
+        Each page is a single channel, so the channels from the smallest
+        pyramid level that is at least as large as the thumbnail
+        are joined and then resized.
+
+        """
+
+        return SlideReader.read_thumbnail(self, max_dim, out_shape_rc=out_shape_rc, *args, **kwargs)
+
     def slide2image(self, level, xywh=None, *args, **kwargs):
         if level < 0:
             valtils.print_warning(f"level is negative {level} for {self.src_f}. Should be >= 0")
@@ -2406,7 +2707,7 @@ class CziJpgxrReader(SlideReader):
         Image series
 
     """
-    def __init__(self, src_f, series=None, *args, **kwargs):
+    def __init__(self, src_f, series=None, random_access=True, n_jobs=None, *args, **kwargs):
         """
         Parameters
         -----------
@@ -2417,6 +2718,18 @@ class CziJpgxrReader(SlideReader):
             The series to be read. If `series` is None, the the `series`
             will be set to the series associated with the largest image.
 
+        random_access : bool
+            Whether or not to read regions using an index of the mosaic's
+            subblocks, so that only the subblocks overlapping the requested
+            region are decoded. Subsampled pyramid levels are read directly
+            from the file. If False, or if the index can't be built (e.g. the
+            image is not a mosaic), the whole level 0 mosaic will be assembled
+            and then sliced/resized.
+
+        n_jobs : int, optional
+            Number of processes used to decode subblocks. If None, will
+            use all but 1 of the available CPUs.
+
         """
         try:
             from aicspylibczi import CziFile
@@ -2430,6 +2743,9 @@ class CziJpgxrReader(SlideReader):
 
         self.is_bgr = False
         self.meta_list = [None]
+        self.random_access = random_access
+        self.n_jobs = n_jobs
+        self._mosaic_tile_index = {}
 
         super().__init__(src_f=src_f, *args, **kwargs)
 
@@ -2513,27 +2829,175 @@ class CziJpgxrReader(SlideReader):
 
         return vips_img
 
+    def _get_mosaic_tile_index(self):
+        """Get bounding boxes of the level 0 subblocks in the current scene
+
+        The index is built once per scene and cached.
+
+        Returns
+        -------
+        m_idx : ndarray
+            M-index of each subblock
+
+        tile_xywh : ndarray
+            (N, 4) array of each subblock's bounding box (x, y, width, height),
+            relative to the scene's top left corner.
+
+        """
+        if self.series not in self._mosaic_tile_index:
+            czi_reader = CziFile(self.src_f)
+            scene_bbox = czi_reader.get_all_scene_bounding_boxes()[self.series]
+            tile_bboxes = czi_reader.get_all_mosaic_tile_bounding_boxes(S=self.series, C=0)
+            if len(tile_bboxes) == 0:
+                raise ValueError(f"No mosaic tiles found for scene {self.series} in {self.src_f}")
+
+            m_idx = np.array([tile_info.m_index for tile_info in tile_bboxes.keys()])
+            tile_xywh = np.array([[bbox.x - scene_bbox.x, bbox.y - scene_bbox.y, bbox.w, bbox.h]
+                                  for bbox in tile_bboxes.values()])
+
+            self._mosaic_tile_index[self.series] = (m_idx, tile_xywh)
+
+        return self._mosaic_tile_index[self.series]
+
+    def _map_to_pool(self, fxn, *iterables):
+        """Run `fxn` in a process pool, or serially if there are only a few jobs
+        """
+        iterables = [list(x) for x in iterables]
+        n_jobs = len(iterables[0])
+        n_cpu = self.n_jobs
+        if n_cpu is None:
+            n_cpu = valtils.get_ncpus_available() - 1
+
+        n_cpu = min(n_cpu, n_jobs)
+        if n_cpu <= 1 or n_jobs < CZI_MIN_TILES_PARALLEL:
+            return [fxn(*args) for args in zip(*iterables)]
+
+        with ProcessPoolExecutor(max_workers=n_cpu) as executor:
+            res = list(executor.map(fxn, *iterables))
+
+        return res
+
+    def _read_mosaic_region(self, level=0, xywh=None):
+        """Read a region of the mosaic, decoding only the overlapping subblocks
+
+        Level 0 regions are assembled from the subblocks that intersect
+        `xywh`, which are decoded in parallel. Other levels are read using
+        the subsampled pyramid subblocks, in horizontal bands that are also
+        read in parallel.
+
+        Parameters
+        ----------
+        level : int
+            Pyramid level
+
+        xywh : tuple of int, optional
+            The region to be read, in the coordinates of `level`. If None,
+            the whole scene will be read.
+
+        Returns
+        -------
+        vips_img : pyvips.Image
+            Image of the region
+
+        """
+
+        level_wh = self.metadata.slide_dimensions[level]
+        if xywh is None:
+            xywh = (0, 0, *level_wh)
+        x, y, w, h = [int(v) for v in xywh]
+
+        m_idx, tile_xywh = self._get_mosaic_tile_index()
+        np_dtype = slide_tools.CZI_FORMAT_TO_BF_FORMAT[CziFile(self.src_f).pixel_type]
+        region = np.zeros((h, w, self.metadata.n_channels), dtype=np_dtype)
+
+        if level == 0:
+            tile_x1 = tile_xywh[:, 0] + tile_xywh[:, 2]
+            tile_y1 = tile_xywh[:, 1] + tile_xywh[:, 3]
+            overlapping = np.where((tile_xywh[:, 0] < x + w) & (tile_x1 > x) &
+                                   (tile_xywh[:, 1] < y + h) & (tile_y1 > y))[0]
+
+            n_tiles = len(overlapping)
+            tiles = self._map_to_pool(_read_czi_tile,
+                                      [self.src_f]*n_tiles,
+                                      [self.series]*n_tiles,
+                                      m_idx[overlapping],
+                                      [self.is_bgr]*n_tiles)
+
+            tile_positions = tile_xywh[overlapping, 0:2] - [x, y]
+        else:
+            zoom = self.metadata._zoom_levels[level]
+            scene_bbox = CziFile(self.src_f).get_all_scene_bounding_boxes()[self.series]
+            band_h = MAX_TILE_SIZE
+            band_y = np.arange(y, y + h, band_h)
+            band_regions = [(scene_bbox.x + int(np.floor(x/zoom)),
+                             scene_bbox.y + int(np.floor(by/zoom)),
+                             int(np.ceil(w/zoom)),
+                             int(np.ceil(min(band_h, y + h - by)/zoom)))
+                            for by in band_y]
+
+            n_bands = len(band_regions)
+            channels = None if self.metadata.is_rgb else list(range(self.metadata.n_channels))
+            tiles = self._map_to_pool(_read_czi_scaled_region,
+                                      [self.src_f]*n_bands,
+                                      [self.series]*n_bands,
+                                      band_regions,
+                                      [zoom]*n_bands,
+                                      [channels]*n_bands,
+                                      [self.is_bgr]*n_bands)
+
+            tile_positions = np.array([[0, by - y] for by in band_y])
+
+        for tile, (tx, ty) in zip(tiles, tile_positions):
+            # Clip tile to the region
+            r0, c0 = max(0, -ty), max(0, -tx)
+            r1 = min(tile.shape[0], h - ty)
+            c1 = min(tile.shape[1], w - tx)
+            if r1 <= r0 or c1 <= c0:
+                continue
+
+            region[ty + r0:ty + r1, tx + c0:tx + c1] = tile[r0:r1, c0:c1, :region.shape[2]]
+
+        if region.shape[2] == 1:
+            region = region[..., 0]
+
+        vips_img = warp_tools.numpy2vips(region)
+
+        return vips_img
+
     def slide2vips(self, level=0, xywh=None, *args, **kwargs):
         if level < 0:
             valtils.print_warning(f"level is negative {level} for {self.src_f}. Should be >= 0")
         level = max(0, level)
 
-        try:
-            # Image is mosaic
-            vips_img = self._read_mosaic(level=level, xywh=xywh,*args, **kwargs)
+        vips_img = None
+        if self.random_access:
+            try:
+                vips_img = self._read_mosaic_region(level=level, xywh=xywh)
+            except Exception as e:
+                traceback_msg = traceback.format_exc()
+                msg = (f"Unable to read {valtils.get_name(self.src_f)} using the mosaic tile index. "
+                       f"Will assemble the full mosaic instead")
+                valtils.print_warning(msg, traceback_msg=traceback_msg)
+                self.random_access = False
 
-        except Exception as e:
-            print(e)
-            print("Reading whole image")
-            vips_img = self._read_whole_img(level=level, xywh=xywh,*args, **kwargs)
+        if vips_img is None:
+            try:
+                # Image is mosaic
+                vips_img = self._read_mosaic(level=level, xywh=xywh,*args, **kwargs)
 
-        czi_reader = CziFile(self.src_f)
-        if xywh is not None:
-            vips_img = vips_img.extract_area(*xywh)
+            except Exception as e:
+                print(e)
+                print("Reading whole image")
+                vips_img = self._read_whole_img(level=level, xywh=xywh,*args, **kwargs)
+
+            if xywh is not None:
+                vips_img = vips_img.extract_area(*xywh)
+
+            if level != 0:
+                scaling = self.metadata._zoom_levels[level]
+                vips_img = warp_tools.rescale_img(vips_img, scaling)
 
-        if level != 0:
-            scaling = self.metadata._zoom_levels[level]
-            vips_img = warp_tools.rescale_img(vips_img, scaling)
+        czi_reader = CziFile(self.src_f)
         if self.is_bgr:
             vips_img = vips_img.copy(interpretation="srgb")
 
@@ -2572,6 +3036,80 @@ class CziJpgxrReader(SlideReader):
 
         return np_img
 
+    def _read_scaled_mosaic(self, zoom):
+        """Read the whole scene, downsampled by `zoom`
+
+        libCZI builds the scaled image from the pyramid's subblocks. The
+        scene is read in horizontal bands, which are read in parallel.
+
+        """
+
+        scene_bbox = CziFile(self.src_f).get_all_scene_bounding_boxes()[self.series]
+        band_h = int(np.ceil(MAX_TILE_SIZE/zoom))
+        band_regions = [(scene_bbox.x, scene_bbox.y + by, scene_bbox.w, min(band_h, scene_bbox.h - by))
+                        for by in range(0, scene_bbox.h, band_h)]
+
+        n_bands = len(band_regions)
+        channels = None if self.metadata.is_rgb else list(range(self.metadata.n_channels))
+        bands = self._map_to_pool(_read_czi_scaled_region,
+                                  [self.src_f]*n_bands,
+                                  [self.series]*n_bands,
+                                  band_regions,
+                                  [zoom]*n_bands,
+                                  [channels]*n_bands,
+                                  [self.is_bgr]*n_bands)
+
+        np_img = np.vstack(bands)
+        if np_img.ndim == 3 and np_img.shape[2] == 1:
+            np_img = np_img[..., 0]
+
+        vips_img = warp_tools.numpy2vips(np_img)
+        if self.is_bgr:
+            vips_img = vips_img.copy(interpretation="srgb")
+
+        return vips_img
+
+    def read_thumbnail(self, max_dim, out_shape_rc=None, *args, **kwargs):
+        """Read a downsampled copy of the slide
+
+        If `random_access` is True, the scene is read at the thumbnail's
+        scale, using the subsampled pyramid subblocks. Otherwise, the
+        smallest pyramid level that is at least as large as the thumbnail
+        is read and then resized.
+
+        Parameters
+        -----------
+        max_dim : int
+            Maximum width or height of the thumbnail
+
+        out_shape_rc : tuple of int, optional
+            Number of rows and columns in the thumbnail. If provided,
+            `max_dim` is ignored.
+
+        Returns
+        -------
+        thumbnail : pyvips.Image
+            Downsampled copy of the slide
+
+        """
+
+        thumbnail_shape_rc = self._get_thumbnail_shape_rc(max_dim, out_shape_rc)
+        if self.random_access:
+            zoom = min(1.0, np.max(thumbnail_shape_rc[::-1]/self.metadata.slide_dimensions[0]))
+            try:
+                vips_img = self._read_scaled_mosaic(zoom)
+                thumbnail = _resize_thumbnail(vips_img, thumbnail_shape_rc)
+
+                return thumbnail
+
+            except Exception as e:
+                traceback_msg = traceback.format_exc()
+                msg = (f"Unable to read scaled mosaic of {valtils.get_name(self.src_f)}. "
+                       f"Will resize a pyramid level instead")
+                valtils.print_warning(msg, traceback_msg=traceback_msg)
+
+        return super().read_thumbnail(max_dim, out_shape_rc=out_shape_rc, *args, **kwargs)
+
     def create_metadata(self):
         """ Create and fill in a MetaData object
 
@@ -2794,6 +3332,83 @@ class CziJpgxrReader(SlideReader):
         return tuple(physical_size_xyu)
 
 
+@functools.lru_cache(maxsize=CZI_READER_CACHE_SIZE)
+def _open_czi_file(src_f, file_id):
+    return CziFile(src_f)
+
+
+def _get_czi_file(src_f):
+    """Get CziFile for `src_f`, opening it only once per process
+
+    Readers are keyed by the file's path, size, and modification time, so
+    that a file that is replaced is re-opened. Only the `CZI_READER_CACHE_SIZE`
+    most recently used files are kept open.
+
+    """
+
+    return _open_czi_file(src_f, valtils.get_file_id(src_f))
+
+
+def _read_czi_tile(src_f, series, m_index, is_bgr):
+    """Decode a single mosaic subblock
+
+    Returns
+    -------
+    np_tile : ndarray
+        Subblock with shape (height, width, n_channels)
+
+    """
+    czi_reader = _get_czi_file(src_f)
+    np_tile, tile_dims = czi_reader.read_image(S=series, M=m_index)
+    dim_names = [k for k, v in tile_dims]
+
+    keep_dims = ["C", "Y", "X", "A"]
+    slice_dims = [slice(None) if k in keep_dims else 0 for k in dim_names]
+    np_tile = np_tile[tuple(slice_dims)]
+    dim_names = [k for k in dim_names if k in keep_dims]
+
+    if "A" in dim_names:
+        # RGB/BGR samples are already the last axis
+        np_tile = np_tile.reshape(np_tile.shape[-3:])
+        if is_bgr:
+            np_tile = np_tile[..., ::-1]
+    elif "C" in dim_names:
+        np_tile = np.moveaxis(np_tile, dim_names.index("C"), -1)
+    else:
+        np_tile = np_tile[..., np.newaxis]
+
+    return np_tile
+
+
+def _read_czi_scaled_region(src_f, series, region_xywh, scale_factor, channels, is_bgr):
+    """Read a region of the mosaic at a subsampled pyramid level
+
+    Parameters
+    ----------
+    region_xywh : tuple of int
+        Region in the mosaic's level 0 coordinates
+
+    channels : list of int, optional
+        Channels to read. If None, the image is assumed to be RGB/BGR
+
+    Returns
+    -------
+    np_region : ndarray
+        Region with shape (height, width, n_channels)
+
+    """
+    czi_reader = _get_czi_file(src_f)
+    if channels is None:
+        np_region = czi_reader.read_mosaic(region=region_xywh, scale_factor=scale_factor, S=series, C=0)[0]
+        if is_bgr:
+            np_region = np_region[..., ::-1]
+    else:
+        np_region = np.dstack([czi_reader.read_mosaic(region=region_xywh, scale_factor=scale_factor, S=series, C=c)[0]
+                               for c in channels])
+
+    return np_region
+
+
 class ImageReader(SlideReader):
     """Read image using scikit-image
 
@@ -2832,6 +3447,22 @@ class ImageReader(SlideReader):
 
         return vips_img
 
+    def read_thumbnail(self, max_dim, out_shape_rc=None, *args, **kwargs):
+        """Read a downsampled copy of the image
+
+        8-bit RGB images that libvips can read are shrunk as they are loaded,
+        e.g. using JPEG's DCT scaling. Other images are read and then resized.
+
+        """
+
+        thumbnail_shape_rc = self._get_thumbnail_shape_rc(max_dim, out_shape_rc)
+        if self.metadata.is_rgb and slide_tools.get_slide_extension(self.src_f) in pyvips.get_suffixes():
+            thumbnail = _vips_thumbnail(self.src_f, thumbnail_shape_rc)
+            if thumbnail is not None and thumbnail.bands == 3:
+                return thumbnail
+
+        return super().read_thumbnail(max_dim, out_shape_rc=out_shape_rc, *args, **kwargs)
+
     def slide2image(self, xywh=None, *args, **kwargs):
         img = io.imread(self.src_f)
 
@@ -3255,7 +3886,7 @@ def create_ome_xml(shape_xyzct, bf_dtype, is_rgb, pixel_physical_size_xyu=None,
         new_img.pixels.physical_size_y_unit = phys_u
 
     if is_rgb:
-        rgb_channel = ome_types.model.Channel(id='Channel:0:0', samples_per_pixel=3)
+        rgb_channel = ome_types.model.Channel(id='Channel:0:0', samples_per_pixel=c)
         new_img.pixels.channels = [rgb_channel]
 
     else:
@@ -3534,6 +4165,75 @@ def warp_and_save_slide(src_f, dst_f, transformation_src_shape_rc, transformatio
                   tile_wh=tile_wh, compression=compression, Q=Q, pyramid=pyramid)
 
 
+def check_ome_tiff_dst_f(dst_f):
+    """Make sure `dst_f` has the .ome.tiff extension
+
+    Returns
+    -------
+    dst_f : str
+        `dst_f`, with the extension changed to .ome.tiff if needed
+
+    """
+    dst_f_extension = slide_tools.get_slide_extension(dst_f)
+    if dst_f_extension != ".ome.tiff":
+        dst_dir, out_f = os.path.split(dst_f)
+        new_out_f = out_f.split(dst_f_extension)[0] + ".ome.tiff"
+        new_dst_f = os.path.join(dst_dir, new_out_f)
+        msg = f"{out_f} is not an ome.tiff. Changing dst_f to {new_dst_f}"
+        valtils.print_warning(msg)
+        dst_f = new_dst_f
+
+    return dst_f
+
+
+def check_ome_xml(ome_xml, shape_xyzct, bf_dtype, is_rgb):
+    """Verify that ome-xml matches the image that will be saved
+
+    Parameters
+    ----------
+    ome_xml : str, optional
+        ome-xml string describing image's metadata. If None, or if it
+        does not match the image, a minimal ome-xml will be created
+
+    shape_xyzct : tuple of int
+        XYZCT shape of image that will be saved, e.g. from `get_shape_xyzct`
+
+    bf_dtype : str
+        Bio-Formats datatype of the image
+
+    is_rgb : bool
+        Whether or not the image is RGB
+
+    Returns
+    -------
+    ome_xml_obj : ome_types.model.OME
+        ome_types.model.OME object containing ome-xml metadata
+
+    """
+    if ome_xml is None:
+        # Create minimal ome-xml
+        ome_xml_obj = create_ome_xml(shape_xyzct=shape_xyzct, bf_dtype=bf_dtype, is_rgb=is_rgb)
+    else:
+        # Verify that image and ome-xml match
+        ome_xml_obj = get_ome_obj(ome_xml)
+        ome_img = ome_xml_obj.images[0].pixels
+        total_pages = ome_img.size_c*ome_img.size_z*ome_img.size_t
+        n_bands = shape_xyzct[3]*shape_xyzct[2]*shape_xyzct[4]
+
+        match_dict = {"same_x": ome_img.size_x == shape_xyzct[0],
+                      "same_y": ome_img.size_y == shape_xyzct[1],
+                      "total_pages": total_pages == n_bands,
+                      "same_type": ome_img.type.name.lower() == bf_dtype
+                      }
+
+        if not all(list(match_dict.values())):
+            msg = f"mismatch in ome-xml and image: {str(match_dict)}. Will create ome-xml"
+            valtils.print_warning(msg)
+            ome_xml_obj = create_ome_xml(shape_xyzct, bf_dtype, is_rgb)
+
+    return ome_xml_obj
+
+
 def save_ome_tiff(img, dst_f, ome_xml=None, tile_wh=512, compression=DEFAULT_COMPRESSION, Q=100, pyramid=True):
     """Save an image in the ome.tiff format using pyvips
 
@@ -3578,14 +4278,7 @@ def save_ome_tiff(img, dst_f, ome_xml=None, tile_wh=512, compression=DEFAULT_COM
 
             return None
 
-    dst_f_extension = slide_tools.get_slide_extension(dst_f)
-    if dst_f_extension != ".ome.tiff":
-        dst_dir, out_f = os.path.split(dst_f)
-        new_out_f = out_f.split(dst_f_extension)[0] + ".ome.tiff"
-        new_dst_f = os.path.join(dst_dir, new_out_f)
-        msg = f"{out_f} is not an ome.tiff. Changing dst_f to {new_dst_f}"
-        valtils.print_warning(msg)
-        dst_f = new_dst_f
+    dst_f = check_ome_tiff_dst_f(dst_f)
 
     # Get ome-xml metadata #
     xyzct = get_shape_xyzct((img.width, img.height), img.bands)
@@ -3594,26 +4287,7 @@ def save_ome_tiff(img, dst_f, ome_xml=None, tile_wh=512, compression=DEFAULT_COM
     is_rgb = og_interpretation in VIPS_RGB_FORMATS
 
     bf_dtype = vips2bf_dtype(img.format)
-    if ome_xml is None:
-        # Create minimal ome-xml
-        ome_xml_obj = create_ome_xml(shape_xyzct=xyzct, bf_dtype=bf_dtype, is_rgb=is_rgb)
-    else:
-        # Verify that vips image and ome-xml match
-        ome_xml_obj = get_ome_obj(ome_xml)
-        ome_img = ome_xml_obj.images[0].pixels
-        total_pages = ome_img.size_c*ome_img.size_z*ome_img.size_t
-
-        match_dict = {"same_x": ome_img.size_x == img.width,
-                      "same_y": ome_img.size_y == img.height,
-                      "total_pages": total_pages == img.bands,
-                      "same_type": ome_img.type.name.lower() == bf_dtype
-                      }
-
-        if not all(list(match_dict.values())):
-            msg = f"mismatch in ome-xml and image: {str(match_dict)}. Will create ome-xml"
-            valtils.print_warning(msg)
-            ome_xml_obj = create_ome_xml(xyzct, bf_dtype, is_rgb)
-
+    ome_xml_obj = check_ome_xml(ome_xml, shape_xyzct=xyzct, bf_dtype=bf_dtype, is_rgb=is_rgb)
     ome_xml_obj.creator = f"pyvips version {pyvips.__version__}"
     ome_metadata = ome_xml_obj.to_xml()
 
@@ -3700,6 +4374,634 @@ def save_ome_tiff(img, dst_f, ome_xml=None, tile_wh=512, compression=DEFAULT_COM
     print("")
 
 
+def _compress_tile(tile, compression_code):
+    """Compress a tile so that it can be written to a TIFF
+    """
+    tile_bytes = np.ascontiguousarray(tile).tobytes()
+    if compression_code == TIFF_COMPRESSION_CODES["deflate"]:
+        tile_bytes = zlib.compress(tile_bytes, DEFLATE_LEVEL)
+
+    return tile_bytes
+
+
+def _decompress_tile(tile_bytes, compression_code, tile_shape, dtype):
+    """Decompress a tile written using `_compress_tile`
+    """
+    if compression_code == TIFF_COMPRESSION_CODES["deflate"]:
+        tile_bytes = zlib.decompress(tile_bytes)
+
+    tile = np.frombuffer(tile_bytes, dtype=dtype).reshape(tile_shape)
+
+    return tile
+
+
+def _downsample_2x(img):
+    """Downsample an image by half, averaging each 2x2 block
+
+    Odd sized images are padded by repeating the last row/column
+
+    """
+    h, w = img.shape[0:2]
+    pad_h = h % 2
+    pad_w = w % 2
+    if pad_h or pad_w:
+        img = np.pad(img, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+
+    acc_dtype = np.float32 if img.dtype.itemsize <= 2 else np.float64
+    blocks = img.reshape(img.shape[0]//2, 2, img.shape[1]//2, 2, img.shape[2]).astype(acc_dtype)
+    small_img = blocks.mean(axis=(1, 3))
+    if np.issubdtype(img.dtype, np.integer):
+        small_img = np.round(small_img)
+
+    return small_img.astype(img.dtype)
+
+
+def _downsample_tile_block(child_tiles, valid_wh, tile_shape, dtype, compression_code):
+    """Create a tile for the next pyramid level from a 2x2 block of tiles
+
+    Parameters
+    ----------
+    child_tiles : list of bytes
+        Compressed tiles in the order TL, TR, BL, BR. Tiles that
+        are outside of the image should be None.
+
+    valid_wh : tuple of int
+        Width and height of the block that is inside the image
+
+    tile_shape : tuple of int
+        Shape of each tile (tile_h, tile_w, samples_per_pixel)
+
+    Returns
+    -------
+    tile_bytes : bytes
+        Compressed tile for the next pyramid level
+
+    """
+
+    tile_h, tile_w = tile_shape[0:2]
+    block = np.zeros((2*tile_h, 2*tile_w, tile_shape[2]), dtype=dtype)
+    for i, tile_bytes in enumerate(child_tiles):
+        if tile_bytes is None:
+            continue
+        r, c = divmod(i, 2)
+        block[r*tile_h:(r + 1)*tile_h, c*tile_w:(c + 1)*tile_w] = _decompress_tile(tile_bytes, compression_code, tile_shape, dtype)
+
+    small_block = _downsample_2x(block[:valid_wh[1], :valid_wh[0]])
+    tile = np.zeros(tile_shape, dtype=dtype)
+    tile[:small_block.shape[0], :small_block.shape[1]] = small_block
+
+    return _compress_tile(tile, compression_code)
+
+
+def _write_tiff_ifd(fh, entries, next_ifd_offset=0):
+    """Write a BigTIFF IFD at the end of the file
+
+    Parameters
+    ----------
+    fh : file
+        File opened in binary mode
+
+    entries : list of tuple
+        List of (tag, tiff_type, value) tuples. ASCII values should
+        be bytes, others numbers or arrays of numbers
+
+    next_ifd_offset : int
+        Offset of the next IFD
+
+    Returns
+    -------
+    ifd_offset : int
+        Where the IFD was written
+
+    next_ifd_pos : int
+        Where the next IFD's offset is stored, so it can be updated later
+
+    """
+
+    entries = sorted(entries, key=lambda x: x[0])
+    ifd_offset = fh.seek(0, 2)
+    if ifd_offset % 2 != 0:
+        fh.write(b"\0")
+        ifd_offset += 1
+
+    n_entries = len(entries)
+    next_ifd_pos = ifd_offset + 8 + 20*n_entries
+    data_offset = next_ifd_pos + 8
+
+    ifd_bytes = [struct.pack("<Q", n_entries)]
+    extra_bytes = []
+    for tag, tiff_type, value in entries:
+        if tiff_type == TIFF_ASCII:
+            value_bytes = value
+        else:
+            value_bytes = np.asarray(value, dtype=TIFF_TYPE_DTYPES[tiff_type]).reshape(-1).tobytes()
+
+        count = len(value_bytes) // np.dtype(TIFF_TYPE_DTYPES[tiff_type]).itemsize
+        if len(value_bytes) <= 8:
+            value_field = value_bytes.ljust(8, b"\0")
+        else:
+            value_field = struct.pack("<Q", data_offset)
+            if len(value_bytes) % 2 != 0:
+                value_bytes += b"\0"
+            extra_bytes.append(value_bytes)
+            data_offset += len(value_bytes)
+
+        ifd_bytes.append(struct.pack("<HHQ", tag, tiff_type, count) + value_field)
+
+    ifd_bytes.append(struct.pack("<Q", next_ifd_offset))
+    fh.write(b"".join(ifd_bytes + extra_bytes))
+
+    return ifd_offset, next_ifd_pos
+
+
+class OmeTiffTileWriter(object):
+    """Write a tiled, pyramid ome.tiff one tile at a time
+
+    Full resolution tiles are passed in one at a time (`write_tile`), or as
+    horizontal strips (`write_strip`). Each tile is compressed in parallel
+    and appended to the file, so only a few tiles are held in memory,
+    regardless of the size of the image or the number of channels.
+    When the writer is closed, the lower resolution pyramid levels are
+    built from the tiles that were already written, so the source image
+    only needs to be computed once. Finally, the IFDs that point to the
+    tiles are written to the end of the BigTIFF.
+
+    Channels are saved as separate pages (one per channel), with the
+    lower resolution levels saved as SubIFDs, which is how `save_ome_tiff`
+    lays out the ome.tiff.
+
+    Attributes
+    ----------
+    dst_f : str
+        Path to the ome.tiff
+
+    shape_wh : tuple of int
+        Width and height of the full resolution image
+
+    n_channels : int
+        Number of channels (bands) in the image
+
+    is_rgb : bool
+        Whether or not the image is RGB. RGB images are saved
+        as a single interleaved page.
+
+    tile_wh : int
+        Width and height of the tiles.
+
+    level_shapes_wh : ndarray
+        Width and height of each level in the pyramid
+
+    n_tiles_xy : ndarray
+        Number of tiles across and down each level in the pyramid
+
+    """
+
+    def __init__(self, dst_f, shape_wh, n_channels, dtype, is_rgb=False, ome_xml=None,
+                 tile_wh=512, compression="deflate", pyramid=True, n_jobs=None):
+        """
+        Parameters
+        ----------
+        dst_f : str
+            Path to where the ome.tiff will be saved
+
+        shape_wh : tuple of int
+            Width and height of the full resolution image
+
+        n_channels : int
+            Number of channels (bands) in the image
+
+        dtype : numpy.dtype
+            Datatype of the image
+
+        is_rgb : bool
+            Whether or not the image is RGB
+
+        ome_xml : str, optional
+            ome-xml string describing image's metadata. If None, it will be created
+
+        tile_wh : int
+            Tile width and height. Will be rounded down to a multiple of 16.
+
+        compression : str
+            Compression method. Either "deflate" or "none".
+
+        pyramid : bool
+            Whether or not to save an image pyramid.
+
+        n_jobs : int, optional
+            Number of threads used to compress tiles. If None, will use all
+            available CPUs.
+
+        """
+
+        compression = str(compression).lower()
+        if compression not in TIFF_COMPRESSION_CODES:
+            raise ValueError(f"compression must be one of {list(TIFF_COMPRESSION_CODES.keys())}, but got {compression}")
+
+        self.dst_f = check_ome_tiff_dst_f(dst_f)
+        self.shape_wh = np.array(shape_wh[0:2], dtype=int)
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.is_rgb = is_rgb
+        self.compression_code = TIFF_COMPRESSION_CODES[compression]
+
+        tile_wh = max(16, tile_wh - (tile_wh % 16))
+        self.tile_wh = tile_wh
+
+        level_shapes_wh = [self.shape_wh]
+        while pyramid and np.max(level_shapes_wh[-1]) > tile_wh:
+            level_shapes_wh.append(np.ceil(level_shapes_wh[-1]/2).astype(int))
+        self.level_shapes_wh = np.array(level_shapes_wh)
+        self.n_levels = len(level_shapes_wh)
+
+        self.n_pages = 1 if is_rgb else n_channels
+        self.samples_per_pixel = n_channels if is_rgb else 1
+        self.tile_shape = (tile_wh, tile_wh, self.samples_per_pixel)
+
+        # Where each tile is in the file, for each level and page
+        self.n_tiles_xy = np.ceil(self.level_shapes_wh/tile_wh).astype(int)
+        self.tile_offsets = [np.zeros((self.n_pages, *self.n_tiles_xy[i][::-1]), dtype=np.uint64) for i in range(self.n_levels)]
+        self.tile_byte_counts = [np.zeros((self.n_pages, *self.n_tiles_xy[i][::-1]), dtype=np.uint64) for i in range(self.n_levels)]
+
+        self._pending_rows = []
+        self._next_strip_y = 0
+        self._pending_tiles = []
+
+        shape_xyzct = get_shape_xyzct(self.shape_wh, n_channels)
+        bf_dtype = slide_tools.NUMPY_FORMAT_BF_DTYPE[self.dtype.name]
+        ome_xml_obj = check_ome_xml(ome_xml, shape_xyzct=shape_xyzct, bf_dtype=bf_dtype, is_rgb=is_rgb)
+        ome_xml_obj.creator = "valis"
+        self.ome_xml = ome_xml_obj.to_xml()
+
+        if n_jobs is None:
+            n_jobs = valtils.get_ncpus_available()
+        self.n_jobs = max(1, n_jobs)
+        self.executor = ThreadPoolExecutor(max_workers=self.n_jobs)
+
+        pathlib.Path(os.path.split(self.dst_f)[0]).mkdir(exist_ok=True, parents=True)
+        self.fh = open(self.dst_f, "w+b")
+        # BigTIFF header. Offset to the first IFD is updated when closed
+        self.fh.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+
+    def write_tile(self, tile, tile_x, tile_y):
+        """Add a full resolution tile
+
+        Parameters
+        ----------
+        tile : ndarray
+            Tile with shape (height, width, n_channels). Tiles on the right
+            and bottom edges can be smaller than `tile_wh`, and will be padded.
+
+        tile_x, tile_y : int
+            Column and row of the tile, i.e. the tile's top left corner
+            is at (tile_x*tile_wh, tile_y*tile_wh)
+
+        """
+        if tile.ndim == 2:
+            tile = tile[..., np.newaxis]
+
+        padded_tile = np.zeros((self.tile_wh, self.tile_wh, tile.shape[2]), dtype=self.dtype)
+        padded_tile[:tile.shape[0], :tile.shape[1]] = tile[:self.tile_wh, :self.tile_wh]
+        for p in range(self.n_pages):
+            if self.is_rgb:
+                page_tile = padded_tile
+            else:
+                page_tile = padded_tile[..., p]
+
+            future = self.executor.submit(_compress_tile, page_tile, self.compression_code)
+            self._pending_tiles.append((0, p, tile_y, tile_x, future))
+
+        # Limit the number of tiles held in memory
+        if len(self._pending_tiles) >= 2*self.n_jobs*self.n_pages:
+            self._write_pending_tiles()
+
+    def write_strip(self, strip):
+        """Add the next strip of the full resolution image
+
+        Parameters
+        ----------
+        strip : ndarray
+            Next rows of the image, with shape (n_rows, width, n_channels).
+            Strips can have any height, but must be passed in order,
+            from top to bottom.
+
+        """
+        if strip.ndim == 2:
+            strip = strip[..., np.newaxis]
+
+        self._pending_rows.append(strip)
+        n_pending = sum([x.shape[0] for x in self._pending_rows])
+        if n_pending < self.tile_wh:
+            return
+
+        pending = np.vstack(self._pending_rows)
+        n_full = (pending.shape[0] // self.tile_wh) * self.tile_wh
+        self._pending_rows = [pending[n_full:]] if n_full < pending.shape[0] else []
+        for r in range(0, n_full, self.tile_wh):
+            self._write_strip_tiles(pending[r:r + self.tile_wh])
+
+    def _write_strip_tiles(self, rows):
+        tile_y = self._next_strip_y // self.tile_wh
+        self._next_strip_y += rows.shape[0]
+        for tile_x in range(self.n_tiles_xy[0][0]):
+            x0 = tile_x*self.tile_wh
+            self.write_tile(rows[:, x0:x0 + self.tile_wh], tile_x, tile_y)
+
+    def _write_pending_tiles(self):
+        """Write compressed tiles to the file, in the order they were submitted
+        """
+        for level, p, tile_y, tile_x, future in self._pending_tiles:
+            tile_bytes = future.result()
+            self.tile_offsets[level][p, tile_y, tile_x] = self.fh.seek(0, 2)
+            self.tile_byte_counts[level][p, tile_y, tile_x] = len(tile_bytes)
+            self.fh.write(tile_bytes)
+
+        self._pending_tiles = []
+
+    def _read_tile(self, level, page, tile_y, tile_x):
+        if tile_y >= self.n_tiles_xy[level][1] or tile_x >= self.n_tiles_xy[level][0]:
+            return None
+
+        n_bytes = int(self.tile_byte_counts[level][page, tile_y, tile_x])
+        if n_bytes == 0:
+            return None
+
+        self.fh.seek(int(self.tile_offsets[level][page, tile_y, tile_x]))
+
+        return self.fh.read(n_bytes)
+
+    def _build_pyramid(self):
+        """Build each pyramid level from the tiles in the level above it
+        """
+        for level in range(1, self.n_levels):
+            prev_w, prev_h = self.level_shapes_wh[level - 1]
+            n_tiles_x, n_tiles_y = self.n_tiles_xy[level]
+            for p in range(self.n_pages):
+                for tile_y in range(n_tiles_y):
+                    for tile_x in range(n_tiles_x):
+                        child_tiles = [self._read_tile(level - 1, p, 2*tile_y + r, 2*tile_x + c) for r in range(2) for c in range(2)]
+                        valid_wh = (min(2*self.tile_wh, prev_w - 2*tile_x*self.tile_wh),
+                                    min(2*self.tile_wh, prev_h - 2*tile_y*self.tile_wh))
+
+                        future = self.executor.submit(_downsample_tile_block, child_tiles, valid_wh,
+                                                      self.tile_shape, self.dtype, self.compression_code)
+                        self._pending_tiles.append((level, p, tile_y, tile_x, future))
+
+                        if len(self._pending_tiles) >= 2*self.n_jobs:
+                            self._write_pending_tiles()
+
+            self._write_pending_tiles()
+
+    def _get_ifd_entries(self, level, page):
+        level_w, level_h = self.level_shapes_wh[level]
+        bits_per_sample = self.dtype.itemsize*8
+        if np.issubdtype(self.dtype, np.floating):
+            sample_format = 3
+        elif np.issubdtype(self.dtype, np.signedinteger):
+            sample_format = 2
+        else:
+            sample_format = 1
+
+        spp = self.samples_per_pixel
+        entries = [(254, TIFF_LONG, 0 if level == 0 else 1),  # NewSubfileType
+                   (256, TIFF_LONG, level_w),
+                   (257, TIFF_LONG, level_h),
+                   (258, TIFF_SHORT, [bits_per_sample]*spp),
+                   (259, TIFF_SHORT, self.compression_code),
+                   (262, TIFF_SHORT, 2 if self.is_rgb else 1),  # Photometric interpretation
+                   (277, TIFF_SHORT, spp),
+                   (284, TIFF_SHORT, 1),  # Planar configuration (contiguous)
+                   (305, TIFF_ASCII, b"valis\0"),  # Software
+                   (322, TIFF_SHORT, self.tile_wh),
+                   (323, TIFF_SHORT, self.tile_wh),
+                   (324, TIFF_LONG8, self.tile_offsets[level][page]),
+                   (325, TIFF_LONG8, self.tile_byte_counts[level][page]),
+                   (339, TIFF_SHORT, [sample_format]*spp)
+                   ]
+
+        if self.is_rgb and spp > 3:
+            # ExtraSamples. The 4th band is unassociated alpha, any others are unspecified
+            entries.append((338, TIFF_SHORT, [2] + [0]*(spp - 4)))
+
+        if level == 0 and page == 0:
+            entries.append((270, TIFF_ASCII, self.ome_xml.encode("utf-8") + b"\0"))
+
+        return entries
+
+    def close(self):
+        """Finish writing the pyramid and write the IFDs
+        """
+        try:
+            if len(self._pending_rows) > 0:
+                pending = np.vstack(self._pending_rows)
+                self._pending_rows = []
+                if pending.shape[0] > 0:
+                    self._write_strip_tiles(pending)
+
+            self._write_pending_tiles()
+            n_missing = np.sum(self.tile_byte_counts[0] == 0)
+            if n_missing > 0:
+                raise ValueError(f"{n_missing} tiles were not written to {self.dst_f}")
+
+            self._build_pyramid()
+        finally:
+            self.executor.shutdown()
+
+        prev_next_ifd_pos = 8  # First IFD's offset is stored in the header
+        for page in range(self.n_pages):
+            subifd_offsets = [_write_tiff_ifd(self.fh, self._get_ifd_entries(level, page))[0]
+                              for level in range(1, self.n_levels)]
+
+            entries = self._get_ifd_entries(0, page)
+            if len(subifd_offsets) > 0:
+                entries.append((330, TIFF_IFD8, subifd_offsets))
+
+            ifd_offset, next_ifd_pos = _write_tiff_ifd(self.fh, entries)
+            self.fh.seek(prev_next_ifd_pos)
+            self.fh.write(struct.pack("<Q", ifd_offset))
+            prev_next_ifd_pos = next_ifd_pos
+
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown()
+            self.fh.close()
+
+
+def _check_tiled_writer_params(img_wh, tile_wh, compression):
+    """Adjust tile size to fit the image, and check that `OmeTiffTileWriter` can use the compression method
+    """
+    if np.any(np.array(img_wh) < tile_wh):
+        min_dim = min(img_wh)
+        tile_wh = int(min_dim - min_dim % 16)
+
+    can_use_compression = str(compression).lower() in TIFF_COMPRESSION_CODES
+    if not can_use_compression:
+        msg = f"{compression} compression is not supported when saving tiles in parallel. Will save using `save_ome_tiff`"
+        valtils.print_warning(msg)
+
+    return tile_wh, can_use_compression
+
+
+def save_ome_tiff_parallel(img, dst_f, ome_xml=None, tile_wh=512, compression="deflate", pyramid=True, n_jobs=None):
+    """Save an image in the ome.tiff format, compressing tiles in parallel
+
+    Alternative to `save_ome_tiff`, intended for large images that are
+    expensive to compute, such as warped and merged slides. Each strip
+    of tiles is computed only once, and the lower resolution pyramid levels
+    are created from those tiles instead of re-evaluating `img`. Tiles are
+    compressed in parallel and written directly to a BigTIFF using
+    `OmeTiffTileWriter`.
+
+    Parameters
+    ---------
+    img : pyvips.Image, ndarray
+        Image to be saved. If a numpy array is provided, it will be converted
+        to a pyvips.Image.
+
+    dst_f : str
+        Path to where the ome.tiff will be saved
+
+    ome_xml : str, optional
+        ome-xml string describing image's metadata. If None, it will be created
+
+    tile_wh : int
+        Tile shape used to save `img`. Used to create a square tile, so `tile_wh`
+        is both the width and height.
+
+    compression : str
+        Compression method used to save ome.tiff. Either "deflate" or "none".
+        Other methods will be saved using `save_ome_tiff`.
+
+    pyramid : bool
+        Whether or not to save an image pyramid.
+
+    n_jobs : int, optional
+        Number of threads used to compress tiles. If None, will use all
+        available CPUs.
+
+    """
+
+    if not isinstance(img, pyvips.vimage.Image):
+        img = slide_tools.numpy2vips(img)
+
+    tile_wh, can_use_compression = _check_tiled_writer_params((img.width, img.height), tile_wh, compression)
+    if not can_use_compression:
+        save_ome_tiff(img, dst_f=dst_f, ome_xml=ome_xml, tile_wh=tile_wh, compression=compression, pyramid=pyramid)
+
+        return None
+
+    is_rgb = img.interpretation in VIPS_RGB_FORMATS
+    np_dtype = slide_tools.VIPS_FORMAT_NUMPY_DTYPE[img.format]
+    writer = OmeTiffTileWriter(dst_f, shape_wh=(img.width, img.height), n_channels=img.bands,
+                               dtype=np_dtype, is_rgb=is_rgb, ome_xml=ome_xml, tile_wh=tile_wh,
+                               compression=compression, pyramid=pyramid, n_jobs=n_jobs)
+
+    print(f"saving {writer.dst_f} ({img.width} x {img.height} and {img.bands} channels)")
+    with writer:
+        strip_h = writer.tile_wh
+        for y in tqdm(range(0, img.height, strip_h), unit="tile rows", leave=None):
+            strip = img.crop(0, y, img.width, min(strip_h, img.height - y))
+            writer.write_strip(warp_tools.vips2numpy(strip))
+
+
+def save_merged_ome_tiff(img_list, dst_f, channel_idx_list=None, ome_xml=None, tile_wh=512,
+                         compression="deflate", pyramid=True, n_jobs=None):
+    """Merge images and save them as a single multichannel ome.tiff, one tile at a time
+
+    For each tile in the output image, the same region is sliced from each
+    image in `img_list` and the channels are stacked. Each image (e.g. a lazily
+    warped slide) is therefore only evaluated once per tile, for all of its
+    channels, and only a few tiles per image are held in memory, regardless of
+    the number of channels. Tiles are written using `OmeTiffTileWriter`.
+
+    Parameters
+    ----------
+    img_list : list of pyvips.Image
+        Images to merge. All images must have the same width and height.
+
+    dst_f : str
+        Path to where the ome.tiff will be saved
+
+    channel_idx_list : list of list of int, optional
+        Indices of the channels to keep from each image. If None,
+        all channels will be kept.
+
+    ome_xml : str, optional
+        ome-xml string describing image's metadata. If None, it will be created
+
+    tile_wh : int
+        Tile width and height used to save the image
+
+    compression : str
+        Compression method used to save ome.tiff. Either "deflate" or "none".
+        Other methods will be saved using `save_ome_tiff` after merging
+        the images with pyvips.
+
+    pyramid : bool
+        Whether or not to save an image pyramid.
+
+    n_jobs : int, optional
+        Number of threads used to warp and compress tiles. If None, will use all
+        available CPUs.
+
+    """
+
+    if channel_idx_list is None:
+        channel_idx_list = [list(range(img.bands)) for img in img_list]
+
+    out_w, out_h = img_list[0].width, img_list[0].height
+    if any([(img.width, img.height) != (out_w, out_h) for img in img_list]):
+        raise ValueError("All images must have the same width and height to be merged")
+
+    n_channels = sum([len(idx) for idx in channel_idx_list])
+    np_dtype = np.result_type(*[slide_tools.VIPS_FORMAT_NUMPY_DTYPE[img.format] for img in img_list])
+
+    tile_wh, can_use_compression = _check_tiled_writer_params((out_w, out_h), tile_wh, compression)
+    if not can_use_compression:
+        keep_channels = list(itertools.chain.from_iterable([[img[c] for c in idx] for img, idx in zip(img_list, channel_idx_list)]))
+        merged_img = keep_channels[0].bandjoin(keep_channels[1:]) if len(keep_channels) > 1 else keep_channels[0]
+        merged_img = merged_img.copy(interpretation="multiband" if n_channels > 1 else "b-w")
+        save_ome_tiff(merged_img, dst_f=dst_f, ome_xml=ome_xml, tile_wh=tile_wh, compression=compression, pyramid=pyramid)
+
+        return None
+
+    writer = OmeTiffTileWriter(dst_f, shape_wh=(out_w, out_h), n_channels=n_channels,
+                               dtype=np_dtype, is_rgb=False, ome_xml=ome_xml, tile_wh=tile_wh,
+                               compression=compression, pyramid=pyramid, n_jobs=n_jobs)
+
+    def get_merged_tile(tile_xy):
+        tile_x, tile_y = tile_xy
+        x0 = tile_x*writer.tile_wh
+        y0 = tile_y*writer.tile_wh
+        w = min(writer.tile_wh, out_w - x0)
+        h = min(writer.tile_wh, out_h - y0)
+        merged_tile = np.zeros((h, w, n_channels), dtype=np_dtype)
+        c0 = 0
+        for img, channel_idx in zip(img_list, channel_idx_list):
+            img_tile = warp_tools.vips2numpy(img, xywh=(x0, y0, w, h))
+            if img_tile.ndim == 2:
+                img_tile = img_tile[..., np.newaxis]
+            merged_tile[..., c0:c0 + len(channel_idx)] = img_tile[..., channel_idx]
+            c0 += len(channel_idx)
+
+        return merged_tile
+
+    print(f"saving {writer.dst_f} ({out_w} x {out_h} and {n_channels} channels)")
+    n_tiles_x, n_tiles_y = writer.n_tiles_xy[0]
+    with writer, ThreadPoolExecutor(max_workers=writer.n_jobs) as executor:
+        for tile_y in tqdm(range(n_tiles_y), unit="tile rows", leave=None):
+            tile_xy = [(tile_x, tile_y) for tile_x in range(n_tiles_x)]
+            for (tile_x, _), merged_tile in zip(tile_xy, executor.map(get_merged_tile, tile_xy)):
+                writer.write_tile(merged_tile, tile_x, tile_y)
+
+
 @valtils.deprecated_args(perceputally_uniform_channel_colors="colormap")
 def convert_to_ome_tiff(src_f, dst_f, level, series=None, xywh=None,
                         colormap=CMAP_AUTO, tile_wh=None, compression=DEFAULT_COMPRESSION, Q=100, pyramid=True, reader=None):
@@ -16,6 +16,7 @@ from collections import Counter
 from . import valtils
 
 from . import warp_tools
+from . import vips_bridge
 from . import slide_io
 from . import viz
 from . import preprocessing
@@ -91,48 +92,23 @@ BF_FORMAT_NUMPY_DTYPE = {v:k for k, v in NUMPY_FORMAT_BF_DTYPE.items()}
 
 
 def vips2numpy(vi):
-    """
-    https://github.com/libvips/pyvips/blob/master/examples/pil-numpy-pyvips.py
-
-    """
-    try:
-        img = vi.numpy()
-    except:
-        img = np.ndarray(buffer=vi.write_to_memory(),
-                        dtype=VIPS_FORMAT_NUMPY_DTYPE[vi.format],
-                        shape=[vi.height, vi.width, vi.bands])
-        if vi.bands == 1:
-            img = img[..., 0]
+    """Convert pyvips.Image to numpy array
 
-    return img
+    See `vips_bridge.vips2numpy`
 
-
-def numpy2vips(a, pyvips_interpretation=None):
     """
 
-    """
-    try:
-        vi = pyvips.Image.new_from_array(a)
+    return vips_bridge.vips2numpy(vi)
 
-    except Exception as e:
-        if a.ndim > 2:
-            height, width, bands = a.shape
-        else:
-            height, width = a.shape
-            bands = 1
 
-        linear = a.reshape(width * height * bands)
-        if linear.dtype.byteorder == ">":
-            # vips seems to expect the array to be little endian, but `a` is big endian
-            linear = linear.byteswap(inplace=False)
+def numpy2vips(a, pyvips_interpretation=None):
+    """Wrap numpy array as a pyvips.Image with interpretation `pyvips_interpretation`
 
-        vi = pyvips.Image.new_from_memory(linear.data, width, height, bands,
-                                        NUMPY_FORMAT_VIPS_DTYPE[a.dtype.name])
+    See `vips_bridge.numpy2vips`
 
-        if pyvips_interpretation is not None:
-            vi = vi.copy(interpretation=pyvips_interpretation)
+    """
 
-    return vi
+    return vips_bridge.numpy2vips(a, interpretation=pyvips_interpretation)
 
 
 def get_slide_extension(src_f):
@@ -291,7 +267,7 @@ def um_to_px(um, um_per_px):
 def warp_slide(src_f, transformation_src_shape_rc, transformation_dst_shape_rc,
                aligned_slide_shape_rc, M=None, dxdy=None,
                level=0, series=None, interp_method="bicubic",
-               bbox_xywh=None, bg_color=None, reader=None):
+               bbox_xywh=None, bg_color=None, reader=None, composed=False):
     """ Warp a slide
 
     Warp slide according to `M` and/or `non_rigid_dxdy`
@@ -333,6 +309,10 @@ def warp_slide(src_f, transformation_src_shape_rc, transformation_dst_shape_rc,
         Bounding box to crop warped slide. Should be in refernce the
         warped slide
 
+    composed : bool, optional
+        If True, `M` and `dxdy` will be composed into a single map, so
+        that the slide is only resampled once. See `warp_tools.warp_img`
+
     Returns
     -------
     vips_warped : pyvips.Image
@@ -356,7 +336,8 @@ def warp_slide(src_f, transformation_src_shape_rc, transformation_dst_shape_rc,
                                       transformation_src_shape_rc=transformation_src_shape_rc,
                                       bbox_xywh=bbox_xywh,
                                       bg_color=bg_color,
-                                      interp_method=interp_method)
+                                      interp_method=interp_method,
+                                      composed=composed)
 
     return vips_warped
 
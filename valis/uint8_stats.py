@@ -0,0 +1,187 @@
+"""Statistics of uint8 images, calculated from integer histograms
+
+Processed images are uint8, and so only have 256 possible values. This
+means that histograms can be built by counting each value with
+`np.bincount`, rather than by binning floats. Other statistics, such as
+percentiles, the mean, and joint histograms used to estimate mutual
+information, can then be calculated from the counts, without converting
+or sorting the pixels.
+
+Each function that takes an image also takes an optional mask, where
+only pixels with mask values greater than 0 are counted.
+
+"""
+
+import numpy as np
+
+N_VALUES = 256
+"""int: Number of values a uint8 pixel can have"""
+
+
+def is_uint8(*imgs):
+    """Whether or not all images are uint8
+    """
+    return all(isinstance(img, np.ndarray) and img.dtype == np.uint8 for img in imgs)
+
+
+def _get_px(img, mask=None):
+    if mask is None:
+        return img.reshape(-1)
+
+    return img[mask > 0]
+
+
+def histogram(img, mask=None):
+    """Count how many times each value occurs in an image
+
+    Parameters
+    ----------
+    img : ndarray
+        uint8 image
+
+    mask : ndarray, optional
+        Only pixels where `mask` > 0 are counted
+
+    Returns
+    -------
+    counts : ndarray
+        (256) array, where counts[i] is the number of pixels with value i
+
+    """
+
+    return np.bincount(_get_px(img, mask), minlength=N_VALUES)
+
+
+def joint_histogram(img1, img2, mask=None):
+    """Count how many times each pair of values occurs at the same position in two images
+
+    Parameters
+    ----------
+    img1, img2 : ndarray
+        uint8 images with the same shape
+
+    mask : ndarray, optional
+        Only pixels where `mask` > 0 are counted
+
+    Returns
+    -------
+    counts : ndarray
+        (256, 256) array, where counts[i, j] is the number of positions
+        where `img1` is i and `img2` is j
+
+    """
+
+    idx = _get_px(img1, mask).astype(np.uint16)*N_VALUES + _get_px(img2, mask)
+
+    return np.bincount(idx, minlength=N_VALUES**2).reshape(N_VALUES, N_VALUES)
+
+
+def rebin(counts, bin_lut, n_bins):
+    """Combine counts of each value into bins
+
+    Parameters
+    ----------
+    counts : ndarray
+        (256) array of counts, from `histogram`
+
+    bin_lut : ndarray
+        (256) array of ints, where bin_lut[i] is the bin that value i belongs to
+
+    n_bins : int
+        Number of bins
+
+    Returns
+    -------
+    binned_counts : ndarray
+        (n_bins) array of the number of pixels in each bin
+
+    """
+
+    return np.bincount(bin_lut, weights=counts, minlength=n_bins)
+
+
+def rebin_joint(counts, bin_lut1, bin_lut2, n_bins1, n_bins2):
+    """Combine counts of each pair of values into 2D bins
+
+    Parameters
+    ----------
+    counts : ndarray
+        (256, 256) array of counts, from `joint_histogram`
+
+    bin_lut1, bin_lut2 : ndarray
+        (256) arrays of ints, where bin_lut[i] is the bin that value i belongs to,
+        for the values in the first and second image
+
+    n_bins1, n_bins2 : int
+        Number of bins for each image
+
+    Returns
+    -------
+    binned_counts : ndarray
+        (n_bins1, n_bins2) array of the number of pixels in each bin
+
+    """
+
+    idx = bin_lut1[:, None]*n_bins2 + bin_lut2[None, :]
+    binned_counts = np.bincount(idx.reshape(-1), weights=counts.reshape(-1), minlength=n_bins1*n_bins2)
+
+    return binned_counts.reshape(n_bins1, n_bins2)
+
+
+def value_range(counts):
+    """Get the minimum and maximum value that occurs in the histogram
+    """
+    present = np.where(counts > 0)[0]
+
+    return present[0], present[-1]
+
+
+def mean(counts):
+    """Mean value, calculated from a histogram
+    """
+    return np.dot(counts, np.arange(len(counts)))/counts.sum()
+
+
+def percentiles(counts, q):
+    """Values at each percentile, calculated from the cumulative counts
+
+    Parameters
+    ----------
+    counts : ndarray
+        Histogram of values, from `histogram`
+
+    q : float, list
+        Percentile(s), between 0 and 100
+
+    Returns
+    -------
+    vals : ndarray
+        For each percentile, the number of values with a cumulative
+        percentage less than or equal to that percentile, i.e. the smallest
+        value that has more than q% of the pixels at or below it
+
+    """
+
+    cdf = 100*np.cumsum(counts)/np.sum(counts)
+
+    return np.searchsorted(cdf, q, side="right")
+
+
+def skew(counts):
+    """Skewness of the values, calculated from a histogram
+
+    Same as `scipy.stats.skew`, i.e. the biased sample skewness
+
+    """
+
+    vals = np.arange(len(counts))
+    n = counts.sum()
+    mean_val = np.dot(counts, vals)/n
+    d = vals - mean_val
+    m2 = np.dot(counts, d**2)/n
+    if m2 == 0:
+        return np.nan
+
+    m3 = np.dot(counts, d**3)/n
+
+    return m3/m2**1.5
@@ -216,6 +216,27 @@ def hex_to_rgb(value):
     return tuple(int(value[i:i + lv // 3], 16) for i in range(0, lv, lv // 3))
 
 
+def get_file_id(f):
+    """Get identity of a file, which changes if the file is modified
+
+    Returns
+    -------
+    file_id : tuple
+        Absolute path, size in bytes, and modification time (ns) of `f`.
+        None if `f` doesn't exist
+
+    """
+    if f is None:
+        return None
+
+    try:
+        f_stat = os.stat(f)
+    except (OSError, TypeError):
+        return None
+
+    return (os.path.abspath(f), f_stat.st_size, f_stat.st_mtime_ns)
+
+
 def get_ncpus_available():
     ncpus = 2  # returning 2 by default as code assumes ncpus > 1 (or that packages gracefully handle scheduling 0 jobs/threads)
 
@@ -0,0 +1,132 @@
+"""Convert between numpy arrays and pyvips.Image
+
+Arrays are wrapped, not copied, when converted to pyvips.Image. The
+pyvips.Image keeps a reference to the array, so the array is not
+garbage collected while libvips may still read it. Arrays that libvips
+can't read directly (non-contiguous, big endian, boolean, or 64 bit
+integer arrays) are converted first.
+
+pyvips.Image are only computed when converted to numpy arrays. If only
+part of the image is needed, just that region is computed.
+
+"""
+
+import sys
+import numpy as np
+import pyvips
+
+NUMPY_FORMAT_VIPS_DTYPE = {
+    'uint8': 'uchar',
+    'int8': 'char',
+    'uint16': 'ushort',
+    'int16': 'short',
+    'uint32': 'uint',
+    'int32': 'int',
+    'float32': 'float',
+    'float64': 'double',
+    'complex64': 'complex',
+    'complex128': 'dpcomplex',
+    }
+"""dict: libvips band format for each numpy dtype"""
+
+VIPS_FORMAT_NUMPY_DTYPE = {v: np.dtype(k) for k, v in NUMPY_FORMAT_VIPS_DTYPE.items()}
+"""dict: numpy dtype for each libvips band format"""
+
+INT64_CAST_DTYPES = {"int64": np.int32, "uint64": np.uint32}
+"""dict: dtypes that 64 bit integer arrays are cast to, as libvips does not have 64 bit integer formats"""
+
+NATIVE_BYTEORDER = "<" if sys.byteorder == "little" else ">"
+"""str: Byte order of this machine, which is the byte order libvips uses"""
+
+
+def _get_vips_compatible_array(a):
+    """Get version of `a` that libvips can wrap without copying
+
+    Only copies `a` if needed.
+
+    """
+
+    a = np.asarray(a)
+    if a.dtype == bool:
+        # True in libvips is 255
+        a = a.astype(np.uint8)*255
+
+    elif a.dtype.name in INT64_CAST_DTYPES:
+        a = a.astype(INT64_CAST_DTYPES[a.dtype.name])
+
+    if a.dtype.byteorder not in ["=", "|", NATIVE_BYTEORDER]:
+        # Values are kept, but the bytes are put in the order libvips expects
+        a = a.astype(a.dtype.newbyteorder("="))
+
+    return np.ascontiguousarray(a)
+
+
+def numpy2vips(a, interpretation=None):
+    """Wrap a numpy array as a pyvips.Image
+
+    Parameters
+    ----------
+    a : ndarray
+        (N, M) or (N, M, C) array
+
+    interpretation : str, optional
+        How libvips should interpret the bands, e.g. "srgb", "b-w",
+        or "multiband". If None, libvips will guess, based on the number
+        of bands and the dtype.
+
+    Returns
+    -------
+    vi : pyvips.Image
+        Image that reads the array's memory. Unless `a` had to be
+        converted, changes to `a` are seen by `vi`.
+
+    """
+
+    a = np.atleast_2d(_get_vips_compatible_array(a))
+    if a.ndim > 2:
+        height, width, bands = a.shape
+    else:
+        height, width = a.shape
+        bands = 1
+
+    # new_from_memory keeps a reference to `a`, so it stays alive as long as `vi`, or images derived from it, do
+    vi = pyvips.Image.new_from_memory(a, width, height, bands, NUMPY_FORMAT_VIPS_DTYPE[a.dtype.name])
+    if interpretation is not None and vi.interpretation != interpretation:
+        vi = vi.copy(interpretation=interpretation)
+
+    return vi
+
+
+def vips2numpy(vi, xywh=None):
+    """Compute a pyvips.Image and get the result as a numpy array
+
+    Parameters
+    ----------
+    vi : pyvips.Image
+        Image to convert
+
+    xywh : tuple of int, optional
+        (top left x, top left y, width, height) of the region to
+        compute. If None, the whole image is computed.
+
+    Returns
+    -------
+    img : ndarray
+        (N, M) array if `vi` has 1 band, otherwise (N, M, C) array. The array owns
+        the memory libvips wrote the pixels to, and so is not copied again.
+
+    """
+
+    if xywh is None:
+        width, height = vi.width, vi.height
+        buffer = vi.write_to_memory()
+    else:
+        x, y, width, height = [int(v) for v in xywh]
+        # Only the pixels in the region are computed
+        buffer = pyvips.Region.new(vi).fetch(x, y, width, height)
+
+    img = np.frombuffer(buffer, dtype=VIPS_FORMAT_NUMPY_DTYPE[vi.format]).reshape(height, width, vi.bands)
+    if vi.bands == 1:
+        img = img[..., 0]
+
+    return img
@@ -21,12 +21,59 @@ import SimpleITK as sitk
 from colorama import Fore
 import os
 import re
+import functools
+import tempfile
 
 from copy import deepcopy
 from . import valtils
+from . import vips_bridge
 
 pyvips.cache_set_max(0)
 
+OUT_OF_BOUNDS_XY = -10.0
+"""float: Position used in warp maps for pixels that map outside of the image, so that they are filled with the background color"""
+
+TILE_PLAN_MAX_DIM = 1024
+"""int: Maximum width or height of the low resolution mask used to plan which tiles to register"""
+
+INVERSE_ITK = "itk"
+"""str: Invert displacement fields using SimpleITK's IterativeInverseDisplacementField"""
+
+INVERSE_FIXED_POINT = "fixed_point"
+"""str: Invert displacement fields using fixed-point iterations, each of which samples the field with OpenCV's remap"""
+
+INVERSE_FIELD_MAX_UNTILED_PX = 2048**2
+"""int: Displacement fields with more pixels than this are inverted tile-wise"""
+
+INVERSE_FIELD_TILE_WH = 1024
+"""int: Width and height of the tiles used when inverting large displacement fields"""
+
+INVERSE_FIELD_MIN_HALO = 32
+"""int: Minimum overlap between tiles when inverting large displacement fields"""
+
+INVERSE_FIELD_MEMMAP_PX = 8192**2
+"""int: Inverses of displacement fields with more pixels than this are written to a memory-mapped file"""
+
+INVERSE_FIELD_TOL = 0.01
+"""float: Maximum change (in pixels) in the inverse field for the fixed-point iterations to have converged"""
+
+WARP_BACKEND_VIPS = "vips"
+"""str: Warp images with libvips"""
+
+WARP_BACKEND_CV2 = "cv2"
+"""str: Warp numpy images in memory with OpenCV's warpAffine and remap"""
+
+CV2_WARP_MAX_PX = 4096**2
+"""int: Numpy images are warped with OpenCV if they, and the warped image, have at most this many pixels"""
+
+CV2_INTERP_METHODS = {"nearest": cv2.INTER_NEAREST,
+                      "bilinear": cv2.INTER_LINEAR,
+                      "bicubic": cv2.INTER_CUBIC}
+"""dict: OpenCV interpolation flag for each libvips interpolation method that OpenCV can perform"""
+
+CV2_WARP_DTYPES = {np.dtype(np.uint8), np.dtype(np.uint16), np.dtype(np.int16), np.dtype(np.float32), np.dtype(np.float64)}
+"""set: Image dtypes that OpenCV can warp"""
+
 
 def is_pyvips_22():
     pvips_ver = pyvips.__version__.split(".")
@@ -508,6 +555,92 @@ def expand_bbox(bbox_xywh, expand, shape_rc=None):
     return np.array([*new_xy, new_w, new_h])
 
 
+def _get_bbox_sums(integral_img, bbox_xyxy):
+    """Sum of the values inside each bounding box, using an integral image
+    """
+    x0, y0, x1, y1 = bbox_xyxy.T
+
+    return integral_img[y1, x1] - integral_img[y0, x1] - integral_img[y1, x0] + integral_img[y0, x0]
+
+
+def plan_tiles(bbox_list, shape_rc, mask, feature_xy=None, min_fg_frac=0.0, max_tiles=None):
+    """Select and prioritize the tiles that should be registered
+
+    Uses a low resolution mask to drop tiles that only contain background,
+    so that they don't need to be read. The remaining tiles are sorted
+    so that the tiles with the most features, and then the most foreground,
+    come first.
+
+    Parameters
+    ----------
+    bbox_list : [N, 4] array
+        xywh of each tile, in an image with shape `shape_rc`
+
+    shape_rc : tuple of int
+        Shape of the image being tiled
+
+    mask : ndarray, pyvips.Image
+        Mask covering the same area as the image being tiled, but usually at a
+        lower resolution. Non-zero pixels are foreground. Will be resized to
+        have a maximum dimension of `TILE_PLAN_MAX_DIM`
+
+    feature_xy : [P, 2] array, optional
+        Positions of features in the image being tiled (e.g. previously matched
+        keypoints), used to prioritize tiles with more features.
+
+    min_fg_frac : float, optional
+        Tiles where the fraction of foreground pixels is less than or equal to
+        `min_fg_frac` will be dropped.
+
+    max_tiles : int, optional
+        Maximum number of tiles to keep. If None, all tiles with foreground will be kept.
+
+    Returns
+    -------
+    tile_idx : ndarray
+        Indices of the tiles in `bbox_list` that should be registered,
+        ordered from most to least informative.
+
+    """
+
+    mask_shape_rc = np.array(get_shape(mask)[0:2])
+    if mask_shape_rc.max() > TILE_PLAN_MAX_DIM:
+        mask_shape_rc = np.round(mask_shape_rc*TILE_PLAN_MAX_DIM/mask_shape_rc.max()).astype(int)
+        mask = resize_img(mask, mask_shape_rc, interp_method="nearest")
+
+    if isinstance(mask, pyvips.Image):
+        mask = vips2numpy(mask)
+
+    fg_integral = np.pad(np.cumsum(np.cumsum(mask > 0, axis=0), axis=1), ((1, 0), (1, 0)))
+
+    bbox_list = np.asarray(bbox_list)
+    mask_sxy = (mask_shape_rc/np.array(shape_rc[0:2]))[::-1]
+    mask_wh = mask_shape_rc[::-1]
+    bbox_xy0 = np.clip(np.floor(bbox_list[:, 0:2]*mask_sxy), 0, mask_wh - 1).astype(int)
+    bbox_xy1 = np.clip(np.ceil((bbox_list[:, 0:2] + bbox_list[:, 2:])*mask_sxy), bbox_xy0 + 1, mask_wh).astype(int)
+    bbox_xyxy = np.hstack([bbox_xy0, bbox_xy1])
+    bbox_area = np.prod(bbox_xy1 - bbox_xy0, axis=1)
+
+    fg_frac = _get_bbox_sums(fg_integral, bbox_xyxy)/bbox_area
+
+    if feature_xy is not None and len(feature_xy) > 0:
+        feature_xy = np.clip(np.floor(np.asarray(feature_xy)*mask_sxy), 0, mask_wh - 1).astype(int)
+        feature_counts = np.zeros(mask_shape_rc, dtype=np.int64)
+        np.add.at(feature_counts, (feature_xy[:, 1], feature_xy[:, 0]), 1)
+        feature_integral = np.pad(np.cumsum(np.cumsum(feature_counts, axis=0), axis=1), ((1, 0), (1, 0)))
+        feature_density = _get_bbox_sums(feature_integral, bbox_xyxy)/bbox_area
+    else:
+        feature_density = np.zeros(len(bbox_list))
+
+    keep_idx = np.where(fg_frac > min_fg_frac)[0]
+    priority = np.lexsort([-fg_frac[keep_idx], -feature_density[keep_idx]])
+    tile_idx = keep_idx[priority]
+    if max_tiles is not None:
+        tile_idx = tile_idx[:max_tiles]
+
+    return tile_idx
+
+
 def stitch_tiles(tile_list, tile_bboxes, nrow, ncol, overlap):
     """
     #. Blend across row, added tiles to the right edge
@@ -680,10 +813,16 @@ def mattes_mi(img1, img2, nbins=50,  mask=None):
         reg.SetMetricFixedMask(sitk_mask)
         reg.SetMetricMovingMask(sitk_mask)
 
+    # SimpleITK needs real valued images. Integer images, such as uint8 processed
+    # images, are exactly represented by float32, which uses half the memory of float64
     if not np.issubdtype(img1.dtype, np.floating):
-        img1 = img1.astype(float)
+        img1 = img1.astype(np.float32)
 
     if not np.issubdtype(img2.dtype, np.floating):
+        img2 = img2.astype(np.float32)
+
+    if img1.dtype != img2.dtype:
+        img1 = img1.astype(float)
         img2 = img2.astype(float)
 
     mmi = reg.MetricEvaluate(sitk.GetImageFromArray(img1), sitk.GetImageFromArray(img2))
@@ -924,98 +1063,301 @@ def get_corners_of_image(shape_rc):
     return corners_rc
 
 
-def _numpy2vips_pre_22(a):
-    """
-    From https://stackoverflow.com/questions/61138272/efficiently-saving-tiles-to-a-bigtiff-image
+def numpy2vips(a, interpretation=None):
+    """Wrap numpy array as a pyvips.Image, without copying it
+
+    See `vips_bridge.numpy2vips`
 
     """
-    dtype_to_format = {
-    'uint8': 'uchar',
-    'int8': 'char',
-    'uint16': 'ushort',
-    'int16': 'short',
-    'uint32': 'uint',
-    'int32': 'int',
-    'float32': 'float',
-    'float64': 'double',
-    'complex64': 'complex',
-    'complex128': 'dpcomplex',
-    }
 
-    if a.ndim > 2:
-        height, width, bands = a.shape
-    else:
-        height, width = a.shape
-        bands = 1
+    return vips_bridge.numpy2vips(a, interpretation=interpretation)
+
 
-    linear = a.reshape(width * height * bands)
-    vi = pyvips.Image.new_from_memory(linear.data, width, height, bands,
-                                      dtype_to_format[str(a.dtype)])
-    return vi
+def vips2numpy(vi, xywh=None):
+    """Convert pyvips.Image to numpy array, only computing the region `xywh` if provided
 
+    See `vips_bridge.vips2numpy`
 
-def _vips2numpy_pre_22(vi):
     """
-    https://github.com/libvips/pyvips/blob/master/examples/pil-numpy-pyvips.py
+
+    return vips_bridge.vips2numpy(vi, xywh=xywh)
+
+
+def pad_img(img, padded_shape, interp_method="bicubic"):
+    padding_T = get_padding_matrix(get_shape(img)[0:2], padded_shape)
+    padded_img = warp_img(img, padding_T, out_shape_rc=padded_shape, interp_method=interp_method)
+
+    return padded_img, padding_T
+
+
+def _get_warp_img_shapes(src_shape_rc, M=None, bk_dxdy=None, out_shape_rc=None,
+                         transformation_src_shape_rc=None,
+                         transformation_dst_shape_rc=None):
+    """Fill in the shapes needed to scale transformations for `warp_img`
+
+    Returns
+    -------
+    transformation_src_shape_rc : ndarray
+        Shape of image used to find the transformations
+
+    transformation_dst_shape_rc : ndarray
+        Shape of the registered image
+
+    out_shape_rc : ndarray
+        Shape of the warped image
 
     """
-    format_to_dtype = {
-        'uchar': np.uint8,
-        'char': np.int8,
-        'ushort': np.uint16,
-        'short': np.int16,
-        'uint': np.uint32,
-        'int': np.int32,
-        'float': np.float32,
-        'double': np.float64,
-        'complex': np.complex64,
-        'dpcomplex': np.complex128,
-    }
+    if transformation_src_shape_rc is None:
+        transformation_src_shape_rc = src_shape_rc
+
+    # Determine shape of unscaled output. If not provided, find shape big enough to avoid cropping
+    if transformation_dst_shape_rc is None:
+        if bk_dxdy is not None:
+            if isinstance(bk_dxdy, pyvips.Image):
+                transformation_dst_shape_rc = np.array([bk_dxdy.height, bk_dxdy.width])
+            else:
+                transformation_dst_shape_rc = bk_dxdy[0].shape
+        elif out_shape_rc is not None:
+            transformation_dst_shape_rc = out_shape_rc
+        else:
+            transformation_src_corners_rc = get_corners_of_image(transformation_src_shape_rc)
+            warped_transformation_src_corners_xy = warp_xy(transformation_src_corners_rc[:, ::-1], M)
+            transformation_dst_shape_rc = np.ceil(np.max(warped_transformation_src_corners_xy[:, ::-1], axis=0)).astype(int)
+
+    # Determine shape of scaled output
+    if out_shape_rc is None:
+        out_shape_rc = transformation_dst_shape_rc
+
+    transformation_src_shape_rc = np.array(transformation_src_shape_rc)
+    out_shape_rc = np.array(out_shape_rc)
+    transformation_dst_shape_rc = np.array(transformation_dst_shape_rc)
+
+    return transformation_src_shape_rc, transformation_dst_shape_rc, out_shape_rc
 
-    img = np.ndarray(buffer=vi.write_to_memory(),
-                      dtype=format_to_dtype[vi.format],
-                      shape=[vi.height, vi.width, vi.bands])
-    if vi.bands == 1:
-        img = img[..., 0]
 
-    return img
+def get_img_warp_M(M, src_shape_rc, out_shape_rc, transformation_src_shape_rc,
+                   transformation_dst_shape_rc):
+    """Get matrix that maps positions in the warped image to the image being warped
+
+    `M` is scaled so that it maps positions in the warped image, with
+    shape `out_shape_rc`, to positions in the image being warped,
+    which has shape `src_shape_rc`.
+
+    Parameters
+    ----------
+    M : ndarray
+        3x3 Affine transformation matrix found using images
+        with shape `transformation_src_shape_rc`
+
+    src_shape_rc : tuple of int
+        Shape of the image being warped
 
+    out_shape_rc : tuple of int
+        Shape of the image after being warped
 
-def _vips2numpy_22(vi):
-    img = vi.numpy()
+    transformation_src_shape_rc : tuple of int
+        Shape of image that was used to find `M`
 
-    return img
+    transformation_dst_shape_rc : tuple of int
+        Shape of the registered image used to find `M`
 
+    Returns
+    -------
+    warp_M : ndarray
+        3x3 matrix mapping xy in the warped image to xy in the unwarped image
 
-def _numpy2vips_22(a):
-    vi = pyvips.Image.new_from_array(a)
+    """
 
-    return vi
+    img_corners_xy = get_corners_of_image(src_shape_rc)[:, ::-1]
+    warped_corners = warp_xy(img_corners_xy, M=M,
+                             transformation_src_shape_rc=transformation_src_shape_rc,
+                             transformation_dst_shape_rc=transformation_dst_shape_rc,
+                             src_shape_rc=src_shape_rc,
+                             dst_shape_rc=out_shape_rc)
+    M_tform = transform.ProjectiveTransform()
+    M_tform.estimate(warped_corners, img_corners_xy)
+    warp_M = M_tform.params
 
+    return warp_M
 
-def numpy2vips(a):
 
-    if is_pyvips_22():
-        vi = _numpy2vips_22(a)
+def _get_vips_warp_dxdy(bk_dxdy, dst_sxy, out_shape_rc, interpolator):
+    """Scale and resize displacements so they can be used to warp an image with shape `out_shape_rc`
+    """
+    if not isinstance(bk_dxdy, pyvips.Image):
+        temp_dxdy = numpy2vips(np.dstack(bk_dxdy))
     else:
-        vi = _numpy2vips_pre_22(a)
+        temp_dxdy = bk_dxdy
 
-    return vi
+    if dst_sxy is not None:
+        scaled_dx = float(dst_sxy[0]) * temp_dxdy[0]
+        scaled_dy = float(dst_sxy[1]) * temp_dxdy[1]
+        vips_dxdy = scaled_dx.bandjoin(scaled_dy)
+    else:
+        vips_dxdy = temp_dxdy
 
-def vips2numpy(vi):
-    if is_pyvips_22():
-        a = _vips2numpy_22(vi)
+    if dst_sxy is not None:
+        S = [dst_sxy[0], 0, 0, dst_sxy[1]]
     else:
-        a = _vips2numpy_pre_22(vi)
+        S = [1.0, 0.0, 0.0, 1.0]
 
-    return a
+    warp_dxdy = vips_dxdy.affine(S,
+                    oarea=[0, 0, out_shape_rc[1], out_shape_rc[0]],
+                    interpolate=interpolator,
+                    premultiplied=True)
 
+    return warp_dxdy
 
-def pad_img(img, padded_shape, interp_method="bicubic"):
-    padding_T = get_padding_matrix(get_shape(img)[0:2], padded_shape)
-    padded_img = warp_img(img, padding_T, out_shape_rc=padded_shape, interp_method=interp_method)
 
-    return padded_img, padding_T
+def _can_warp_with_cv2(img, bk_dxdy, out_shape_rc, interp_method):
+    """Determine if `img` is small enough, and of a type, that can be warped with OpenCV
+    """
+    if isinstance(img, pyvips.Image) or isinstance(bk_dxdy, pyvips.Image):
+        return False
+
+    if interp_method not in CV2_INTERP_METHODS or img.dtype not in CV2_WARP_DTYPES:
+        return False
+
+    n_px = max(np.prod(img.shape[0:2]), np.prod(out_shape_rc))
+
+    return n_px <= CV2_WARP_MAX_PX
+
+
+def _cv2_warp_bands(warp_fxn, img, bg_color=None):
+    """Apply `warp_fxn` to `img`, which may have more bands than OpenCV can warp at once
+
+    `warp_fxn` takes an image with at most 4 bands, and the color of the background
+    """
+    if bg_color is None:
+        n_bands = 1 if img.ndim == 2 else img.shape[2]
+        bg_color = [0] * n_bands
+
+    bg_color = [float(c) for c in bg_color]
+    if img.ndim == 2 or img.shape[2] <= 4:
+        return warp_fxn(img, tuple(bg_color))
+
+    warped_bands = [warp_fxn(np.ascontiguousarray(img[..., i:i+4]), tuple(bg_color[i:i+4])) for i in range(0, img.shape[2], 4)]
+    warped_bands = [b if b.ndim == 3 else b[..., None] for b in warped_bands]
+
+    return np.dstack(warped_bands)
+
+
+def _get_cv2_warp_dxdy(bk_dxdy, dst_sxy, out_shape_rc, interp_method):
+    """Scale and resize displacements so they can be used to warp an image with shape `out_shape_rc`
+
+    Same as `_get_vips_warp_dxdy`, but for numpy arrays
+    """
+    if dst_sxy is None:
+        dst_sxy = (1.0, 1.0)
+
+    bk_dxdy = [np.asarray(bk_dxdy[i], dtype=np.float32)*float(dst_sxy[i]) for i in range(2)]
+    if interp_method == "nearest":
+        # Use the displacement in the pixel that contains each position, like libvips
+        warp_dxdy = []
+        src_r = np.floor(np.arange(out_shape_rc[0])/dst_sxy[1]).astype(int)
+        src_c = np.floor(np.arange(out_shape_rc[1])/dst_sxy[0]).astype(int)
+        r_inside = src_r < bk_dxdy[0].shape[0]
+        c_inside = src_c < bk_dxdy[0].shape[1]
+        for d in bk_dxdy:
+            resized_d = np.zeros(out_shape_rc, dtype=np.float32)
+            resized_d[np.ix_(r_inside, c_inside)] = d[np.ix_(src_r[r_inside], src_c[c_inside])]
+            warp_dxdy.append(resized_d)
+
+        return warp_dxdy
+
+    dsize = (int(out_shape_rc[1]), int(out_shape_rc[0]))
+    S = np.array([[1/dst_sxy[0], 0, 0], [0, 1/dst_sxy[1], 0]])
+    warp_dxdy = [cv2.warpAffine(d, S, dsize, flags=CV2_INTERP_METHODS[interp_method] | cv2.WARP_INVERSE_MAP,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+                 for d in bk_dxdy]
+
+    return warp_dxdy
+
+
+def _get_cv2_remap_fxn(map_x, map_y, interp_method):
+    """Get function that samples an image at the positions in `map_x` and `map_y`
+
+    OpenCV rounds positions when using nearest neighbor interpolation, while
+    libvips uses the pixel that contains the position. So, for nearest neighbor
+    interpolation, the positions are floored before remapping.
+
+    """
+
+    if interp_method == "nearest":
+        map_x = np.floor(map_x)
+        map_y = np.floor(map_y)
+
+    map_x = map_x.astype(np.float32, copy=False)
+    map_y = map_y.astype(np.float32, copy=False)
+    cv2_interp = CV2_INTERP_METHODS[interp_method]
+
+    return lambda x, border_value: cv2.remap(x, map_x, map_y, cv2_interp,
+                                             borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+
+
+def _warp_img_cv2(img, warp_M=None, warp_dxdy=None, out_shape_rc=None, bg_color=None,
+                  interp_method="bicubic", composed=False):
+    """Warp a numpy image with OpenCV
+
+    Follows the same conventions as the libvips warps in `warp_img`,
+    i.e. pixel centers are at integer coordinates, the image is padded
+    with `bg_color`, positions more than 1 pixel outside of the image are
+    background, and "nearest" interpolation uses the pixel that contains
+    the sampled position.
+
+    OpenCV's bicubic kernel (a=-0.75) is sharper than libvips' (Catmull-Rom, a=-0.5).
+    Within a few pixels of where the image meets the background, the ringing
+    differs, and so values can differ by 10-35 gray levels. Elsewhere, bicubic
+    results differ by at most a few gray levels. Bilinear results differ by at most
+    1-2 gray levels, and nearest neighbor results only differ where positions fall
+    exactly on the edge between pixels.
+
+    Parameters
+    ----------
+    warp_M : ndarray, optional
+        3x3 matrix mapping xy in the warped image to xy in `img`
+
+    warp_dxdy : list, optional
+        Displacements, already scaled and resized to have shape `out_shape_rc`
+
+    """
+
+    dsize = (int(out_shape_rc[1]), int(out_shape_rc[0]))
+
+    if warp_dxdy is not None and (composed or warp_M is None):
+        # Single resampling, where the displacements are applied before the rigid transformation
+        map_y, map_x = np.indices(out_shape_rc, dtype=np.float32)
+        map_x += warp_dxdy[0]
+        map_y += warp_dxdy[1]
+        if warp_M is not None:
+            # Displaced positions outside of the rigidly warped image would be background
+            is_inside = (map_x >= 0) & (map_x <= out_shape_rc[1] - 1) & (map_y >= 0) & (map_y <= out_shape_rc[0] - 1)
+            map_x, map_y = [(warp_M[i, 0]*map_x + warp_M[i, 1]*map_y + warp_M[i, 2]).astype(np.float32) for i in range(2)]
+            map_x[~is_inside] = OUT_OF_BOUNDS_XY
+            map_y[~is_inside] = OUT_OF_BOUNDS_XY
+
+        return _cv2_warp_bands(_get_cv2_remap_fxn(map_x, map_y, interp_method), img, bg_color)
+
+    warped = img
+    if warp_M is not None:
+        if interp_method == "nearest":
+            map_y, map_x = np.indices(out_shape_rc, dtype=np.float64)
+            map_x, map_y = [warp_M[i, 0]*map_x + warp_M[i, 1]*map_y + warp_M[i, 2] for i in range(2)]
+            affine = _get_cv2_remap_fxn(map_x, map_y, interp_method)
+        else:
+            affine_M = warp_M[0:2]
+            cv2_interp = CV2_INTERP_METHODS[interp_method]
+            affine = lambda x, border_value: cv2.warpAffine(x, affine_M, dsize, flags=cv2_interp | cv2.WARP_INVERSE_MAP,
+                                                            borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+        warped = _cv2_warp_bands(affine, warped, bg_color)
+
+    if warp_dxdy is not None:
+        map_y, map_x = np.indices(out_shape_rc, dtype=np.float32)
+        map_x += warp_dxdy[0]
+        map_y += warp_dxdy[1]
+        warped = _cv2_warp_bands(_get_cv2_remap_fxn(map_x, map_y, interp_method), warped, bg_color)
+
+    return warped
 
 
 def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
@@ -1023,7 +1365,9 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
              transformation_dst_shape_rc=None,
              bbox_xywh=None,
              bg_color=None,
-             interp_method="bicubic"):
+             interp_method="bicubic",
+             composed=False,
+             backend=None):
     """Warp an image using rigid and/or non-rigid transformations
 
     Warp an image using the trasformations defined by `M` and the optional
@@ -1068,6 +1412,24 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
 
     interp_method : str, optional
 
+    composed : bool, optional
+        If True, and both `M` and `bk_dxdy` are provided, the rigid and
+        non-rigid transformations will be composed into a single map
+        of positions (see `get_img_warp_map`), so that `img` is only
+        resampled once. The map is lazy, and so is calculated tile by tile
+        as the warped image is used. If False, `img` is warped using
+        `M`, and that image is then warped using `bk_dxdy`.
+
+    backend : str, optional
+        How to warp the image. `WARP_BACKEND_VIPS` uses libvips.
+        `WARP_BACKEND_CV2` warps numpy images in memory using OpenCV,
+        which avoids converting them to and from pyvips.Image.
+        If None, numpy images with at most `CV2_WARP_MAX_PX` pixels are warped
+        with OpenCV, if it supports `interp_method` and the image's dtype.
+        Other images are warped with libvips. Both backends sample the same
+        positions, but their bicubic kernels differ, mostly where the image
+        meets the background (see `_warp_img_cv2`).
+
     Returns
     -------
     warped : ndarray, pyvips.Image
@@ -1075,37 +1437,41 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
 
     """
 
-    is_array = False
-    if not isinstance(img, pyvips.Image):
-        is_array = True
-        img = numpy2vips(img)
+    if isinstance(img, pyvips.Image):
+        src_shape_rc = np.array([img.height, img.width])
+    else:
+        src_shape_rc = np.array(img.shape[0:2])
 
-    src_shape_rc = np.array([img.height, img.width])
-    if transformation_src_shape_rc is None:
-        transformation_src_shape_rc = src_shape_rc
+    if backend is None:
+        _, _, temp_out_shape_rc = _get_warp_img_shapes(src_shape_rc, M=M, bk_dxdy=bk_dxdy,
+                                                       out_shape_rc=out_shape_rc,
+                                                       transformation_src_shape_rc=transformation_src_shape_rc,
+                                                       transformation_dst_shape_rc=transformation_dst_shape_rc)
 
-    # Determine shape of unscaled output. If not provided, find shape big enough to avoid cropping
-    if transformation_dst_shape_rc is None:
-        if bk_dxdy is not None:
-            if isinstance(bk_dxdy, pyvips.Image):
-                transformation_dst_shape_rc = np.array([bk_dxdy.height, bk_dxdy.width])
-            else:
-                transformation_dst_shape_rc = bk_dxdy[0].shape
-        elif out_shape_rc is not None:
-            transformation_dst_shape_rc = out_shape_rc
+        if _can_warp_with_cv2(img, bk_dxdy, temp_out_shape_rc, interp_method):
+            backend = WARP_BACKEND_CV2
         else:
-            transformation_src_corners_rc = get_corners_of_image(transformation_src_shape_rc)
-            warped_transformation_src_corners_xy = warp_xy(transformation_src_corners_rc[:, ::-1], M)
-            transformation_dst_shape_rc = np.ceil(np.max(warped_transformation_src_corners_xy[:, ::-1], axis=0)).astype(int)
+            backend = WARP_BACKEND_VIPS
 
-    # Determine shape of scaled output
-    if out_shape_rc is None:
-        out_shape_rc = transformation_dst_shape_rc
+    use_cv2 = backend == WARP_BACKEND_CV2
+    if use_cv2 and interp_method not in CV2_INTERP_METHODS:
+        raise ValueError(f"OpenCV can't warp using interp_method='{interp_method}'. "
+                         f"Supported methods are {list(CV2_INTERP_METHODS.keys())}, "
+                         f"or use backend='{WARP_BACKEND_VIPS}'")
 
-    src_shape_rc = np.array(src_shape_rc)
-    transformation_src_shape_rc = np.array(transformation_src_shape_rc)
-    out_shape_rc = np.array(out_shape_rc)
-    transformation_dst_shape_rc = np.array(transformation_dst_shape_rc)
+    is_array = False
+    if not isinstance(img, pyvips.Image):
+        is_array = True
+        if not use_cv2:
+            img = numpy2vips(img)
+
+    elif use_cv2:
+        img = vips2numpy(img)
+    transformation_src_shape_rc, transformation_dst_shape_rc, out_shape_rc = \
+        _get_warp_img_shapes(src_shape_rc, M=M, bk_dxdy=bk_dxdy,
+                             out_shape_rc=out_shape_rc,
+                             transformation_src_shape_rc=transformation_src_shape_rc,
+                             transformation_dst_shape_rc=transformation_dst_shape_rc)
 
     src_sxy, dst_sxy, displacement_sxy, displacement_shape_rc = get_warp_scaling_factors(
                                                                      transformation_src_shape_rc=transformation_src_shape_rc,
@@ -1131,10 +1497,41 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
         do_non_rigid = False
 
     if not any([do_rigid, do_non_rigid, do_crop]):
-        if is_array:
+        if is_array and not use_cv2:
             img = vips2numpy(img)
         return img
 
+    if use_cv2:
+        if do_rigid:
+            warp_M = get_img_warp_M(M, src_shape_rc=src_shape_rc,
+                                    out_shape_rc=out_shape_rc,
+                                    transformation_src_shape_rc=transformation_src_shape_rc,
+                                    transformation_dst_shape_rc=transformation_dst_shape_rc)
+        else:
+            warp_M = None
+
+        if do_non_rigid:
+            if isinstance(bk_dxdy, pyvips.Image):
+                bk_dxdy = vips2numpy(bk_dxdy).transpose(2, 0, 1)
+            warp_dxdy = _get_cv2_warp_dxdy(bk_dxdy, dst_sxy, out_shape_rc, interp_method)
+        else:
+            warp_dxdy = None
+
+        if do_rigid or do_non_rigid:
+            warped = _warp_img_cv2(img, warp_M=warp_M, warp_dxdy=warp_dxdy, out_shape_rc=out_shape_rc,
+                                   bg_color=bg_color, interp_method=interp_method, composed=composed)
+        else:
+            warped = img
+
+        if do_crop:
+            x, y, w, h = bbox_xywh.astype(int)
+            warped = warped[y:y+h, x:x+w]
+
+        if not is_array:
+            warped = numpy2vips(warped)
+
+        return warped
+
     # Do transformations
     if bg_color is None:
         bg_color = [0] * img.bands
@@ -1145,20 +1542,26 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
 
     interpolator = pyvips.Interpolate.new(interp_method)
 
-    if do_rigid:
-        if not np.all(src_sxy == 1):
-            img_corners_xy = get_corners_of_image(src_shape_rc)[:, ::-1]
-            warped_corners = warp_xy(img_corners_xy, M=M,
-                                     transformation_src_shape_rc=transformation_src_shape_rc,
-                                     transformation_dst_shape_rc=transformation_dst_shape_rc,
-                                     src_shape_rc=src_shape_rc,
-                                     dst_shape_rc=out_shape_rc)
-            M_tform = transform.ProjectiveTransform()
-            M_tform.estimate(warped_corners, img_corners_xy)
-            warp_M = M_tform.params
+    if composed and do_rigid and do_non_rigid:
+        warp_map = get_img_warp_map(src_shape_rc, M=M, bk_dxdy=bk_dxdy,
+                                    out_shape_rc=out_shape_rc,
+                                    transformation_src_shape_rc=transformation_src_shape_rc,
+                                    transformation_dst_shape_rc=transformation_dst_shape_rc,
+                                    bbox_xywh=bbox_xywh,
+                                    interp_method=interp_method)
 
-        else:
-            warp_M = M
+        warped = _mapim(img, warp_map, bg_color=bg_color,
+                        bg_extender=bg_extender, interpolator=interpolator)
+        if is_array:
+            warped = vips2numpy(warped)
+
+        return warped
+
+    if do_rigid:
+        warp_M = get_img_warp_M(M, src_shape_rc=src_shape_rc,
+                                out_shape_rc=out_shape_rc,
+                                transformation_src_shape_rc=transformation_src_shape_rc,
+                                transformation_dst_shape_rc=transformation_dst_shape_rc)
 
         tx, ty = warp_M[:2, 2]
         warp_M = np.linalg.inv(warp_M)
@@ -1178,51 +1581,307 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
         affine_warped = img
 
     if do_non_rigid:
-        # Scale dxdy map
-        if not isinstance(bk_dxdy, pyvips.Image):
-            temp_dxdy = numpy2vips(np.dstack(bk_dxdy))
-        else:
-            temp_dxdy = bk_dxdy
+        warp_dxdy = _get_vips_warp_dxdy(bk_dxdy, dst_sxy, out_shape_rc, interpolator)
 
-        if dst_sxy is not None:
-            scaled_dx = float(dst_sxy[0]) * temp_dxdy[0]
-            scaled_dy = float(dst_sxy[1]) * temp_dxdy[1]
-            vips_dxdy = scaled_dx.bandjoin(scaled_dy)
-        else:
-            vips_dxdy = temp_dxdy
+        index = pyvips.Image.xyz(affine_warped.width, affine_warped.height)
+        warp_index = (index[0] + warp_dxdy[0]).bandjoin(index[1] + warp_dxdy[1])
+        warped = _mapim(affine_warped, warp_index, bg_color=bg_color,
+                        bg_extender=bg_extender, interpolator=interpolator)
 
-        if dst_sxy is not None:
-            S = [dst_sxy[0], 0, 0, dst_sxy[1]]
-        else:
-            S = [1.0, 0.0, 0.0, 1.0]
+    else:
+        warped = affine_warped
 
+    if bbox_xywh is not None:
+        warped = warped.extract_area(*bbox_xywh)
 
-        warp_dxdy = vips_dxdy.affine(S,
-                        oarea=[0, 0, out_shape_rc[1], out_shape_rc[0]],
-                        interpolate=interpolator,
-                        premultiplied=True)
+    if is_array:
+        warped = vips2numpy(warped)
 
-        index = pyvips.Image.xyz(affine_warped.width, affine_warped.height)
-        warp_index = (index[0] + warp_dxdy[0]).bandjoin(index[1] + warp_dxdy[1])
+    return warped
 
-        try:
-            #Option to set backround color in mapim added in libvips 8.13
-            warped = affine_warped.mapim(warp_index,
-                premultiplied=True,
-                background=bg_color,
-                extend=bg_extender,
-                interpolate=interpolator)
 
-        except pyvips.error.Error:
-            warped = affine_warped.mapim(warp_index, interpolate=interpolator)
-            if bg_color is not None:
-                warped = (warped == 0).ifthenelse(bg_color, warped)
+def _mapim(img, warp_index, bg_color, bg_extender, interpolator):
+    """Resample `img` at the positions in `warp_index`
+    """
+    try:
+        #Option to set backround color in mapim added in libvips 8.13
+        warped = img.mapim(warp_index,
+            premultiplied=True,
+            background=bg_color,
+            extend=bg_extender,
+            interpolate=interpolator)
+
+    except pyvips.error.Error:
+        warped = img.mapim(warp_index, interpolate=interpolator)
+        if bg_color is not None:
+            warped = (warped == 0).ifthenelse(bg_color, warped)
+
+    return warped
 
-    else:
-        warped = affine_warped
 
+def get_img_warp_map(src_shape_rc, M=None, bk_dxdy=None, out_shape_rc=None,
+                     transformation_src_shape_rc=None,
+                     transformation_dst_shape_rc=None,
+                     bbox_xywh=None,
+                     interp_method="bicubic"):
+    """Get position of each pixel in the warped image, in the image being warped
+
+    Composes the rigid (`M`) and non-rigid (`bk_dxdy`) transformations
+    into a single coordinate map, so that an image can be warped with
+    a single `mapim`. Arguments are the same as for `warp_img`. The map
+    is lazy, and so is only calculated when it is used or saved.
+
+    Parameters
+    ----------
+    src_shape_rc : tuple of int
+        Shape of the image that will be warped
+
+    M : ndarray, optional
+        3x3 Affine transformation matrix to perform rigid warp
+
+    bk_dxdy : ndarray, pyvips.Image, optional
+        The backward x-axis (column) displacement,
+        and y-axis (row) displacement applied after the rigid transformation.
+
+    out_shape_rc : tuple of int
+        Shape of the image after warping.
+
+    transformation_src_shape_rc : tuple of int
+        Shape of image that was used to find the transformations M and/or `bk_dxdy`.
+
+    transformation_dst_shape_rc : tuple of int
+        Shape of image with shape transformation_src_shape_rc after
+        being warped.
+
+    bbox_xywh : tuple
+        Bounding box to crop warped image. Should be in reference to the image
+        with shape = `out_shape_rc`.
+
+    interp_method : str, optional
+        Method used to resize the displacement fields
+
+    Returns
+    -------
+    warp_map : pyvips.Image
+        2 band float image, where the bands are the x and y positions in
+        the unwarped image.
+
+    """
+
+    src_shape_rc = np.array(src_shape_rc)
+    transformation_src_shape_rc, transformation_dst_shape_rc, out_shape_rc = \
+        _get_warp_img_shapes(src_shape_rc, M=M, bk_dxdy=bk_dxdy,
+                             out_shape_rc=out_shape_rc,
+                             transformation_src_shape_rc=transformation_src_shape_rc,
+                             transformation_dst_shape_rc=transformation_dst_shape_rc)
+
+    src_sxy, dst_sxy, displacement_sxy, displacement_shape_rc = get_warp_scaling_factors(
+                                                                     transformation_src_shape_rc=transformation_src_shape_rc,
+                                                                     transformation_dst_shape_rc=transformation_dst_shape_rc,
+                                                                     src_shape_rc=src_shape_rc, dst_shape_rc=out_shape_rc,
+                                                                     bk_dxdy=bk_dxdy)
+
+    warp_map = pyvips.Image.xyz(out_shape_rc[1], out_shape_rc[0]).cast("float")
     if bbox_xywh is not None:
-        warped = warped.extract_area(*bbox_xywh)
+        # Crop first, so that only the needed positions are calculated
+        bbox_xywh = np.ceil(bbox_xywh).astype(int).tolist()
+        warp_map = warp_map.extract_area(*bbox_xywh)
+
+    if bk_dxdy is not None:
+        interpolator = pyvips.Interpolate.new(interp_method)
+        warp_dxdy = _get_vips_warp_dxdy(bk_dxdy, dst_sxy, out_shape_rc, interpolator)
+        if bbox_xywh is not None:
+            warp_dxdy = warp_dxdy.extract_area(*bbox_xywh)
+
+        warp_map = warp_map + warp_dxdy
+        # Displaced positions outside of the rigidly warped image would be background
+        is_inside = _get_is_inside_mask(warp_map, out_shape_rc)
+    else:
+        is_inside = None
+
+    warp_map = _apply_M_to_warp_map(warp_map,
+                                    M=M,
+                                    src_shape_rc=src_shape_rc,
+                                    out_shape_rc=out_shape_rc,
+                                    transformation_src_shape_rc=transformation_src_shape_rc,
+                                    transformation_dst_shape_rc=transformation_dst_shape_rc)
+
+    if is_inside is not None:
+        warp_map = is_inside.ifthenelse(warp_map, [OUT_OF_BOUNDS_XY] * 2)
+
+    warp_map = warp_map.cast("float")
+
+    return warp_map
+
+
+def _apply_M_to_warp_map(warp_map, M, src_shape_rc, out_shape_rc,
+                         transformation_src_shape_rc,
+                         transformation_dst_shape_rc):
+    """Map positions in the rigidly warped image to positions in the unwarped image
+    """
+    if M is None:
+        return warp_map
+
+    warp_M = get_img_warp_M(M, src_shape_rc=src_shape_rc,
+                            out_shape_rc=out_shape_rc,
+                            transformation_src_shape_rc=transformation_src_shape_rc,
+                            transformation_dst_shape_rc=transformation_dst_shape_rc)
+
+    warp_map = warp_map.recomb(warp_M[:2, :2].tolist()) + warp_M[:2, 2].tolist()
+
+    return warp_map
+
+
+def _get_is_inside_mask(xy_map, shape_rc):
+    """Determine which positions in `xy_map` are inside an image with shape `shape_rc`
+    """
+    is_inside = (xy_map[0] >= 0) & (xy_map[0] <= shape_rc[1] - 1) & \
+                (xy_map[1] >= 0) & (xy_map[1] <= shape_rc[0] - 1)
+
+    return is_inside
+
+
+def _sample_vips_dxdy(vips_dxdy, xy_map):
+    """Get displacements at the positions in `xy_map`
+
+    Displacements are smooth, so bilinear interpolation is used.
+    """
+    interpolator = pyvips.Interpolate.new("bilinear")
+    try:
+        sampled_dxdy = vips_dxdy.mapim(xy_map, interpolate=interpolator,
+                                       extend=pyvips.enums.Extend.COPY)
+    except pyvips.error.Error:
+        sampled_dxdy = vips_dxdy.mapim(xy_map, interpolate=interpolator)
+
+    return sampled_dxdy
+
+
+def get_img_from_to_warp_map(from_M=None, from_transformation_src_shape_rc=None,
+                             from_transformation_dst_shape_rc=None, from_src_shape_rc=None,
+                             from_dst_shape_rc=None, from_bk_dxdy=None,
+                             to_M=None, to_transformation_src_shape_rc=None,
+                             to_transformation_dst_shape_rc=None, to_src_shape_rc=None,
+                             to_bk_dxdy=None, to_fwd_dxdy=None, interp_method="bicubic"):
+    """Get position of each pixel in the "to" image, in the "from" image
+
+    Composes the inverse of the "to" transformations with the "from"
+    transformations, so that an image can be warped from one slide onto
+    another with a single `mapim`. Parameters are the same as for
+    `warp_img_from_to`, with `from_src_shape_rc` being the shape
+    of the image that will be warped.
+
+    Returns
+    -------
+    warp_map : pyvips.Image
+        2 band float image, where the bands are the x and y positions
+        in the "from" image.
+
+    """
+
+    from_src_shape_rc = np.array(from_src_shape_rc)
+    from_transformation_src_shape_rc, from_transformation_dst_shape_rc, reg_shape_rc = \
+        _get_warp_img_shapes(from_src_shape_rc, M=from_M, bk_dxdy=from_bk_dxdy,
+                             out_shape_rc=from_dst_shape_rc,
+                             transformation_src_shape_rc=from_transformation_src_shape_rc,
+                             transformation_dst_shape_rc=from_transformation_dst_shape_rc)
+
+    if to_transformation_dst_shape_rc is None:
+        to_transformation_dst_shape_rc = reg_shape_rc
+
+    if to_M is not None:
+        out_shape_rc = np.array(to_src_shape_rc)
+    else:
+        out_shape_rc = reg_shape_rc
+
+    # Position in the registered image #
+    reg_xy = pyvips.Image.xyz(out_shape_rc[1], out_shape_rc[0]).cast("float")
+    if to_M is not None:
+        to_warp_M = get_img_warp_M(to_M, src_shape_rc=to_src_shape_rc,
+                                   out_shape_rc=reg_shape_rc,
+                                   transformation_src_shape_rc=to_transformation_src_shape_rc,
+                                   transformation_dst_shape_rc=to_transformation_dst_shape_rc)
+
+        to_warp_M = np.linalg.inv(to_warp_M)
+        reg_xy = reg_xy.recomb(to_warp_M[:2, :2].tolist()) + to_warp_M[:2, 2].tolist()
+
+    is_inside = _get_is_inside_mask(reg_xy, reg_shape_rc)
+
+    interpolator = pyvips.Interpolate.new(interp_method)
+    if to_fwd_dxdy is not None or to_bk_dxdy is not None:
+        if to_fwd_dxdy is None:
+            to_fwd_dxdy = get_inverse_field(to_bk_dxdy)
+
+        _, to_dst_sxy, _, _ = get_warp_scaling_factors(transformation_src_shape_rc=to_transformation_src_shape_rc,
+                                                       transformation_dst_shape_rc=to_transformation_dst_shape_rc,
+                                                       src_shape_rc=to_src_shape_rc, dst_shape_rc=reg_shape_rc,
+                                                       fwd_dxdy=to_fwd_dxdy)
+
+        to_warp_dxdy = _get_vips_warp_dxdy(to_fwd_dxdy, to_dst_sxy, reg_shape_rc, interpolator)
+        reg_xy = reg_xy + _sample_vips_dxdy(to_warp_dxdy, reg_xy)
+        is_inside = is_inside & _get_is_inside_mask(reg_xy, reg_shape_rc)
+
+    # Position in the "from" image #
+    if from_bk_dxdy is not None:
+        _, from_dst_sxy, _, _ = get_warp_scaling_factors(transformation_src_shape_rc=from_transformation_src_shape_rc,
+                                                         transformation_dst_shape_rc=from_transformation_dst_shape_rc,
+                                                         src_shape_rc=from_src_shape_rc, dst_shape_rc=reg_shape_rc,
+                                                         bk_dxdy=from_bk_dxdy)
+
+        from_warp_dxdy = _get_vips_warp_dxdy(from_bk_dxdy, from_dst_sxy, reg_shape_rc, interpolator)
+        reg_xy = reg_xy + _sample_vips_dxdy(from_warp_dxdy, reg_xy)
+        is_inside = is_inside & _get_is_inside_mask(reg_xy, reg_shape_rc)
+
+    warp_map = _apply_M_to_warp_map(reg_xy,
+                                    M=from_M,
+                                    src_shape_rc=from_src_shape_rc,
+                                    out_shape_rc=reg_shape_rc,
+                                    transformation_src_shape_rc=from_transformation_src_shape_rc,
+                                    transformation_dst_shape_rc=from_transformation_dst_shape_rc)
+
+    warp_map = is_inside.ifthenelse(warp_map, [OUT_OF_BOUNDS_XY] * 2).cast("float")
+
+    return warp_map
+
+
+def warp_img_with_map(img, warp_map, bg_color=None, interp_method="bicubic"):
+    """Warp an image using a map created by `get_img_warp_map`
+
+    Parameters
+    ----------
+    img : ndarray, pyvips.Image
+        Image to be warped. Should have the same shape as the `src_shape_rc`
+        used to create `warp_map`.
+
+    warp_map : pyvips.Image
+        2 band image containing the position of each warped pixel in `img`
+
+    bg_color : optional, list
+        Background color, if `None`, then the background color will be black
+
+    interp_method : str, optional
+
+    Returns
+    -------
+    warped : ndarray, pyvips.Image
+        Warped version of `img`
+
+    """
+
+    is_array = False
+    if not isinstance(img, pyvips.Image):
+        is_array = True
+        img = numpy2vips(img)
+
+    if bg_color is None:
+        bg_color = [0] * img.bands
+        bg_extender = pyvips.enums.Extend.BLACK
+    else:
+        bg_extender = pyvips.enums.Extend.BACKGROUND
+        bg_color = list(bg_color)
+
+    interpolator = pyvips.Interpolate.new(interp_method)
+    warped = _mapim(img, warp_map, bg_color=bg_color,
+                    bg_extender=bg_extender, interpolator=interpolator)
 
     if is_array:
         warped = vips2numpy(warped)
@@ -1230,6 +1889,123 @@ def warp_img(img, M=None, bk_dxdy=None, out_shape_rc=None,
     return warped
 
 
+class CompiledWarp(object):
+    """Precomputed warp that can be applied to many images
+
+    Composes the rigid and non-rigid transformations into a single map
+    of float32 positions, which is calculated once and either kept in
+    memory or saved as a memory-mapped .v file. Warping an image then
+    only requires one `mapim`, rather than an `affine` followed by
+    a `mapim`, and there is no need to re-scale the displacement
+    fields each time. Useful when warping several images with the
+    same shape, such as the channels or levels of a processed slide.
+
+    Attributes
+    ----------
+    src_shape_rc : ndarray
+        Shape of the image that can be warped
+
+    out_shape_rc : ndarray
+        Shape of the warped image
+
+    map_f : str
+        Path to the saved map. If None, the map is kept in memory.
+
+    """
+
+    def __init__(self, src_shape_rc, M=None, bk_dxdy=None, out_shape_rc=None,
+                 transformation_src_shape_rc=None,
+                 transformation_dst_shape_rc=None,
+                 bbox_xywh=None,
+                 interp_method="bicubic",
+                 map_f=None):
+        """
+        Parameters
+        ----------
+        src_shape_rc : tuple of int
+            Shape of the image(s) that will be warped
+
+        map_f : str, optional
+            Where to save the map. Should end with ".v", so that the
+            map can be memory-mapped when it is opened. If None, the
+            map will be kept in memory.
+
+        Other parameters are the same as for `warp_img`.
+
+        """
+
+        self.src_shape_rc = np.array(src_shape_rc)
+        self.map_f = map_f
+
+        warp_map = get_img_warp_map(src_shape_rc=src_shape_rc, M=M, bk_dxdy=bk_dxdy,
+                                    out_shape_rc=out_shape_rc,
+                                    transformation_src_shape_rc=transformation_src_shape_rc,
+                                    transformation_dst_shape_rc=transformation_dst_shape_rc,
+                                    bbox_xywh=bbox_xywh,
+                                    interp_method=interp_method)
+
+        self.out_shape_rc = np.array([warp_map.height, warp_map.width])
+        if map_f is not None:
+            warp_map.write_to_file(map_f)
+            self._warp_map = None
+        else:
+            self._warp_map = warp_map.copy_memory()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.map_f is not None:
+            # Re-open the map when needed
+            state["_warp_map"] = None
+        else:
+            state["_warp_map"] = vips2numpy(self._warp_map)
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self._warp_map, np.ndarray):
+            self._warp_map = numpy2vips(self._warp_map)
+
+    @property
+    def warp_map(self):
+        """2 band image containing the position of each warped pixel in the image being warped
+        """
+        if self._warp_map is None:
+            self._warp_map = pyvips.Image.new_from_file(self.map_f)
+
+        return self._warp_map
+
+    def warp(self, img, bg_color=None, interp_method="bicubic"):
+        """Warp an image
+
+        Parameters
+        ----------
+        img : ndarray, pyvips.Image
+            Image to warp. Should have shape `src_shape_rc`
+
+        bg_color : optional, list
+            Background color, if `None`, then the background color will be black
+
+        interp_method : str, optional
+
+        Returns
+        -------
+        warped : ndarray, pyvips.Image
+            Warped version of `img`
+
+        """
+        img_shape_rc = np.array(get_shape(img)[0:2])
+        if np.any(img_shape_rc != self.src_shape_rc):
+            msg = (f"Image has shape {tuple(img_shape_rc)}, but the warp map "
+                   f"was made for images with shape {tuple(self.src_shape_rc)}")
+            valtils.print_warning(msg)
+
+        warped = warp_img_with_map(img, self.warp_map, bg_color=bg_color,
+                                   interp_method=interp_method)
+
+        return warped
+
+
 def warp_img_inv(img, M=None, fwd_dxdy=None, transformation_src_shape_rc=None, transformation_dst_shape_rc=None, src_shape_rc=None, bk_dxdy=None, bg_color=None, interp_method="bicubic"):
     """Unwarp an image using rigid and/or non-rigid transformations
 
@@ -1391,7 +2167,8 @@ def warp_img_from_to(img, from_M=None, from_transformation_src_shape_rc=None,
                    from_dst_shape_rc=None, from_bk_dxdy=None,
                    to_M=None, to_transformation_src_shape_rc=None,
                    to_transformation_dst_shape_rc=None, to_src_shape_rc=None,
-                   to_bk_dxdy=None, to_fwd_dxdy=None, bg_color=None, interp_method="bicubic"):
+                   to_bk_dxdy=None, to_fwd_dxdy=None, bg_color=None, interp_method="bicubic",
+                   composed=False):
     """Warp image onto another
 
     Warps `img` to registered coordinates using the "from" parameters, and then uses
@@ -1456,6 +2233,12 @@ def warp_img_from_to(img, from_M=None, from_transformation_src_shape_rc=None,
 
     interp_method : str, optional
 
+    composed : bool, optional
+        If True, the "from" transformations and inverse "to" transformations
+        will be composed into a single map of positions (see `get_img_from_to_warp_map`),
+        so that `img` is only resampled once, instead of being warped to
+        the registered coordinates and then unwarped.
+
     Returns
     -------
     in_target_space : ndarray, pvips.Image
@@ -1463,6 +2246,32 @@ def warp_img_from_to(img, from_M=None, from_transformation_src_shape_rc=None,
 
     """
 
+    if composed:
+        is_array = False
+        if not isinstance(img, pyvips.Image):
+            is_array = True
+            img = numpy2vips(img)
+
+        warp_map = get_img_from_to_warp_map(from_M=from_M,
+                                            from_transformation_src_shape_rc=from_transformation_src_shape_rc,
+                                            from_transformation_dst_shape_rc=from_transformation_dst_shape_rc,
+                                            from_src_shape_rc=[img.height, img.width],
+                                            from_dst_shape_rc=from_dst_shape_rc,
+                                            from_bk_dxdy=from_bk_dxdy,
+                                            to_M=to_M,
+                                            to_transformation_src_shape_rc=to_transformation_src_shape_rc,
+                                            to_transformation_dst_shape_rc=to_transformation_dst_shape_rc,
+                                            to_src_shape_rc=to_src_shape_rc,
+                                            to_bk_dxdy=to_bk_dxdy,
+                                            to_fwd_dxdy=to_fwd_dxdy,
+                                            interp_method=interp_method)
+
+        in_target_space = warp_img_with_map(img, warp_map, bg_color=bg_color,
+                                            interp_method=interp_method)
+        if is_array:
+            in_target_space = vips2numpy(in_target_space)
+
+        return in_target_space
 
     in_reg_space = warp_img(img,
                             M=from_M,
@@ -1925,17 +2734,143 @@ def smooth_dxdy(dxdy, grid_spacing_ratio=0.015, sigma_ratio=0.005,
     return np.dstack([smooth_dx, smooth_dy])
 
 
-def get_inverse_field(backwards_xy_deltas, n_inter=10):
+def _get_dxdy_array(dxdy):
+    """Get displacement field as a (N, M, 2) float32 array
+    """
+    if isinstance(dxdy, pyvips.Image):
+        dxdy = vips2numpy(dxdy)
+    elif isinstance(dxdy, np.ndarray) and dxdy.ndim == 3 and dxdy.shape[0] == 2 and dxdy.shape[2] != 2:
+        # (2, N, M) array
+        dxdy = np.dstack(dxdy)
+    elif not isinstance(dxdy, np.ndarray):
+        dxdy = np.dstack(dxdy)
+
+    return dxdy.astype(np.float32, copy=False)
+
+
+def _invert_field_itk(dxdy, n_iter=10):
+    sitk_bk_dxdy = sitk.GetImageFromArray(dxdy.astype(np.float64), isVector=True)
+    sitk_fw_dxdy = sitk.IterativeInverseDisplacementField(sitk_bk_dxdy, numberOfIterations=n_iter)
+
+    return sitk.GetArrayFromImage(sitk_fw_dxdy).astype(np.float32)
+
+
+def _invert_field_fixed_point(dxdy, n_iter=10, tol=INVERSE_FIELD_TOL):
+    """Invert displacement field using fixed-point iterations
+
+    The inverse `inv_dxdy` satisfies inv_dxdy(p) = -dxdy(p + inv_dxdy(p)),
+    which is solved by iteratively sampling `dxdy` at p + inv_dxdy(p).
+
+    """
+
+    dxdy = np.ascontiguousarray(dxdy, dtype=np.float32)
+    grid_y, grid_x = np.indices(dxdy.shape[0:2], dtype=np.float32)
+    inv_dxdy = -dxdy
+    for i in range(n_iter):
+        new_inv_dxdy = -cv2.remap(dxdy, grid_x + inv_dxdy[..., 0], grid_y + inv_dxdy[..., 1],
+                                  interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        max_change = np.abs(new_inv_dxdy - inv_dxdy).max()
+        inv_dxdy = new_inv_dxdy
+        if max_change < tol:
+            break
+
+    return inv_dxdy
+
+
+def get_inverse_field(backwards_xy_deltas, n_inter=10, method=INVERSE_ITK, tol=INVERSE_FIELD_TOL,
+                      tile_wh=None, halo=None, dst_f=None):
     """
     Invert transform
+
+    Large displacement fields are inverted tile-wise, in parallel. Each
+    tile overlaps its neighbors by a halo that is at least as large as the
+    largest displacement, so that the inverse in each tile only depends
+    on displacements inside the tile.
+
+    Parameters
+    ----------
+    backwards_xy_deltas : list, ndarray, pyvips.Image
+        Displacement field to invert. Can be a list of the x and y
+        displacements, or an array/pyvips.Image with 2 bands.
+
+    n_inter : int
+        Maximum number of iterations
+
+    method : str
+        How to invert the field. `INVERSE_ITK` uses SimpleITK's
+        IterativeInverseDisplacementField. `INVERSE_FIXED_POINT` uses fixed-point
+        iterations, sampling the field with OpenCV, which is faster.
+
+    tol : float
+        If `method` is `INVERSE_FIXED_POINT`, iterations stop once the inverse
+        changes by less than `tol` pixels.
+
+    tile_wh : int, optional
+        Width and height of tiles. If None, fields with more than
+        `INVERSE_FIELD_MAX_UNTILED_PX` pixels will be inverted using tiles
+        with width and height `INVERSE_FIELD_TILE_WH`.
+
+    halo : int, optional
+        Overlap between tiles. If None, the halo will be the larger of
+        `INVERSE_FIELD_MIN_HALO` and the maximum displacement.
+
+    dst_f : str, optional
+        Path to file where the inverted field will be memory-mapped. If None, inverses of fields
+        with more than `INVERSE_FIELD_MEMMAP_PX` pixels will be memory-mapped to a temporary file.
+
+    Returns
+    -------
+    fwd_dxdy : list of ndarray
+        The x and y displacements of the inverted field
+
     """
 
-    sitk_bk_dxdy = sitk.GetImageFromArray(np.dstack(backwards_xy_deltas),  isVector=True)
-    sitk_fw_dxdy = sitk.IterativeInverseDisplacementField(sitk_bk_dxdy, numberOfIterations=n_inter)
-    fwd_dxdy = sitk.GetArrayFromImage(sitk_fw_dxdy)
-    fwd_dxdy = [fwd_dxdy[..., 0], fwd_dxdy[..., 1]]
+    if method == INVERSE_ITK:
+        invert_fxn = functools.partial(_invert_field_itk, n_iter=n_inter)
+    elif method == INVERSE_FIXED_POINT:
+        invert_fxn = functools.partial(_invert_field_fixed_point, n_iter=n_inter, tol=tol)
+    else:
+        msg = f"method must be {INVERSE_ITK} or {INVERSE_FIXED_POINT}, but got {method}"
+        valtils.print_warning(msg, rgb=Fore.RED)
+        return None
+
+    dxdy = _get_dxdy_array(backwards_xy_deltas)
+    shape_rc = np.array(dxdy.shape[0:2])
+    n_px = np.prod(shape_rc)
+    if tile_wh is None and n_px <= INVERSE_FIELD_MAX_UNTILED_PX and dst_f is None:
+        fwd_dxdy = invert_fxn(dxdy)
+
+        return [fwd_dxdy[..., 0], fwd_dxdy[..., 1]]
+
+    if dst_f is not None:
+        fwd_dxdy = np.memmap(dst_f, dtype=np.float32, mode="w+", shape=dxdy.shape)
+    elif n_px > INVERSE_FIELD_MEMMAP_PX:
+        fwd_dxdy = np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=dxdy.shape)
+    else:
+        fwd_dxdy = np.empty(dxdy.shape, dtype=np.float32)
+
+    if tile_wh is None:
+        tile_wh = INVERSE_FIELD_TILE_WH
+
+    if halo is None:
+        halo = int(max(INVERSE_FIELD_MIN_HALO, np.ceil(np.abs(dxdy).max())))
+
+    tile_bboxes = get_grid_bboxes(shape_rc, tile_wh, tile_wh, inclusive=True)
+    def invert_tile(tile_idx):
+        x, y, w, h = tile_bboxes[tile_idx]
+        ex, ey, ew, eh = expand_bbox(tile_bboxes[tile_idx], halo, shape_rc)
+        tile_fwd_dxdy = invert_fxn(dxdy[ey:ey+eh, ex:ex+ew])
+        fwd_dxdy[y:y+h, x:x+w] = tile_fwd_dxdy[y-ey:y-ey+h, x-ex:x-ex+w]
+
+    n_cpu = valtils.get_ncpus_available() - 1
+    if n_cpu > 1:
+        pqdm(range(len(tile_bboxes)), invert_tile, n_jobs=n_cpu, exception_behaviour="immediate", disable=True)
+    else:
+        for tile_idx in range(len(tile_bboxes)):
+            invert_tile(tile_idx)
 
-    return fwd_dxdy
+    return [fwd_dxdy[..., 0], fwd_dxdy[..., 1]]
 
 
 def warp_xy_rigid(xy, inv_matrix):
@@ -2146,7 +3081,7 @@ def _warp_pt_vips(xy, M=None, vips_bk_dxdy=None, vips_fwd_dxdy=None, src_sxy=Non
     elif vips_bk_dxdy is not None and vips_fwd_dxdy is None:
         vips_region_bk_dxdy = vips_bk_dxdy.extract_area(*region_bbox_xywh)
         region_bk_dxdy = vips2numpy(vips_region_bk_dxdy)
-        region_dxdy = np.dstack(get_inverse_field(region_bk_dxdy[..., 0], region_bk_dxdy[..., 1]))
+        region_dxdy = np.dstack(get_inverse_field([region_bk_dxdy[..., 0], region_bk_dxdy[..., 1]]))
 
     nonrigid_xy = warp_xy_non_rigid(xy=rigid_xy_in_tile, dxdy=[region_dxdy[..., 0], region_dxdy[..., 1]], displacement_shape_rc=[bbox_h, bbox_w])
     nonrigid_xy += region_bbox_xywh[0:2]